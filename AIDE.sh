@@ -9,20 +9,46 @@
 # 
 # 2020 Benjamin Kellenberger
 
+function is_positive {
+    awk -v value="$1" 'BEGIN { exit !(value + 0 > 0) }';
+}
+
 function start {
 
     IFS=',' read -ra ADDR <<< "$AIDE_MODULES"
 
     # Celery
+    # Celery beat (periodic tasks) is enabled for folder watching (FileServer)
+    # and prediction retention policies (AIController). Since every beat
+    # instance schedules the tasks anew, this should be the case on one
+    # machine only.
     numCeleryModules=0;
+    launchCeleryBeat=false;
     for i in "${ADDR[@]}"; do
         module="$(echo "$i" | tr '[:upper:]' '[:lower:]')";
-        if [ "$module" == "aiworker" ] || [ "$module" == "fileserver" ]; then
+        if [ "$module" == "aiworker" ] || [ "$module" == "fileserver" ] || [ "$module" == "aicontroller" ]; then
             ((numCeleryModules++));
         fi
+        if [ "$module" == "fileserver" ]; then
+            folderWatchInterval=$(python util/configDef.py --section=FileServer --parameter=watch_folder_interval --fallback=60);
+            if is_positive "$folderWatchInterval"; then
+                launchCeleryBeat=true;
+            fi
+        elif [ "$module" == "aicontroller" ]; then
+            retentionInterval=$(python util/configDef.py --section=AIController --parameter=prediction_retention_interval --fallback=86400);
+            if is_positive "$retentionInterval"; then
+                launchCeleryBeat=true;
+            fi
+        fi
     done
     if [ $numCeleryModules -gt 0 ]; then
-        celery -A celery_worker worker -Q aide_broadcast,$AIDE_MODULES &
+        if [ "$launchCeleryBeat" == true ]; then
+            tempDir="$(python util/configDef.py --section=FileServer --parameter=tempfiles_dir --fallback=/tmp)/aide/celery/";
+            mkdir -p $tempDir;
+            celery -A celery_worker worker -B -s ${tempDir}celerybeat-schedule -Q aide_broadcast,$AIDE_MODULES &
+        else
+            celery -A celery_worker worker -Q aide_broadcast,$AIDE_MODULES &
+        fi
     else
         echo "Machine does not need a Celery consumer to be launched; skipping..."
     fi
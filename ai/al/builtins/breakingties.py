@@ -5,20 +5,16 @@
     2019 Benjamin Kellenberger
 '''
 
-from ai.al.functional.noarch.functional import _breaking_ties
+from ai.al.functional.noarch.functional import _breaking_ties, apply_heuristics
 
 class BreakingTies:
+
+    # predictions are ranked in one go (see "util.predictionBatch")
+    acceptsPredictionBatch = True
     
     def __init__(self, project, config, dbConnector, fileServer, options):
         pass
 
     
     def rank(self, data, updateStateFun, **kwargs):
-        
-        # iterate through the images and predictions
-        for imgID in data.keys():
-            if 'predictions' in data[imgID]:
-                for p in range(len(data[imgID]['predictions'])):
-                    btVal = _breaking_ties(data[imgID]['predictions'][p])
-                    data[imgID]['predictions'][p]['priority'] = btVal
-        return data
\ No newline at end of file
+        return apply_heuristics(data, [_breaking_ties])
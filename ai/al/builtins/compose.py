@@ -5,6 +5,7 @@
 '''
 
 from util.helpers import get_class_executable
+from ai.al.functional.noarch.functional import apply_heuristics, is_vectorized
 
 class Compose:
 
@@ -15,16 +16,11 @@ class Compose:
         for h in options['rank']['heuristics']:
             self.heuristics.append(get_class_executable(h))
 
+        # prediction batches can only be ranked if all heuristics are built-in ones
+        self.acceptsPredictionBatch = is_vectorized(self.heuristics)
+
     
     def rank(self, data, updateStateFun, **kwargs):
         
-        # iterate through the images and predictions
-        for imgID in data.keys():
-            if 'predictions' in data[imgID]:
-                for p in range(len(data[imgID]['predictions'])):
-                    # iterate over heuristics and take the max
-                    val = -1
-                    for h in self.heuristics:
-                        val = max(val, h(data[imgID]['predictions'][p]))
-                    data[imgID]['predictions'][p]['priority'] = val
-        return data
\ No newline at end of file
+        # take the max over all heuristics (at least -1)
+        return apply_heuristics(data, self.heuristics, floor=-1)
@@ -4,20 +4,16 @@
     2019 Benjamin Kellenberger
 '''
 
-from ai.al.functional.noarch.functional import _max_confidence
+from ai.al.functional.noarch.functional import _max_confidence, apply_heuristics
 
 class MaxConfidence:
 
+    # predictions are ranked in one go (see "util.predictionBatch")
+    acceptsPredictionBatch = True
+
     def __init__(self, project, config, dbConnector, fileServer, options):
         pass
 
     
     def rank(self, data, updateStateFun, **kwargs):
-        
-        # iterate through the images and predictions
-        for imgID in data.keys():
-            if 'predictions' in data[imgID]:
-                for p in range(len(data[imgID]['predictions'])):
-                    btVal = _max_confidence(data[imgID]['predictions'][p])
-                    data[imgID]['predictions'][p]['priority'] = btVal
-        return data
\ No newline at end of file
+        return apply_heuristics(data, [_max_confidence])
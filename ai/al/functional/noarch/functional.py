@@ -1,10 +1,56 @@
 '''
     Helper snippets for built-in AL heuristics on computing the priority score.
 
+    Every heuristic is available as a function of a single prediction (e.g.
+    "_breaking_ties"; these can also be combined with "Compose") and as a
+    vectorized function of an array of logits with one row per prediction
+    (e.g. "breaking_ties"). "apply_heuristics" ranks all predictions of an
+    inference result at once with the vectorized functions where possible.
+
     2019-20 Benjamin Kellenberger
 '''
 
+import math
 import numpy as np
+from util.predictionBatch import PredictionBatch
+
+
+def breaking_ties(logits):
+    '''
+        Computes the Breaking Ties heuristic for an array of logits sized
+        [NxC] (one row per prediction) and returns an array sized [N] (NaN
+        for fewer than two classes and for rows containing NaNs).
+    '''
+    logits = np.asarray(logits, dtype=np.float64)
+    if logits.ndim != 2 or logits.shape[1] < 2:
+        return np.full(logits.shape[0], np.nan)
+    top2 = -np.partition(-logits, 1, axis=1)[:,:2]
+    btVal = 1 - (top2[:,0] - top2[:,1])
+    btVal[np.isnan(logits).any(1)] = np.nan       # partitioning moves NaNs to the end
+    return btVal
+
+
+def max_confidence(logits):
+    '''
+        Returns the maximum value of every row of an array of logits sized
+        [NxC] (NaN for zero classes and for rows containing NaNs).
+    '''
+    logits = np.asarray(logits, dtype=np.float64)
+    if logits.ndim != 2 or logits.shape[1] == 0:
+        return np.full(logits.shape[0], np.nan)
+    return logits.max(1)
+
+
+def _to_value(value):
+    value = float(value)
+    return (None if math.isnan(value) else value)
+
+
+def _is_vector(logits):
+    # avoids converting (nested) lists to arrays just to get their dimensions
+    if isinstance(logits, (list, tuple)):
+        return not len(logits) or np.isscalar(logits[0])
+    return np.ndim(logits) == 1
 
 
 def _breaking_ties(prediction):
@@ -13,25 +59,109 @@ def _breaking_ties(prediction):
         (Luo et al. 2005: "Active Learning to Recognize Multiple Types of Plankton." JMLR 6, 589-613.)
 
         In case of segmentation masks, the average BT value is returned.
+        Models that do not return logits may instead provide the (average)
+        margin between the two most confident classes ("margin").
     '''
     btVal = None
-    if 'logits' in prediction:
-        logits = np.array(prediction['logits'].copy())
+    if prediction.get('logits', None) is not None:
+        logits = np.asarray(prediction['logits'], dtype=np.float64)
 
         if logits.ndim == 3:
             # spatial prediction
-            logits = np.sort(logits, 0)
-            btVal = 1 - np.mean(logits[-1,...] - logits[-2,...])
+            btVal = _to_value(np.mean(breaking_ties(logits.reshape(logits.shape[0], -1).T)))
         else:
-            logits = np.sort(logits)
-            btVal = 1 - (logits[-1] - logits[-2])
+            btVal = _to_value(breaking_ties(logits.reshape(1, -1))[0])
+    elif prediction.get('margin', None) is not None:
+        btVal = 1 - prediction['margin']
     return btVal
 
 
 def _max_confidence(prediction):
     '''
         Returns the maximum value of the logits as a priority value.
+        For predictions without logits, the (average) confidence is used
+        instead; for segmentation masks, the average maximum value across
+        all pixels is returned.
     '''
-    if 'logits' in prediction:
-        return max(prediction['logits'])
-    return None
\ No newline at end of file
+    if prediction.get('logits', None) is not None:
+        logits = np.asarray(prediction['logits'], dtype=np.float64)
+        if logits.ndim == 3:
+            return _to_value(np.mean(max_confidence(logits.reshape(logits.shape[0], -1).T)))
+        return _to_value(max_confidence(logits.reshape(1, -1))[0])
+    elif isinstance(prediction.get('confidence', None), (int, float)):
+        return prediction['confidence']
+    return None
+
+
+def _breaking_ties_batch(batch):
+    if 'logits' in batch and batch['logits'].ndim == 2:
+        return breaking_ties(batch['logits'])
+    elif 'margin' in batch:
+        return 1 - batch['margin'].astype(np.float64)
+    return np.full(len(batch), np.nan)
+
+
+def _max_confidence_batch(batch):
+    if 'logits' in batch and batch['logits'].ndim == 2:
+        return max_confidence(batch['logits'])
+    elif 'confidence' in batch:
+        return batch['confidence'].astype(np.float64)
+    return np.full(len(batch), np.nan)
+
+
+# vectorized versions of the heuristics: (function of logits array, function of PredictionBatch)
+VECTORIZED_HEURISTICS = {
+    _breaking_ties: (breaking_ties, _breaking_ties_batch),
+    _max_confidence: (max_confidence, _max_confidence_batch)
+}
+
+
+def is_vectorized(heuristics):
+    '''
+        Returns True if all given heuristics have vectorized versions.
+    '''
+    return all([h in VECTORIZED_HEURISTICS for h in heuristics])
+
+
+def _reduce_max(values, floor=None):
+    values = np.fmax.reduce(np.stack(values, 0), 0)     # ignores NaNs unless all are NaN
+    if floor is not None:
+        values = np.fmax(values, floor)
+    return values
+
+
+def apply_heuristics(data, heuristics, floor=None):
+    '''
+        Sets the priority of every prediction in "data" (PredictionBatch or
+        dict format) to the maximum value of the given heuristics (functions
+        of a single prediction, e.g. "_breaking_ties"), but at least "floor"
+        if provided. Predictions of a PredictionBatch, as well as those in
+        dict format with logits vectors, are grouped by their number of
+        classes and processed at once with the vectorized heuristics. Re-
+        quires all heuristics to be vectorized for PredictionBatch inputs.
+    '''
+    if isinstance(data, PredictionBatch):
+        data['priority'] = _reduce_max([VECTORIZED_HEURISTICS[h][1](data) for h in heuristics], floor)
+        return data
+
+    vectorized = is_vectorized(heuristics)
+    groups = {}
+    for imgID in data.keys():
+        for prediction in data[imgID].get('predictions', []):
+            logits = prediction.get('logits', None)
+            if vectorized and logits is not None and _is_vector(logits):
+                groups.setdefault(len(logits), []).append(prediction)
+            else:
+                # e.g. segmentation masks, predictions without logits
+                values = [h(prediction) for h in heuristics]
+                values = [v for v in values if v is not None]
+                if floor is not None:
+                    values.append(floor)
+                prediction['priority'] = (max(values) if len(values) else None)
+
+    for predictions in groups.values():
+        logits = np.array([p['logits'] for p in predictions], dtype=np.float64)
+        values = _reduce_max([VECTORIZED_HEURISTICS[h][0](logits) for h in heuristics], floor)
+        for prediction, value in zip(predictions, values.tolist()):
+            prediction['priority'] = (None if math.isnan(value) else value)
+    return data
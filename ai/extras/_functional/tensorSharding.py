@@ -1,5 +1,24 @@
+"""
+    Splitting of tensors (e.g. images) into sub-portions (shards) and their
+    re-assembly.
+
+    "shardTensor" and "foldShards" work on a regular grid of shards (with
+    optional overlap) that is centred on the tensor: shards are created as
+    strided views ("Tensor.unfold") of the (padded) tensor and re-assembled
+    with "torch.nn.functional.fold", with optionally weighted blending of
+    the overlapping areas. Alternatively, "tight" grids start at the top left
+    corner and keep all shards within the tensor (the last shard along each
+    axis is shifted to end at the tensor border), so that all coordinates
+    are non-negative. "splitTensor" and "combineShards" accept arbi-
+    trary shard locations (e.g. from "createSplitLocations_auto").
+
+    2019-20 Benjamin Kellenberger
+"""
+
 import numpy as np
+import torch
 import torch.nn
+import torch.nn.functional as F
 
 
 
@@ -125,29 +144,23 @@ def splitTensor(inputTensor,shardSize,locX,locY):
         The locations determine the top left corners of the sub-tensors.
         If the locations exceed the input tensor's boundaries, it is
         padded with zeros.
+        All sub-tensors are gathered at once through advanced indexing.
     """
     if len(inputTensor.size())>3:
-        inputTensor = torch.squeeze(inputTensor)
+        inputTensor = torch.squeeze(inputTensor, 0)
         
     sz = inputTensor.size()
     
-    locX = locX.long()
-    locY = locY.long()
-    
-    startLocX = torch.min(locX)
-    startLocY = torch.min(locY)
-    endLocX = torch.max(locX) + shardSize[0]
-    endLocY = torch.max(locY) + shardSize[1]
-    
+    locX = torch.as_tensor(locX).long().view(-1)
+    locY = torch.as_tensor(locY).long().view(-1)
     
     # pad tensor with zeros
-    if startLocX<0 or startLocY<0 or endLocX>sz[1] or endLocY>sz[2]:
-        padL = int(torch.abs(startLocX))
-        padT = int(torch.abs(startLocY))
-        padR = int(endLocX - sz[1])
-        padB = int(endLocY - sz[2])
-        tensor = torch.nn.ZeroPad2d((padT,padB,padL,padR))(inputTensor.unsqueeze(0))
-        tensor = tensor.data.squeeze()
+    padL = max(0, -int(torch.min(locX)))
+    padT = max(0, -int(torch.min(locY)))
+    padR = max(0, int(torch.max(locX)) + shardSize[0] - sz[1])
+    padB = max(0, int(torch.max(locY)) + shardSize[1] - sz[2])
+    if padL or padT or padR or padB:
+        tensor = F.pad(inputTensor.unsqueeze(0), (padT,padB,padL,padR)).squeeze(0)
         
         # shift locations accordingly
         locX = locX + padL
@@ -155,20 +168,12 @@ def splitTensor(inputTensor,shardSize,locX,locY):
     else:
         tensor = inputTensor
     
-    
     # crop tensor
-    if locX.dim()==2:
-        numPatches = locX.size(0)*locX.size(1)
-        locX = locX.view(-1)
-        locY = locY.view(-1)
-    else:
-        numPatches = locX.size(0)
-
-    result = torch.Tensor(numPatches,sz[0],shardSize[0],shardSize[1]).type(tensor.dtype).to(tensor.device)
-    for x in range(0,numPatches):
-        result[x,:,:,:] = tensor[:,locX[x]:locX[x]+shardSize[0],locY[x]:locY[x]+shardSize[1]]
+    idxX = locX.to(tensor.device).view(-1,1) + torch.arange(shardSize[0], device=tensor.device).view(1,-1)
+    idxY = locY.to(tensor.device).view(-1,1) + torch.arange(shardSize[1], device=tensor.device).view(1,-1)
+    result = tensor[:,idxX[:,:,None],idxY[:,None,:]]      # C x N x shardSize
     
-    return result
+    return result.permute(1,0,2,3).contiguous()
 
 
 
@@ -188,10 +193,11 @@ def combineShards(shards,locX,locY,outSize,overlapRule):
         - "max": the maximum value is retained
         - "min": the minimum value is chosen
         - "sum": the sum is calculated along all overlapping patches
+        For regular grids of shards, see "foldShards".
     """
     
-    locX = locX.astype(int)
-    locY = locY.astype(int)
+    locX = np.array(locX).astype(int).ravel()
+    locY = np.array(locY).astype(int).ravel()
     
     sz = shards.size()
     
@@ -208,45 +214,238 @@ def combineShards(shards,locX,locY,outSize,overlapRule):
         
     
     # prepare output tensor as well as counting grid
-    out = torch.Tensor(sz[1],int(endLocX),int(endLocY))
-    out[:] = 0
-    count = torch.Tensor(1,int(endLocX),int(endLocY))
-    count[:] = 0
-    
-    # iterate over shards and restore
-    for i in range(0,sz[0]):
-        posX = int(i / locX.shape[1])
-        posY = int(i % locX.shape[1])
-        
-        coordsX = locX[posX,posY]
-        coordsY = locY[posX,posY]
-        
-        shard = shards[i,:,:,:]
-        
-        if overlapRule=='sum':
-            out[:,coordsX:coordsX+sz[2],coordsY:coordsY+sz[3]] += shard
-        elif overlapRule=='max':
-            out[:,coordsX:coordsX+sz[2],coordsY:coordsY+sz[3]] = torch.max(out[:,coordsX:coordsX+sz[2],coordsY:coordsY+sz[3]],shard)
-        elif overlapRule=='min':
-            out[:,coordsX:coordsX+sz[2],coordsY:coordsY+sz[3]] = torch.min(out[:,coordsX:coordsX+sz[2],coordsY:coordsY+sz[3]],shard)
+    out = torch.zeros(sz[1],int(endLocX),int(endLocY), dtype=shards.dtype, device=shards.device)
+    count = torch.zeros(1,int(endLocX),int(endLocY), dtype=shards.dtype, device=shards.device)
+    
+    # flat indices of all shard elements in the output tensor
+    idxX = torch.from_numpy(locX).to(shards.device).view(-1,1,1) + torch.arange(sz[2], device=shards.device).view(1,-1,1)
+    idxY = torch.from_numpy(locY).to(shards.device).view(-1,1,1) + torch.arange(sz[3], device=shards.device).view(1,1,-1)
+    index = (idxX * int(endLocY) + idxY).view(-1)
+    values = shards.permute(1,0,2,3).reshape(sz[1],-1)
+    
+    if overlapRule in ('max', 'min'):
+        if hasattr(out, 'scatter_reduce_'):
+            out.view(sz[1],-1).scatter_reduce_(1, index.view(1,-1).expand_as(values), values,
+                                                reduce=('amax' if overlapRule=='max' else 'amin'))
         else:
-            out[:,coordsX:coordsX+sz[2],coordsY:coordsY+sz[3]] += shard
-            count[:,coordsX:coordsX+sz[2],coordsY:coordsY+sz[3]] += 1
-
+            # older PyTorch versions: iterate over shards and restore
+            for i in range(0,sz[0]):
+                window = out[:,locX[i]:locX[i]+sz[2],locY[i]:locY[i]+sz[3]]
+                out[:,locX[i]:locX[i]+sz[2],locY[i]:locY[i]+sz[3]] = (torch.max(window,shards[i,...]) if overlapRule=='max' \
+                                                                    else torch.min(window,shards[i,...]))
+    else:
+        out.view(sz[1],-1).index_add_(1, index, values)
+        count.view(1,-1).index_add_(1, index, torch.ones_like(values[:1,:]))
     
     
     # normalise according to specified flag
     if overlapRule=='average' or overlapRule=='avg':
-        out /= count.expand_as(out)
+        out /= count.clamp(min=1).expand_as(out)
         
         
     # crop if necessary
     if outSize is not None:
         sz_out = out.size()
         if sz_out[1]!=outSize[0] or sz_out[2]!=outSize[1]:
-            overhangX = (sz_out[1] - outSize[0])/2
-            overhangY = (sz_out[2] - outSize[1])/2
+            overhangX = int((sz_out[1] - outSize[0])/2)
+            overhangY = int((sz_out[2] - outSize[1])/2)
             
-            out = out[:,overhangX:-overhangX,overhangY:-overhangY]
+            out = out[:,overhangX:overhangX+outSize[0],overhangY:overhangY+outSize[1]]
         
-    return out
\ No newline at end of file
+    return out
+
+
+
+def _toPair(value):
+    if isinstance(value, (int, float)):
+        return (value, value)
+    return tuple(value)
+
+
+
+def _parseStride(stride, shardSize):
+    """
+        Returns the stride in pixels (Y, X) for a given stride that is either
+        None (equal to the shard size), one or two ints, or one or two floats
+        smaller than one (relative to the shard size).
+    """
+    if stride is None:
+        return tuple(int(s) for s in shardSize)
+    stride = _toPair(stride)
+    return tuple(
+        int(max(1, s * shardSize[i])) if isinstance(s, float) and s < 1.0 else int(s)
+        for i, s in enumerate(stride)
+    )
+
+
+
+def getShardGrid(tensorSize, shardSize, stride=None, tight=False):
+    """
+        Returns the layout of the regular grid of shards of size "shardSize"
+        (height, width) spaced by "stride" (see "_parseStride") that covers
+        a tensor with spatial size "tensorSize" (height, width; or the full
+        size of the tensor):
+        - the number of shards along Y and X
+        - the padding (left, right, top, bottom) required for the grid; the
+          grid is centred on the tensor. For "tight" grids, the tensor is
+          only padded (right and bottom) if it is smaller than a shard.
+        - the stride in pixels (Y, X)
+    """
+    tensorSize = [int(s) for s in tensorSize[-2:]]
+    shardSize = [int(s) for s in _toPair(shardSize)]
+    stride = _parseStride(stride, shardSize)
+    numShards = [int(np.ceil(max(0, tensorSize[i] - shardSize[i]) / stride[i])) + 1 for i in range(2)]
+    padding = []
+    for i in (1, 0):
+        if tight:
+            padding.extend([0, max(0, shardSize[i] - tensorSize[i])])
+        else:
+            total = (numShards[i]-1)*stride[i] + shardSize[i] - tensorSize[i]
+            padding.extend([total // 2, total - total // 2])
+    return numShards, padding, stride
+
+
+
+def _getShardCoordinates(tensorSize, shardSize, stride=None, tight=False):
+    # coordinates of the shards along Y and X in the (unpadded) tensor
+    numShards, padding, stride = getShardGrid(tensorSize, shardSize, stride, tight)
+    tensorSize = [int(s) for s in tensorSize[-2:]]
+    shardSize = [int(s) for s in _toPair(shardSize)]
+    coordsY = torch.arange(numShards[0]) * stride[0] - padding[2]
+    coordsX = torch.arange(numShards[1]) * stride[1] - padding[0]
+    if tight:
+        coordsY = coordsY.clamp(max=max(0, tensorSize[0] - shardSize[0]))
+        coordsX = coordsX.clamp(max=max(0, tensorSize[1] - shardSize[1]))
+    return coordsY, coordsX
+
+
+
+def getShardLocations(tensorSize, shardSize, stride=None, tight=False):
+    """
+        Returns the X and Y coordinates of the top left corners of the shards
+        created by "shardTensor" in the (unpadded) tensor, as LongTensors in
+        the order of the shards of an image (coordinates are negative for
+        shards that start in the padding, which "tight" grids avoid).
+    """
+    coordsY, coordsX = _getShardCoordinates(tensorSize, shardSize, stride, tight)
+    return coordsX.repeat(coordsY.numel()), coordsY.repeat_interleave(coordsX.numel())
+
+
+
+def shardTensor(inputTensor, shardSize, stride=None, padding='constant', value=0, tight=False):
+    """
+        Divides an input tensor (CxHxW or BxCxHxW) into shards of size "shard-
+        Size" (height, width) on a regular grid (see "getShardGrid"). Shards
+        overlap if the stride is smaller than the shard size. The tensor is
+        padded to fit the grid according to "padding" ("constant" with the
+        given value, "reflect", or "replicate"; see "torch.nn.functional.pad").
+        If "tight" is True, shards stay within the tensor instead (and are
+        gathered by indexing rather than as strided views).
+        Returns a tensor of size (B*N)xCxhxw with the N shards of every image
+        in turn, ready for the forward pass (in batches of any size), as well
+        as the X and Y coordinates of the shards (see "getShardLocations").
+    """
+    tensor = (inputTensor.unsqueeze(0) if inputTensor.dim()==3 else inputTensor)
+    shardSize = [int(s) for s in _toPair(shardSize)]
+    numShards, pad, stride = getShardGrid(tensor.size(), shardSize, stride, tight)
+
+    if any(pad):
+        if padding == 'constant':
+            tensor = F.pad(tensor, pad, mode='constant', value=value)
+        else:
+            tensor = F.pad(tensor, pad, mode=padding)
+    
+    if tight:
+        # gather all shards at once: B x C x nY x nX x h x w
+        coordsY, coordsX = _getShardCoordinates(inputTensor.size(), shardSize, stride, tight)
+        idxY = coordsY.to(tensor.device).view(-1,1) + torch.arange(shardSize[0], device=tensor.device).view(1,-1)
+        idxX = coordsX.to(tensor.device).view(-1,1) + torch.arange(shardSize[1], device=tensor.device).view(1,-1)
+        shards = tensor[:,:,idxY[:,None,:,None],idxX[None,:,None,:]]
+    else:
+        # strided views of all shards: B x C x nY x nX x h x w
+        shards = tensor.unfold(2, shardSize[0], stride[0]).unfold(3, shardSize[1], stride[1])
+    shards = shards.permute(0,2,3,1,4,5).reshape(-1, tensor.size(1), shardSize[0], shardSize[1])
+
+    coordsX, coordsY = getShardLocations(inputTensor.size(), shardSize, stride, tight)
+    return shards, coordsX, coordsY
+
+
+
+def blendingWeights(shardSize, blending='average', stride=None, device=None, dtype=torch.float32):
+    """
+        Returns the weights (h x w) of the elements of a shard for blending
+        overlapping shards:
+        - "average": equal weights (overlapping areas are averaged)
+        - "linear": weights increase linearly across the overlap with the
+          neighbouring shards (given by "stride") from the shard borders
+        - "gaussian": Gaussian weights centred on the shard (with a standard
+          deviation of 1/8 of the shard size), emphasising shard centres
+    """
+    shardSize = [int(s) for s in _toPair(shardSize)]
+    if blending == 'average':
+        return torch.ones(shardSize, device=device, dtype=dtype)
+
+    weights = []
+    stride = _parseStride(stride, shardSize)
+    for size, step in zip(shardSize, stride):
+        pos = torch.arange(size, device=device, dtype=dtype)
+        if blending == 'linear':
+            dist = torch.min(pos + 1, size - pos)
+            weights.append((dist / (max(0, size - step) + 1)).clamp(max=1))
+        elif blending == 'gaussian':
+            sigma = size / 8.0
+            weights.append(torch.exp(-(pos + 0.5 - size/2.0)**2 / (2*sigma**2)))
+        else:
+            raise ValueError(f'Unknown blending mode "{blending}".')
+    
+    # avoid zero weights at the tensor borders (covered by a single shard)
+    return (weights[0].view(-1,1) * weights[1].view(1,-1)).clamp(min=1e-3)
+
+
+
+def foldShards(shards, tensorSize, stride=None, blending='average', tight=False):
+    """
+        Re-assembles shards as created by "shardTensor" ((B*N)xCxhxw) into
+        a tensor of spatial size "tensorSize" (height, width), using the same
+        stride (and "tight" setting). Overlapping areas are blended with
+        weights according to "blending" (see "blendingWeights"), or summed up
+        ("sum"). Returns a tensor sized BxCxHxW.
+    """
+    shardSize = (shards.size(2), shards.size(3))
+    numShards, pad, stride = getShardGrid(tensorSize, shardSize, stride, tight)
+    tensorSize = [int(s) for s in tensorSize[-2:]]
+    paddedSize = (tensorSize[0] + pad[2] + pad[3], tensorSize[1] + pad[0] + pad[1])
+    numPerImage = numShards[0] * numShards[1]
+    numChannels = shards.size(1)
+    if not shards.is_floating_point():
+        shards = shards.float()
+
+    if blending == 'sum':
+        weights = None
+    else:
+        weights = blendingWeights(shardSize, blending, stride, shards.device, shards.dtype)
+        shards = shards * weights
+
+    if tight:
+        # irregular spacing of the last shards: accumulate at the flat indices of all shard elements
+        coordsY, coordsX = _getShardCoordinates(tensorSize, shardSize, stride, tight)
+        idxY = coordsY.to(shards.device).view(-1,1) + torch.arange(shardSize[0], device=shards.device).view(1,-1)
+        idxX = coordsX.to(shards.device).view(-1,1) + torch.arange(shardSize[1], device=shards.device).view(1,-1)
+        index = (idxY[:,None,:,None] * paddedSize[1] + idxX[None,:,None,:]).view(-1)    # nY x nX x h x w
+        values = shards.reshape(-1, numPerImage, numChannels, shardSize[0], shardSize[1]).permute(0,2,1,3,4)
+        out = torch.zeros(values.size(0), numChannels, paddedSize[0]*paddedSize[1], dtype=shards.dtype, device=shards.device)
+        out.index_add_(2, index, values.reshape(values.size(0), numChannels, -1))
+        out = out.view(-1, numChannels, paddedSize[0], paddedSize[1])
+        if weights is not None:
+            norm = torch.zeros(paddedSize[0]*paddedSize[1], dtype=shards.dtype, device=shards.device)
+            norm.index_add_(0, index, weights.view(1,-1).expand(numPerImage,-1).reshape(-1))
+            out = out / norm.view(1,1,paddedSize[0],paddedSize[1]).clamp(min=1e-8)
+    else:
+        # B x (C*h*w) x N
+        columns = shards.reshape(-1, numPerImage, numChannels*shardSize[0]*shardSize[1]).permute(0,2,1)
+        out = F.fold(columns, paddedSize, shardSize, stride=stride)
+        if weights is not None:
+            norm = F.fold(weights.view(1,-1,1).expand(1,-1,numPerImage), paddedSize, shardSize, stride=stride)
+            out = out / norm.clamp(min=1e-8)
+
+    return out[:,:,pad[2]:pad[2]+tensorSize[0],pad[0]:pad[0]+tensorSize[1]]
@@ -129,8 +129,8 @@ class WindowCropper:
             maxX = sz[0] - self.patchSize[0]
             maxY = sz[1] - self.patchSize[1]
 
-            coordsX = np.append(np.arange(0, maxX, self.stride[0], dtype=np.int), maxX)
-            coordsY = np.append(np.arange(0, maxY, self.stride[1], dtype=np.int), maxY)
+            coordsX = np.append(np.arange(0, maxX, self.stride[0], dtype=int), maxX)
+            coordsY = np.append(np.arange(0, maxY, self.stride[1], dtype=int), maxY)
 
             # expand to all locations
             coordsX, coordsY = np.meshgrid(coordsX, coordsY)
@@ -138,8 +138,8 @@ class WindowCropper:
             coordsX = coordsX.ravel()
             coordsY = coordsY.ravel()
 
-            cropSizesX = np.repeat(self.patchSize[0], len(coordsX)).astype(np.int)
-            cropSizesY = np.repeat(self.patchSize[1], len(coordsY)).astype(np.int)
+            cropSizesX = np.repeat(self.patchSize[0], len(coordsX)).astype(int)
+            cropSizesY = np.repeat(self.patchSize[1], len(coordsY)).astype(int)
         
         elif self.cropMode == 'objectCentered':
             # create positions around bboxes
@@ -197,7 +197,7 @@ class WindowCropper:
                 bboxIndices = np.arange(len(bboxes))
 
                 # identify query order by clustering the coordinates
-                numClusters = np.max([2, np.sqrt(len(bboxes))]).astype(np.int)
+                numClusters = np.max([2, np.sqrt(len(bboxes))]).astype(int)
                 kmeans = KMeans(n_clusters=numClusters).fit(bboxes[:,0:2])
                 count = np.zeros(numClusters)
                 distances = np.zeros(len(bboxes))
@@ -290,8 +290,8 @@ class WindowCropper:
                     if b not in bboxes_covered:
                         print('something is wrong')
 
-            cropSizesX = np.repeat(self.patchSize[0], len(coordsX)).astype(np.int)
-            cropSizesY = np.repeat(self.patchSize[1], len(coordsY)).astype(np.int)
+            cropSizesX = np.repeat(self.patchSize[0], len(coordsX)).astype(int)
+            cropSizesY = np.repeat(self.patchSize[1], len(coordsY)).astype(int)
 
 
         if len(bboxes):
@@ -301,24 +301,29 @@ class WindowCropper:
             bboxes[:,2] += bboxes[:,0]
             bboxes[:,3] += bboxes[:,1]
     
+        # find bounding boxes within all frames at once (patches x bboxes)
+        frames = np.stack([coordsX, coordsY,
+                        np.add(coordsX, cropSizesX), np.add(coordsY, cropSizesY)], 1).astype(int) \
+                    if len(coordsX) else np.zeros((0,4), dtype=int)
+        if len(bboxes):
+            validFrames = (bboxes[None,:,0] < frames[:,None,2]) * \
+                        (bboxes[None,:,1] < frames[:,None,3]) * \
+                        (bboxes[None,:,2] > frames[:,None,0]) * \
+                        (bboxes[None,:,3] > frames[:,None,1])
+        else:
+            validFrames = np.zeros((len(frames), 0), dtype=bool)
+
         # iterate, split, reposition and export
         for cIdx in range(len(coordsX)):
-            frame = np.array([coordsX[cIdx], coordsY[cIdx], coordsX[cIdx]+cropSizesX[cIdx], coordsY[cIdx]+cropSizesY[cIdx]])
+            frame = frames[cIdx,:]
+            valid = validFrames[cIdx,:]
+            if not self.exportEmptyPatches and not np.sum(valid):
+                continue
+
             patch = image.crop(frame)
 
             # prepare result
             patchKey = '{}_{}_{}_{}'.format(coordsX[cIdx], coordsY[cIdx], cropSizesX[cIdx], cropSizesY[cIdx])
-
-            # find bounding boxes within frame
-            valid = 0
-            if len(bboxes):
-                valid = (bboxes[:,0] < frame[2]) * \
-                        (bboxes[:,1] < frame[3]) * \
-                        (bboxes[:,2] > frame[0]) * \
-                        (bboxes[:,3] > frame[1])
-
-            if not self.exportEmptyPatches and not np.sum(valid):
-                continue
             
             hasBoxes = False
             if np.sum(valid):
@@ -19,6 +19,7 @@ from torchvision import transforms as tr
 from PIL import Image
 import rawpy
 from util.helpers import check_args
+from util.predictionBatch import PredictionBatch
 from ai.models.pytorch import parse_transforms
 from ai.models.pytorch.boundingBoxes.retinanet import RetinaNet
 from ai.models.pytorch.functional._retinanet.model import RetinaNet as Model
@@ -145,10 +146,9 @@ class RetinaNet_ois(RetinaNet):
         # transform
         tensor = transform(img).to(device)
 
-        # evaluate in a grid fashion
-        gridX, gridY = tensorSharding.createSplitLocations_auto(img.size, [self.patchSize[1], self.patchSize[0]], stride=self.stride, tight=True)
-        tensors = tensorSharding.splitTensor(tensor, [self.patchSize[1], self.patchSize[0]], gridY, gridX)
-        gridX, gridY = gridX.view(-1).float(), gridY.view(-1).float()
+        # evaluate in a grid fashion (patches within the image, so that box offsets are non-negative)
+        tensors, gridX, gridY = tensorSharding.shardTensor(tensor, [self.patchSize[1], self.patchSize[0]], stride=self.stride, tight=True)
+        gridX, gridY = gridX.float(), gridY.float()
 
         bboxes = torch.empty(size=(0,4,), dtype=torch.float32)
         labels = torch.empty(size=(0,), dtype=torch.long)
@@ -372,6 +372,8 @@ class RetinaNet_ois(RetinaNet):
         # also do regular inference
         print('Doing inference on existing patches...')
         response_regular = super(RetinaNet_ois, self).inference(stateDict, data, updateStateFun)
+        if isinstance(response_regular, PredictionBatch):
+            response_regular = response_regular.to_dict()
         for key in response_regular.keys():
             response[key] = response_regular[key]
 
@@ -1,8 +1,106 @@
+'''
+    Filter that merges overlapping bounding boxes (e.g. of multiple users)
+    into one.
+
+    Boxes are connected if their IoU is at least "min_iou" (and, unless
+    "class_agnostic" is set, if they have the same label). All boxes that
+    are (transitively) connected form a group and are replaced by a single
+    box. The pairwise IoUs are computed with NumPy in blocks, so that memory
+    is bounded for images with thousands of boxes, and only for boxes whose
+    horizontal extents overlap. Groups are found with a vectorized union-find
+    (label propagation with pointer jumping) on the resulting edges.
+
+    2019-20 Benjamin Kellenberger
+'''
+
 import numpy as np
 from ai.filter import AbstractFilter
 from util.helpers import check_args
 
 
+# number of boxes per block of rows (and columns) of the IoU matrix
+CHUNK_SIZE = 256
+
+
+def box_ious(boxes_a, boxes_b):
+    '''
+        Returns the matrix of IoUs between two arrays of boxes sized [Nx4]
+        and [Mx4] (format: x1, y1, x2, y2).
+    '''
+    leftX = np.maximum(boxes_a[:,None,0], boxes_b[None,:,0])
+    topY = np.maximum(boxes_a[:,None,1], boxes_b[None,:,1])
+    rightX = np.minimum(boxes_a[:,None,2], boxes_b[None,:,2])
+    bottomY = np.minimum(boxes_a[:,None,3], boxes_b[None,:,3])
+    intersection = np.clip(rightX - leftX, 0, None) * np.clip(bottomY - topY, 0, None)
+    area_a = (boxes_a[:,2] - boxes_a[:,0]) * (boxes_a[:,3] - boxes_a[:,1])
+    area_b = (boxes_b[:,2] - boxes_b[:,0]) * (boxes_b[:,3] - boxes_b[:,1])
+    union = area_a[:,None] + area_b[None,:] - intersection
+    return intersection / np.maximum(union, 1e-12)
+
+
+def _overlap_edges(boxes, labels, minIoU, classAgnostic, chunkSize=CHUNK_SIZE):
+    '''
+        Returns the index pairs (i < j) of all boxes with an IoU of at least
+        "minIoU" (and the same label if not "classAgnostic"). The IoU matrix
+        is computed in blocks of "chunkSize" x "chunkSize" boxes. Boxes are
+        sorted by their left edge first, so that every block of rows is only
+        compared to the boxes that start before its rightmost right edge
+        (all others cannot overlap it).
+    '''
+    numBoxes = len(boxes)
+    order = np.argsort(boxes[:,0], kind='stable')
+    boxes, labels = boxes[order], labels[order]
+    edges_i, edges_j = [], []
+    for start in range(0, numBoxes, chunkSize):
+        end = min(start + chunkSize, numBoxes)
+        stop = numBoxes
+        if minIoU > 0:
+            stop = max(end, np.searchsorted(boxes[:,0], boxes[start:end,2].max(), side='left'))
+
+        # only the upper triangle is needed
+        for colStart in range(start, stop, chunkSize):
+            colEnd = min(colStart + chunkSize, stop)
+            valid = box_ious(boxes[start:end], boxes[colStart:colEnd]) >= minIoU
+            if not classAgnostic:
+                valid &= labels[start:end,None] == labels[None,colStart:colEnd]
+            valid &= np.arange(start, end)[:,None] < np.arange(colStart, colEnd)[None,:]
+            ii, jj = np.nonzero(valid)
+            edges_i.append(order[ii + start])
+            edges_j.append(order[jj + colStart])
+    if not len(edges_i):
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    edges_i, edges_j = np.concatenate(edges_i), np.concatenate(edges_j)
+    return np.minimum(edges_i, edges_j), np.maximum(edges_i, edges_j)
+
+
+def _connected_components(numNodes, edges_i, edges_j):
+    '''
+        Returns a group index for every node, such that nodes connected by
+        (a chain of) edges share the same index. Every node points to the
+        smallest node of its group.
+    '''
+    parent = np.arange(numNodes)
+    if not len(edges_i):
+        return parent
+    while True:
+        # hook the parents of both nodes of an edge to the smaller one
+        parent_i, parent_j = parent[edges_i], parent[edges_j]
+        smaller = np.minimum(parent_i, parent_j)
+        np.minimum.at(parent, parent_i, smaller)
+        np.minimum.at(parent, parent_j, smaller)
+
+        # pointer jumping
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+        if np.array_equal(parent[edges_i], parent[edges_j]):
+            return parent
+
+
+
 class BoundingBoxFilter(AbstractFilter):
 
     def __init__(self, config, dbConnector, fileServer, options):
@@ -12,60 +110,61 @@ class BoundingBoxFilter(AbstractFilter):
         defaultOptions = {
             'box_rule': 'average',          # how to generate the resulting bounding box from overlapping ones. One of {'average', 'intersection', 'union'}
             'min_iou': 0.75,                # minimum IoU between overlapping bboxes to employ filtering
-            'class_agnostic': False,        # if True, only overlapping boxes with the same class will be subject to filtering
+            'class_agnostic': False,        # if False, only overlapping boxes with the same class will be subject to filtering
             'class_assignment': 'mode',     # how to assign class label of overlapping boxes. One of {'mode', 'random'}
             'keep_unsure': True             # if True, "unsure" bounding boxes will directly be appended without modification to output
         }
         self.options = check_args(options, defaultOptions)
 
 
-    def __box_ious(self, box_a, boxes_b):
-        leftX = np.maximum(box_a[0], boxes_b[:,0])
-        rightX = np.minimum(box_a[2], boxes_b[:,2])
-        topY = np.maximum(box_a[1], boxes_b[:,1])
-        bottomY = np.minimum(box_a[3], boxes_b[:,3])
-
-        width = np.clip(rightX - leftX + 1, 0, 1)
-        height = np.clip(bottomY - topY + 1, 0, 1)
-        intersection = width * height
-        union = (box_a[2] - box_a[0])*(box_a[3] - box_a[1]) + \
-                (boxes_b[:,2] - boxes_b[:,0])*(boxes_b[:,3] - boxes_b[:,1]) - \
-                intersection
-        return intersection/union
-
-
-    def _get_result_box(self, box_a, boxes_b, label_a, labels_b):
+    def _get_result_boxes(self, boxes, groups):
         '''
-            Returns the resulting bounding box based on the options (i.e., intersection,
-            union, or average), as well as the indices of the bounding boxes in 'boxes_b'
-            that were involved in it.
+            Returns the resulting bounding box of every group (i.e., the in-
+            tersection, union, or average of its boxes, based on the options)
+            as an array sized [Gx4], with groups given as the indices of the
+            boxes' groups in [0, G).
         '''
-        # convert to numpy
-        box_a = np.array(box_a)
-        boxes_b = np.array(boxes_b)
+        numGroups = groups.max() + 1
+        if self.options['box_rule'] == 'intersection':
+            topLeft = np.full((numGroups, 2), -np.inf)
+            bottomRight = np.full((numGroups, 2), np.inf)
+            np.maximum.at(topLeft, groups, boxes[:,0:2])
+            np.minimum.at(bottomRight, groups, boxes[:,2:])
+            return np.concatenate([topLeft, bottomRight], 1)
+        elif self.options['box_rule'] == 'union':
+            topLeft = np.full((numGroups, 2), np.inf)
+            bottomRight = np.full((numGroups, 2), -np.inf)
+            np.minimum.at(topLeft, groups, boxes[:,0:2])
+            np.maximum.at(bottomRight, groups, boxes[:,2:])
+            return np.concatenate([topLeft, bottomRight], 1)
+        else:
+            # average
+            sums = np.zeros((numGroups, 4))
+            np.add.at(sums, groups, boxes)
+            return sums / np.bincount(groups, minlength=numGroups)[:,None]
 
-        # calc. intersections and unions
-        iou = self.__box_ious(box_a, boxes_b)
 
-        # filter for valid ones
-        if self.options['class_agnostic']:
-            indices = np.where(iou >= self.options['min_iou'])
-        else:
-            indices = np.where((iou >= self.options['min_iou']) * np.array([int(l==label_a) for l in labels_b]))
-
-        # calculate resulting box
-        boxes_concat = np.concatenate([box_a[np.newaxis,:], boxes_b], 0)
-        if self.options['box_rule'] == 'average':
-            box_out = np.mean(boxes_concat, 0)
-        elif self.options['box_rule'] == 'intersection':
-            topLeft = boxes_concat.max(0)[0:2]
-            bottomRight = boxes_concat.min(0)[2:]
-            box_out = np.concatenate([topLeft, bottomRight])
-        elif self.options['box_rule'] == 'union':
-            topLeft = boxes_concat.min(0)[0:2]
-            bottomRight = boxes_concat.max(0)[2:]
-            box_out = np.concatenate([topLeft, bottomRight])
-        return box_out, indices
+    def _get_result_labels(self, labels, groups):
+        '''
+            Returns the label index of every group: the most frequent one
+            ("mode"; ties are resolved in favor of the label that appears
+            first) or the one of a random member ("random").
+        '''
+        numGroups = groups.max() + 1
+        if self.options['class_assignment'] == 'random':
+            order = np.random.permutation(len(groups))
+            result = np.zeros(numGroups, dtype=np.int64)
+            result[groups[order]] = labels[order]
+            return result
+
+        # count (group, label) pairs and pick the most frequent label per group
+        numLabels = labels.max() + 1
+        counts = np.bincount(groups * numLabels + labels, minlength=numGroups*numLabels)
+        counts = counts.reshape((numGroups, numLabels))
+        firstOccurrence = np.full((numGroups, numLabels), len(groups))
+        np.minimum.at(firstOccurrence, (groups, labels), np.arange(len(groups)))
+        score = counts.astype(np.float64) - firstOccurrence / (len(groups) + 1)
+        return score.argmax(1)
 
 
     def filter(self, data, **kwargs):
@@ -77,6 +176,7 @@ class BoundingBoxFilter(AbstractFilter):
         for key in data.keys():
             if not 'annotations' in data[key] or not len(data[key]['annotations']):
                 continue
+            data_out[key] = {'annotations': []}
 
             # prepare all bounding boxes and labels
             bboxes_in = []
@@ -95,19 +195,38 @@ class BoundingBoxFilter(AbstractFilter):
                     ])
                     labels_in.append(anno['label'])
                     ids_in.append(annoKey)
-            
-            # iterate over bounding boxes
-            bboxes_out = []
-            while len(bboxes_in):
-                if len(bboxes_in) == 1:
-                    # only one box left; append directly without modification
-                    data_out[key]['annotations'].append(data[key]['annotations'][ids_in[0]])
+            if not len(bboxes_in):
+                continue
 
-                else:
-                    # get resulting box and indices of other bounding boxes that overlap with the next one
-                    resultingBox, idx_other = self._get_result_box(bboxes_in[0], bboxes_in[1:], \
-                                                                labels_in[0], labels_in[1:])
-                    
-                    # remove all involved boxes from pool
-                    del bboxes_in[0]
-                    del bboxes_in[idx_other]    #TODO...
\ No newline at end of file
+            # find groups of overlapping bounding boxes
+            bboxes_in = np.array(bboxes_in, dtype=np.float64)
+            labelMap = {}
+            labels_in = np.array([labelMap.setdefault(l, len(labelMap)) for l in labels_in], dtype=np.int64)
+            labelClasses = list(labelMap.keys())
+            edges_i, edges_j = _overlap_edges(bboxes_in, labels_in,
+                                            self.options['min_iou'], self.options['class_agnostic'])
+            _, firstIndex, groups = np.unique(_connected_components(len(bboxes_in), edges_i, edges_j),
+                                            return_index=True, return_inverse=True)
+
+            # merge every group into one bounding box
+            resultingBoxes = self._get_result_boxes(bboxes_in, groups)
+            resultingLabels = self._get_result_labels(labels_in, groups)
+            groupSizes = np.bincount(groups)
+            for g in range(len(groupSizes)):
+                anno = data[key]['annotations'][ids_in[firstIndex[g]]]
+                if groupSizes[g] == 1:
+                    # no overlapping boxes; append directly without modification
+                    data_out[key]['annotations'].append(anno)
+                    continue
+                box = resultingBoxes[g,:]
+                anno = anno.copy()
+                anno.update({
+                    'x': float(box[0] + box[2]) / 2,
+                    'y': float(box[1] + box[3]) / 2,
+                    'width': float(box[2] - box[0]),
+                    'height': float(box[3] - box[1]),
+                    'label': labelClasses[int(resultingLabels[g])]
+                })
+                data_out[key]['annotations'].append(anno)
+
+        return data_out
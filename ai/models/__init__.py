@@ -95,7 +95,10 @@ class AIModel:
                                 AIController
             
             Returns:
-                stateDict: a bytes object containing the model's state after training
+                stateDict: a bytes object containing the model's state after training.
+                           May also be a readable binary file-like object (e.g. a
+                           temporary file), which is then streamed to the database
+                           or the model state store.
         """
         raise NotImplementedError('not implemented for base class.')
     
@@ -107,12 +110,18 @@ class AIModel:
             by exactly one AIWorker after the "train" function has finished.
             Args:
                 stateDicts: a list of N bytes objects containing model states as trained by
-                            the N AIWorkers attached
+                            the N AIWorkers attached. The states are only retrieved upon
+                            accessing the respective list entry, so models may process them
+                            one at a time to limit memory usage.
                 updateStateFun: function handle for updating the progress to the
                                 AIController
+                weights: (optional argument) list of N numbers of images the AIWorkers
+                         have trained on (None if unknown), e.g. for a weighted average.
+                         Only passed if the function declares this argument.
 
             Returns:
-                stateDict: a bytes object containing the combined model states
+                stateDict: a bytes object (or readable binary file-like object) con-
+                           taining the combined model states
         """
         raise NotImplementedError('not implemented for base class.')
 
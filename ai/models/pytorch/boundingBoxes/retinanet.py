@@ -16,8 +16,11 @@ from .. import parse_transforms
 from ..functional._retinanet import DEFAULT_OPTIONS, collation, encoder, loss
 from ..functional._retinanet.model import RetinaNet as Model
 from ..functional.datasets.bboxDataset import BoundingBoxesDataset
+from ..functional.datasets.imageCache import get_decoded_image_cache, get_decode_size
+from ..functional._util import dataLoading
 from util.helpers import get_class_executable
 from util import optionsHelper
+from util.predictionBatch import PredictionBatch, get_label_classes
 
 
 '''
@@ -387,17 +390,22 @@ class RetinaNet(GenericPyTorchModel):
                                     labelclassMap=labelclassMap,
                                     targetFormat='xyxy',
                                     transform=transform,
-                                    ignoreUnsure=optionsHelper.get_hierarchical_value(self.options, ['options', 'train', 'encoding', 'ignore_unsure', 'value'], fallback=False))
+                                    ignoreUnsure=optionsHelper.get_hierarchical_value(self.options, ['options', 'train', 'encoding', 'ignore_unsure', 'value'], fallback=False),
+                                    imageCache=get_decoded_image_cache(self.config, self.project, inputSize),
+                                    targetSize=get_decode_size(self.config, inputSize))
 
         dataEncoder = encoder.DataEncoder(
             minIoU_pos=optionsHelper.get_hierarchical_value(self.options, ['options', 'train', 'encoding', 'minIoU_pos', 'value'], fallback=0.5),
             maxIoU_neg=optionsHelper.get_hierarchical_value(self.options, ['options', 'train', 'encoding', 'maxIoU_neg', 'value'], fallback=0.4)
         )
         collator = collation.Collator(self.project, self.dbConnector, (inputSize[1], inputSize[0],), dataEncoder)
+        device = self.get_device()
+        loaderKwargs = dataLoading.get_kwargs(self.options, 'train', device)
+        loaderKwargs['shuffle'] = optionsHelper.get_hierarchical_value(self.options, ['options', 'train', 'dataLoader', 'shuffle', 'value'], fallback=True)
         dataLoader = DataLoader(
             dataset=dataset,
             collate_fn=collator.collate_fn,
-            shuffle=optionsHelper.get_hierarchical_value(self.options, ['options', 'train', 'dataLoader', 'shuffle', 'value'], fallback=True)
+            **dataLoading.add_prefetching(loaderKwargs, dataset, self.config)
         )
 
         # optimizer
@@ -418,7 +426,6 @@ class RetinaNet(GenericPyTorchModel):
         criterion = loss.FocalLoss(**critArgs_out)
 
         # train model
-        device = self.get_device()
         seed = int(optionsHelper.get_hierarchical_value(self.options, ['options', 'general', 'seed', 'value'], fallback=0))
         torch.manual_seed(seed)
         if 'cuda' in device:
@@ -474,18 +481,20 @@ class RetinaNet(GenericPyTorchModel):
         dataset = BoundingBoxesDataset(data=data,
                                     fileServer=self.fileServer,
                                     labelclassMap=labelclassMap,
-                                    transform=transform)
+                                    transform=transform,
+                                    targetSize=get_decode_size(self.config, inputSize))
         dataEncoder = encoder.DataEncoder(minIoU_pos=0.5, maxIoU_neg=0.4)   # IoUs don't matter for inference
         collator = collation.Collator(self.project, self.dbConnector, (inputSize[1], inputSize[0],), dataEncoder)
+        device = self.get_device()
         dataLoader = DataLoader(
             dataset=dataset,
             collate_fn=collator.collate_fn,
-            shuffle=False
+            **dataLoading.add_prefetching(dataLoading.get_kwargs(self.options, 'inference', device), dataset, self.config)
         )
 
         # perform inference
-        response = {}
-        device = self.get_device()
+        predictions = []
+        labelClasses = get_label_classes(dataset.labelclassMap_inv)
         model.to(device)
         imgCount = 0
         for (img, _, _, fVec, imgID) in tqdm(dataLoader):
@@ -507,55 +516,33 @@ class RetinaNet(GenericPyTorchModel):
                                     cls_thresh=optionsHelper.get_hierarchical_value(self.options, ['options', 'inference', 'encoding', 'cls_thresh', 'value'], fallback=0.1),
                                     nms_thresh=optionsHelper.get_hierarchical_value(self.options, ['options', 'inference', 'encoding', 'nms_thresh', 'value'], fallback=0.1),
                                     numPred_max=int(optionsHelper.get_hierarchical_value(self.options, ['options', 'inference', 'encoding', 'numPred_max', 'value'], fallback=128)),
-                                    return_conf=True)
-
-                for i in range(len(imgID)):
-                    bboxes_pred = bboxes_pred_batch[i]
-                    labels_pred = labels_pred_batch[i]
-                    confs_pred = confs_pred_batch[i]
-                    if bboxes_pred.dim() == 2:
-                        bboxes_pred = bboxes_pred.unsqueeze(0)
-                        labels_pred = labels_pred.unsqueeze(0)
-                        confs_pred = confs_pred.unsqueeze(0)
-
-                    # convert bounding boxes to YOLO format
-                    predictions = []
-                    bboxes_pred_img = bboxes_pred[0,...]
-                    labels_pred_img = labels_pred[0,...]
-                    confs_pred_img = confs_pred[0,...]
-                    if len(bboxes_pred_img):
-                        bboxes_pred_img[:,2] -= bboxes_pred_img[:,0]
-                        bboxes_pred_img[:,3] -= bboxes_pred_img[:,1]
-                        bboxes_pred_img[:,0] += bboxes_pred_img[:,2]/2
-                        bboxes_pred_img[:,1] += bboxes_pred_img[:,3]/2
-                        bboxes_pred_img[:,0] /= inputSize[0]
-                        bboxes_pred_img[:,1] /= inputSize[1]
-                        bboxes_pred_img[:,2] /= inputSize[0]
-                        bboxes_pred_img[:,3] /= inputSize[1]
-
-                        # limit to image bounds
-                        bboxes_pred_img = torch.clamp(bboxes_pred_img, 0, 1)
-
-
-                        # append to dict
-                        for b in range(bboxes_pred_img.size(0)):
-                            bbox = bboxes_pred_img[b,:]
-                            label = labels_pred_img[b]
-                            logits = confs_pred_img[b,:]
-                            predictions.append({
-                                'x': bbox[0].item(),
-                                'y': bbox[1].item(),
-                                'width': bbox[2].item(),
-                                'height': bbox[3].item(),
-                                'label': dataset.labelclassMap_inv[label.item()],
-                                'logits': logits.numpy().tolist(),        #TODO: for AL criterion?
-                                'confidence': torch.max(logits).item()
-                            })
-                    
-                    response[imgID[i]] = {
-                        'predictions': predictions,
-                        #TODO: exception if fVec is not torch tensor: 'fVec': io.BytesIO(fVec.numpy().astype(np.float32)).getvalue()
-                    }
+                                    return_conf=True,
+                                    nms_method=optionsHelper.get_hierarchical_value(self.options, ['options', 'inference', 'encoding', 'nms_method', 'value', 'id'], fallback='iou'),
+                                    nms_class_aware=optionsHelper.get_hierarchical_value(self.options, ['options', 'inference', 'encoding', 'nms_class_aware', 'value'], fallback=False))
+
+                # convert bounding boxes of all images to YOLO format at once
+                numPred = torch.tensor([b.size(0) for b in bboxes_pred_batch], dtype=torch.long)
+                bboxes_pred = torch.cat(bboxes_pred_batch, 0)
+                labels_pred = torch.cat(labels_pred_batch, 0)
+                confs_pred = torch.cat(confs_pred_batch, 0)
+
+                wh = bboxes_pred[:,2:] - bboxes_pred[:,:2]
+                xy = bboxes_pred[:,:2] + wh/2
+                scale = torch.tensor(inputSize, dtype=bboxes_pred.dtype)
+                bboxes_pred = torch.clamp(torch.cat((xy, wh), 1) / scale.repeat(2), 0, 1)     # limit to image bounds
+
+                predictions.append(PredictionBatch(imgID,
+                    torch.repeat_interleave(torch.arange(len(imgID)), numPred),
+                    labelClasses,
+                    x=bboxes_pred[:,0],
+                    y=bboxes_pred[:,1],
+                    width=bboxes_pred[:,2],
+                    height=bboxes_pred[:,3],
+                    label=labels_pred,
+                    logits=confs_pred,
+                    confidence=confs_pred.max(1)[0]
+                ))
+                #TODO: feature vectors
 
             # update worker state
             imgCount += len(imgID)
@@ -565,4 +552,4 @@ class RetinaNet(GenericPyTorchModel):
         if 'cuda' in device:
             torch.cuda.empty_cache()
 
-        return response
\ No newline at end of file
+        return PredictionBatch.concatenate(predictions)
\ No newline at end of file
@@ -380,7 +380,25 @@ DEFAULT_OPTIONS = {
 			"torchvision.transforms.Normalize",
 			"torchvision.transforms.ColorJitter",
 			"torchvision.transforms.Grayscale"
-		]
+		],
+		"nms_method": {
+			"iou": {
+				"name": "IoU",
+				"description": "Discard boxes whose intersection-over-union with a higher-scoring box is above the threshold."
+			},
+			"diou": {
+				"name": "Distance-IoU",
+				"description": "Like IoU, but reduces the overlap value by the (normalized) distance between the box centers. Helps keep adjacent objects in crowded scenes."
+			},
+			"soft_linear": {
+				"name": "Soft-NMS (linear)",
+				"description": "Instead of discarding them, reduce the confidence of boxes that overlap higher-scoring boxes by more than the threshold, proportionally to their IoU."
+			},
+			"soft_gaussian": {
+				"name": "Soft-NMS (Gaussian)",
+				"description": "Reduce the confidence of all boxes that overlap higher-scoring boxes with a Gaussian function of their IoU."
+			}
+		}
 	},
 	"options": {
 		"general": {
@@ -496,6 +514,30 @@ DEFAULT_OPTIONS = {
 					"min": 1,
 					"max": 8192,
 					"value": 1
+				},
+				"num_workers": {
+					"name": "Number of workers",
+					"description": "Number of processes that load and prepare images in parallel. Set to 0 to load images in the main process.",
+					"min": 0,
+					"max": 64,
+					"value": 0
+				},
+				"prefetch_factor": {
+					"name": "Prefetch factor",
+					"description": "Number of batches loaded in advance by each worker. Only used if the number of workers is above zero.",
+					"min": 1,
+					"max": 64,
+					"value": 2
+				},
+				"persistent_workers": {
+					"name": "Persistent workers",
+					"description": "Keep worker processes alive after iterating over the data once. Only used if the number of workers is above zero.",
+					"value": False
+				},
+				"pin_memory": {
+					"name": "Pin memory",
+					"description": "Load batches into page-locked memory for faster transfer to the GPU. Only used with CUDA devices.",
+					"value": False
 				}
 			},
 			"optim": {
@@ -707,6 +749,30 @@ DEFAULT_OPTIONS = {
 					"min": 1,
 					"max": 8192,
 					"value": 1
+				},
+				"num_workers": {
+					"name": "Number of workers",
+					"description": "Number of processes that load and prepare images in parallel. Set to 0 to load images in the main process.",
+					"min": 0,
+					"max": 64,
+					"value": 0
+				},
+				"prefetch_factor": {
+					"name": "Prefetch factor",
+					"description": "Number of batches loaded in advance by each worker. Only used if the number of workers is above zero.",
+					"min": 1,
+					"max": 64,
+					"value": 2
+				},
+				"persistent_workers": {
+					"name": "Persistent workers",
+					"description": "Keep worker processes alive after iterating over the data once. Only used if the number of workers is above zero.",
+					"value": False
+				},
+				"pin_memory": {
+					"name": "Pin memory",
+					"description": "Load batches into page-locked memory for faster transfer to the GPU. Only used with CUDA devices.",
+					"value": False
 				}
 			},
 			"transform": {
@@ -740,9 +806,20 @@ DEFAULT_OPTIONS = {
 						"slider": True
 					}
 				},
+				"nms_method": {
+					"name": "Non-maximum suppression method",
+					"type": "select",
+					"options": "nms_method",
+					"value": "iou"
+				},
+				"nms_class_aware": {
+					"name": "Class-aware non-maximum suppression",
+					"description": "If checked, boxes only suppress boxes predicted for the same label class.",
+					"value": True
+				},
 				"numPred_max": {
 					"name": "Maximum number of predictions",
-					"description": "Limit the number of predicted boxes to the value given. This is especially useful at the beginning of model training, where a high number of boxes is usually predicted.",
+					"description": "Limit the number of predicted boxes per image to the value given (boxes with the highest confidence are kept). This is especially useful at the beginning of model training, where a high number of boxes is usually predicted.",
 					"type": "int",
 					"min": 1,
 					"max": 1000,
@@ -12,13 +12,12 @@
 
 import torch
 from .encoder import DataEncoder
-from util import helpers
+from .._util.dataLoading import DBCollator
 
 
-class Collator():
+class Collator(DBCollator):
     def __init__(self, project, dbConnector, inputSize, encoder):
-        self.project = project
-        self.dbConnector = dbConnector
+        super(Collator, self).__init__(project, dbConnector)
         self.inputSize = inputSize
         self.encoder = encoder
 
@@ -31,7 +30,7 @@ class Collator():
         for idx in range(len(batch)):
             if batch[idx][0] is None:
                 # corrupt image
-                helpers.setImageCorrupt(self.dbConnector, self.project, batch[idx][4], True)
+                self.setImageCorrupt(batch[idx][4])
             
             else:
                 imgs.append(batch[idx][0])
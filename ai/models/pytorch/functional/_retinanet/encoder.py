@@ -1,8 +1,9 @@
 '''Encode object boxes and labels.'''
 import math
+from collections import OrderedDict
 import torch
 
-from .utils import meshgrid, box_iou, box_nms, change_box_order
+from .utils import meshgrid, box_iou, batched_nms, soft_nms, change_box_order
 
 
 class DataEncoder:
@@ -13,6 +14,8 @@ class DataEncoder:
         self.aspect_ratios = [1/2., 1/1., 2/1.]
         self.scale_ratios = [1., pow(2,1/3.), pow(2,2/3.)]
         self.anchor_wh = self._get_anchor_wh()
+        self.anchor_cache = OrderedDict()   # (w, h, device, dtype) -> (anchors in xywh, anchors in xyxy)
+        self.anchor_cache_size = 8
 
     def _get_anchor_wh(self):
         '''Compute anchor width and height for each feature map.
@@ -32,7 +35,37 @@ class DataEncoder:
         num_fms = len(self.anchor_areas)
         return torch.Tensor(anchor_wh).view(num_fms, -1, 2)
 
-    def _get_anchor_boxes(self, input_size):
+    def _get_anchor_boxes(self, input_size, device=None, dtype=None, order='xywh'):
+        '''Return the anchor boxes for a given input size, computed once and cached
+        per input size, device and data type. Cached anchors are shared and must not
+        be modified in-place.
+
+        Args:
+          input_size: (tensor) model input size of (w,h).
+          device: (torch.device) device of the anchors (default: CPU).
+          dtype: (torch.dtype) data type of the anchors (default: float32).
+          order: (str) box order, either 'xywh' or 'xyxy'.
+
+        Returns:
+          boxes: (tensor) anchor boxes of all feature maps, sized [#anchors,4],
+                          where #anchors = sum(fmw * fmh * #anchors_per_cell)
+        '''
+        if device is None:
+            device = torch.device('cpu')
+        if dtype is None:
+            dtype = torch.float32
+        key = (float(input_size[0]), float(input_size[1]), str(device), dtype)
+        if key in self.anchor_cache:
+            self.anchor_cache.move_to_end(key)
+        else:
+            anchors = self._compute_anchor_boxes(input_size).to(device=device, dtype=dtype)
+            self.anchor_cache[key] = (anchors, change_box_order(anchors, 'xywh2xyxy'))
+            while len(self.anchor_cache) > self.anchor_cache_size:
+                self.anchor_cache.popitem(last=False)
+        anchors_xywh, anchors_xyxy = self.anchor_cache[key]
+        return anchors_xyxy if order == 'xyxy' else anchors_xywh
+
+    def _compute_anchor_boxes(self, input_size):
         '''Compute anchor boxes for each feature map.
 
         Args:
@@ -87,7 +120,8 @@ class DataEncoder:
 
         boxes = change_box_order(boxes, 'xyxy2xywh')
 
-        ious = box_iou(anchor_boxes, boxes, order='xywh')
+        ious = box_iou(self._get_anchor_boxes(input_size, order='xyxy'),
+                       change_box_order(boxes, 'xywh2xyxy'))
         max_ious, max_ids = ious.max(1)
 
         # best-matching anchor per target (to make sure every target gets assigned)
@@ -118,13 +152,19 @@ class DataEncoder:
         return loc_targets, cls_targets
 
 
-    def decode(self, loc_preds, cls_preds, input_size, cls_thresh=0.5, nms_thresh=0.5, numPred_max=None, return_conf=False):
+    def decode(self, loc_preds, cls_preds, input_size, cls_thresh=0.5, nms_thresh=0.5, numPred_max=None, return_conf=False,
+               nms_method='iou', nms_class_aware=False):
         '''Decode outputs back to bouding box locations and class labels.
 
         Args:
           loc_preds: (tensor) predicted locations, sized [#anchors, 4].
           cls_preds: (tensor) predicted class labels, sized [#anchors, #classes].
           input_size: (int/tuple) model input size of (w,h).
+          nms_method: (str) non-maximum suppression variant: 'iou', 'diou' (Distance-IoU),
+                      'soft_linear' or 'soft_gaussian' (Soft-NMS; confidences of overlapping
+                      boxes are decayed instead of discarding the boxes).
+          nms_class_aware: (bool) if True, boxes only suppress boxes of the same class.
+          numPred_max: (int) maximum number of boxes per image (highest scores after NMS).
 
         Returns:
           boxes: (tensor) decode box locations, sized [#obj,4].
@@ -133,7 +173,7 @@ class DataEncoder:
 
         input_size = torch.Tensor([input_size,input_size]) if isinstance(input_size, int) \
                      else torch.Tensor(input_size)
-        anchor_boxes = self._get_anchor_boxes(input_size)
+        anchor_boxes = self._get_anchor_boxes(input_size, loc_preds.device, loc_preds.dtype)
 
         if loc_preds.dim() == 2:
           loc_preds = loc_preds.unsqueeze(0)
@@ -154,34 +194,44 @@ class DataEncoder:
 
         logits = cls_preds.sigmoid()
         score, labels = logits.max(2)          # [#images,#anchors,]
-        ids = score > cls_thresh
-        
-        # limit number of predictions per image
-        if numPred_max is not None and numPred_max < len(ids):
-          order = torch.argsort(score[ids])
-          order = torch.flip(order, (0,))
-          ids = ids[order[0:numPred_max]]
-
-        ids = ids.nonzero().squeeze(1)             # [imgIdx,objIdx]
-
-        keep = []
-        for b in range(batch_size):
-          nextB = ids[:,0] == b
-          if nms_thresh > 0:
-            keepB = box_nms(boxes[ids[nextB,0],ids[nextB,1],:], score[ids[nextB,0],ids[nextB,1]], threshold=nms_thresh)
-          else:
-            keepB = torch.arange(ids[nextB,1].size(0))
-          keep.append(ids[nextB,1][keepB])
+        ids = (score > cls_thresh).nonzero()   # [#candidates,2] of (image index, anchor index)
+        boxes_cand = boxes[ids[:,0],ids[:,1],:]
+        score_cand = score[ids[:,0],ids[:,1]]
+
+        # NMS for all images (and classes, if class-aware) at once
+        groups = ids[:,0]
+        if nms_class_aware:
+          groups = groups * cls_preds.size(2) + labels[ids[:,0],ids[:,1]]
+        decay = None
+        if nms_thresh > 0 and nms_method in ('soft_linear', 'soft_gaussian'):
+          keep, score_keep = soft_nms(boxes_cand, score_cand, groups, threshold=nms_thresh,
+                                      decay=nms_method[5:], score_thresh=cls_thresh)
+          decay = score_keep / score_cand[keep]
+        elif nms_thresh > 0:
+          keep = batched_nms(boxes_cand, score_cand, groups, threshold=nms_thresh, method=nms_method)
+        else:
+          keep = score_cand.argsort(descending=True)
 
         # assemble final annotations
         boxes_out = []
         labels_out = []
         logits_out = []
         for b in range(batch_size):
-          boxes_out.append(boxes[b,keep[b],:])
-          labels_out.append(labels[b,keep[b]])
+          keepB = ids[keep,0] == b
+          idsB = ids[keep[keepB],1]
+          decayB = (decay[keepB] if decay is not None else None)
+          if numPred_max is not None:
+            # limit number of predictions per image
+            idsB = idsB[:numPred_max]
+            if decayB is not None:
+              decayB = decayB[:numPred_max]
+          boxes_out.append(boxes[b,idsB,:])
+          labels_out.append(labels[b,idsB])
           if return_conf:
-            logits_out.append(logits[b,keep[b],:])
+            if decayB is not None:
+              logits_out.append(logits[b,idsB,:] * decayB.unsqueeze(1))
+            else:
+              logits_out.append(logits[b,idsB,:])
 
         if return_conf:
           return boxes_out, labels_out, logits_out
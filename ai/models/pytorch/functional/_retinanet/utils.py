@@ -131,65 +131,226 @@ def box_iou(box1, box2, order='xyxy', return_intersection=False):
     else:
       return iou
 
-def box_nms(bboxes, scores, threshold=0.5, mode='union'):
-    '''Non maximum suppression.
+def box_overlap(box1, box2, method='iou', aligned=False):
+    '''Compute the pairwise overlaps of two sets of boxes in (xmin,ymin,xmax,ymax) order.
 
     Args:
-      bboxes: (tensor) bounding boxes, sized [N,4].
-      scores: (tensor) bbox scores, sized [N,].
-      threshold: (float) overlap threshold.
-      mode: (str) 'union' or 'min'.
+      box1: (tensor) bounding boxes, sized [N,4].
+      box2: (tensor) bounding boxes, sized [M,4].
+      method: (str) 'iou', 'min' (intersection over the smaller area), or 'diou'
+              (IoU minus the squared distance between the box centers, normalized
+              by the squared diagonal of the smallest enclosing box).
+      aligned: (bool) if True, only the overlaps of corresponding boxes are computed
+               (requires N == M).
 
-    Returns:
-      keep: (tensor) selected indices.
+    Return:
+      (tensor) overlaps, sized [N,M] (or [N,] if aligned).
 
     Reference:
-      https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/nms/py_cpu_nms.py
+      Zheng et al. "Distance-IoU Loss: Faster and Better Learning for Bounding Box Regression." AAAI 2020.
     '''
+    if not aligned:
+        box1 = box1[:,None,:]        # [N,1,4]
+    lt = torch.max(box1[...,:2], box2[...,:2])  # [N,M,2]
+    rb = torch.min(box1[...,2:], box2[...,2:])  # [N,M,2]
 
+    wh = (rb-lt+1).clamp(min=0)      # [N,M,2]
+    inter = wh[...,0] * wh[...,1]  # [N,M]
+
+    area1 = (box1[...,2]-box1[...,0]+1) * (box1[...,3]-box1[...,1]+1)  # [N,1]
+    area2 = (box2[...,2]-box2[...,0]+1) * (box2[...,3]-box2[...,1]+1)  # [M,]
+    if method == 'min':
+        return inter / torch.min(area1, area2)
+    iou = inter / (area1 + area2 - inter)
+    if method == 'diou':
+        ctr1 = (box1[...,:2] + box1[...,2:]) / 2
+        ctr2 = (box2[...,:2] + box2[...,2:]) / 2
+        dist = ((ctr1 - ctr2)**2).sum(-1)  # [N,M]
+        lt = torch.min(box1[...,:2], box2[...,:2])
+        rb = torch.max(box1[...,2:], box2[...,2:])
+        diag = ((rb-lt+1)**2).sum(-1)  # [N,M]
+        return iou - dist / diag
+    elif method != 'iou':
+        raise TypeError('Unknown overlap method: %s.' % method)
+    return iou
+
+def _group_overlap(box1, box2, groups1, groups2, method):
+    '''Pairwise overlaps, set to -inf for boxes of different groups.'''
+    ovr = box_overlap(box1, box2, method)
+    if groups1 is not None:
+        ovr = ovr.masked_fill(groups1[:,None] != groups2[None,:], float('-inf'))
+    return ovr
+
+def batched_nms(bboxes, scores, idxs=None, threshold=0.5, method='iou', tile_size=512, block_size=4096):
+    '''Non maximum suppression, vectorized and optionally per group (e.g. per image
+    and class).
+
+    Boxes are processed in tiles of decreasing score. Each tile is first compared
+    against all boxes kept so far (in blocks), and then resolved internally by
+    iterating the greedy suppression rule on the tile's overlap matrix until it no
+    longer changes. The result is identical to the classic sequential algorithm.
+
+    Args:
+      bboxes: (tensor) bounding boxes in (xmin,ymin,xmax,ymax) order, sized [N,4].
+      scores: (tensor) bbox scores, sized [N,].
+      idxs: (tensor) group indices, sized [N,]. Boxes only suppress boxes of the same
+            group. If None, all boxes are treated as one group.
+      threshold: (float) overlap threshold.
+      method: (str) overlap method: 'iou', 'min' or 'diou' (see "box_overlap").
+      tile_size: (int) number of boxes resolved at once.
+      block_size: (int) number of kept boxes compared to a tile at once.
+
+    Returns:
+      keep: (tensor) selected indices, in order of decreasing score.
+    '''
     if bboxes.dim()==1:
         bboxes = bboxes.unsqueeze(0)
-        scores = scores.unsqueeze(0)
-
-    x1 = bboxes[:,0]
-    y1 = bboxes[:,1]
-    x2 = bboxes[:,2]
-    y2 = bboxes[:,3]
+        scores = scores.view(-1)
+    if bboxes.size(0) == 0:
+        return torch.zeros(0, dtype=torch.long, device=bboxes.device)
 
-    areas = (x2-x1+1) * (y2-y1+1)
     _, order = scores.sort(0, descending=True)
+    boxes = bboxes[order]
+    groups = (idxs[order] if idxs is not None else None)
+    num = boxes.size(0)
+    keep = torch.zeros(num, dtype=torch.bool, device=boxes.device)
+
+    for start in range(0, num, tile_size):
+        end = min(start+tile_size, num)
+        tile = boxes[start:end]
+        tileGroups = (groups[start:end] if groups is not None else None)
+
+        # suppression by boxes kept in previous tiles
+        candidates = torch.ones(end-start, dtype=torch.bool, device=boxes.device)
+        kept = keep[:start].nonzero().squeeze(1)
+        for b in range(0, kept.numel(), block_size):
+            block = kept[b:b+block_size]
+            ovr = _group_overlap(boxes[block], tile,
+                        (groups[block] if groups is not None else None), tileGroups, method)
+            candidates &= ~(ovr > threshold).any(0)
+            if not candidates.any():
+                break
+
+        # suppression within the tile: iterate the greedy rule until convergence
+        suppress = (_group_overlap(tile, tile, tileGroups, tileGroups, method) > threshold).triu(1)
+        tileKeep = candidates
+        while True:
+            nextKeep = candidates & ~(suppress & tileKeep[:,None]).any(0)
+            if torch.equal(nextKeep, tileKeep):
+                break
+            tileKeep = nextKeep
+        keep[start:end] = tileKeep
+
+    return order[keep]
+
+def soft_nms(bboxes, scores, idxs=None, threshold=0.5, method='iou', decay='linear', sigma=0.5, score_thresh=0.001):
+    '''Soft non maximum suppression: instead of discarding overlapping boxes, their
+    scores are decayed according to their overlap with higher-scoring boxes.
+
+    Groups (e.g. images and classes) are independent of each other, so the highest-
+    scoring remaining box of every group is kept at once; the number of iterations
+    is that of the boxes kept in the largest group. The result is identical to
+    processing the boxes of all groups one at a time.
 
-    keep = []
-    while order.numel() > 0:
-        i = order[0]
-        keep.append(i)
+    Args:
+      bboxes: (tensor) bounding boxes in (xmin,ymin,xmax,ymax) order, sized [N,4].
+      scores: (tensor) bbox scores, sized [N,].
+      idxs: (tensor) group indices, sized [N,] (see "batched_nms").
+      threshold: (float) overlap threshold above which scores are decayed linearly
+                 (decay 'linear').
+      method: (str) overlap method: 'iou', 'min' or 'diou' (see "box_overlap").
+      decay: (str) 'linear' (score * (1-overlap)) or 'gaussian' (score * exp(-overlap^2/sigma)).
+      sigma: (float) width of the Gaussian decay.
+      score_thresh: (float) boxes whose (decayed) score falls below this value are discarded.
 
-        if order.numel() == 1:
-            break
+    Returns:
+      keep: (tensor) selected indices, in order of decreasing (decayed) score.
+      scores: (tensor) decayed scores of the selected boxes, sized [#keep,].
 
-        xx1 = x1[order[1:]].clamp(min=x1[i])
-        yy1 = y1[order[1:]].clamp(min=y1[i])
-        xx2 = x2[order[1:]].clamp(max=x2[i])
-        yy2 = y2[order[1:]].clamp(max=y2[i])
+    Reference:
+      Bodla et al. "Soft-NMS -- Improving Object Detection With One Line of Code." ICCV 2017.
+    '''
+    if decay not in ('linear', 'gaussian'):
+        raise TypeError('Unknown soft NMS decay: %s.' % decay)
+    if bboxes.dim()==1:
+        bboxes = bboxes.unsqueeze(0)
+        scores = scores.view(-1)
+    if idxs is not None:
+        _, groups = torch.unique(idxs, return_inverse=True)
+    else:
+        groups = torch.zeros_like(scores, dtype=torch.long)
+    numGroups = int(groups.max()) + 1 if groups.numel() else 0
+    vectorized = (numGroups > 1 and hasattr(scores, 'scatter_reduce'))
+
+    # remaining boxes, compacted after every iteration
+    remaining = (scores >= score_thresh).nonzero().squeeze(1)
+    boxesR, scoresR, groupsR = bboxes[remaining], scores[remaining], groups[remaining]
+
+    keep, keepScores = [], []
+    while remaining.numel() > 0:
+        num = remaining.numel()
+        if vectorized:
+            # highest-scoring box of every group (first one upon ties)
+            position = torch.arange(num, device=remaining.device)
+            groupMax = scoresR.new_full((numGroups,), float('-inf')).scatter_reduce(0, groupsR, scoresR, 'amax')
+            isMax = scoresR == groupMax[groupsR]
+            top = position.new_full((numGroups,), num).scatter_reduce(0, groupsR[isMax], position[isMax], 'amin')
+            selected = top[top < num]
+            partner = top[groupsR]
+            ovr = box_overlap(boxesR, boxesR[partner.clamp(max=num-1)], method, aligned=True)
+            ovr = ovr.masked_fill(partner == num, float('-inf'))
+        else:
+            # one group (or older PyTorch versions): one box per iteration
+            best = scoresR.argmax()
+            selected = best.view(1)
+            ovr = box_overlap(boxesR, boxesR[selected], method)[:,0]
+            if numGroups > 1:
+                ovr = ovr.masked_fill(groupsR != groupsR[best], float('-inf'))
+        keep.append(remaining[selected])
+        keepScores.append(scoresR[selected])
+
+        # decay the scores of the other boxes of the same groups
+        if decay == 'linear':
+            weight = torch.where(ovr > threshold, 1 - ovr, torch.ones_like(ovr))
+        else:
+            weight = torch.exp(-(ovr.clamp(min=0)**2) / sigma)
+        scoresR = scoresR * weight
+        valid = scoresR >= score_thresh
+        valid[selected] = False
+        remaining, boxesR, scoresR, groupsR = remaining[valid], boxesR[valid], scoresR[valid], groupsR[valid]
+
+    if not len(keep):
+        return torch.zeros(0, dtype=torch.long, device=bboxes.device), scores[:0]
+    keep, keepScores = torch.cat(keep), torch.cat(keepScores)
+    if vectorized:
+        # order of decreasing score (kept boxes are no longer decayed), then index
+        keep, order = keep.sort()
+        keepScores, order2 = keepScores[order].sort(descending=True, stable=True)
+        keep = keep[order2]
+    return keep, keepScores
 
-        w = (xx2-xx1+1).clamp(min=0)
-        h = (yy2-yy1+1).clamp(min=0)
-        inter = w*h
+def box_nms(bboxes, scores, threshold=0.5, mode='union'):
+    '''Non maximum suppression.
 
-        if mode == 'union':
-            ovr = inter / (areas[i] + areas[order[1:]] - inter)
-        elif mode == 'min':
-            ovr = inter / areas[order[1:]].clamp(max=areas[i])
-        else:
-            raise TypeError('Unknown nms mode: %s.' % mode)
-
-        ids = (ovr<=threshold).nonzero().squeeze()
-        if ids.numel() == 0:
-            break
-        order = order[ids+1]
-        if not order.dim():
-            order = order.unsqueeze(0)
-    return torch.LongTensor(keep)
+    Args:
+      bboxes: (tensor) bounding boxes, sized [N,4].
+      scores: (tensor) bbox scores, sized [N,].
+      threshold: (float) overlap threshold.
+      mode: (str) 'union' or 'min'.
+
+    Returns:
+      keep: (tensor) selected indices.
+
+    Reference:
+      https://github.com/rbgirshick/py-faster-rcnn/blob/master/lib/nms/py_cpu_nms.py
+    '''
+    if mode == 'union':
+        method = 'iou'
+    elif mode == 'min':
+        method = 'min'
+    else:
+        raise TypeError('Unknown nms mode: %s.' % mode)
+    return batched_nms(bboxes, scores, None, threshold, method)
 
 def softmax(x):
     '''Softmax along a specific dimension.
@@ -0,0 +1,195 @@
+'''
+    Helpers for parallel data loading with the PyTorch DataLoader.
+
+    Images can be loaded, augmented and encoded in separate worker processes
+    (DataLoader argument "num_workers"). AIWorker tasks run in the daemonic
+    child processes of Celery's (default) prefork pool, which Python does not
+    allow to start processes of their own; this is lifted where needed (see
+    "allow_worker_processes"). Since the DataLoader workers are forked from
+    the AIWorker process, they must not use its database connections (psy-
+    copg2 connections cannot be shared across processes). Collators that flag cor-
+    rupt images in the database therefore derive from "DBCollator", which
+    opens a separate connection in every worker process where needed.
+    If the images are retrieved from a remote FileServer, the ones of upcoming
+    indices can further be prefetched into the AIWorker's local file cache
+    while earlier batches are being processed (see "PrefetchingSampler").
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import inspect
+import multiprocessing
+from torch.utils.data import DataLoader, Sampler, RandomSampler, SequentialSampler
+from util import helpers, optionsHelper
+
+
+# DataLoader arguments for parallel loading that can be set in the model options
+PARALLEL_LOADING_ARGS = ('num_workers', 'prefetch_factor', 'persistent_workers', 'pin_memory')
+
+# arguments supported by the installed PyTorch version
+_SUPPORTED_ARGS = set(inspect.signature(DataLoader.__init__).parameters.keys())
+
+
+
+def allow_worker_processes():
+    '''
+        Allows the current process to start DataLoader worker processes if it
+        is daemonic, as are the pool processes of Celery's prefork pool that
+        run the AIWorker tasks (Python would otherwise refuse with "daemonic
+        processes are not allowed to have children"). The DataLoader workers
+        are daemonic themselves and are terminated together with the pool
+        process.
+    '''
+    process = multiprocessing.current_process()
+    if process.daemon:
+        process._config['daemon'] = False
+
+
+
+def sanitize_kwargs(kwargs, device=None):
+    '''
+        Returns a copy of the given DataLoader keyword arguments with all
+        parallel loading arguments made valid: "prefetch_factor" and "persis-
+        tent_workers" are removed if no worker processes are used, "pin_me-
+        mory" is disabled for devices other than CUDA, and arguments not sup-
+        ported by the installed PyTorch version are removed. If worker pro-
+        cesses are used, the current process is allowed to start them (see
+        "allow_worker_processes").
+    '''
+    kwargs = dict(kwargs)
+    kwargs['num_workers'] = max(0, int(kwargs.get('num_workers', 0) or 0))
+    if kwargs['num_workers'] == 0:
+        # only valid with worker processes
+        kwargs.pop('prefetch_factor', None)
+        kwargs.pop('persistent_workers', None)
+    else:
+        allow_worker_processes()
+        if 'prefetch_factor' in kwargs:
+            kwargs['prefetch_factor'] = max(1, int(kwargs['prefetch_factor']))
+    if kwargs.get('pin_memory', False) and (device is None or 'cuda' not in device):
+        kwargs['pin_memory'] = False
+    for key in list(kwargs.keys()):
+        if key not in _SUPPORTED_ARGS:
+            print(f'WARNING: data loader argument "{key}" is not supported by the installed version of PyTorch and will be ignored.')
+            del kwargs[key]
+    return kwargs
+
+
+
+def get_kwargs(options, stage, device=None):
+    '''
+        Returns the DataLoader keyword arguments (batch size and parallel
+        loading arguments) for a given stage ("train" or "inference") from
+        GUI-enhanced model options.
+    '''
+    kwargs = {}
+    for key in ('batch_size',) + PARALLEL_LOADING_ARGS:
+        value = optionsHelper.get_hierarchical_value(options, ['options', stage, 'dataLoader', key, 'value'], fallback=None)
+        if value is not None:
+            kwargs[key] = value
+    if 'batch_size' in kwargs:
+        kwargs['batch_size'] = max(1, int(kwargs['batch_size']))
+    return sanitize_kwargs(kwargs, device)
+
+
+
+class PrefetchingSampler(Sampler):
+    '''
+        Wraps a sampler and requests the images of the indices that will be
+        drawn next from the file server ahead of time (see "FileServer.pre-
+        fetch"), so that they are downloaded concurrently. Requires the data-
+        set to provide its file server ("fileServer") and a function "get_-
+        filename" that returns the image file name for a given index.
+    '''
+
+    def __init__(self, sampler, dataset, lookahead):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.lookahead = max(1, int(lookahead))
+
+
+    def _prefetch(self, indices):
+        try:
+            self.dataset.fileServer.prefetch([self.dataset.get_filename(idx) for idx in indices])
+        except Exception as e:
+            print(f'WARNING: could not prefetch images (message: "{str(e)}").')
+
+
+    def __iter__(self):
+        indices = list(self.sampler)
+        self._prefetch(indices[:self.lookahead])
+        for pos, idx in enumerate(indices):
+            if pos + self.lookahead < len(indices):
+                self._prefetch([indices[pos + self.lookahead]])
+            yield idx
+
+
+    def __len__(self):
+        return len(self.sampler)
+
+
+
+def add_prefetching(kwargs, dataset, config):
+    '''
+        Returns a copy of the given DataLoader keyword arguments with a sam-
+        pler that prefetches upcoming images (see "PrefetchingSampler"), if
+        enabled in section [AIWorker] of the configuration file and supported
+        by the dataset. Argument "shuffle" is replaced by the sampler.
+    '''
+    lookahead = config.getProperty('AIWorker', 'file_prefetch_lookahead', type=int, fallback=0)
+    fileServer = getattr(dataset, 'fileServer', None)
+    if lookahead is None or lookahead <= 0 or not hasattr(fileServer, 'prefetch') or \
+        not hasattr(dataset, 'get_filename') or 'sampler' in kwargs or 'batch_sampler' in kwargs:
+        return kwargs
+    kwargs = dict(kwargs)
+    if kwargs.pop('shuffle', False):
+        sampler = RandomSampler(dataset)
+    else:
+        sampler = SequentialSampler(dataset)
+    kwargs['sampler'] = PrefetchingSampler(sampler, dataset, lookahead)
+    return kwargs
+
+
+
+class DBCollator:
+    '''
+        Base class for collators that flag corrupt images in the database.
+        In DataLoader worker processes, a separate database connection is
+        created upon first use. The connection pool of the parent process is
+        kept referenced (but unused) there, so that its connections are not
+        closed from within the worker. It is also excluded when pickling the
+        collator (e.g. for the "spawn" start method).
+    '''
+
+    def __init__(self, project, dbConnector):
+        self.project = project
+        self.dbConnector = dbConnector
+        self.dbConfig = getattr(dbConnector, 'config', None)
+        self._pid = os.getpid()
+        self._parentConnector = None
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['dbConnector'] = None
+        state['_parentConnector'] = None
+        state['_pid'] = None
+        return state
+
+
+    def _get_db_connector(self):
+        if self._pid != os.getpid():
+            # running in a worker process
+            from modules.Database.app import Database
+            self._parentConnector = self.dbConnector
+            self.dbConnector = Database(self.dbConfig)
+            self._pid = os.getpid()
+        return self.dbConnector
+
+
+    def setImageCorrupt(self, imageID):
+        try:
+            helpers.setImageCorrupt(self._get_db_connector(), self.project, imageID, True)
+        except Exception as e:
+            print(f'WARNING: could not flag image "{imageID}" as corrupt (message: "{str(e)}").')
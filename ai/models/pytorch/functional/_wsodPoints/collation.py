@@ -6,13 +6,12 @@
 
 import torch
 from .encoder import DataEncoder
-from util import helpers
+from .._util.dataLoading import DBCollator
 
 
-class Collator():
+class Collator(DBCollator):
     def __init__(self, project, dbConnector, target_size, encoder):
-        self.project = project
-        self.dbConnector = dbConnector
+        super(Collator, self).__init__(project, dbConnector)
         self.target_size = target_size
         self.encoder = encoder
 
@@ -39,7 +38,7 @@ class Collator():
         for i in range(len(batch)):
             if batch[i][0] is None:
                 # corrupt image
-                helpers.setImageCorrupt(self.dbConnector, self.project, batch[i][3], True)
+                self.setImageCorrupt(batch[i][5])
 
             else:
                 imgs.append(batch[i][0])
@@ -5,6 +5,7 @@
 '''
 
 import torch
+import torch.nn.functional as F
 
 class DataEncoder:
 
@@ -64,22 +65,44 @@ class DataEncoder:
 
         return loc_targets
 
+
+    @staticmethod
+    def _window_max(grid, radius):
+        '''
+            Maximum within a square window of given radius around every cell of
+            a 2D grid. Computed separably (rows, then columns), which is
+            identical to, but faster than, a max-pooling with a square kernel.
+        '''
+        kernel = 2*radius + 1
+        pooled = F.max_pool2d(grid[None,None,...], (1,kernel), stride=1, padding=(0,radius))
+        pooled = F.max_pool2d(pooled, (kernel,1), stride=1, padding=(radius,0))
+        return pooled[0,0,...]
+
     
-    def decode(self, loc_preds, min_conf=0.5, nms_dist=2):
+    def decode(self, loc_preds, min_conf=0.5, nms_dist=2, top_k=None):
         '''
-            Extracts coordinates from a prediction grid.
+            Extracts coordinates from a prediction grid by picking the peaks of
+            the heatmap: a grid cell becomes a point if its maximum value across
+            all classes is >= min_conf and the highest within a square window of
+            radius "nms_dist" cells (found with max-pooling). Of several cells
+            with equal values within a window, only one is kept.
 
             Args:
                 loc_preds (tensor): prediction coordinate; sized [CxWxH], with C =
                                     #classes, W, H = width, height
                 min_conf (float): minimum value entries in loc_preds must have to
                                   be considered as potential predictions.
+                nms_dist (int): radius (in grid cells) within which only the point
+                                with the highest value is kept. Zero disables the
+                                suppression (every cell >= min_conf becomes a point).
+                top_k (int): if provided, only the top_k points with the highest
+                             values are returned.
             
             Returns:
-                points (tensor): extracted points whose predicted value is >= min_conf,
-                                 converted back to relative values (convention: the cen-
-                                 ter of the grid cell the point falls into denotes its
-                                 position)
+                points (tensor): extracted points, converted back to relative values
+                                 (convention: the center of the grid cell the point
+                                 falls into denotes its position); sized [Nx2], in
+                                 order of decreasing confidence
                 labels (tensor): arg max of the predicted values (i.e., class label)
                 confidences (tensor): predicted values; sized [NxC], with N = number of
                                       predicted points, C = number of classes
@@ -88,19 +111,36 @@ class DataEncoder:
         if loc_preds.dim() == 2:
             loc_preds = loc_preds.unsqueeze(0)
         loc_preds = loc_preds.float()
+        sz = loc_preds.size()
+
+        # maximum across classes per grid cell
+        heatmap, _ = loc_preds.max(0)                                           # [WxH]
+        valid = heatmap >= min_conf
+
+        nms_dist = int(nms_dist or 0)
+        if nms_dist > 0:
+            # local maxima
+            pooled = self._window_max(heatmap, nms_dist)
+            valid &= heatmap == pooled
+
+            # plateaus: keep the cell with the highest index per window
+            index = torch.arange(1, heatmap.numel()+1, dtype=torch.float64, device=heatmap.device).view_as(heatmap)
+            index = index * valid.double()
+            pooled = self._window_max(index, nms_dist)
+            valid &= index == pooled
+
+        positions = torch.nonzero(valid)                                        # [Nx2]
+        scores = heatmap[positions[:,0], positions[:,1]]
+        if top_k is not None and top_k < scores.size(0):
+            scores, order = torch.topk(scores, int(top_k))
+        else:
+            scores, order = torch.sort(scores, descending=True)
+        positions = positions[order,:]
 
-        # locate valid points
-        loc_preds_flat = loc_preds.view(self.num_classes, -1)
-        positions_flat = torch.nonzero(loc_preds_flat >= min_conf)
-        confidences = torch.index_select(loc_preds_flat, 1, positions_flat[:,1]).permute(1,0)
-        points = (torch.nonzero(loc_preds >= min_conf)[:,1:]).cpu()
-        labels = (torch.argmax(confidences, 1).squeeze()).cpu()
-
-        # perform NMS
-        #TODO
+        confidences = loc_preds[:, positions[:,0], positions[:,1]].permute(1,0)     # [NxC]
+        labels = torch.argmax(confidences, 1).cpu()
 
         # convert points to relative format
-        sz = torch.tensor(loc_preds.size(), dtype=torch.float)
-        points = (points.float() + 0.5) / sz[1:]
+        points = (positions.cpu().float() + 0.5) / torch.tensor(sz[1:], dtype=torch.float)
 
-        return points, labels, confidences
\ No newline at end of file
+        return points, labels, confidences
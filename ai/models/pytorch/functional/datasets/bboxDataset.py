@@ -4,11 +4,11 @@
     2019-20 Benjamin Kellenberger
 '''
 
-from io import BytesIO
 import torch
 from torch.utils.data import Dataset
 import numpy as np
 from PIL import Image
+from .imageCache import load_image
 
 
 class BoundingBoxesDataset(Dataset):
@@ -21,13 +21,17 @@ class BoundingBoxesDataset(Dataset):
                     - images: dict with
                               { <image UUID> : { 'annotations' : { <annotation UUID> : { 'x', 'y', 'width', 'height', 'label' (label UUID) }}}}
                     - 'fVec': optional, contains feature vector bytes for image
-        - fileServer: Instance that implements a 'getFile' function to load images
+        - fileServer: Instance that implements a 'getImage' function to load images
         - labelclassMap: a dictionary/LUT with mapping: key = label class UUID, value = index (number) according
                          to the model.
         - targetFormat: str for output bounding box format, either 'xywh' (xy = center coordinates, wh = width & height)
                         or 'xyxy' (top left and bottom right coordinates)
         - transform: Instance of classes defined in 'ai.models.pytorch.functional.transforms.boundingBoxes'. May be None for no transformation at all.
         - ignoreUnsure: if True, all annotations with flag 'unsure' will get a label of -1 (i.e., 'ignore')
+        - imageCache: optional instance of 'DecodedImageCache' (see 'imageCache.py') to load decoded and
+                      pre-resized images from.
+        - targetSize: optional tuple of (width, height) of the model input. If provided, JPEG images are decoded
+                      at the lowest resolution that still covers it.
 
         The '__getitem__' function returns the data entry at given index as a tuple with the following contents:
         - img: the loaded and transformed (if specified) image.
@@ -37,13 +41,15 @@ class BoundingBoxesDataset(Dataset):
         - fVec: a torch tensor of feature vectors (if available; else None)
         - imageID: str, filename of the image loaded
     '''
-    def __init__(self, data, fileServer, labelclassMap, targetFormat='xywh', transform=None, ignoreUnsure=False):
+    def __init__(self, data, fileServer, labelclassMap, targetFormat='xywh', transform=None, ignoreUnsure=False, imageCache=None, targetSize=None):
         super(BoundingBoxesDataset, self).__init__()
         self.fileServer = fileServer
         self.labelclassMap = labelclassMap
         self.targetFormat = targetFormat
         self.transform = transform
         self.ignoreUnsure = ignoreUnsure
+        self.imageCache = imageCache
+        self.targetSize = targetSize
         self.__parse_data(data)
 
     
@@ -116,6 +122,10 @@ class BoundingBoxesDataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+
+    def get_filename(self, idx):
+        return self.data[idx][4]
+
     
     def __getitem__(self, idx):
 
@@ -123,7 +133,7 @@ class BoundingBoxesDataset(Dataset):
 
         # load image
         try:
-            img = Image.open(BytesIO(self.fileServer.getFile(imagePath))).convert('RGB')
+            img, _ = load_image(self.fileServer, imagePath, self.imageCache, self.targetSize)
         except:
             print('WARNING: Image {} is corrupt and could not be loaded.'.format(imagePath))
             img = None
@@ -4,19 +4,21 @@
     2019 Benjamin Kellenberger
 '''
 
-from io import BytesIO
 import torch
 from torch.utils.data import Dataset
 from PIL import Image
+from .imageCache import load_image
 
 
 class LabelsDataset(Dataset):
 
-    def __init__(self, data, fileServer, labelclassMap, transform, ignoreUnsure=False, **kwargs):
+    def __init__(self, data, fileServer, labelclassMap, transform, ignoreUnsure=False, imageCache=None, targetSize=None, **kwargs):
         super(LabelsDataset, self).__init__()
         self.fileServer = fileServer
         self.labelclassMap = labelclassMap
         self.transform = transform
+        self.imageCache = imageCache
+        self.targetSize = targetSize
         self.ignoreUnsure = ignoreUnsure
         self.__parse_data(data)
 
@@ -66,6 +68,10 @@ class LabelsDataset(Dataset):
 
     def __len__(self):
         return len(self.data)
+
+
+    def get_filename(self, idx):
+        return self.data[idx][3]
     
 
     def __getitem__(self, idx):
@@ -74,7 +80,7 @@ class LabelsDataset(Dataset):
 
         # load image
         try:
-            img = Image.open(BytesIO(self.fileServer.getFile(imagePath))).convert('RGB')
+            img, _ = load_image(self.fileServer, imagePath, self.imageCache, self.targetSize)
         except:
             print('WARNING: Image {} is corrupt and could not be loaded.'.format(imagePath))
             img = None
@@ -0,0 +1,236 @@
+'''
+    Disk-based cache of decoded, pre-resized images for the datasets of the
+    built-in PyTorch models.
+
+    Decoding large images (e.g. JPEGs of aerial imagery) anew in every epoch
+    is costly, especially on CPU-only AIWorkers. With this cache, images are
+    decoded once, downscaled so that they still cover the model's input size
+    (aspect ratio preserved; images are never upscaled), and appended as raw
+    uint8 arrays to a shard file. Subsequent loads map the shard file into
+    memory and skip the decoding altogether.
+
+    Entries are keyed by image file name, target size and file modification
+    time (if available), so that files replaced on disk are decoded anew.
+    The shard file and its index (one JSON line per entry) are shared between
+    DataLoader worker processes; appending is serialized with a file lock.
+    The cache grows until its maximum size is reached; it can be cleared by
+    deleting its directory.
+
+    Since annotations of AIDE are stored in relative coordinates, using down-
+    scaled images is transparent to the datasets.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import json
+import numpy as np
+from PIL import Image
+from util.helpers import draftImage
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; appending is not serialized across processes
+    fcntl = None
+
+
+class DecodedImageCache:
+
+    def __init__(self, cacheDir, targetSize, maxSize):
+        '''
+            Inputs:
+            - cacheDir:     directory for the shard file and its index
+            - targetSize:   tuple of (width, height) of the model input. Cached
+                            images are downscaled to cover this size.
+            - maxSize:      maximum size of the shard file in bytes
+        '''
+        self.cacheDir = cacheDir
+        self.targetSize = (int(targetSize[0]), int(targetSize[1]))
+        self.maxSize = maxSize
+        os.makedirs(self.cacheDir, exist_ok=True)
+        self.shardPath = os.path.join(self.cacheDir, 'images.bin')
+        self.indexPath = os.path.join(self.cacheDir, 'index.jsonl')
+        self.lockPath = os.path.join(self.cacheDir, '.lock')
+
+        self.index = {}
+        self.indexPos = 0
+        self.shard = None
+
+
+    def __getstate__(self):
+        # memory maps cannot be pickled; they are re-created upon use
+        state = self.__dict__.copy()
+        state['shard'] = None
+        return state
+
+
+    def _lock(self, f):
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+
+
+    def _unlock(self, f):
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def _reload_index(self):
+        '''
+            Reads all entries appended to the index since the last call.
+        '''
+        if not os.path.isfile(self.indexPath):
+            return
+        with open(self.indexPath, 'r') as f:
+            f.seek(self.indexPos)
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    # incomplete line (should not happen due to locking)
+                    break
+                try:
+                    entry = json.loads(line)
+                    self.index[entry['key']] = entry
+                except Exception:
+                    pass
+                self.indexPos = f.tell()
+
+
+    def _get_key(self, filename, mtime):
+        return f'{filename}|{self.targetSize[0]}x{self.targetSize[1]}|{mtime}'
+
+
+    def get(self, filename, mtime=None):
+        '''
+            Returns a tuple of the cached image (PIL.Image, RGB) and the size
+            (width, height) of the original image, or (None, None) if the im-
+            age is not in the cache.
+        '''
+        key = self._get_key(filename, mtime)
+        if key not in self.index:
+            self._reload_index()
+            if key not in self.index:
+                return None, None
+        entry = self.index[key]
+        end = entry['offset'] + int(np.prod(entry['shape']))
+        try:
+            if self.shard is None or self.shard.shape[0] < end:
+                self.shard = np.memmap(self.shardPath, dtype=np.uint8, mode='r')
+            array = np.array(self.shard[entry['offset']:end]).reshape(entry['shape'])
+            return Image.fromarray(array), tuple(entry['size'])
+        except Exception as e:
+            print(f'WARNING: could not read image "{filename}" from cache (message: "{str(e)}").')
+            return None, None
+
+
+    def resize(self, img):
+        '''
+            Downscales an image so that it still covers the target size.
+        '''
+        scale = max(self.targetSize[0] / img.size[0], self.targetSize[1] / img.size[1])
+        if scale >= 1:
+            return img
+        newSize = (max(1, int(round(img.size[0] * scale))), max(1, int(round(img.size[1] * scale))))
+        return img.resize(newSize, Image.BILINEAR)
+
+
+    def put(self, filename, img, originalSize, mtime=None):
+        '''
+            Appends a (pre-resized) RGB image to the cache, unless it is al-
+            ready cached or the cache is full.
+        '''
+        key = self._get_key(filename, mtime)
+        array = np.asarray(img.convert('RGB'), dtype=np.uint8)
+        try:
+            with open(self.lockPath, 'a') as lockFile:
+                self._lock(lockFile)
+                try:
+                    self._reload_index()
+                    if key in self.index:
+                        return
+                    offset = (os.path.getsize(self.shardPath) if os.path.isfile(self.shardPath) else 0)
+                    if offset + array.nbytes > self.maxSize:
+                        return
+                    with open(self.shardPath, 'ab') as f:
+                        f.write(array.tobytes())
+                    entry = {
+                        'key': key,
+                        'offset': offset,
+                        'shape': list(array.shape),
+                        'size': list(originalSize)
+                    }
+                    with open(self.indexPath, 'a') as f:
+                        f.write(json.dumps(entry) + '\n')
+                finally:
+                    self._unlock(lockFile)
+        except Exception as e:
+            print(f'WARNING: could not cache image "{filename}" (message: "{str(e)}").')
+
+
+
+def _decode_image(fileServer, filename, targetSize):
+    img = fileServer.getImage(filename)
+    originalSize = img.size
+    img = draftImage(img, targetSize).convert('RGB')
+    return img, originalSize
+
+
+
+def load_image(fileServer, filename, imageCache=None, targetSize=None):
+    '''
+        Loads an image through the given file server (resp. the decoded image
+        cache, if provided and the image is cached) and returns a tuple of the
+        RGB PIL.Image and the size (width, height) of the original image.
+        Images not yet cached are downscaled and added to the cache.
+        If "targetSize" (width, height; defaults to the one of the cache) is
+        provided, JPEG images are decoded at the lowest resolution that still
+        covers it.
+    '''
+    if imageCache is None:
+        return _decode_image(fileServer, filename, targetSize)
+    if targetSize is None:
+        targetSize = imageCache.targetSize
+
+    mtime = (fileServer.getModificationTime(filename) if hasattr(fileServer, 'getModificationTime') else None)
+    img, originalSize = imageCache.get(filename, mtime)
+    if img is not None:
+        return img, originalSize
+
+    img, originalSize = _decode_image(fileServer, filename, targetSize)
+    img = imageCache.resize(img)
+    imageCache.put(filename, img, originalSize, mtime)
+    return img, originalSize
+
+
+
+def get_decoded_image_cache(config, project, targetSize):
+    '''
+        Returns a decoded image cache for the given project and model input
+        size (tuple of width, height) as configured in section [AIWorker] of
+        the configuration file, or None if disabled.
+    '''
+    maxSize = config.getProperty('AIWorker', 'decoded_image_cache_size', type=int, fallback=0)
+    if maxSize is None or maxSize <= 0 or targetSize is None:
+        return None
+    cacheDir = config.getProperty('AIWorker', 'decoded_image_cache_dir', type=str, fallback='')
+    if cacheDir is None or not len(cacheDir):
+        import tempfile
+        cacheDir = os.path.join(tempfile.gettempdir(), 'aide', 'decodedImages')
+    cacheDir = os.path.join(cacheDir, project, f'{int(targetSize[0])}x{int(targetSize[1])}')
+    try:
+        return DecodedImageCache(cacheDir, targetSize, maxSize*1024*1024)
+    except Exception as e:
+        print(f'WARNING: could not initialize decoded image cache (message: "{str(e)}").')
+        return None
+
+
+
+def get_decode_size(config, targetSize):
+    '''
+        Returns the size (width, height) at which the datasets may decode
+        images, i.e. the model input size if reduced-resolution decoding is
+        enabled in section [AIWorker] of the configuration file (off by de-
+        fault, since random clips of a given pixel size would then cover a
+        larger area of the original image), else None.
+    '''
+    if targetSize is None or not config.getProperty('AIWorker', 'reduced_resolution_decoding', type=bool, fallback=False):
+        return None
+    return (int(targetSize[0]), int(targetSize[1]))
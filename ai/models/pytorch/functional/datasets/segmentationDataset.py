@@ -4,11 +4,10 @@
     2020 Benjamin Kellenberger
 '''
 
-from io import BytesIO
-import numpy as np
-import base64
 from PIL import Image
 from torch.utils.data import Dataset
+from util.helpers import base64ToImage
+from .imageCache import load_image
 
 
 class SegmentationDataset(Dataset):
@@ -21,22 +20,29 @@ class SegmentationDataset(Dataset):
                     - images: dict with
                               { <image UUID> : { 'annotations' : { <annotation UUID> : { 'segmentationmask', 'width', 'height' }}}}
                     - 'fVec': optional, contains feature vector bytes for image
-        - fileServer: Instance that implements a 'getFile' function to load images
+        - fileServer: Instance that implements a 'getImage' function to load images
         - labelclassMap: a dictionary/LUT with mapping: key = label class UUID, value = index (number) according
                          to the model.
         - transform: Instance of classes defined in 'ai.models.pytorch.functional.transforms.segmentationMasks'. May be None for no transformation at all.
+        - imageCache: optional instance of 'DecodedImageCache' (see 'imageCache.py') to load decoded and
+                      pre-resized images from. Segmentation masks are resized to the cached images.
+        - targetSize: optional tuple of (width, height) of the model input. If provided, JPEG images are decoded
+                      at the lowest resolution that still covers it (segmentation
+                      masks are resized accordingly).
 
         The '__getitem__' function returns the data entry at given index as a tuple with the following contents:
         - img: the loaded and transformed (if specified) image.
         - segmentationMask: the loaded and transformed (if specified) segmentation mask.
         - imageID: str, filename of the image loaded
     '''
-    def __init__(self, data, fileServer, labelclassMap, transform=None, **kwargs):
+    def __init__(self, data, fileServer, labelclassMap, transform=None, imageCache=None, targetSize=None, **kwargs):
         super(SegmentationDataset, self).__init__()
         self.data = data
         self.fileServer = fileServer
         self.labelclassMap = labelclassMap
         self.transform = transform
+        self.imageCache = imageCache
+        self.targetSize = targetSize
         self.imageOrder = list(self.data['images'].keys())
         self.ignore_unlabeled = (kwargs['ignore_unlabeled'] if 'ignore_unlabeled' in kwargs else True)
 
@@ -44,6 +50,10 @@ class SegmentationDataset(Dataset):
     def __len__(self):
         return len(self.imageOrder)
 
+
+    def get_filename(self, idx):
+        return self.data['images'][self.imageOrder[idx]]['filename']
+
     
     def __getitem__(self, idx):
         imageID = self.imageOrder[idx]
@@ -52,8 +62,7 @@ class SegmentationDataset(Dataset):
         # load image
         imagePath = dataDesc['filename']
         try:
-            img = Image.open(BytesIO(self.fileServer.getFile(imagePath))).convert('RGB')
-            imageSize = img.size
+            img, imageSize = load_image(self.fileServer, imagePath, self.imageCache, self.targetSize)
         except:
             print(f'WARNING: Image "{imagePath}" is corrupt and could not be loaded.')
             img = None
@@ -63,16 +72,17 @@ class SegmentationDataset(Dataset):
         if 'annotations' in dataDesc and len(dataDesc['annotations']):
             annotation = dataDesc['annotations'][0]
             try:
-                width = int(annotation['width'])
-                height = int(annotation['height'])
-                raster = np.frombuffer(base64.b64decode(annotation['segmentationmask']), dtype=np.uint8)
-                raster = np.reshape(raster, (height,width,))
-                segmentationMask = Image.fromarray(raster)
+                segmentationMask = base64ToImage(annotation['segmentationmask'],
+                                                annotation.get('width', None), annotation.get('height', None))
             except:
                 print(f'WARNING: Segmentation mask for image "{imagePath}" could not be loaded or decoded.')
                 segmentationMask = None
         else:
             segmentationMask = None
+
+        if img is not None and segmentationMask is not None and segmentationMask.size != img.size:
+            # image has been loaded at reduced resolution
+            segmentationMask = segmentationMask.resize(img.size, Image.NEAREST)
         
         if self.transform is not None and img is not None:
             img, segmentationMask = self.transform(img, segmentationMask)
@@ -11,14 +11,13 @@
 import numpy as np
 from PIL import Image
 import torch
-from util import helpers
+from .._util.dataLoading import DBCollator
 
 
-class Collator:
+class Collator(DBCollator):
 
     def __init__(self, project, dbConnector):
-        self.project = project
-        self.dbConnector = dbConnector
+        super(Collator, self).__init__(project, dbConnector)
 
 
     def collate(self, batch):
@@ -30,7 +29,7 @@ class Collator:
         for i in range(len(batch)):
             if batch[i][0] is None:
                 # corrupt image
-                helpers.setImageCorrupt(self.dbConnector, self.project, batch[i][3], True)
+                self.setImageCorrupt(batch[i][3])
 
             else:
                 imgs.append(batch[i][0])
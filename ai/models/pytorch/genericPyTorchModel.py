@@ -9,14 +9,94 @@
 '''
 
 import io
+import inspect
+import tempfile
 import torch
 from torch.optim import SGD
 from ai.models import AIModel
-from ai.models.pytorch import parse_transforms
+from ai.models.pytorch import parse_transforms, stateSerialization
+from ai.models.pytorch.stateAveraging import StreamingStateAverager, get_parameter_keys
+from ai.models.pytorch.functional.datasets.imageCache import get_decoded_image_cache, get_decode_size
 from util.helpers import get_class_executable, check_args
 from util import optionsHelper
 
 
+def _open_state_dict(stateDict):
+    '''
+        Returns a readable binary file-like object for a model state provided
+        as bytes or file-like object.
+    '''
+    if isinstance(stateDict, (bytes, bytearray, memoryview)):
+        return io.BytesIO(stateDict)
+    return stateDict
+
+
+def _load_state_dict(stateDict):
+    '''
+        Deserializes a model state (bytes or file-like object) that has been
+        stored in either the compact (see "stateSerialization") or the plain
+        "torch.save" format.
+    '''
+    return stateSerialization.load_state(_open_state_dict(stateDict))
+
+
+def _get_serialization_options(config):
+    return {
+        'compression': config.getProperty('AIWorker', 'model_state_compression', type=str, fallback='none').strip().lower(),
+        'precision': config.getProperty('AIWorker', 'model_state_precision', type=str, fallback='fp32').strip().lower(),
+        'chunked': config.getProperty('AIWorker', 'model_state_chunked', type=bool, fallback=False)
+    }
+
+
+def _serialize_state_dict(config, stateDict, fileObj):
+    options = _get_serialization_options(config)
+    if options['compression'] == 'none' and options['precision'] == 'fp32' and not options['chunked']:
+        # plain format, readable by older versions of AIDE
+        torch.save(stateDict, fileObj)
+    else:
+        stateSerialization.save_state(stateDict, fileObj, **options)
+
+
+def _export_state_dict(config, stateDict):
+    '''
+        Serializes a state dict. Returns bytes if model states are stored in
+        the database, or else a temporary file (kept in memory up to a limit)
+        that can be streamed to the model state store.
+    '''
+    backend = config.getProperty('ModelStateStore', 'backend', type=str, fallback='database').strip().lower()
+    if backend in ('', 'database'):
+        bio = io.BytesIO()
+        _serialize_state_dict(config, stateDict, bio)
+        return bio.getvalue()
+    stream = tempfile.SpooledTemporaryFile(max_size=64*1024*1024)
+    _serialize_state_dict(config, stateDict, stream)
+    stream.seek(0)
+    return stream
+
+
+
+def _average_state_dicts(config, modelClass, stateDicts, updateStateFun, weights=None):
+    '''
+        Averages model states incrementally (see "StreamingStateAverager").
+        The parameters to be averaged are determined from the model of the
+        first state. Returns the serialized average state.
+    '''
+    averager = None
+    numStates = len(stateDicts)
+    for s in range(numStates):
+        stateDict = stateDicts[s]
+        if averager is None:
+            stateDict = _load_state_dict(stateDict)
+            model = modelClass.loadFromStateDict(stateDict)
+            averager = StreamingStateAverager(get_parameter_keys(model))
+            del model
+        averager.add(stateDict, (weights[s] if weights is not None else 1.0))
+        updateStateFun(state='PREPARING', message='averaging models', done=s+1, total=numStates)
+
+    # all done; return state dict as bytes
+    return _export_state_dict(config, averager.result())
+
+
 
 class GenericPyTorchModel(AIModel):
 
@@ -67,9 +147,10 @@ class GenericPyTorchModel(AIModel):
     
     def initializeModel(self, stateDict, data, addMissingLabelClasses=False, removeObsoleteLabelClasses=False):
         '''
-            Converts the provided stateDict from a bytes array to a torch-loadable
-            object and initializes a model from it. Also returns a 'labelClassMap',
-            defining the indexing between label classes and the model.
+            Converts the provided stateDict from a bytes array (or binary file-like
+            object, which is read as a stream) to a torch-loadable object and ini-
+            tializes a model from it. Also returns a 'labelClassMap', defining the
+            indexing between label classes and the model.
             If the stateDict object is None, a new model and labelClassMap are crea-
             ted from the defaults.
 
@@ -82,7 +163,7 @@ class GenericPyTorchModel(AIModel):
         '''
         # initialize model
         if stateDict is not None:
-            stateDict = torch.load(io.BytesIO(stateDict), map_location=lambda storage, loc: storage)
+            stateDict = _load_state_dict(stateDict)
             model = self.model_class.loadFromStateDict(stateDict)
             
             # mapping labelclass (UUID) to index in model (number)
@@ -198,35 +279,26 @@ class GenericPyTorchModel(AIModel):
             Retrieves a state dict from the model (e.g. after training) and converts it
             to a byte array that can be sent back to the AIWorker, and eventually the
             database.
+            If an external model state store is configured, a temporary file
+            is returned instead, which is streamed to the store.
             Also puts the model back on CPU and empties the CUDA cache (if available).
         '''
         if 'cuda' in self.get_device():
             torch.cuda.empty_cache()
         model.cpu()
 
-        bio = io.BytesIO()
-        torch.save(model.getStateDict(), bio)
-
-        return bio.getvalue()
+        return _export_state_dict(self.config, model.getStateDict())
 
     
-    def average_model_states(self, stateDicts, updateStateFun):
+    def average_model_states(self, stateDicts, updateStateFun, weights=None):
         '''
-            Receives a list of model states (as bytes) and calls the model's
-            averaging function to return a single, unified model state.
+            Receives a list of model states (as bytes or file-like objects) and
+            averages the model parameters, weighted by "weights" (e.g. the num-
+            ber of images each AIWorker has trained on; uniform if None).
+            States are folded in one at a time, so that only one of them needs
+            to be in memory at once.
         '''
-
-        # read state dicts from bytes
-        for s in range(len(stateDicts)):
-            stateDict = io.BytesIO(stateDicts[s])
-            stateDicts[s] = torch.load(stateDict, map_location=lambda storage, loc: storage)
-
-        average_states = self.model_class.averageStateDicts(stateDicts)
-
-        # all done; return state dict as bytes
-        bio = io.BytesIO()
-        torch.save(average_states, bio)
-        return bio.getvalue()
+        return _average_state_dicts(self.config, self.model_class, stateDicts, updateStateFun, weights)
 
 
 
@@ -269,6 +341,32 @@ class GenericPyTorchModel_Legacy(AIModel):
             self.dataset_class = None
 
 
+    def get_image_loading_kwargs(self, useCache=True):
+        '''
+            Returns keyword arguments that provide the dataset with the model
+            input size (option "general.image_size") for reduced-resolution
+            decoding and, if "useCache" is True, with a decoded image cache,
+            as far as enabled in the configuration and supported by the
+            dataset class.
+        '''
+        if self.dataset_class is None:
+            return {}
+        try:
+            imageSize = self.options['general']['image_size']
+        except:
+            return {}
+        supportedArgs = inspect.signature(self.dataset_class.__init__).parameters
+        kwargs = {}
+        decodeSize = get_decode_size(self.config, imageSize)
+        if decodeSize is not None and 'targetSize' in supportedArgs:
+            kwargs['targetSize'] = decodeSize
+        if useCache and 'imageCache' in supportedArgs:
+            imageCache = get_decoded_image_cache(self.config, self.project, imageSize)
+            if imageCache is not None:
+                kwargs['imageCache'] = imageCache
+        return kwargs
+
+
     def get_device(self):
         device = self.options['general']['device']
         if 'cuda' in device and not torch.cuda.is_available():
@@ -287,7 +385,7 @@ class GenericPyTorchModel_Legacy(AIModel):
 
         # initialize model
         if stateDict is not None:
-            stateDict = torch.load(io.BytesIO(stateDict), map_location=lambda storage, loc: storage)
+            stateDict = _load_state_dict(stateDict)
             model = self.model_class.loadFromStateDict(stateDict)
             
             # mapping labelclass (UUID) to index in model (number)
@@ -310,32 +408,23 @@ class GenericPyTorchModel_Legacy(AIModel):
             Retrieves a state dict from the model (e.g. after training) and converts it
             to a byte array that can be sent back to the AIWorker, and eventually the
             database.
+            If an external model state store is configured, a temporary file
+            is returned instead, which is streamed to the store.
             Also puts the model back on CPU and empties the CUDA cache (if available).
         '''
         if 'cuda' in self.get_device():
             torch.cuda.empty_cache()
         model.cpu()
 
-        bio = io.BytesIO()
-        torch.save(model.getStateDict(), bio)
-
-        return bio.getvalue()
+        return _export_state_dict(self.config, model.getStateDict())
 
     
-    def average_model_states(self, stateDicts, updateStateFun):
+    def average_model_states(self, stateDicts, updateStateFun, weights=None):
         '''
-            Receives a list of model states (as bytes) and calls the model's
-            averaging function to return a single, unified model state.
+            Receives a list of model states (as bytes or file-like objects) and
+            averages the model parameters, weighted by "weights" (e.g. the num-
+            ber of images each AIWorker has trained on; uniform if None).
+            States are folded in one at a time, so that only one of them needs
+            to be in memory at once.
         '''
-
-        # read state dicts from bytes
-        for s in range(len(stateDicts)):
-            stateDict = io.BytesIO(stateDicts[s])
-            stateDicts[s] = torch.load(stateDict, map_location=lambda storage, loc: storage)
-
-        average_states = self.model_class.averageStateDicts(stateDicts)
-
-        # all done; return state dict as bytes
-        bio = io.BytesIO()
-        torch.save(average_states, bio)
-        return bio.getvalue()
\ No newline at end of file
+        return _average_state_dicts(self.config, self.model_class, stateDicts, updateStateFun, weights)
@@ -11,8 +11,10 @@ from tqdm import tqdm
 from ..genericPyTorchModel import GenericPyTorchModel_Legacy
 from .. import parse_transforms
 from ..functional.classification.collation import Collator
+from ..functional._util.dataLoading import sanitize_kwargs, add_prefetching
 
 from util.helpers import get_class_executable, check_args
+from util.predictionBatch import PredictionBatch, get_label_classes
 
 
 
@@ -39,13 +41,14 @@ class ClassificationModel(GenericPyTorchModel_Legacy):
 
         dataset = self.dataset_class(data, self.fileServer, labelclassMap,
                                 transform, self.options['train']['ignore_unsure'],
+                                **self.get_image_loading_kwargs(),
                                 **self.options['dataset']['kwargs']
                                 )
 
         collator = Collator(self.project, self.dbConnector)
         dataLoader = DataLoader(dataset,
                                 collate_fn=collator.collate,
-                                **self.options['train']['dataLoader']['kwargs']
+                                **add_prefetching(sanitize_kwargs(self.options['train']['dataLoader']['kwargs'], self.get_device()), dataset, self.config)
                                 )
 
         optimizer_class = get_class_executable(self.options['train']['optim']['class'])
@@ -99,18 +102,20 @@ class ClassificationModel(GenericPyTorchModel_Legacy):
 
         dataset = self.dataset_class(data, self.fileServer, labelclassMap,
                                 transform, False,
+                                **self.get_image_loading_kwargs(False),
                                 **self.options['dataset']['kwargs']
                                 )
 
         collator = Collator(self.project, self.dbConnector)
         dataLoader = DataLoader(dataset,
                                 collate_fn=collator.collate,
-                                **self.options['inference']['dataLoader']['kwargs']
+                                **add_prefetching(sanitize_kwargs(self.options['inference']['dataLoader']['kwargs'], self.get_device()), dataset, self.config)
                                 )
 
         # perform inference
         device = self.get_device()
-        response = {}
+        predictions = []
+        labelClasses = get_label_classes(dataset.labelclassMap_inv)
         model.to(device)
         imgCount = 0
         for (img, _, fVec, imgID) in tqdm(dataLoader):
@@ -119,20 +124,15 @@ class ClassificationModel(GenericPyTorchModel_Legacy):
             with torch.no_grad():
                 pred_batch = model(dataItem)
             
-            # append to dict
-            for i in range(len(imgID)):
-                logits = pred_batch[i,:]
-                label = torch.argmax(logits).item()
-                
-                response[imgID[i]] = {
-                    'predictions': [
-                        {
-                            'label': dataset.labelclassMap_inv[label],
-                            'logits': logits.cpu().numpy().tolist(),        #TODO: for AL criterion?
-                            'confidence': torch.max(logits).item()
-                        }
-                    ]
-                }
+            # one prediction per image
+            confidence, label = torch.max(pred_batch, 1)
+            predictions.append(PredictionBatch(imgID,
+                torch.arange(len(imgID)),
+                labelClasses,
+                label=label,
+                logits=pred_batch,
+                confidence=confidence
+            ))
         
             # update worker state
             imgCount += len(imgID)
@@ -142,4 +142,4 @@ class ClassificationModel(GenericPyTorchModel_Legacy):
         if 'cuda' in device:
             torch.cuda.empty_cache()
 
-        return response
\ No newline at end of file
+        return PredictionBatch.concatenate(predictions)
\ No newline at end of file
@@ -24,7 +24,9 @@ DEFAULT_OPTIONS = {
         "dataLoader": {
             "kwargs": {
                 "shuffle": True,
-                "batch_size": 32
+                "batch_size": 32,
+                "num_workers": 0,
+                "pin_memory": False
             }
         },
 		"optim": {
@@ -94,7 +96,9 @@ DEFAULT_OPTIONS = {
 		"dataLoader": {
             "kwargs": {
                 "shuffle": False,
-                "batch_size": 32
+                "batch_size": 32,
+                "num_workers": 0,
+                "pin_memory": False
             }
         }
 	}
@@ -33,8 +33,10 @@ from tqdm import tqdm
 from ..genericPyTorchModel import GenericPyTorchModel_Legacy
 from .. import parse_transforms
 from ..functional._wsodPoints import encoder, collation
+from ..functional._util.dataLoading import sanitize_kwargs, add_prefetching
 
 from util.helpers import get_class_executable, check_args
+from util.predictionBatch import PredictionBatch, get_label_classes
 
 
 class PointModel(GenericPyTorchModel_Legacy):
@@ -65,6 +67,7 @@ class PointModel(GenericPyTorchModel_Legacy):
 
         dataset = self.dataset_class(data, self.fileServer, labelclassMap,
                                 transform, self.options['train']['ignore_unsure'],
+                                **self.get_image_loading_kwargs(),
                                 **self.options['dataset']['kwargs']
                                 )
         
@@ -73,7 +76,7 @@ class PointModel(GenericPyTorchModel_Legacy):
         dataLoader = DataLoader(
             dataset=dataset,
             collate_fn=collator.collate_fn,
-            **self.options['train']['dataLoader']['kwargs']
+            **add_prefetching(sanitize_kwargs(self.options['train']['dataLoader']['kwargs'], self.get_device()), dataset, self.config)
         )
 
         # optimizer
@@ -131,6 +134,7 @@ class PointModel(GenericPyTorchModel_Legacy):
 
         dataset = self.dataset_class(data, self.fileServer, labelclassMap,
                                 transform, False,
+                                **self.get_image_loading_kwargs(False),
                                 **self.options['dataset']['kwargs']
                                 )
 
@@ -139,12 +143,14 @@ class PointModel(GenericPyTorchModel_Legacy):
         dataLoader = DataLoader(
             dataset=dataset,
             collate_fn=collator.collate_fn,
-            **self.options['train']['dataLoader']['kwargs']
+            **add_prefetching(sanitize_kwargs(self.options['inference']['dataLoader']['kwargs'], self.get_device()), dataset, self.config)
         )
         
         # perform inference
         device = self.get_device()
-        response = {}
+        predictions = []
+        labelClasses = get_label_classes(dataset.labelclassMap_inv)
+        decodingOptions = self.options['inference'].get('decoding', {})
         model.to(device)
         imgCount = 0
         for (img, _, _, fVec, imgID) in tqdm(dataLoader):
@@ -153,25 +159,29 @@ class PointModel(GenericPyTorchModel_Legacy):
             with torch.no_grad():
                 pred_batch = model(dataItem)
             
-            # decode and append to dict
+            # decode
+            pred_points, pred_labels, pred_confs, imageIndex = [], [], [], []
             for i in range(len(imgID)):
-                pred_points, pred_labels, pred_confs = dataEncoder.decode(pred_batch[i,...].squeeze(),
-                                                        min_conf=0.1, nms_dist=2)   #TODO
-                
-                predictions = []
-                for p in range(pred_points.size(0)):
-                    predictions.append({
-                        'x': pred_points[p,0].item(),
-                        'y': pred_points[p,1].item(),
-                        'label': dataset.labelclassMap_inv[pred_labels[p].item()],
-                        'logits': pred_confs[p,:].cpu().numpy().tolist(),
-                        'confidence': torch.max(pred_confs[p,:]).item()
-                    })
-            
-            response[imgID[i]] = {
-                'predictions': predictions,
-                #TODO: exception if fVec is not torch tensor: 'fVec': io.BytesIO(fVec.numpy().astype(np.float32)).getvalue()
-            }
+                points, labels, confs = dataEncoder.decode(pred_batch[i,...].squeeze(),
+                                                        min_conf=decodingOptions.get('min_conf', 0.1),
+                                                        nms_dist=decodingOptions.get('nms_dist', 2),
+                                                        top_k=decodingOptions.get('top_k', None))
+                pred_points.append(points.view(-1,2))
+                pred_labels.append(labels.view(-1))
+                pred_confs.append(confs.cpu())
+                imageIndex.append(torch.full((points.size(0),), i, dtype=torch.long))
+            pred_points = torch.cat(pred_points, 0)
+            pred_confs = torch.cat(pred_confs, 0)
+            predictions.append(PredictionBatch(imgID,
+                torch.cat(imageIndex, 0),
+                labelClasses,
+                x=pred_points[:,0],
+                y=pred_points[:,1],
+                label=torch.cat(pred_labels, 0),
+                logits=pred_confs,
+                confidence=pred_confs.max(1)[0]
+            ))
+            #TODO: feature vectors
         
             # update worker state
             imgCount += len(imgID)
@@ -181,4 +191,4 @@ class PointModel(GenericPyTorchModel_Legacy):
         if 'cuda' in device:
             torch.cuda.empty_cache()
 
-        return response
\ No newline at end of file
+        return PredictionBatch.concatenate(predictions)
\ No newline at end of file
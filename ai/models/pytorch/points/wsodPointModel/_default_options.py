@@ -26,7 +26,9 @@ DEFAULT_OPTIONS = {
         "dataLoader": {
             "kwargs": {
                 "shuffle": True,
-                "batch_size": 1
+                "batch_size": 1,
+                "num_workers": 0,
+                "pin_memory": False
             }
         },
 		"optim": {
@@ -132,8 +134,15 @@ DEFAULT_OPTIONS = {
 		"dataLoader": {
             "kwargs": {
                 "shuffle": False,
-                "batch_size": 1
+                "batch_size": 1,
+                "num_workers": 0,
+                "pin_memory": False
             }
-        }
+        },
+		"decoding": {
+			"min_conf": 0.1,
+			"nms_dist": 2,
+			"top_k": None
+		}
 	}
 }
\ No newline at end of file
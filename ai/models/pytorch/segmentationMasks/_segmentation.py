@@ -4,7 +4,8 @@
     2019-20 Benjamin Kellenberger
 '''
 
-import io
+import os
+import numpy as np
 import torch
 import torch.nn.functional as F
 from torch.utils.data import DataLoader
@@ -13,6 +14,7 @@ from tqdm import tqdm
 from ..genericPyTorchModel import GenericPyTorchModel_Legacy
 from .. import parse_transforms
 from ..functional.segmentationMasks.collation import Collator
+from ..functional._util.dataLoading import sanitize_kwargs, add_prefetching
 
 from util.helpers import get_class_executable, check_args
 
@@ -38,8 +40,9 @@ class SegmentationModel(GenericPyTorchModel_Legacy):
 
         # setup transform, data loader, dataset, optimizer, criterion
         transform = parse_transforms(self.options['train']['transform'])
-        dataset_kwargs = self.options['dataset']['kwargs']
+        dataset_kwargs = self.options['dataset']['kwargs'].copy()
         dataset_kwargs['ignore_unlabeled'] = self.ignore_unlabeled
+        dataset_kwargs.update(self.get_image_loading_kwargs())
         dataset = self.dataset_class(data, self.fileServer, labelclassMap,
                                 transform,
                                 **dataset_kwargs
@@ -47,7 +50,7 @@ class SegmentationModel(GenericPyTorchModel_Legacy):
         collator = Collator(self.project, self.dbConnector)
         dataLoader = DataLoader(dataset,
                                 collate_fn=collator.collate,
-                                **self.options['train']['dataLoader']['kwargs']
+                                **add_prefetching(sanitize_kwargs(self.options['train']['dataLoader']['kwargs'], self.get_device()), dataset, self.config)
                                 )
 
         optimizer_class = get_class_executable(self.options['train']['optim']['class'])
@@ -102,8 +105,9 @@ class SegmentationModel(GenericPyTorchModel_Legacy):
 
         # setup transform, data loader, dataset, optimizer, criterion
         transform = parse_transforms(self.options['inference']['transform'])
-        dataset_kwargs = self.options['dataset']['kwargs']
+        dataset_kwargs = self.options['dataset']['kwargs'].copy()
         dataset_kwargs['ignore_unlabeled'] = self.ignore_unlabeled
+        dataset_kwargs.update(self.get_image_loading_kwargs(False))
         dataset = self.dataset_class(data, self.fileServer, labelclassMap,
                                 transform,
                                 **dataset_kwargs
@@ -111,9 +115,14 @@ class SegmentationModel(GenericPyTorchModel_Legacy):
         collator = Collator(self.project, self.dbConnector)
         dataLoader = DataLoader(dataset,
                                 collate_fn=collator.collate,
-                                **self.options['inference']['dataLoader']['kwargs']
+                                **add_prefetching(sanitize_kwargs(self.options['inference']['dataLoader']['kwargs'], self.get_device()), dataset, self.config)
                                 )
 
+        # optional export of the class probabilities
+        logitsDir = self.options['inference'].get('logits_export_dir', None)
+        if logitsDir is not None and len(logitsDir):
+            os.makedirs(logitsDir, exist_ok=True)
+
         # perform inference
         device = self.get_device()
         response = {}
@@ -126,22 +135,37 @@ class SegmentationModel(GenericPyTorchModel_Legacy):
                 pred_batch = model(dataItem)
                 pred_batch = F.softmax(pred_batch, dim=1)
 
-            # scale up to original size
-            pred_batch = F.interpolate(pred_batch, size=imageSizes[0])
-            
+                # per-pixel confidence and label map (at model resolution)
+                if pred_batch.size(1) > 1:
+                    top2 = torch.topk(pred_batch, 2, dim=1)
+                    confidence, label = top2.values[:,0,...], top2.indices[:,0,...]
+                    margin = confidence - top2.values[:,1,...]
+                else:
+                    confidence = pred_batch[:,0,...]
+                    label = torch.zeros_like(confidence, dtype=torch.long)
+                    margin = confidence
+                confidence_mean = confidence.mean(dim=(1,2)).cpu().numpy()
+                margin_mean = margin.mean(dim=(1,2)).cpu().numpy()
+
             # append to dict
             for i in range(len(imgID)):
-                logits = pred_batch[i,...]
-                confidence, label = torch.max(logits, 0)
+                # scale label map up to original size (width, height); nearest neighbor
+                # interpolation yields the same labels as interpolating the probabilities
+                label_i = F.interpolate(label[i:i+1,...].unsqueeze(1).float(),
+                                        size=(int(imageSizes[i][1]), int(imageSizes[i][0])),
+                                        mode='nearest')
                 response[imgID[i]] = {
                     'predictions': [
                         {
-                            'label': label.cpu().numpy(),
-                            'logits': logits.cpu().numpy().tolist(),
-                            'confidence': confidence.cpu().numpy()
+                            'label': label_i[0,0,...].to(torch.uint8).cpu().numpy(),
+                            'confidence': float(confidence_mean[i]),
+                            'margin': float(margin_mean[i]),
+                            'priority': float(1 - margin_mean[i])        # Breaking Ties
                         }
                     ]
                 }
+                if logitsDir is not None and len(logitsDir):
+                    self._export_logits(logitsDir, imgID[i], pred_batch[i,...], imageSizes[i])
         
             # update worker state
             imgCount += len(imgID)
@@ -151,4 +175,19 @@ class SegmentationModel(GenericPyTorchModel_Legacy):
         if 'cuda' in device:
             torch.cuda.empty_cache()
 
-        return response
\ No newline at end of file
+        return response
+
+
+    def _export_logits(self, logitsDir, imageID, logits, imageSize):
+        '''
+            Saves the class probabilities of an image (at model resolution,
+            16-bit floats) into a compressed NumPy file "<image ID>.npz" in the
+            given directory, together with the size (width, height) of the
+            original image.
+        '''
+        try:
+            np.savez_compressed(os.path.join(logitsDir, str(imageID) + '.npz'),
+                                logits=logits.cpu().numpy().astype(np.float16),
+                                size=np.array(imageSize))
+        except Exception as e:
+            print(f'WARNING: could not export logits of image "{imageID}" (message: "{str(e)}").')
\ No newline at end of file
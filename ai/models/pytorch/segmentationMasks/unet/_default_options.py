@@ -29,7 +29,9 @@ DEFAULT_OPTIONS = {
         "dataLoader": {
             "kwargs": {
                 "shuffle": True,
-                "batch_size": 1
+                "batch_size": 1,
+                "num_workers": 0,
+                "pin_memory": False
             }
         },
         "optim": {
@@ -118,8 +120,11 @@ DEFAULT_OPTIONS = {
         "dataLoader": {
             "kwargs": {
                 "shuffle": False,
-                "batch_size": 1
+                "batch_size": 1,
+                "num_workers": 0,
+                "pin_memory": False
             }
-        }
+        },
+        "logits_export_dir": None
     }
 }
\ No newline at end of file
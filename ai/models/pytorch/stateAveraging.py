@@ -0,0 +1,94 @@
+'''
+    Incremental averaging of PyTorch model states.
+
+    Model states are folded in one at a time, so that only the running sums
+    of the averaged parameters and the model state currently being processed
+    need to be kept in memory, regardless of the number of states. States in
+    the chunked layout (see "stateSerialization") are even read tensor by
+    tensor.
+    States can be weighted, e.g. by the number of images each AIWorker has
+    trained on. All tensors that are not averaged (such as buffers, e.g. the
+    running statistics of batch normalization layers), as well as all other
+    entries of the state, are taken from the last state added.
+
+    2020 Benjamin Kellenberger
+'''
+
+from ai.models.pytorch.stateSerialization import StateReader, walk_tensors, set_path
+
+
+def get_parameter_keys(model, prefix=('model_state',)):
+    '''
+        Returns the key paths of the parameters of a model (torch.nn.Module)
+        within a model state.
+    '''
+    return set([prefix + (name,) for name, _ in model.named_parameters()])
+
+
+
+class StreamingStateAverager:
+
+    def __init__(self, parameterKeys=None):
+        '''
+            Inputs:
+            - parameterKeys: set of key paths (tuples of keys) of the tensors
+                             to average (see "get_parameter_keys"). If None,
+                             all floating point tensors are averaged.
+        '''
+        self.parameterKeys = parameterKeys
+        self.sums = {}
+        self.totalWeight = 0.0
+        self.numStates = 0
+        self.baseState = None
+
+
+    def _is_averaged(self, path, tensor):
+        if self.parameterKeys is not None:
+            return path in self.parameterKeys
+        return tensor.is_floating_point()
+
+
+    def add(self, stateDict, weight=1.0):
+        '''
+            Folds a model state into the average. "stateDict" may be bytes, a
+            binary file-like object, or an already deserialized state dict.
+        '''
+        if weight is None or weight <= 0:
+            weight = 1.0
+        if isinstance(stateDict, dict):
+            baseState = stateDict
+            tensors = list(walk_tensors(stateDict))
+        else:
+            reader = StateReader(stateDict)
+            baseState = reader.get_metadata()
+            tensors = reader.iter_tensors()
+
+        for path, tensor in tensors:
+            if not self._is_averaged(path, tensor):
+                set_path(baseState, path, tensor)
+                continue
+            tensor = tensor.detach().cpu()
+            if weight != 1.0:
+                tensor = tensor * weight
+            if path in self.sums:
+                self.sums[path] += tensor
+            else:
+                self.sums[path] = tensor.clone()
+            # release the tensor of this state
+            set_path(baseState, path, None)
+
+        self.baseState = baseState
+        self.totalWeight += weight
+        self.numStates += 1
+
+
+    def result(self):
+        '''
+            Returns the averaged model state, or None if no state has been
+            added.
+        '''
+        if self.baseState is None:
+            return None
+        for path, tensor in self.sums.items():
+            set_path(self.baseState, path, tensor / self.totalWeight)
+        return self.baseState
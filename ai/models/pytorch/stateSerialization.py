@@ -0,0 +1,357 @@
+'''
+    Compact serialization format for PyTorch model states.
+
+    Model states are by default serialized with "torch.save", uncompressed
+    and in full (fp32) precision. This module provides an alternative format
+    with the following options:
+    - compression: "none", "zlib", or "zstd" (requires package "zstandard";
+                   falls back to zlib if unavailable)
+    - precision:   "fp32" (unchanged), "fp16" or "bf16". Floating point
+                   tensors stored in fp32 are converted to the given type
+                   upon saving and restored to fp32 upon loading.
+    - chunked:     if True, every tensor is compressed separately and its
+                   position recorded in the header. Individual tensors can
+                   then be loaded lazily, and all tensors can be iterated one
+                   at a time without deserializing the full model state.
+
+    Layout:
+        MAGIC (8 bytes) | header length (4 bytes, little endian) | header
+        (JSON) | payload
+    For the unchunked layout, the payload is the (compressed) "torch.save"
+    output of the state. For the chunked one, it is the (compressed) "torch.
+    save" output of the state without tensors, followed by one compressed
+    frame of raw bytes per tensor.
+
+    Data without the magic bytes are loaded with "torch.load", so existing
+    model states remain readable.
+
+    2020 Benjamin Kellenberger
+'''
+
+import io
+import json
+import struct
+import zlib
+import numpy as np
+import torch
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'AIDESD\x00\x01'
+
+# storage types for option "precision"
+PRECISION_TYPES = {
+    'fp32': None,
+    'fp16': torch.float16,
+    'bf16': torch.bfloat16
+}
+
+# torch data types of tensors in the chunked layout, by name
+TENSOR_TYPES = {
+    'float64': torch.float64,
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'int64': torch.int64,
+    'int32': torch.int32,
+    'int16': torch.int16,
+    'int8': torch.int8,
+    'uint8': torch.uint8,
+    'bool': torch.bool
+}
+TENSOR_TYPE_NAMES = dict([(v, k) for k, v in TENSOR_TYPES.items()])
+
+
+
+def _compress(data, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    elif compression == 'zlib':
+        return zlib.compress(data, 6)
+    return data
+
+
+def _decompress(data, compression):
+    if compression == 'zstd':
+        if zstandard is None:
+            raise Exception('Package "zstandard" is required to load this model state.')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif compression == 'zlib':
+        return zlib.decompress(data)
+    return data
+
+
+def _resolve_compression(compression):
+    compression = (compression or 'none').lower()
+    if compression == 'zstd' and zstandard is None:
+        print('WARNING: package "zstandard" not found; compressing model state with zlib instead.')
+        compression = 'zlib'
+    if compression not in ('none', 'zlib', 'zstd'):
+        raise ValueError(f'Unsupported compression "{compression}".')
+    return compression
+
+
+def walk_tensors(state, path=()):
+    '''
+        Yields tuples of (key path, tensor) for all tensors within nested dicts
+        with string keys.
+    '''
+    if not isinstance(state, dict):
+        return
+    for key, value in state.items():
+        if not isinstance(key, str):
+            continue
+        if torch.is_tensor(value):
+            yield path + (key,), value
+        elif isinstance(value, dict):
+            yield from walk_tensors(value, path + (key,))
+
+
+def get_path(state, path):
+    for key in path:
+        state = state[key]
+    return state
+
+
+def set_path(state, path, value):
+    for key in path[:-1]:
+        state = state[key]
+    state[path[-1]] = value
+
+
+def _copy_structure(state):
+    # shallow copies of all nested dicts, so that the original state is left untouched
+    if isinstance(state, dict):
+        copy = type(state)() if type(state) is not dict else {}
+        for key, value in state.items():
+            copy[key] = _copy_structure(value)
+        return copy
+    return state
+
+
+def _tensor_to_bytes(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    if tensor.dtype == torch.bfloat16:
+        # no numpy equivalent; store bit pattern
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy().tobytes()
+
+
+def _tensor_from_bytes(data, dtypeName, shape):
+    if dtypeName == 'bfloat16':
+        array = np.frombuffer(data, dtype=np.int16).copy()
+        return torch.from_numpy(array).view(torch.bfloat16).reshape(shape)
+    array = np.frombuffer(data, dtype=torch.empty(0, dtype=TENSOR_TYPES[dtypeName]).numpy().dtype).copy()
+    return torch.from_numpy(array).reshape(shape)
+
+
+
+def save_state(state, fileObj=None, compression='none', precision='fp32', chunked=False):
+    '''
+        Serializes a model state (dict that may contain tensors) into the
+        compact format and writes it to "fileObj" (binary file-like object).
+        If "fileObj" is None, the serialized state is returned as bytes.
+    '''
+    compression = _resolve_compression(compression)
+    precision = (precision or 'fp32').lower()
+    if precision not in PRECISION_TYPES:
+        raise ValueError(f'Unsupported precision "{precision}".')
+    storageType = PRECISION_TYPES[precision]
+
+    state = _copy_structure(state)
+    header = {
+        'compression': compression,
+        'precision': precision,
+        'chunked': bool(chunked),
+        'converted': []
+    }
+
+    # convert precision
+    tensors = []
+    for path, tensor in list(walk_tensors(state)):
+        if storageType is not None and tensor.dtype == torch.float32:
+            tensor = tensor.to(storageType)
+            header['converted'].append(list(path))
+        tensors.append((path, tensor))
+        if not chunked:
+            set_path(state, path, tensor)
+
+    frames = []
+    if chunked:
+        # remove tensors from state and compress them separately
+        header['tensors'] = []
+        offset = 0
+        for path, tensor in tensors:
+            if tensor.dtype not in TENSOR_TYPE_NAMES:
+                # unsupported type; keep in state
+                continue
+            set_path(state, path, None)
+            frame = _compress(_tensor_to_bytes(tensor), compression)
+            header['tensors'].append({
+                'key': list(path),
+                'dtype': TENSOR_TYPE_NAMES[tensor.dtype],
+                'shape': list(tensor.shape),
+                'offset': offset,
+                'length': len(frame)
+            })
+            frames.append(frame)
+            offset += len(frame)
+
+    bio = io.BytesIO()
+    torch.save(state, bio)
+    stateFrame = _compress(bio.getvalue(), compression)
+    header['state_length'] = len(stateFrame)
+    headerBytes = json.dumps(header).encode('utf-8')
+
+    returnBytes = (fileObj is None)
+    if returnBytes:
+        fileObj = io.BytesIO()
+    fileObj.write(MAGIC)
+    fileObj.write(struct.pack('<I', len(headerBytes)))
+    fileObj.write(headerBytes)
+    fileObj.write(stateFrame)
+    for frame in frames:
+        fileObj.write(frame)
+    if returnBytes:
+        return fileObj.getvalue()
+    return fileObj
+
+
+
+class StateReader:
+    '''
+        Reads model states from bytes or binary file-like objects, in the
+        compact format or in plain "torch.save" format (legacy).
+        For the chunked layout, tensors can be iterated one at a time (see
+        "iter_tensors") or loaded individually (see "get_tensor"; requires
+        a seekable file-like object).
+    '''
+
+    def __init__(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = io.BytesIO(data)
+        self.stream = data
+        self.header = None
+        self.state = None
+        self.legacy = False
+        self.chunked = False
+        self.converted = set()
+        self._tensorIndex = {}
+
+        start = self.stream.read(len(MAGIC))
+        if start != MAGIC:
+            # legacy format: load in full
+            self.legacy = True
+            rest = self.stream.read()
+            self.state = torch.load(io.BytesIO(start + rest), map_location=lambda storage, loc: storage)
+            return
+
+        headerLength = struct.unpack('<I', self.stream.read(4))[0]
+        self.header = json.loads(self.stream.read(headerLength).decode('utf-8'))
+        self.compression = self.header['compression']
+        self.converted = set([tuple(c) for c in self.header.get('converted', [])])
+        self.chunked = self.header.get('chunked', False)
+
+        stateFrame = _decompress(self.stream.read(self.header['state_length']), self.compression)
+        self.state = torch.load(io.BytesIO(stateFrame), map_location=lambda storage, loc: storage)
+        if self.chunked:
+            try:
+                self.payloadStart = self.stream.tell()
+            except Exception:
+                self.payloadStart = None
+            for entry in self.header['tensors']:
+                self._tensorIndex[tuple(entry['key'])] = entry
+        else:
+            self._restore_precision(self.state)
+        self._nextOffset = 0
+
+
+    def _restore(self, path, tensor):
+        if path in self.converted:
+            tensor = tensor.to(torch.float32)
+        return tensor
+
+
+    def _restore_precision(self, state):
+        for path in self.converted:
+            set_path(state, path, get_path(state, path).to(torch.float32))
+
+
+    def _read_tensor(self, entry):
+        frame = _decompress(self.stream.read(entry['length']), self.compression)
+        self._nextOffset = entry['offset'] + entry['length']
+        path = tuple(entry['key'])
+        return path, self._restore(path, _tensor_from_bytes(frame, entry['dtype'], entry['shape']))
+
+
+    def keys(self):
+        '''
+            Returns the key paths of all tensors in the state.
+        '''
+        if self.chunked:
+            return list(self._tensorIndex.keys())
+        return [path for path, _ in walk_tensors(self.state)]
+
+
+    def get_tensor(self, path):
+        '''
+            Loads the tensor at given key path (tuple of keys).
+        '''
+        path = tuple(path)
+        if not self.chunked:
+            return get_path(self.state, path)
+        entry = self._tensorIndex[path]
+        if entry['offset'] != self._nextOffset:
+            if self.payloadStart is None:
+                raise Exception('Random access to tensors requires a seekable stream.')
+            self.stream.seek(self.payloadStart + entry['offset'])
+        return self._read_tensor(entry)[1]
+
+
+    def iter_tensors(self):
+        '''
+            Yields tuples of (key path, tensor) for all tensors in the state.
+            For the chunked layout, tensors are read sequentially one at a
+            time.
+        '''
+        if not self.chunked:
+            yield from list(walk_tensors(self.state))
+            return
+        for entry in self.header['tensors']:
+            if entry['offset'] != self._nextOffset:
+                if self.payloadStart is None:
+                    raise Exception('Tensors have been accessed out of order on a non-seekable stream.')
+                self.stream.seek(self.payloadStart + entry['offset'])
+            yield self._read_tensor(entry)
+
+
+    def get_metadata(self):
+        '''
+            Returns the state without the tensors of the chunked layout (their
+            entries are None), resp. the full state otherwise.
+        '''
+        return self.state
+
+
+    def load(self):
+        '''
+            Returns the full state, with all tensors loaded.
+        '''
+        if not self.chunked:
+            return self.state
+        state = _copy_structure(self.state)
+        for path, tensor in self.iter_tensors():
+            set_path(state, path, tensor)
+        return state
+
+
+
+def load_state(data):
+    '''
+        Loads a full model state from bytes or a binary file-like object, in
+        the compact or the legacy ("torch.save") format.
+    '''
+    return StateReader(data).load()
@@ -27,6 +27,12 @@ if not 'AIDE_MODULES' in os.environ:
     raise ValueError('Missing system environment variable "AIDE_MODULES".')
 config = Config()
 
+# AIWorker processes are recycled after every task unless warm workers are enabled
+warmWorkers = config.getProperty('AIWorker', 'warm_workers', type=bool, fallback=False)
+maxTasksPerChild = (None if warmWorkers else 1)
+maxMemoryPerChild = config.getProperty('AIWorker', 'max_memory_per_child', type=int, fallback=0)
+maxMemoryPerChild = (maxMemoryPerChild * 1024 if warmWorkers and maxMemoryPerChild > 0 else None)
+
 
 # parse AIDE modules and set up queues
 queues = []
@@ -61,7 +67,8 @@ app.conf.update(
     task_track_started = True,
     broker_pool_limit=None,                 # required to avoid peer connection resets
     broker_heartbeat = 0,                   # required to avoid peer connection resets
-    worker_max_tasks_per_child = 1,         # required to free memory (also CUDA) after each process
+    worker_max_tasks_per_child = maxTasksPerChild,      # 1 (default) is required to free memory (also CUDA) after each process
+    worker_max_memory_per_child = maxMemoryPerChild,    # warm workers: recycle processes exceeding memory limit (KiB)
     task_default_rate_limit = 3,            #TODO
     worker_prefetch_multiplier = 1,         #TODO
     task_acks_late = True,
@@ -80,6 +87,14 @@ app.conf.update(
             'queue': 'AIController',
             'routing_key': 'get_inference_images'
         },
+        'AIController.prediction_retention': {
+            'queue': 'AIController',
+            'routing_key': 'prediction_retention'
+        },
+        'AIController.apply_prediction_retention': {
+            'queue': 'AIController',
+            'routing_key': 'apply_prediction_retention'
+        },
         'AIWorker.call_train': {
             'queue': 'AIWorker',
             'routing_key': 'call_train'
@@ -115,6 +130,10 @@ app.conf.update(
         'DataAdministration.watch_image_folders': {
             'queue': 'FileServer',
             'routing_key': 'watch_image_folders'
+        },
+        'DataAdministration.watch_project_folder': {
+            'queue': 'FileServer',
+            'routing_key': 'watch_project_folder'
         }
     }
     #task_default_queue = Broadcast('aide_admin')
@@ -128,6 +147,13 @@ num_modules = 0
 if 'aicontroller' in aideModules:
     from modules.AIController.backend import celery_interface as aic_int
     num_modules += 1
+
+    # applying prediction retention policies: set up periodic task
+    retentionInterval = config.getProperty('AIController', 'prediction_retention_interval', type=float, fallback=86400)
+    if retentionInterval > 0:
+        @app.on_after_configure.connect
+        def setup_retention_tasks(sender, **kwargs):
+            sender.add_periodic_task(retentionInterval, aic_int.predictionRetention.s())
 if 'aiworker' in aideModules:
     from modules.AIWorker.backend import celery_interface as aiw_int
     num_modules += 1
@@ -3,9 +3,17 @@
 # Launches a Celery consumer on the current machine.
 # Requires pwd to be the root of the project and the correct Python
 # env to be loaded.
+# Celery beat (the scheduler of periodic tasks) is enabled if the
+# machine runs the FileServer with folder watching, or the AIController
+# with prediction retention policies enabled. Since every beat instance
+# schedules the tasks anew, this should be the case on one machine only.
 #
 # 2019-20 Benjamin Kellenberger
 
+function is_positive {
+    awk -v value="$1" 'BEGIN { exit !(value + 0 > 0) }';
+}
+
 launchCeleryBeat=false
 
 IFS=',' read -ra ADDR <<< "$AIDE_MODULES"
@@ -13,18 +21,23 @@ for i in "${ADDR[@]}"; do
     module="$(echo "$i" | tr '[:upper:]' '[:lower:]')";
     if [ "$module" == "fileserver" ]; then
         folderWatchInterval=$(python util/configDef.py --section=FileServer --parameter=watch_folder_interval --fallback=60);
-        if [ $folderWatchInterval -gt 0 ]; then
+        if is_positive "$folderWatchInterval"; then
+            launchCeleryBeat=true;
+        fi
+    elif [ "$module" == "aicontroller" ]; then
+        retentionInterval=$(python util/configDef.py --section=AIController --parameter=prediction_retention_interval --fallback=86400);
+        if is_positive "$retentionInterval"; then
             launchCeleryBeat=true;
         fi
     fi
 done
 
 
-if [ $launchCeleryBeat ]; then
-    # folder watching interval specified; enable Celery beat
+if [ "$launchCeleryBeat" == true ]; then
+    # periodic tasks specified; enable Celery beat
 	tempDir="$(python util/configDef.py --section=FileServer --parameter=tempfiles_dir --fallback=/tmp)/aide/celery/";
     mkdir -p $tempDir;
-    celery -A celery_worker worker -B -s $tempDir --hostname aide@%h
+    celery -A celery_worker worker -B -s ${tempDir}celerybeat-schedule --hostname aide@%h
 else
 	celery -A celery_worker worker --hostname aide@%h
-fi
\ No newline at end of file
+fi
@@ -6,7 +6,7 @@
 '''
 
 import os
-from celery import current_app
+from celery import current_app, group
 # from modules.AIController.backend.middleware import AIMiddleware
 from modules.AIController.backend.functional import AIControllerWorker
 from util.configDef import Config
@@ -33,4 +33,18 @@ def get_training_images(blank, project, epoch, numEpochs, minTimestamp='lastStat
 
 @current_app.task(name='AIController.get_inference_images')
 def get_inference_images(blank, project, epoch, numEpochs, goldenQuestionsOnly=False, forceUnlabeled=False, maxNumImages=None, numWorkers=1):
-    return aim.get_inference_images(project, epoch, numEpochs, goldenQuestionsOnly, forceUnlabeled, maxNumImages, numWorkers)
\ No newline at end of file
+    return aim.get_inference_images(project, epoch, numEpochs, goldenQuestionsOnly, forceUnlabeled, maxNumImages, numWorkers)
+
+
+@current_app.task(name='AIController.apply_prediction_retention')
+def applyPredictionRetention(project):
+    return aim.apply_prediction_retention(project)
+
+
+@current_app.task(name='AIController.prediction_retention', rate_limit=1)
+def predictionRetention():
+    # distribute projects across AIController workers
+    projects = aim.get_prediction_retention_projects()
+    if len(projects):
+        group([applyPredictionRetention.si(p) for p in projects]).apply_async(queue='AIController')
+    return len(projects)
@@ -10,6 +10,7 @@ from datetime import datetime
 from psycopg2 import sql
 from modules.Database.app import Database
 from util.helpers import array_split
+from util import predictionRetention
 from .sql_string_builder import SQLStringBuilder
 
 
@@ -173,4 +174,74 @@ class AIControllerWorker:
                 imageIDs = array_split(imageIDs, max(1, len(imageIDs) // numChunks))
             else:
                 imageIDs = [imageIDs]
-            return imageIDs
\ No newline at end of file
+            return imageIDs
+
+
+
+    def get_prediction_retention_projects(self):
+        '''
+            Returns the shortnames of all projects that have a prediction re-
+            tention policy or partitioning of their predictions enabled.
+        '''
+        projects = self.dbConn.execute('''
+                SELECT shortname
+                FROM aide_admin.project
+                WHERE prediction_retention_num_states > 0
+                OR prediction_partitioning_enabled IS TRUE;
+            ''', None, 'all')
+        if projects is None:
+            return []
+        return [p['shortname'] for p in projects]
+
+
+
+    def apply_prediction_retention(self, project):
+        '''
+            Applies the project's prediction retention policy: partitions the
+            "prediction" table by model state if enabled (and creates missing
+            partitions), then keeps the predictions of the latest model states
+            only, summarizing older ones if enabled. Returns statistics about
+            the removed predictions.
+        '''
+        settings = self.dbConn.execute('''
+                SELECT prediction_retention_num_states, prediction_retention_summarize,
+                    prediction_partitioning_enabled
+                FROM aide_admin.project
+                WHERE shortname = %s;
+            ''', (project,), 1)
+        if settings is None or not len(settings):
+            return None
+        settings = settings[0]
+        numStates = settings['prediction_retention_num_states']
+
+        if settings['prediction_partitioning_enabled']:
+            if not predictionRetention.is_partitioned(self.dbConn, project):
+                print(f'[{project}] Partitioning predictions by model state...')
+                if not predictionRetention.partition_table(self.dbConn, project):
+                    print(f'[{project}] WARNING: predictions could not be partitioned.')
+
+            # partitions for the retained model states
+            queryStr = sql.SQL('''
+                SELECT id FROM {id_cnnstate}
+                WHERE partial IS FALSE
+                ORDER BY timeCreated DESC
+                {limit};
+            ''').format(
+                id_cnnstate=sql.Identifier(project, 'cnnstate'),
+                limit=(sql.SQL('LIMIT %s') if numStates is not None and numStates > 0 else sql.SQL(''))
+            )
+            stateIDs = self.dbConn.execute(queryStr,
+                ((numStates,) if numStates is not None and numStates > 0 else None), 'all')
+            if stateIDs is not None:
+                partitions = predictionRetention.get_partitions(self.dbConn, project)
+                for s in stateIDs:
+                    if predictionRetention.get_partition_name(s['id']) not in partitions:
+                        predictionRetention.create_partition(self.dbConn, project, s['id'])
+
+        stats = predictionRetention.apply_retention(self.dbConn, project, numStates,
+                    settings['prediction_retention_summarize'])
+        if stats['num_states']:
+            print(f'[{project}] Removed predictions of {stats["num_states"]} old model state(s) ' + \
+                f'({stats["num_deleted"]} deleted, {stats["num_partitions_dropped"]} partition(s) dropped, ' + \
+                f'{stats["num_summarized"]} image summaries added).')
+        return stats
@@ -2,15 +2,24 @@
     2019-20 Benjamin Kellenberger
 '''
 
+import os
+import sys
+import gc
 import inspect
 import json
+import hashlib
+import tempfile
+from collections import OrderedDict
 from psycopg2 import sql
 from celery import current_app
 from kombu import Queue
 from modules.AIWorker.backend.worker import functional
 from modules.AIWorker.backend import fileserver
+from modules.AIWorker.backend.modelStateCache import ModelStateCache
 from modules.Database.app import Database
 from util.helpers import get_class_executable
+from util.modelStateStore import get_model_state_store
+from util import maskCodec
 
 
 class AIWorker():
@@ -20,6 +29,12 @@ class AIWorker():
         self.dbConnector = Database(config)
         self.passiveMode = passiveMode
         self._init_fileserver()
+        self._init_model_state_cache()
+
+        # cache of model and AL criterion instances (only for warm workers)
+        self.warmWorkers = self.config.getProperty('AIWorker', 'warm_workers', type=bool, fallback=False)
+        self.instanceCacheSize = (self.config.getProperty('AIWorker', 'model_cache_size', type=int, fallback=2) if self.warmWorkers else 0)
+        self.instanceCache = OrderedDict()
             
 
     def _init_fileserver(self):
@@ -31,6 +46,21 @@ class AIWorker():
         self.fileServer = fileserver.FileServer(self.config)
 
 
+    def _init_model_state_cache(self):
+        '''
+            Sets up the local disk cache of model states, which avoids loading
+            the same states from the database over and over again.
+        '''
+        cacheDir = self.config.getProperty('AIWorker', 'model_state_cache_dir', type=str, fallback=None)
+        if cacheDir is None or not len(cacheDir):
+            cacheDir = os.path.join(tempfile.gettempdir(), 'aide/modelStates')
+        cacheSize = self.config.getProperty('AIWorker', 'model_state_cache_size', type=int, fallback=0)
+        self.modelStateCache = ModelStateCache(cacheDir, cacheSize * 1024 * 1024)
+
+        # external store of model states (None if stored in database)
+        self.modelStateStore = get_model_state_store(self.config)
+
+
     def _init_model_instance(self, project, modelLibrary, modelSettings):
 
         # try to parse model settings
@@ -55,6 +85,9 @@ class AIWorker():
             'average_model_states' : ['stateDicts', 'updateStateFun'],
             'inference' : ['stateDict', 'data', 'updateStateFun']
         }
+        optionalArguments = {
+            'average_model_states': ['weights']
+        }
         functionNames = [func for func in dir(modelClass) if callable(getattr(modelClass, func))]
 
         for key in requiredFunctions:
@@ -67,7 +100,7 @@ class AIWorker():
                 if not arg in funArgs.args:
                     raise Exception('Method {} of class {} is missing required argument {}.'.format(modelLibrary, key, arg))
             for arg in funArgs.args:
-                if arg != 'self' and not arg in requiredFunctions[key]:
+                if arg != 'self' and not arg in requiredFunctions[key] and not arg in optionalArguments.get(key, []):
                     raise Exception('Unsupported argument {} of method {} in class {}.'.format(arg, key, modelLibrary))
 
         # create AI model instance
@@ -125,11 +158,54 @@ class AIWorker():
                             options=alSettings)
 
 
+    def _get_cached_instance(self, key, initFun, *args):
+        '''
+            Returns the instance stored under "key" in the LRU instance
+            cache, or creates it by calling "initFun" with the given argu-
+            ments. The least recently used instances are evicted if the
+            cache exceeds "model_cache_size" entries. Without warm workers,
+            instances are created anew upon every call.
+        '''
+        if self.instanceCacheSize <= 0:
+            return initFun(*args)
+
+        if key in self.instanceCache:
+            self.instanceCache.move_to_end(key)
+            return self.instanceCache[key]
+
+        instance = initFun(*args)
+        self.instanceCache[key] = instance
+        while len(self.instanceCache) > self.instanceCacheSize:
+            self.instanceCache.popitem(last=False)
+        return instance
+
+
+    @staticmethod
+    def _settings_hash(library, settings):
+        return hashlib.sha1('{}\n{}'.format(library, settings).encode('utf-8')).hexdigest()
+
+
+    def _release_memory(self):
+        '''
+            Frees memory of objects that are no longer referenced after a task,
+            including cached GPU memory if PyTorch is in use, so that warm
+            worker processes do not accumulate memory over tasks.
+        '''
+        if not self.warmWorkers:
+            return
+        gc.collect()
+        if 'torch' in sys.modules:
+            torch = sys.modules['torch']
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
     def _get_model_instance(self, project):
         '''
             Returns the class instance of the model specified in the given
-            project.
-            TODO: cache models?
+            project. Instances are cached by project and hash of the model
+            library and settings in warm worker mode, so that changes to the
+            project's model settings automatically yield a new instance.
         '''
         # get model settings for project
         queryStr = '''
@@ -140,17 +216,17 @@ class AIWorker():
         modelLibrary = result[0]['ai_model_library']
         modelSettings = result[0]['ai_model_settings']
 
-        # create new model instance
-        modelInstance = self._init_model_instance(project, modelLibrary, modelSettings)
-
-        return modelInstance
+        # get (or create new) model instance
+        key = ('model', project, self._settings_hash(modelLibrary, modelSettings))
+        return self._get_cached_instance(key, self._init_model_instance,
+                                        project, modelLibrary, modelSettings)
 
 
     def _get_alCriterion_instance(self, project):
         '''
             Returns the class instance of the Active Learning model
-            specified in the project.
-            TODO: cache models?
+            specified in the project. Cached like the model instances
+            (see "_get_model_instance").
         '''
         # get model settings for project
         queryStr = '''
@@ -161,10 +237,10 @@ class AIWorker():
         modelLibrary = result[0]['ai_alcriterion_library']
         modelSettings = result[0]['ai_alcriterion_settings']
 
-        # create new model instance
-        modelInstance = self._init_alCriterion_instance(project, modelLibrary, modelSettings)
-
-        return modelInstance
+        # get (or create new) AL criterion instance
+        key = ('alCriterion', project, self._settings_hash(modelLibrary, modelSettings))
+        return self._get_cached_instance(key, self._init_alCriterion_instance,
+                                        project, modelLibrary, modelSettings)
 
 
 
@@ -184,8 +260,11 @@ class AIWorker():
         # get project-specific model
         modelInstance = self._get_model_instance(project)
 
-        return functional._call_train(project, data, epoch, numEpochs, subset, getattr(modelInstance, 'train'),
-                self.dbConnector, self.fileServer)
+        try:
+            return functional._call_train(project, data, epoch, numEpochs, subset, getattr(modelInstance, 'train'),
+                    self.dbConnector, self.fileServer, self.modelStateCache, self.modelStateStore)
+        finally:
+            self._release_memory()
     
 
 
@@ -194,8 +273,11 @@ class AIWorker():
         # get project-specific model
         modelInstance = self._get_model_instance(project)
         
-        return functional._call_average_model_states(project, epoch, numEpochs, getattr(modelInstance, 'average_model_states'),
-                self.dbConnector, self.fileServer)
+        try:
+            return functional._call_average_model_states(project, epoch, numEpochs, getattr(modelInstance, 'average_model_states'),
+                    self.dbConnector, self.fileServer, self.modelStateCache, self.modelStateStore)
+        finally:
+            self._release_memory()
 
 
 
@@ -205,11 +287,17 @@ class AIWorker():
         modelInstance = self._get_model_instance(project)
         alCriterionInstance = self._get_alCriterion_instance(project)
 
-        return functional._call_inference(project, imageIDs, epoch, numEpochs,
-                getattr(modelInstance, 'inference'),
-                getattr(alCriterionInstance, 'rank'),
-                self.dbConnector, self.fileServer,
-                self.config.getProperty('AIWorker', 'inference_batch_size_limit', type=int, fallback=-1))
+        try:
+            return functional._call_inference(project, imageIDs, epoch, numEpochs,
+                    getattr(modelInstance, 'inference'),
+                    getattr(alCriterionInstance, 'rank'),
+                    self.dbConnector, self.fileServer,
+                    self.config.getProperty('AIWorker', 'inference_batch_size_limit', type=int, fallback=-1),
+                    self.modelStateCache, self.modelStateStore,
+                    self.config.getProperty('AIWorker', 'inference_write_queue_size', type=int, fallback=2),
+                    maskCodec.get_codec(self.config))
+        finally:
+            self._release_memory()
 
 
 
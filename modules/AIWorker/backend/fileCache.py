@@ -0,0 +1,282 @@
+'''
+    Local on-disk cache of files (e.g. images) that AIWorkers retrieve from a
+    remote FileServer instance.
+    Unlike model states, files on the FileServer may be replaced at any time.
+    Every cached file is therefore stored together with the validators sent
+    by the server ("ETag" and "Last-Modified" headers), with which the file
+    is revalidated by a conditional request (answered with status 304 if it
+    is unchanged) instead of being downloaded again. Files that have been
+    validated less than a configurable number of seconds ago are served
+    without contacting the server at all.
+
+    The cache is shared between processes (e.g. data loader workers) and
+    limited in total size, with the least recently used files being evicted
+    first. The total size is kept up-to-date in a small SQLite database in
+    the cache directory, so that the cache directory only needs to be scanned
+    for eviction once the limit is exceeded. The cache is then reduced to a
+    fraction of the limit, so that this happens only every so often.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import glob
+import json
+import time
+import hashlib
+import sqlite3
+from uuid import uuid4
+from threading import Lock
+
+
+class RemoteFileCache:
+
+    # name of the database with the total size of the cache
+    INDEX_NAME = 'index.sqlite'
+
+    # fraction of the maximum size the cache is reduced to upon eviction
+    EVICTION_TARGET = 0.9
+
+
+    def __init__(self, cacheDir, maxSize, maxAge=0):
+        '''
+            Inputs:
+            - cacheDir: directory on the local disk to store files in
+            - maxSize:  maximum total size of the cached files in bytes. The
+                        cache is disabled if zero or negative.
+            - maxAge:   number of seconds after a validation during which a
+                        cached file is considered up-to-date without re-
+                        validating it with the server
+        '''
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.enabled():
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+
+    def enabled(self):
+        return self.maxSize > 0
+
+
+    def _get_paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        baseName = os.path.join(self.cacheDir, key[:2], key)
+        return baseName + '.bin', baseName + '.json'
+
+
+    def _remove(self, url=None, paths=None):
+        if paths is None:
+            paths = self._get_paths(url)
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def get_metadata(self, url):
+        '''
+            Returns the metadata (dict with validators "etag" and "last_modi-
+            fied", and time of last validation "validated") of the cached file
+            for the given URL, or None if the file is not cached.
+        '''
+        if not self.enabled():
+            return None
+        filePath, metaPath = self._get_paths(url)
+        try:
+            with open(metaPath, 'r') as f:
+                meta = json.load(f)
+            if meta.get('url') != url or os.path.getsize(filePath) != meta.get('size'):
+                raise Exception('invalid entry')
+            return meta
+        except Exception:
+            self._remove(url)
+            return None
+
+
+    def is_fresh(self, meta):
+        '''
+            Returns True if the cached file does not need to be revalidated.
+        '''
+        return meta is not None and self.maxAge > 0 and \
+            time.time() - meta.get('validated', 0) < self.maxAge
+
+
+    def get(self, url, revalidated=False):
+        '''
+            Returns the bytes of the cached file for the given URL, or None if
+            it is not cached. If "revalidated" is True, the time of the last
+            validation is updated (the server responded with status 304).
+        '''
+        if not self.enabled():
+            return None
+        filePath, metaPath = self._get_paths(url)
+        try:
+            with open(filePath, 'rb') as f:
+                bytea = f.read()
+            if revalidated:
+                meta = self.get_metadata(url)
+                if meta is not None:
+                    meta['validated'] = time.time()
+                    self._write_metadata(metaPath, meta)
+
+            # mark as recently used
+            os.utime(filePath)
+            self.hits += 1
+            return bytea
+
+        except Exception:
+            self._remove(url)
+            self.misses += 1
+            return None
+
+
+    def _write_metadata(self, metaPath, meta):
+        tempPath = metaPath + '.' + str(uuid4()) + '.tmp'
+        with open(tempPath, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tempPath, metaPath)
+
+
+    def put(self, url, bytea, etag=None, lastModified=None):
+        '''
+            Stores a file (bytes) in the cache and evicts the least recently
+            used files if the cache exceeds its maximum size. The file is only
+            kept if the server provided a validator ("etag" or "lastModified").
+            Files are written under a temporary name first and then renamed,
+            so that concurrent readers never see incomplete files.
+        '''
+        if not self.enabled() or bytea is None or (etag is None and lastModified is None):
+            return
+        self.misses += 1
+        if len(bytea) > self.maxSize:
+            return
+        filePath, metaPath = self._get_paths(url)
+        os.makedirs(os.path.dirname(filePath), exist_ok=True)
+        tempPath = filePath + '.' + str(uuid4()) + '.tmp'
+        try:
+            with open(tempPath, 'wb') as f:
+                f.write(bytea)
+            try:
+                # file replaces a previous version
+                oldSize = os.path.getsize(filePath)
+            except OSError:
+                oldSize = 0
+            # remove outdated metadata first, so that it never refers to the new file
+            self._remove(paths=(metaPath,))
+            os.replace(tempPath, filePath)
+            self._write_metadata(metaPath, {
+                'url': url,
+                'etag': etag,
+                'last_modified': lastModified,
+                'size': len(bytea),
+                'validated': time.time()
+            })
+        except Exception as e:
+            print(f'WARNING: could not cache file "{url}" (reason: {str(e)}).')
+            if os.path.isfile(tempPath):
+                os.remove(tempPath)
+            return
+        try:
+            self._update_size(len(bytea) - oldSize)
+        except Exception as e:
+            print(f'WARNING: could not update size of file cache (reason: {str(e)}).')
+
+
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.cacheDir, self.INDEX_NAME), timeout=60, isolation_level=None)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS cache_size (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total INTEGER NOT NULL
+            );
+        ''')
+        return conn
+
+
+    def _update_size(self, delta):
+        '''
+            Adds "delta" bytes to the total size of the cache and evicts the
+            least recently used files if it exceeds the limit. The total is
+            determined from the files in the cache directory upon first use
+            and after every eviction, which corrects for files removed other-
+            wise (e.g. corrupt ones).
+        '''
+        conn = self._connect()
+        try:
+            # lock database for writing: only one process at a time may evict
+            conn.execute('BEGIN IMMEDIATE;')
+            try:
+                row = conn.execute('SELECT total FROM cache_size WHERE id = 0;').fetchone()
+                if row is None:
+                    totalSize = sum([size for _, size, _ in self._scan()])
+                else:
+                    totalSize = row[0] + delta
+                if totalSize > self.maxSize:
+                    totalSize = self._evict()
+                conn.execute('INSERT OR REPLACE INTO cache_size (id, total) VALUES (0, ?);', (totalSize,))
+                conn.execute('COMMIT;')
+            except Exception:
+                conn.execute('ROLLBACK;')
+                raise
+        finally:
+            conn.close()
+
+
+    def _scan(self):
+        '''
+            Returns a list of tuples (time of last use, size, path) of all
+            files in the cache.
+        '''
+        entries = []
+        for filePath in glob.glob(os.path.join(self.cacheDir, '*', '*.bin')):
+            try:
+                stat = os.stat(filePath)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filePath))
+        return entries
+
+
+    def _evict(self):
+        '''
+            Removes the least recently used files until the total size of the
+            cache is within a fraction of the limit (see "EVICTION_TARGET").
+            Returns the total size of the remaining files.
+        '''
+        with self.lock:
+            entries = self._scan()
+            totalSize = sum([size for _, size, _ in entries])
+            targetSize = self.maxSize * self.EVICTION_TARGET
+            entries.sort()
+            for _, size, filePath in entries:
+                if totalSize <= targetSize:
+                    break
+                self._remove(paths=(filePath, os.path.splitext(filePath)[0] + '.json'))
+                totalSize -= size
+            return totalSize
+
+
+    def get_stats(self):
+        '''
+            Returns the number of cache hits and misses of this instance.
+        '''
+        return {
+            'hits': self.hits,
+            'misses': self.misses
+        }
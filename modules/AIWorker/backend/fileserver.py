@@ -5,15 +5,29 @@
     frontend.
     An instance of this FileServer class may be provided to the AIModel instead,
     and serves as a gateway to the project's actual file server.
+    Files of a remote FileServer are retrieved through a pool of keep-alive
+    connections (with retries upon connection errors) and can be cached on the
+    local disk (see "fileCache"), as well as prefetched in the background.
 
     2019-20 Benjamin Kellenberger
 '''
 
 import os
+import tempfile
+from io import BytesIO
+from threading import RLock
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from urllib import request
-from urllib.error import HTTPError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
+from modules.AIWorker.backend.fileCache import RemoteFileCache
 from util.helpers import is_localhost
+from util.imageSharding import ImageCache, parse_virtual_filename
+
+
+# size of the chunks in which files are read from a remote FileServer
+CHUNK_SIZE = 1024*1024
 
 
 class FileServer:
@@ -31,7 +45,88 @@ class FileServer:
         
         else:
             self.baseURI = self.config.getProperty('Server', 'dataServer_uri')
-            
+
+        # cache of decoded parent images to crop virtual patches from
+        self.imageCache = ImageCache(self.config.getProperty('AIWorker', 'virtual_image_cache_size', type=int, fallback=512)*1024*1024)
+
+        # connection pool and local disk cache for files of a remote FileServer
+        self.poolSize = max(1, self.config.getProperty('AIWorker', 'file_pool_size', type=int, fallback=8))
+        self.numRetries = max(0, self.config.getProperty('AIWorker', 'file_request_retries', type=int, fallback=3))
+        self.timeout = self.config.getProperty('AIWorker', 'file_request_timeout', type=float, fallback=60.0)
+        self.fileCache = self._init_file_cache()
+        self._session = None
+        self._executor = None
+        self._pending = {}
+        self._lock = RLock()
+        self._pid = os.getpid()
+
+
+    def __getstate__(self):
+        # connections, threads and locks cannot be pickled; they are re-created upon use
+        state = self.__dict__.copy()
+        state['_session'] = None
+        state['_executor'] = None
+        state['_pending'] = {}
+        del state['_lock']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = RLock()
+        self._pid = os.getpid()
+
+
+    def _init_file_cache(self):
+        '''
+            Sets up the local disk cache for files of a remote FileServer. The
+            cache is disabled if the FileServer runs on the same instance.
+        '''
+        cacheSize = self.config.getProperty('AIWorker', 'file_cache_size', type=int, fallback=0)
+        if self.isLocal or cacheSize is None:
+            cacheSize = 0
+        cacheDir = self.config.getProperty('AIWorker', 'file_cache_dir', type=str, fallback='')
+        if cacheDir is None or not len(cacheDir):
+            cacheDir = os.path.join(tempfile.gettempdir(), 'aide/files')
+        maxAge = self.config.getProperty('AIWorker', 'file_cache_max_age', type=int, fallback=0)
+        return RemoteFileCache(cacheDir, cacheSize * 1024 * 1024, maxAge)
+
+
+    def _get_lock(self):
+        if self._pid != os.getpid():
+            # forked process (e.g. data loader worker); connections and threads
+            # of the parent must not be used
+            self._lock = RLock()
+            self._session = None
+            self._executor = None
+            self._pending = {}
+            self._pid = os.getpid()
+        return self._lock
+
+
+    def _get_session(self):
+        '''
+            Returns the HTTP session of this process, whose connections to the
+            FileServer are kept alive and reused across requests.
+        '''
+        with self._get_lock():
+            if self._session is None:
+                retries = Retry(total=self.numRetries, backoff_factor=0.5,
+                                status_forcelist=(500, 502, 503, 504))
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.poolSize, max_retries=retries)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+
+    def _get_executor(self):
+        with self._get_lock():
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.poolSize)
+            return self._executor
+
 
     
     def _check_running_local(self):
@@ -68,6 +163,97 @@ class FileServer:
 
     
 
+    def _get_query_path(self, project, filename):
+        localSpec = ('files' if not self.isLocal else '')
+        if project is not None:
+            queryPath = os.path.join(self.baseURI, project, localSpec, filename)
+        else:
+            queryPath = os.path.join(self.baseURI, filename)
+
+        if '..' in queryPath or filename.startswith(os.sep):
+            # parent and absolute paths are not allowed (to protect the system and other projects)
+            raise Exception('Parent accessors ("..") and absolute paths ("{}path") are not allowed.'.format(os.sep))
+        return queryPath
+
+
+    def _request_file(self, url):
+        '''
+            Retrieves a file from the remote FileServer, resp. from the local
+            file cache if it is still up-to-date. Cached files are revalidated
+            with a conditional request, so that they are only downloaded again
+            if they have changed on the server.
+        '''
+        meta = self.fileCache.get_metadata(url)
+        if self.fileCache.is_fresh(meta):
+            bytea = self.fileCache.get(url)
+            if bytea is not None:
+                return bytea
+
+        headers = {}
+        if meta is not None:
+            if meta.get('etag') is not None:
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified') is not None:
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        with self._get_session().get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            if response.status_code == 304:
+                bytea = self.fileCache.get(url, revalidated=True)
+                if bytea is not None:
+                    return bytea
+                # cached file has been evicted in the meantime
+                return self._request_file(url)
+            response.raise_for_status()
+            bytea = b''.join(response.iter_content(chunk_size=CHUNK_SIZE))
+            self.fileCache.put(url, bytea, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return bytea
+
+
+    def _get_remote_file(self, url):
+        with self._get_lock():
+            future = self._pending.get(url)
+        if future is not None:
+            # file is being prefetched; wait for it instead of requesting it twice
+            try:
+                future.result()
+                bytea = self.fileCache.get(url)
+                if bytea is not None:
+                    return bytea
+            except Exception:
+                pass
+        return self._request_file(url)
+
+
+    def _release_pending(self, url, future):
+        with self._get_lock():
+            if self._pending.get(url) is future:
+                del self._pending[url]
+
+
+    def prefetch(self, project, filenames):
+        '''
+            Starts retrieving the given files from the remote FileServer into
+            the local file cache in the background, so that subsequent calls
+            to "getFile" and "getImage" (also from other processes, such as
+            data loader workers) can be served from the cache. Has no effect if
+            the FileServer runs on the same instance or the cache is disabled.
+        '''
+        if self.isLocal or not self.fileCache.enabled():
+            return
+        executor = self._get_executor()
+        for filename in filenames:
+            try:
+                url = self._get_query_path(project, filename)
+            except Exception:
+                continue
+            with self._get_lock():
+                if url in self._pending:
+                    continue
+                future = executor.submit(self._request_file, url)
+                self._pending[url] = future
+            future.add_done_callback(lambda f, url=url: self._release_pending(url, f))
+
+
     def getFile(self, project, filename):
         '''
             Returns the file as a byte array.
@@ -76,26 +262,25 @@ class FileServer:
             Otherwise an HTTP request is being sent.
         '''
         try:
-            #TODO: make generator that yields bytes?
-            localSpec = ('files' if not self.isLocal else '')
-            if project is not None:
-                queryPath = os.path.join(self.baseURI, project, localSpec, filename)
-            else:
-                queryPath = os.path.join(self.baseURI, filename)
-            
-            if '..' in queryPath or filename.startswith(os.sep):
-                # parent and absolute paths are not allowed (to protect the system and other projects)
-                raise Exception('Parent accessors ("..") and absolute paths ("{}path") are not allowed.'.format(os.sep))
+            queryPath = self._get_query_path(project, filename)
 
             if self.isLocal:
-                # load file from disk
-                with open(queryPath, 'rb') as f:
-                    bytea = f.read()
+                parentPath, window = parse_virtual_filename(queryPath)
+                if window is not None:
+                    # virtual patch; crop from parent image and encode
+                    parent = self.imageCache.get_image(parentPath)
+                    patch = parent.crop((window[0], window[1], window[0]+window[2], window[1]+window[3]))
+                    bio = BytesIO()
+                    patch.save(bio, parent.format if parent.format is not None else 'PNG')
+                    bytea = bio.getvalue()
+                else:
+                    # load file from disk
+                    with open(queryPath, 'rb') as f:
+                        bytea = f.read()
             else:
-                response = request.urlopen(queryPath)
-                bytea = response.read()
+                bytea = self._get_remote_file(queryPath)
 
-        except HTTPError as httpErr:
+        except requests.HTTPError as httpErr:
             print('HTTP error')
             print(httpErr)
             bytea = None
@@ -107,6 +292,46 @@ class FileServer:
         return bytea
 
 
+    def getImage(self, project, filename):
+        '''
+            Returns the image under "filename" as a PIL image, or None if
+            it could not be loaded.
+            Virtual patches (file name plus window) are cropped directly
+            from their decoded parent image if the FileServer module runs
+            on the same instance, without encoding them to bytes first.
+        '''
+        try:
+            if self.isLocal and project is not None:
+                parentName, window = parse_virtual_filename(filename)
+                if window is not None:
+                    if '..' in parentName or parentName.startswith(os.sep):
+                        raise Exception('Parent accessors ("..") and absolute paths ("{}path") are not allowed.'.format(os.sep))
+                    return self.imageCache.get_window(os.path.join(self.baseURI, project, parentName), window)
+
+            return Image.open(BytesIO(self.getFile(project, filename)))
+
+        except Exception as err:
+            print(err)
+            return None
+
+
+    def getModificationTime(self, project, filename):
+        '''
+            Returns the modification time of the file under "filename" (resp.
+            of the parent image for virtual patches), or None if the FileServer
+            module does not run on the same instance or the file does not exist.
+        '''
+        if not self.isLocal or project is None:
+            return None
+        parentName, _ = parse_virtual_filename(filename)
+        if '..' in parentName or parentName.startswith(os.sep):
+            return None
+        try:
+            return os.path.getmtime(os.path.join(self.baseURI, project, parentName))
+        except OSError:
+            return None
+
+
     def putFile(self, project, bytea, filename):
         '''
             Saves a file to disk.
@@ -129,15 +354,34 @@ class FileServer:
     
     def get_secure_instance(self, project):
         '''
-            Returns a wrapper class to the "getFile" and "putFile"
-            functions that disallow access to other projects
+            Returns a wrapper class to the "getFile", "getImage", "prefetch" and
+            "putFile" functions that disallow access to other projects
             than the one included.
         '''
-        this = self
-        class _secure_file_server:
-            def getFile(self, filename):
-                return this.getFile(project, filename)
-            def putFile(self, bytea, filename):
-                return this.putFile(project, bytea, filename)
-        
-        return _secure_file_server()
\ No newline at end of file
+        return _SecureFileServer(self, project)
+
+
+
+class _SecureFileServer:
+    '''
+        Wrapper returned by "FileServer.get_secure_instance". Defined at module
+        level so that it can be pickled, e.g. for data loader worker processes.
+    '''
+    def __init__(self, fileServer, project):
+        self.fileServer = fileServer
+        self.project = project
+
+    def getFile(self, filename):
+        return self.fileServer.getFile(self.project, filename)
+
+    def getImage(self, filename):
+        return self.fileServer.getImage(self.project, filename)
+
+    def getModificationTime(self, filename):
+        return self.fileServer.getModificationTime(self.project, filename)
+
+    def prefetch(self, filenames):
+        return self.fileServer.prefetch(self.project, filenames)
+
+    def putFile(self, bytea, filename):
+        return self.fileServer.putFile(self.project, bytea, filename)
\ No newline at end of file
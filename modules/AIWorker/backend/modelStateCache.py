@@ -0,0 +1,146 @@
+'''
+    Local on-disk cache of model states for AIWorkers.
+    Model states (rows of a project's "cnnstate" table) never change once
+    written, so they can be cached on every AIWorker node by their ID. This
+    way, the (potentially large) state dicts only need to be transferred from
+    the database if they are not yet available locally.
+
+    Every cached state is stored together with its SHA-256 hash, which is
+    verified upon loading; corrupt or incomplete files are discarded. The
+    cache is limited in total size, with the least recently used states being
+    evicted first.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import glob
+import hashlib
+from uuid import uuid4
+from threading import Lock
+from util.modelStateStore import iter_chunks
+
+
+class ModelStateCache:
+
+    def __init__(self, cacheDir, maxSize):
+        '''
+            Inputs:
+            - cacheDir: directory on the local disk to store model states in
+            - maxSize:  maximum total size of the cached states in bytes. The
+                        cache is disabled if zero or negative.
+        '''
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self.lock = Lock()
+        if self.enabled():
+            os.makedirs(self.cacheDir, exist_ok=True)
+
+
+    def enabled(self):
+        return self.maxSize > 0
+
+
+    def _get_paths(self, project, stateID):
+        baseName = os.path.join(self.cacheDir, project, str(stateID))
+        return baseName + '.bin', baseName + '.sha256'
+
+
+    def _remove(self, project, stateID):
+        for path in self._get_paths(project, stateID):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+    def get(self, project, stateID, size=None):
+        '''
+            Returns the bytes of the model state with given ID from the cache,
+            or None if it is not cached (or corrupt). If "size" (in bytes) is
+            provided, the cached state must match it.
+        '''
+        if not self.enabled() or stateID is None:
+            return None
+        statePath, hashPath = self._get_paths(project, stateID)
+        try:
+            if size is not None and os.path.getsize(statePath) != size:
+                raise Exception('size mismatch')
+            with open(hashPath, 'r') as f:
+                expectedHash = f.read().strip()
+            with open(statePath, 'rb') as f:
+                stateDict = f.read()
+            if hashlib.sha256(stateDict).hexdigest() != expectedHash:
+                raise Exception('hash mismatch')
+
+            # mark as recently used
+            os.utime(statePath)
+            return stateDict
+
+        except Exception:
+            # not cached or corrupt
+            self._remove(project, stateID)
+            return None
+
+
+    def put(self, project, stateID, stateDict):
+        '''
+            Stores a model state (bytes or binary file-like object, which is
+            read in chunks) in the cache and evicts the least recently used
+            states if the cache exceeds its maximum size.
+            Files are written under a temporary name first and then renamed,
+            so that concurrent readers never see incomplete states.
+        '''
+        if not self.enabled() or stateID is None or stateDict is None:
+            return
+        statePath, hashPath = self._get_paths(project, stateID)
+        os.makedirs(os.path.dirname(statePath), exist_ok=True)
+        tempSuffix = '.' + str(uuid4()) + '.tmp'
+        try:
+            h = hashlib.sha256()
+            size = 0
+            with open(statePath + tempSuffix, 'wb') as f:
+                for chunk in iter_chunks(stateDict):
+                    h.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            if size > self.maxSize:
+                os.remove(statePath + tempSuffix)
+                return
+            with open(hashPath + tempSuffix, 'w') as f:
+                f.write(h.hexdigest())
+            os.replace(hashPath + tempSuffix, hashPath)
+            os.replace(statePath + tempSuffix, statePath)
+        except Exception as e:
+            print(f'WARNING: could not cache model state {stateID} (reason: {str(e)}).')
+            for path in (statePath + tempSuffix, hashPath + tempSuffix):
+                if os.path.isfile(path):
+                    os.remove(path)
+            return
+        self._evict()
+
+
+    def _evict(self):
+        '''
+            Removes the least recently used states until the total size of
+            the cache is within the limit.
+        '''
+        with self.lock:
+            entries = []
+            totalSize = 0
+            for statePath in glob.glob(os.path.join(self.cacheDir, '*', '*.bin')):
+                try:
+                    stat = os.stat(statePath)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, statePath))
+                totalSize += stat.st_size
+            entries.sort()
+            for _, size, statePath in entries:
+                if totalSize <= self.maxSize:
+                    break
+                project = os.path.basename(os.path.dirname(statePath))
+                stateID = os.path.splitext(os.path.basename(statePath))[0]
+                self._remove(project, stateID)
+                totalSize -= size
+
@@ -22,22 +22,32 @@
     2019-20 Benjamin Kellenberger
 '''
 
-import base64
+import time
+import inspect
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from celery import current_task, states
 import psycopg2
 from psycopg2 import sql
 from util.helpers import current_time, array_split
+from util.modelStateStore import to_bytes
+from util.predictionRetention import create_partition
+from util.maskCodec import encode_mask
+from util.predictionBatch import PredictionBatch, accepts_prediction_batch
 from constants.dbFieldNames import FieldNames_annotation, FieldNames_prediction
 
 
 
-def __get_message_fun(project, cumulatedTotal=None, epoch=None, numEpochs=None):
+def __get_message_fun(project, cumulatedTotal=None, epoch=None, numEpochs=None, extraMeta=None):
     def __on_message(state, message, done=None, total=None):
         meta = {
             'project': project,
             'epoch': epoch
         }
+        if extraMeta is not None:
+            meta.update(extraMeta)
         if (isinstance(done, int) or isinstance(done, float)) and \
             (isinstance(total, int) or isinstance(total, float)):
             trueTotal = total
@@ -62,28 +72,315 @@ def __get_message_fun(project, cumulatedTotal=None, epoch=None, numEpochs=None):
     return __on_message
 
 
-def __load_model_state(project, dbConnector):
-    # load model state from database
+def __get_cache_meta(stateCache, hits):
+    # cache hits and misses of the current task for the task meta data
+    if stateCache is None or not stateCache.enabled():
+        return {}
+    return {
+        'model_state_cache': {
+            'hits': hits[0],
+            'misses': hits[1]
+        }
+    }
+
+
+def __fetch_model_states(project, dbConnector, stateStore, entries):
+    '''
+        Retrieves the state dicts of the given "cnnstate" rows (dicts with
+        keys "id" and "statedict_ref") from the model state store (if the row
+        holds a reference) or the database. Returns a dict of ID and bytes.
+    '''
+    stateDicts = {}
+    ids_db = []
+    for entry in entries:
+        if entry['statedict_ref'] is None:
+            ids_db.append(entry['id'])
+        elif stateStore is None:
+            raise Exception('Model state is stored externally, but no model state store is configured.')
+        else:
+            stateDicts[entry['id']] = stateStore.get(entry['statedict_ref'])
+    if len(ids_db):
+        queryStr = sql.SQL('''
+            SELECT id, statedict FROM {} WHERE id IN %s;
+        ''').format(sql.Identifier(project, 'cnnstate'))
+        for r in dbConnector.execute(queryStr, (tuple(ids_db),), 'all'):
+            stateDicts[r['id']] = r['statedict']
+    return stateDicts
+
+
+def __load_model_state(project, dbConnector, stateCache=None, stateStore=None):
+    '''
+        Loads the latest model state of the project. If a model state cache
+        is provided, the state dict is only retrieved from the database (resp.
+        the model state store) if it is not available in the cache.
+        Returns the state dict, its ID, and a tuple of the number of cache
+        hits and misses.
+    '''
     queryStr = sql.SQL('''
-        SELECT query.statedict, query.id FROM (
-            SELECT statedict, id, timecreated
-            FROM {}
-            ORDER BY timecreated DESC NULLS LAST
-            LIMIT 1
-        ) AS query;
+        SELECT id, statedict_ref, octet_length(statedict) AS size
+        FROM {}
+        ORDER BY timecreated DESC NULLS LAST
+        LIMIT 1;
     ''').format(sql.Identifier(project, 'cnnstate'))
     result = dbConnector.execute(queryStr, None, numReturn=1)     #TODO: issues Celery warning if no state dict found
-    if not len(result):
+    if result is None or not len(result):
         # force creation of new model
-        stateDict = None
-        stateDictID = None
+        return None, None, (0, 0)
+
+    stateDictID = result[0]['id']
+    if stateCache is not None:
+        stateDict = stateCache.get(project, stateDictID, result[0]['size'])
+        if stateDict is not None:
+            return stateDict, stateDictID, (1, 0)
 
+    # load model state from database or store
+    stateDict = __fetch_model_states(project, dbConnector, stateStore, result)[stateDictID]
+    if stateCache is None:
+        return stateDict, stateDictID, (0, 0)
+    stateCache.put(project, stateDictID, stateDict)
+    return stateDict, stateDictID, (0, 1)
+
+
+def __save_model_state(project, dbConnector, stateStore, stateCache, stateDict, partial, model_library, alcriterion_library, numImages=None):
+    '''
+        Inserts a new model state (bytes or binary file-like object) into the
+        project's "cnnstate" table. If a model state store is configured, the
+        state dict is streamed to the store and only its reference is saved in
+        the database. "numImages" is the number of images the model has been
+        trained on (used to weigh partial states during averaging). Returns
+        the ID of the new row.
+    '''
+    if stateStore is not None:
+        stateDictValue = None
+        stateDictRef = stateStore.put(stateDict)
     else:
-        # extract
-        stateDict = result[0]['statedict']
-        stateDictID = result[0]['id']
+        stateDict = to_bytes(stateDict)
+        stateDictValue = psycopg2.Binary(stateDict)
+        stateDictRef = None
+    queryStr = sql.SQL('''
+        INSERT INTO {} (stateDict, stateDict_ref, partial, model_library, alcriterion_library, num_images)
+        VALUES( %s, %s, %s, %s, %s, %s )
+        RETURNING id;
+    ''').format(sql.Identifier(project, 'cnnstate'))
+    result = dbConnector.execute(queryStr, (stateDictValue, stateDictRef, partial, model_library, alcriterion_library, numImages), numReturn=1)
+    stateDictID = result[0]['id']
+
+    if not partial:
+        try:
+            # partition for the predictions of the new state (if predictions are partitioned)
+            create_partition(dbConnector, project, stateDictID)
+        except Exception as e:
+            print(f'WARNING: could not create prediction partition for model state {stateDictID} (reason: {str(e)}).')
+
+    if stateCache is not None:
+        if hasattr(stateDict, 'seek'):
+            # rewind file-like object consumed by model state store
+            stateDict.seek(0)
+        stateCache.put(project, stateDictID, stateDict)
+    return stateDictID
+
+
+
+class _PartialModelStates:
+    '''
+        List-like access to the partial model states to be averaged. States
+        are retrieved from the model state cache, the model state store, or
+        the database only upon accessing an entry and are not retained, so
+        that averaging functions processing one state at a time never hold
+        all of them in memory. Entries may be overwritten (e.g. by averaging
+        functions that deserialize the states in place).
+    '''
+
+    def __init__(self, project, entries, fetchFun, stateCache=None):
+        self.project = project
+        self.entries = entries
+        self.fetchFun = fetchFun
+        self.stateCache = stateCache
+        self.overrides = {}
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx in self.overrides:
+            return self.overrides[idx]
+        entry = self.entries[idx]
+        if self.stateCache is not None:
+            stateDict = self.stateCache.get(self.project, entry['id'], entry['size'])
+            if stateDict is not None:
+                self.hits += 1
+                return stateDict
+        stateDict = self.fetchFun([entry])[entry['id']]
+        self.misses += 1
+        if self.stateCache is not None:
+            self.stateCache.put(self.project, entry['id'], stateDict)
+        return stateDict
+
+
+    def __setitem__(self, idx, value):
+        if idx < 0:
+            idx += len(self)
+        self.overrides[idx] = value
+
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+
+class _PredictionWriter:
+    '''
+        Background thread that parses inference results into prediction rows
+        and writes them to the database (with "COPY"), so that this overlaps
+        with the inference of the next chunk of images. Results are passed
+        through a bounded queue, which blocks the inference if the database
+        cannot keep up. The first error is re-raised in the calling thread
+        upon the next call to "put" or "close"; later results are discarded.
+    '''
+
+    def __init__(self, project, epoch, predType, stateDictID, dbConnector, queueSize, timings, segMaskCodec='png'):
+        self.project = project
+        self.epoch = epoch
+        self.predType = predType
+        self.stateDictID = stateDictID
+        self.dbConnector = dbConnector
+        self.timings = timings
+        self.segMaskCodec = segMaskCodec
+        self.queue = queue.Queue(maxsize=max(1, queueSize))
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self._write(*item)
+            except Exception as e:
+                print(e)
+                self.error = e
+
+
+    def _parse(self, result):
+        fieldNames = list(getattr(FieldNames_prediction, self.predType).value)
+        fieldNames.append('image')      # image ID
+        fieldNames.append('cnnstate')   # model state ID
+        if isinstance(result, PredictionBatch):
+            # columnar format: no per-prediction parsing required
+            return fieldNames, list(result.to_rows(fieldNames, {'cnnstate': self.stateDictID})), []
+
+        values_pred = []
+        values_img = []     # mostly for feature vectors
+        for imgID in result.keys():
+            for prediction in result[imgID]['predictions']:
+
+                # if segmentation mask: encode
+                if self.predType == 'segmentationMasks':
+                    segMask = np.array(result[imgID]['predictions'][0]['label']).astype(np.uint8)
+                    height, width = segMask.shape
+                    segMask = encode_mask(segMask, self.segMaskCodec)
+                    segMaskDimensions = {
+                        'width': width,
+                        'height': height
+                    }
+
+                nextResultValues = []
+                # we expect a dict of values, so we can use the fieldNames directly
+                for fn in fieldNames:
+                    if fn == 'image':
+                        nextResultValues.append(imgID)
+                    elif fn == 'cnnstate':
+                        nextResultValues.append(self.stateDictID)
+                    elif fn == 'segmentationmask':
+                        nextResultValues.append(segMask)
+                    elif fn == 'width' or fn == 'height':
+                        if self.predType == 'segmentationMasks':
+                            nextResultValues.append(segMaskDimensions[fn])
+                        elif fn in prediction:
+                            nextResultValues.append(prediction[fn])
+                        else:
+                            nextResultValues.append(None)
+                    else:
+                        if fn in prediction:
+                            #TODO: might need to do typecasts (e.g. UUID?)
+                            nextResultValues.append(prediction[fn])
+
+                        else:
+                            # field name is not in return value; might need to raise a warning, Exception, or set to None
+                            nextResultValues.append(None)
+                        
+                values_pred.append(tuple(nextResultValues))
 
-    return stateDict, stateDictID
+            if 'fVec' in result[imgID] and len(result[imgID]['fVec']):
+                values_img.append((imgID, psycopg2.Binary(result[imgID]['fVec']),))
+        return fieldNames, values_pred, values_img
+
+
+    def _write(self, chunkStr, result):
+        tic = time.time()
+        try:
+            fieldNames, values_pred, values_img = self._parse(result)
+        except Exception as e:
+            raise Exception(f'[Epoch {self.epoch}] error during result parsing (chunk {chunkStr}, reason: {str(e)})')
+        self.timings['parsing'] += time.time() - tic
+
+        # commit to database
+        tic = time.time()
+        try:
+            if len(values_pred):
+                # TODO: we do not delete old predictions anymore, to keep track of model performance over time
+                self.dbConnector.copy_from(sql.Identifier(self.project, 'prediction'), fieldNames, values_pred)
+
+            if len(values_img):
+                queryStr = sql.SQL('''
+                    INSERT INTO {} ( id, fVec )
+                    VALUES %s
+                    ON CONFLICT (id) DO UPDATE SET fVec = EXCLUDED.fVec;
+                ''').format(sql.Identifier(self.project, 'image'))
+                self.dbConnector.insert(queryStr, values_img)
+        except Exception as e:
+            raise Exception(f'[Epoch {self.epoch}] error during data committing (chunk {chunkStr}, reason: {str(e)})')
+        self.timings['writing'] += time.time() - tic
+
+
+    def put(self, chunkStr, result):
+        '''
+            Queues the result of a chunk for writing. Blocks while the queue is
+            full.
+        '''
+        if self.error is not None:
+            raise self.error
+        tic = time.time()
+        self.queue.put((chunkStr, result))
+        self.timings['writer_wait'] += time.time() - tic
+
+
+    def close(self, raiseError=True):
+        '''
+            Waits until all queued results have been written and stops the
+            thread. Re-raises the first error if "raiseError" is True.
+        '''
+        if self.thread.is_alive():
+            tic = time.time()
+            self.queue.put(None)
+            self.thread.join()
+            self.timings['writer_wait'] += time.time() - tic
+        if raiseError and self.error is not None:
+            raise self.error
 
 
 
@@ -157,7 +454,7 @@ def __get_ai_library_names(project, dbConnector):
         return model_library, alcriterion_library
 
 
-def _call_train(project, imageIDs, epoch, numEpochs, subset, trainingFun, dbConnector, fileServer):
+def _call_train(project, imageIDs, epoch, numEpochs, subset, trainingFun, dbConnector, fileServer, stateCache=None, stateStore=None):
     '''
         Initiates model training and maintains workers, status and failure
         events.
@@ -169,6 +466,9 @@ def _call_train(project, imageIDs, epoch, numEpochs, subset, trainingFun, dbConn
         Function then performs sanity checks and forwards the data to the AI model's anonymous
         'train' function, together with some helper instances (a 'Database' instance as well as a
         'FileServer' instance TODO for the model to access more data, if needed).
+        If a 'ModelStateCache' instance is provided as "stateCache", model states are loaded from
+        and stored in it, too. If a 'ModelStateStore' instance is provided as "stateStore", new
+        model states are saved in the store instead of the database.
 
         Returns:
         - modelStateDict: a new, updated state dictionary of the model as returned by the AI model's
@@ -177,13 +477,15 @@ def _call_train(project, imageIDs, epoch, numEpochs, subset, trainingFun, dbConn
     '''
 
     print(f'[{project}] Epoch {epoch}: Initiated training...')
-    update_state = __get_message_fun(project, len(imageIDs), epoch, numEpochs)
+    extraMeta = {}
+    update_state = __get_message_fun(project, len(imageIDs), epoch, numEpochs, extraMeta)
 
 
     # load model state
     update_state(state='PREPARING', message=f'[Epoch {epoch}] loading model state')
     try:
-        stateDict, _ = __load_model_state(project, dbConnector)
+        stateDict, _, cacheHits = __load_model_state(project, dbConnector, stateCache, stateStore)
+        extraMeta.update(__get_cache_meta(stateCache, cacheHits))
     except Exception as e:
         print(e)
         raise Exception(f'[Epoch {epoch}] error during model state loading (reason: {str(e)})')
@@ -210,11 +512,8 @@ def _call_train(project, imageIDs, epoch, numEpochs, subset, trainingFun, dbConn
     try:
         update_state(state='FINALIZING', message=f'[Epoch {epoch}] saving model state')
         model_library, alcriterion_library = __get_ai_library_names(project, dbConnector)
-        queryStr = sql.SQL('''
-            INSERT INTO {} (stateDict, partial, model_library, alcriterion_library)
-            VALUES( %s, %s, %s, %s )
-        ''').format(sql.Identifier(project, 'cnnstate'))
-        dbConnector.execute(queryStr, (psycopg2.Binary(stateDict), subset, model_library, alcriterion_library), numReturn=None)
+        __save_model_state(project, dbConnector, stateStore, stateCache, stateDict,
+                            subset, model_library, alcriterion_library, len(imageIDs))
     except Exception as e:
         print(e)
         raise Exception(f'[Epoch {epoch}] error during data committing (reason: {str(e)})')
@@ -226,23 +525,31 @@ def _call_train(project, imageIDs, epoch, numEpochs, subset, trainingFun, dbConn
 
 
 
-def _call_average_model_states(project, epoch, numEpochs, averageFun, dbConnector, fileServer):
+def _call_average_model_states(project, epoch, numEpochs, averageFun, dbConnector, fileServer, stateCache=None, stateStore=None):
     '''
         Receives a number of model states (coming from different AIWorker instances),
         averages them by calling the AI model's 'average_model_states' function and inserts
         the returning averaged model state into the database.
+        Model states available in the "stateCache" (if provided) are not retrieved from the
+        database, resp. the "stateStore".
     '''
 
     print(f'[{project}] Epoch {epoch}: Initiated model state averaging...')
-    update_state = update_state = __get_message_fun(project, None, epoch, numEpochs)
+    extraMeta = {}
+    update_state = __get_message_fun(project, None, epoch, numEpochs, extraMeta)
 
-    # get all model states
+    # get all model states (retrieved lazily by the averaging function)
     update_state(state='PREPARING', message=f'[Epoch {epoch}] loading model states')
     try:
         queryStr = sql.SQL('''
-            SELECT stateDict, model_library, alcriterion_library FROM {} WHERE partial IS TRUE;
+            SELECT id, stateDict_ref, octet_length(stateDict) AS size, model_library, alcriterion_library, num_images
+            FROM {} WHERE partial IS TRUE
+            ORDER BY timecreated;
         ''').format(sql.Identifier(project, 'cnnstate'))
         queryResult = dbConnector.execute(queryStr, None, 'all')
+        modelStates = _PartialModelStates(project, queryResult,
+                        lambda entries: __fetch_model_states(project, dbConnector, stateStore, entries),
+                        stateCache)
     except Exception as e:
         print(e)
         raise Exception(f'[Epoch {epoch}] error during model state loading (reason: {str(e)})')
@@ -256,8 +563,17 @@ def _call_average_model_states(project, epoch, numEpochs, averageFun, dbConnecto
     # do the work
     update_state(state='PREPARING', message=f'[Epoch {epoch}] averaging models')
     try:
-        modelStates = [qr['statedict'] for qr in queryResult]
-        modelStates_avg = averageFun(stateDicts=modelStates, updateStateFun=update_state)
+        kwargs = {}
+        if 'weights' in inspect.signature(averageFun).parameters:
+            # weigh states by number of training images (uniformly if unknown for any)
+            weights = [qr['num_images'] for qr in queryResult]
+            if all(w is not None and w > 0 for w in weights):
+                kwargs['weights'] = weights
+            else:
+                kwargs['weights'] = None
+        modelStates_avg = averageFun(stateDicts=modelStates, updateStateFun=update_state, **kwargs)
+        if stateCache is not None:
+            extraMeta.update(__get_cache_meta(stateCache, (modelStates.hits, modelStates.misses)))
     except Exception as e:
         print(e)
         raise Exception(f'[Epoch {epoch}] error during model state fusion (reason: {str(e)})')
@@ -271,11 +587,10 @@ def _call_average_model_states(project, epoch, numEpochs, averageFun, dbConnecto
         # load model library from database
         model_library, alcriterion_library = __get_ai_library_names(project, dbConnector)
     try:
-        queryStr = sql.SQL('''
-            INSERT INTO {} (stateDict, partial, model_library, alcriterion_library)
-            VALUES ( %s )
-        ''').format(sql.Identifier(project, 'cnnstate'))
-        dbConnector.insert(queryStr, (modelStates_avg, False, model_library, alcriterion_library))
+        numImages = [qr['num_images'] for qr in queryResult]
+        numImages = (sum(numImages) if all(n is not None for n in numImages) else None)
+        __save_model_state(project, dbConnector, stateStore, stateCache, modelStates_avg,
+                            False, model_library, alcriterion_library, numImages)
     except Exception as e:
         print(e)
         raise Exception(f'[Epoch {epoch}] error during data committing (reason: {str(e)})')
@@ -299,12 +614,23 @@ def _call_average_model_states(project, epoch, numEpochs, averageFun, dbConnecto
 
 
 
-def _call_inference(project, imageIDs, epoch, numEpochs, inferenceFun, rankFun, dbConnector, fileServer, batchSizeLimit):
+def _call_inference(project, imageIDs, epoch, numEpochs, inferenceFun, rankFun, dbConnector, fileServer, batchSizeLimit, stateCache=None, stateStore=None, writeQueueSize=2, segMaskCodec='png'):
     '''
-
+        Performs inference (and ranking) on the given images in chunks of at
+        most "batchSizeLimit" images. The stages are pipelined: while a chunk
+        is being processed, the metadata of the next chunk are loaded in the
+        background, and the predictions of previous chunks are parsed and
+        written to the database by a separate thread (see "_PredictionWrit-
+        er"; at most "writeQueueSize" chunks are queued). The accumulated
+        time spent per stage is reported in the task meta data ("timings").
+        Models may return their predictions in the dict format or as a "Pre-
+        dictionBatch" (see "util.predictionBatch"). Segmentation masks are stored with codec "segMaskCodec" (see "util.
+        maskCodec").
     '''
     print(f'[{project}] Epoch {epoch}: Initiated inference on {len(imageIDs)} images...')
-    update_state = update_state = __get_message_fun(project, len(imageIDs), epoch, numEpochs)
+    timings = dict.fromkeys(('metadata', 'inference', 'ranking', 'parsing', 'writing', 'writer_wait'), 0.0)
+    extraMeta = {'timings': timings}
+    update_state = __get_message_fun(project, len(imageIDs), epoch, numEpochs, extraMeta)
 
     # get project's prediction type
     projectMeta = dbConnector.execute(sql.SQL('''
@@ -319,7 +645,8 @@ def _call_inference(project, imageIDs, epoch, numEpochs, inferenceFun, rankFun,
     # load model state
     update_state(state='PREPARING', message=f'[Epoch {epoch}] loading model state')
     try:
-        stateDict, stateDictID = __load_model_state(project, dbConnector)
+        stateDict, stateDictID, cacheHits = __load_model_state(project, dbConnector, stateCache, stateStore)
+        extraMeta.update(__get_cache_meta(stateCache, cacheHits))
     except Exception as e:
         print(e)
         raise Exception(f'[Epoch {epoch}] error during model state loading (reason: {str(e)})')
@@ -330,123 +657,70 @@ def _call_inference(project, imageIDs, epoch, numEpochs, inferenceFun, rankFun,
     else:
         imageID_chunks = [imageIDs]
 
-    # process in batches
-    for idx, imageID_batch in enumerate(imageID_chunks):
-        chunkStr = f'{idx+1}/{len(imageID_chunks)}'
-        print(f'Chunk {chunkStr}')
+    def _load_metadata(imageID_batch):
+        tic = time.time()
+        data = __load_metadata(project, dbConnector, imageID_batch, False)
+        timings['metadata'] += time.time() - tic
+        return data
 
-        # load remaining data (image filenames, class definitions)
-        update_state(state='PREPARING', message=f'[Epoch {epoch}] loading metadata (chunk {chunkStr})')
-        try:
-            data = __load_metadata(project, dbConnector, imageID_batch, False)
-        except Exception as e:
-            print(e)
-            raise Exception(f'[Epoch {epoch}] error during metadata loading (chunk {chunkStr})')
+    metadataLoader = ThreadPoolExecutor(max_workers=1)
+    writer = _PredictionWriter(project, epoch, predType, stateDictID, dbConnector, writeQueueSize, timings, segMaskCodec)
+    try:
+        nextMetadata = metadataLoader.submit(_load_metadata, imageID_chunks[0])
 
-        # call inference function
-        update_state(state='PREPARING', message=f'[Epoch {epoch}] starting inference (chunk {chunkStr})')
-        try:
-            result = inferenceFun(stateDict=stateDict, data=data, updateStateFun=update_state)
-        except Exception as e:
-            print(e)
-            raise Exception(f'[Epoch {epoch}] error during inference (chunk {chunkStr}; reason: {str(e)})')
+        # process in batches
+        for idx in range(len(imageID_chunks)):
+            chunkStr = f'{idx+1}/{len(imageID_chunks)}'
+            print(f'Chunk {chunkStr}')
 
-        # call ranking function (AL criterion)
-        if rankFun is not None:
-            update_state(state='PREPARING', message=f'[Epoch {epoch}] calculating priorities (chunk {chunkStr})')
+            # load remaining data (image filenames, class definitions); prefetch those of the next chunk
+            update_state(state='PREPARING', message=f'[Epoch {epoch}] loading metadata (chunk {chunkStr})')
             try:
-                result = rankFun(data=result, updateStateFun=update_state, **{'stateDict':stateDict})
+                data = nextMetadata.result()
             except Exception as e:
                 print(e)
-                raise Exception(f'[Epoch {epoch}] error during ranking (chunk {chunkStr}, reason: {str(e)})')
+                raise Exception(f'[Epoch {epoch}] error during metadata loading (chunk {chunkStr})')
+            if idx + 1 < len(imageID_chunks):
+                nextMetadata = metadataLoader.submit(_load_metadata, imageID_chunks[idx+1])
 
-        # parse result
-        try:
+            # call inference function
+            update_state(state='PREPARING', message=f'[Epoch {epoch}] starting inference (chunk {chunkStr})')
+            tic = time.time()
+            try:
+                result = inferenceFun(stateDict=stateDict, data=data, updateStateFun=update_state)
+            except Exception as e:
+                print(e)
+                raise Exception(f'[Epoch {epoch}] error during inference (chunk {chunkStr}; reason: {str(e)})')
+            timings['inference'] += time.time() - tic
+
+            # call ranking function (AL criterion)
+            if rankFun is not None:
+                update_state(state='PREPARING', message=f'[Epoch {epoch}] calculating priorities (chunk {chunkStr})')
+                tic = time.time()
+                try:
+                    if isinstance(result, PredictionBatch) and not accepts_prediction_batch(rankFun):
+                        result = result.to_dict()
+                    result = rankFun(data=result, updateStateFun=update_state, **{'stateDict':stateDict})
+                except Exception as e:
+                    print(e)
+                    raise Exception(f'[Epoch {epoch}] error during ranking (chunk {chunkStr}, reason: {str(e)})')
+                timings['ranking'] += time.time() - tic
+
+            # parse result and commit to database in the background
             update_state(state='FINALIZING', message=f'[Epoch {epoch}] saving predictions (chunk {chunkStr})')
-            fieldNames = list(getattr(FieldNames_prediction, predType).value)
-            fieldNames.append('image')      # image ID
-            fieldNames.append('cnnstate')   # model state ID
-            values_pred = []
-            values_img = []     # mostly for feature vectors
-            # ids_img = []        # to delete previous predictions
-            for imgID in result.keys():
-                for prediction in result[imgID]['predictions']:
-
-                    # if segmentation mask: encode
-                    if predType == 'segmentationMasks':
-                        segMask = np.array(result[imgID]['predictions'][0]['label']).astype(np.uint8)
-                        height, width = segMask.shape
-                        segMask = base64.b64encode(segMask.ravel()).decode('utf-8')
-                        segMaskDimensions = {
-                            'width': width,
-                            'height': height
-                        }
-
-                    nextResultValues = []
-                    # we expect a dict of values, so we can use the fieldNames directly
-                    for fn in fieldNames:
-                        if fn == 'image':
-                            nextResultValues.append(imgID)
-                            # ids_img.append(imgID)
-                        elif fn == 'cnnstate':
-                            nextResultValues.append(stateDictID)
-                        elif fn == 'segmentationmask':
-                            nextResultValues.append(segMask)
-                        elif fn == 'width' or fn == 'height':
-                            if predType == 'segmentationMasks':
-                                nextResultValues.append(segMaskDimensions[fn])
-                            elif fn in prediction:
-                                nextResultValues.append(prediction[fn])
-                            else:
-                                nextResultValues.append(None)
-                        else:
-                            if fn in prediction:
-                                #TODO: might need to do typecasts (e.g. UUID?)
-                                nextResultValues.append(prediction[fn])
-
-                            else:
-                                # field name is not in return value; might need to raise a warning, Exception, or set to None
-                                nextResultValues.append(None)
-                            
-                    values_pred.append(tuple(nextResultValues))
-
-                if 'fVec' in result[imgID] and len(result[imgID]['fVec']):
-                    values_img.append((imgID, psycopg2.Binary(result[imgID]['fVec']),))
-        except Exception as e:
-            print(e)
-            raise Exception(f'[Epoch {epoch}] error during result parsing (chunk {chunkStr}, reason: {str(e)})')
+            writer.put(chunkStr, result)
+            del data, result
 
+        update_state(state='FINALIZING', message=f'[Epoch {epoch}] saving predictions')
+        writer.close()
 
-        # commit to database
-        try:
-            if len(values_pred):
-                # TODO: we do not delete old predictions anymore, to keep track of model performance over time
-                # # remove previous predictions first
-                # queryStr = sql.SQL('''
-                #     DELETE FROM {} WHERE image IN %s;
-                # ''').format(sql.Identifier(project, 'prediction'))
-                # dbConnector.insert(queryStr, (ids_img,))
-                
-                queryStr = sql.SQL('''
-                    INSERT INTO {id_pred} ( {fieldNames} )
-                    VALUES %s;
-                ''').format(
-                    id_pred=sql.Identifier(project, 'prediction'),
-                    fieldNames=sql.SQL(',').join([sql.SQL(f) for f in fieldNames]))
-                dbConnector.insert(queryStr, values_pred)
+    finally:
+        writer.close(raiseError=False)
+        metadataLoader.shutdown(wait=True)
 
-            if len(values_img):
-                queryStr = sql.SQL('''
-                    INSERT INTO {} ( id, fVec )
-                    VALUES %s
-                    ON CONFLICT (id) DO UPDATE SET fVec = EXCLUDED.fVec;
-                ''').format(sql.Identifier(project, 'image'))
-                dbConnector.insert(queryStr, values_img)
-        except Exception as e:
-            print(e)
-            raise Exception(f'[Epoch {epoch}] error during data committing (chunk {chunkStr}, reason: {str(e)})')
-    
     update_state(state=states.SUCCESS, message='predicted on {} images'.format(len(imageIDs)))
 
+    print(f'[{project}] Epoch {epoch}: Inference timings (seconds): ' + \
+        ', '.join([f'{key}: {value:.2f}' for key, value in timings.items()]))
     print(f'[{project}] Epoch {epoch}: Inference completed successfully.')
     return
\ No newline at end of file
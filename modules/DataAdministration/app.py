@@ -203,9 +203,16 @@ class DataAdministrator:
                 except:
                     splitIntoPatches = False
                     splitProperties = None
+                try:
+                    deduplicate = request.params.get('deduplicate')
+                    if deduplicate is not None:
+                        deduplicate = helpers.parse_boolean(deduplicate)
+                except:
+                    deduplicate = None
 
                 result = self.middleware.uploadImages(project, images, existingFiles,
-                                                    splitIntoPatches, splitProperties)
+                                                    splitIntoPatches, splitProperties,
+                                                    deduplicate)
                 return {'result': result}
             except Exception as e:
                 return {'status': 1, 'message': str(e)}
@@ -12,7 +12,7 @@
 '''
 
 import os
-from celery import current_app
+from celery import current_app, group
 from .dataWorker import DataWorker
 from util.configDef import Config
 
@@ -62,6 +62,17 @@ def prepareDataDownload(project, dataType='annotation', userList=None, dateRange
     return worker.prepareDataDownload(project, dataType, userList, dateRange, extraFields, segmaskFilenameOptions, segmaskEncoding)
 
 
+@current_app.task(name='DataAdministration.watch_project_folder')
+def watchProjectFolder(project, removeMissing=False):
+    imgs_added, imgs_orphaned = worker.watchProjectFolder(project, removeMissing)
+    return len(imgs_added), len(imgs_orphaned)
+
+
 @current_app.task(name='DataAdministration.watch_image_folders', rate_limit=1)
 def watchImageFolders():
-    return worker.watchImageFolders()
\ No newline at end of file
+    # distribute projects across FileServer workers
+    print('Scanning project image folders for changes...')
+    projects = worker.getWatchedProjects()
+    if len(projects):
+        group([watchProjectFolder.si(p, removeMissing) for p, removeMissing in projects]).apply_async(queue='FileServer')
+    return len(projects)
\ No newline at end of file
@@ -14,17 +14,85 @@ import glob
 import tempfile
 import zipfile
 import zlib
+import shutil
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; concurrent scans of projects are not prevented
+    fcntl = None
+from concurrent.futures import ProcessPoolExecutor, Future, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
 import pytz
-from uuid import UUID
+from uuid import UUID, uuid4
 from celery import current_app
 from kombu import Queue
 from PIL import Image
 from psycopg2 import sql
 from modules.Database.app import Database
 from modules.LabelUI.backend.annotation_sql_tokens import QueryStrings_annotation, QueryStrings_prediction
-from util.helpers import valid_image_extensions, listDirectory, base64ToImage
-from util.imageSharding import split_image
+from util.helpers import valid_image_extensions, iterDirectory, base64ToImage, array_split, hashFile, hashFiles
+from .folderWatcher import FolderSnapshot
+from util.imageSharding import split_image, get_split_positions, get_virtual_filename, parse_virtual_filename, VIRTUAL_WINDOW_SEPARATOR
+
+
+
+def _prepare_upload(filePath, patchDir, fileName, splitArgs=None, virtual=False):
+    '''
+        Verifies that an uploaded file on disk is loadable by PIL. If
+        "splitArgs" (tuple of patch size, stride and tightness) is given,
+        the image is additionally split into patches, which are saved into
+        "patchDir". If "virtual" is True, the patches are not materialized;
+        only their windows are calculated from the image size.
+        Runs in a worker process of the upload pipeline.
+        Returns the SHA-256 hash of the uploaded file and a list of tuples of
+        (staged file path, destination file name, list of virtual patch
+        windows or None).
+    '''
+    try:
+        with Image.open(filePath) as image:
+            imageSize = image.size
+            image.verify()
+    except Exception:
+        raise Exception('File is not a valid image.')
+    contentHash = hashFile(filePath)
+
+    if splitArgs is None:
+        return contentHash, [(filePath, fileName, None)]
+
+    if virtual:
+        # keep original file and register patches by their windows
+        return contentHash, [(filePath, fileName, get_split_positions(imageSize, *splitArgs))]
+
+    # split image into patches instead
+    os.makedirs(patchDir, exist_ok=True)
+    bareFileName, ext = os.path.splitext(fileName)
+    stagedFiles = []
+    with Image.open(filePath) as image:
+        patches, coords = split_image(image, *splitArgs)
+        for patch, c in zip(patches, coords):
+            patchName = f'{bareFileName}_{c[0]}_{c[1]}{ext}'
+            patchPath = os.path.join(patchDir, patchName)
+            patch.save(patchPath)
+            stagedFiles.append((patchPath, patchName, None))
+    return contentHash, stagedFiles
+
+
+
+class _InlineExecutor:
+    '''
+        Minimal stand-in for a process pool that runs jobs directly in the
+        calling process (used for small uploads, e.g. the single-file re-
+        quests of the web interface).
+    '''
+    def submit(self, fun, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fun(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
 
 
 class DataWorker:
@@ -43,6 +111,12 @@ class DataWorker:
         ':'    # for macOS
     )
 
+    # default upper bound for the number of upload worker processes (per web server worker)
+    UPLOAD_MAX_NUM_WORKERS = 4
+
+    # uploads with fewer files are verified in the calling process
+    UPLOAD_MIN_FILES_POOL = 4
+
 
 
     def __init__(self, config, passiveMode=False):
@@ -52,6 +126,24 @@ class DataWorker:
         self.passiveMode = passiveMode
 
         self.tempDir = self.config.getProperty('FileServer', 'tempfiles_dir', type=str, fallback=tempfile.gettempdir())
+        if not len(self.tempDir):
+            self.tempDir = tempfile.gettempdir()
+
+        # image upload pipeline
+        self.uploadNumWorkers = self.config.getProperty('FileServer', 'upload_num_workers', type=int, fallback=-1)
+        if self.uploadNumWorkers <= 0:
+            self.uploadNumWorkers = min(self.UPLOAD_MAX_NUM_WORKERS, os.cpu_count() or 1)
+        self.uploadPool = None      # created upon first upload large enough to need it
+        self.uploadDBbatchSize = max(1, self.config.getProperty('FileServer', 'upload_db_batch_size', type=int, fallback=1000))
+
+        # content hash-based deduplication of ingested images
+        self.deduplicateImages = self.config.getProperty('FileServer', 'deduplicate_images', type=bool, fallback=False)
+
+        # incremental folder watching
+        self.snapshotDir = self.config.getProperty('FileServer', 'watch_folder_snapshot_dir', type=str, fallback=None)
+        if self.snapshotDir is None or not len(self.snapshotDir):
+            self.snapshotDir = os.path.join(self.tempDir, 'aide/folderSnapshots')
+        self.watchFolderBatchSize = self.uploadDBbatchSize
 
 
 
@@ -184,8 +276,176 @@ class DataWorker:
         return result
 
 
+    def _resolve_filename(self, destFolder, filename, existingNames):
+        '''
+            Appends an underscore and trailing number to "filename" until it
+            does not collide with any file in "destFolder" anymore. Existing
+            file names are listed only once per folder and cached in the
+            "existingNames" dict, so that large upload batches do not need to
+            query the file system for every rename attempt.
+        '''
+        if destFolder not in existingNames:
+            existingNames[destFolder] = set(os.listdir(destFolder))
+        names = existingNames[destFolder]
+        newFileName = filename
+        while newFileName in names:
+            fn, ext = os.path.splitext(newFileName)
+            match = self.countPattern.search(fn)
+            if match is None:
+                newFileName = fn + '_1' + ext
+            else:
+                # parse number
+                number = int(fn[match.span()[0]+1:match.span()[1]])
+                newFileName = fn[:match.span()[0]] + '_' + str(number+1) + ext
+        return newFileName
+
+
+    def _register_uploaded_images(self, project, imgPaths, imgPaths_replace):
+        '''
+            Removes metadata of images that have been replaced on disk (if
+            any), including virtual patches of them, and registers a batch of
+            uploaded images in the database. "imgPaths" is a list of tuples of
+            (file name, content hash).
+        '''
+        if len(imgPaths_replace):
+            queryStr = sql.SQL('''
+                DELETE FROM {id_iu}
+                WHERE image IN (
+                    SELECT id FROM {id_img}
+                    WHERE split_part(filename, %s, 1) IN %s
+                );
+                DELETE FROM {id_anno}
+                WHERE image IN (
+                    SELECT id FROM {id_img}
+                    WHERE split_part(filename, %s, 1) IN %s
+                );
+                DELETE FROM {id_pred}
+                WHERE image IN (
+                    SELECT id FROM {id_img}
+                    WHERE split_part(filename, %s, 1) IN %s
+                );
+                DELETE FROM {id_img}
+                WHERE split_part(filename, %s, 1) IN %s;
+            ''').format(
+                id_iu=sql.Identifier(project, 'image_user'),
+                id_anno=sql.Identifier(project, 'annotation'),
+                id_pred=sql.Identifier(project, 'prediction'),
+                id_img=sql.Identifier(project, 'image')
+            )
+            self.dbConnector.execute(queryStr,
+                tuple([VIRTUAL_WINDOW_SEPARATOR, tuple(imgPaths_replace)]*4), None)
+
+        if len(imgPaths):
+            queryStr = sql.SQL('''
+                INSERT INTO {id_img} (filename, content_hash)
+                VALUES %s
+                ON CONFLICT (filename) DO NOTHING;
+            ''').format(
+                id_img=sql.Identifier(project, 'image')
+            )
+            self.dbConnector.insert(queryStr, imgPaths)
+
+
+    def _lookup_content_hashes(self, project, contentHashes):
+        '''
+            Queries the project's image entries for the given content hashes.
+            Returns a dict of content hash and file name of an image (resp.
+            of the parent image for virtual patches) with identical content.
+        '''
+        contentHashes = [h for h in contentHashes if h is not None]
+        if not len(contentHashes):
+            return {}
+        result = self.dbConnector.execute(sql.SQL('''
+            SELECT DISTINCT ON (content_hash) content_hash, split_part(filename, %s, 1) AS filename
+            FROM {id_img}
+            WHERE content_hash = ANY(%s::VARCHAR[]);
+        ''').format(
+            id_img=sql.Identifier(project, 'image')
+        ), (VIRTUAL_WINDOW_SEPARATOR, list(contentHashes)), 'all')
+        if result is None:
+            return {}
+        return dict([(r['content_hash'], r['filename']) for r in result])
+
+
+    def _deduplicate_files(self, project, projectFolder, filenames):
+        '''
+            Hashes the contents of files that exist in the project folder in
+            parallel threads and compares them against each other and against
+            the images registered in the database.
+            Returns a list of tuples of (file name, content hash) for unique
+            files, and a list of tuples of (file name, content hash) for files
+            that are exact duplicates of an existing image or of one of the
+            unique files. If deduplication is disabled, all files are returned
+            as unique, without hash.
+        '''
+        if not self.deduplicateImages:
+            return [(f, None) for f in filenames], []
+
+        hashes = hashFiles([os.path.join(projectFolder, f) for f in filenames], self.uploadNumWorkers)
+        knownHashes = self._lookup_content_hashes(project, set(hashes))
+        imgs_unique, imgs_duplicate = [], []
+        for filename, contentHash in zip(filenames, hashes):
+            if contentHash is not None and contentHash in knownHashes:
+                imgs_duplicate.append((filename, contentHash))
+            else:
+                imgs_unique.append((filename, contentHash))
+                if contentHash is not None:
+                    knownHashes[contentHash] = filename
+        return imgs_unique, imgs_duplicate
+
+
+    def _register_image_aliases(self, project, aliases):
+        '''
+            Registers files in the project folder that are exact duplicates of
+            an image in the database as aliases of that image. "aliases" is a
+            list of tuples of (file name, content hash).
+            Patches of split images (virtual or on disk) carry the content
+            hash of their original image, so duplicates are only registered
+            if their hash belongs to exactly one image that is not a patch.
+            Duplicates of split images are not registered, but reported.
+        '''
+        if not len(aliases):
+            return
+        result = self.dbConnector.execute(sql.SQL('''
+            INSERT INTO {id_alias} (filename, image)
+            SELECT a.filename, img.id
+            FROM unnest(%s::VARCHAR[], %s::VARCHAR[]) AS a(filename, content_hash)
+            JOIN LATERAL (
+                SELECT (array_agg(id))[1] AS id FROM {id_img}
+                WHERE content_hash = a.content_hash
+                HAVING COUNT(*) = 1 AND bool_and(strpos(filename, {separator}) = 0)
+            ) AS img
+            ON TRUE
+            ON CONFLICT (filename) DO NOTHING
+            RETURNING filename;
+        ''').format(
+            id_alias=sql.Identifier(project, 'image_alias'),
+            id_img=sql.Identifier(project, 'image'),
+            separator=sql.Literal(VIRTUAL_WINDOW_SEPARATOR)
+        ), ([a[0] for a in aliases], [a[1] for a in aliases]), 'all')
+        registered = set([r['filename'] for r in result or []])
+        for filename, _ in aliases:
+            if filename not in registered:
+                print(f'\t[Project {project}] File "{filename}" is identical to a split image (or to several images) and has not been registered.')
+
+
+    def _get_upload_pool(self, numFiles):
+        '''
+            Returns the executor to verify uploaded files with: the process
+            pool of this DataWorker (created once and re-used for all up-
+            loads), or an inline executor for small uploads and if only one
+            worker is configured.
+        '''
+        if numFiles < self.UPLOAD_MIN_FILES_POOL or self.uploadNumWorkers <= 1:
+            return _InlineExecutor()
+        if self.uploadPool is None:
+            self.uploadPool = ProcessPoolExecutor(max_workers=self.uploadNumWorkers)
+        return self.uploadPool
+
+
+
     def uploadImages(self, project, images, existingFiles='keepExisting',
-        splitImages=False, splitProperties=None):
+        splitImages=False, splitProperties=None, deduplicate=None):
         '''
             Receives a dict of files (bottle.py file format),
             verifies their file extension and checks if they
@@ -225,6 +485,24 @@ class DataWorker:
             "imageName_x_y.jpg", with "imageName" denoting the name of the ori-
             ginal image, and "x" and "y" the left and top position of the patch
             inside the original image.
+            If "splitProperties" additionally contains "'virtual': True", the
+            original image is stored as-is and the patches are registered as
+            virtual images (file name plus window, e.g. "imageName.jpg?window=
+            x,y,width,height") that are cropped on the fly by the file server.
+            This way, images can be re-split with other patch sizes later on.
+
+            Uploads are first streamed to a temporary staging folder, then ve-
+            rified (and split, if requested) in a pool of worker processes (see
+            "upload_num_workers" in the configuration file) that is shared by
+            all uploads; uploads of few files (e.g. the single-file requests
+            of the web interface) are verified directly. Verified images
+            are moved to the project folder without re-encoding, and regis-
+            tered in the database in batches of "upload_db_batch_size".
+            If "deduplicate" is True (default: value of "deduplicate_images" in
+            the configuration file), uploads whose contents are identical to an
+            image already in the project (or to another upload of the same re-
+            quest) are not stored. Their keys are returned in "imgs_duplicate",
+            together with the file name of the identical image.
 
             Returns image keys for images that were successfully
             saved, and keys and error messages for those that
@@ -234,155 +512,236 @@ class DataWorker:
         imgs_valid = []
         imgs_warn = {}
         imgs_error = {}
-        for key in images.keys():
-            try:
-                nextUpload = images[key]
-                nextFileName = nextUpload.raw_filename
-                #TODO: check if raw_filename is compatible with uploads made from Windows
-
-                # check if correct file suffix
-                _, ext = os.path.splitext(nextFileName)
-                if not ext.lower() in valid_image_extensions:
-                    raise Exception(f'Invalid file type (*{ext})')
-
-                # check if loadable as image
-                cache = io.BytesIO()
-                nextUpload.save(cache)
+        imgs_duplicate = {}
+        bytesSaved = 0
+
+        if deduplicate is None:
+            deduplicate = self.deduplicateImages
+
+        projectFolder = os.path.join(self.config.getProperty('FileServer', 'staticfiles_dir'), project)
+        stagingDir = os.path.join(self.tempDir, 'aide/uploads', project, str(uuid4()))
+        os.makedirs(stagingDir, exist_ok=True)
+
+        if splitImages:
+            splitArgs = (splitProperties['patchSize'],
+                        splitProperties['stride'],
+                        splitProperties['tight'])
+            splitVirtual = bool(splitProperties.get('virtual', False))
+        else:
+            splitArgs = None
+            splitVirtual = False
+
+        existingNames = {}          # cache of file names per destination folder
+        uploadHashes = {}           # content hashes of files stored through this upload
+        imgPaths_register = []      # pending batch of (path, hash) to register in database
+        imgPaths_replace = []       # pending batch of paths whose metadata must be removed
+        pool = self._get_upload_pool(len(images))
+        try:
+            # stream uploads to staging folder and dispatch verification
+            jobs = {}
+            for idx, key in enumerate(images.keys()):
                 try:
-                    image = Image.open(cache)
-                except Exception:
-                    raise Exception('File is not a valid image.')
-
-                # prepare image(s) to save to disk
-                parent, filename = os.path.split(nextFileName)
-                destFolder = os.path.join(self.config.getProperty('FileServer', 'staticfiles_dir'), project, parent)
-                os.makedirs(destFolder, exist_ok=True)
-
-                images = []
-                filenames = []
-
-                if not splitImages:
-                    # upload the single image directly
-                    images.append(image)
-                    filenames.append(filename)
-
-                else:
-                    # split image into patches instead
-                    images, coords = split_image(image,
-                                            splitProperties['patchSize'],
-                                            splitProperties['stride'],
-                                            splitProperties['tight'])
-                    bareFileName, ext = os.path.splitext(filename)
-                    filenames = [f'{bareFileName}_{c[0]}_{c[1]}{ext}' for c in coords]
-
-                # register and save all the images
-                for i in range(len(images)):
-                    subImage = images[i]
-                    subFilename = filenames[i]
-
-                    absFilePath = os.path.join(destFolder, subFilename)
-
-                    # check if an image with the same name does not already exist
-                    newFileName = subFilename
-                    fileExists = os.path.exists(absFilePath)
-                    if fileExists:
-                        if existingFiles == 'keepExisting':
-                            # rename new file
-                            while(os.path.exists(absFilePath)):
-                                # rename file
-                                fn, ext = os.path.splitext(newFileName)
-                                match = self.countPattern.search(fn)
-                                if match is None:
-                                    newFileName = fn + '_1' + ext
-                                else:
-                                    # parse number
-                                    number = int(fn[match.span()[0]+1:match.span()[1]])
-                                    newFileName = fn[:match.span()[0]] + '_' + str(number+1) + ext
-
-                                absFilePath = os.path.join(destFolder, newFileName)
-                                if not os.path.exists(absFilePath):
+                    nextUpload = images[key]
+                    nextFileName = nextUpload.raw_filename
+                    #TODO: check if raw_filename is compatible with uploads made from Windows
+
+                    # check if correct file suffix
+                    _, ext = os.path.splitext(nextFileName)
+                    if not ext.lower() in valid_image_extensions:
+                        raise Exception(f'Invalid file type (*{ext})')
+
+                    stagingPath = os.path.join(stagingDir, str(idx) + ext)
+                    nextUpload.save(stagingPath)
+                    job = pool.submit(_prepare_upload, stagingPath,
+                                    os.path.join(stagingDir, str(idx)),
+                                    os.path.split(nextFileName)[1],
+                                    splitArgs, splitVirtual)
+                    jobs[job] = (key, nextFileName, stagingPath)
+
+                except Exception as e:
+                    if isinstance(e, BrokenProcessPool):
+                        self.uploadPool = None
+                    imgs_error[key] = str(e)
+
+            # move verified images to project folder in batches, as they come in
+            numPending = len(jobs)
+            completed = []
+            for job in as_completed(jobs):
+                completed.append(job)
+                numPending -= 1
+                if len(completed) < self.uploadDBbatchSize and numPending > 0:
+                    continue
+
+                # look up content hashes of batch in database
+                knownHashes = {}
+                if deduplicate:
+                    batchHashes = set([j.result()[0] for j in completed if j.exception() is None])
+                    knownHashes = self._lookup_content_hashes(project, batchHashes.difference(uploadHashes.keys()))
+
+                for job in completed:
+                    key, nextFileName, stagingPath = jobs[job]
+                    try:
+                        contentHash, stagedFiles = job.result()
+
+                        if deduplicate:
+                            duplicateOf = uploadHashes.get(contentHash, knownHashes.get(contentHash, None))
+                            if duplicateOf is not None:
+                                # identical image exists; do not store again
+                                imgs_duplicate[key] = duplicateOf
+                                imgs_warn[key] = f'Image is identical to existing image "{duplicateOf}" and has been skipped.'
+                                imgs_valid.append(key)
+                                imgPaths_valid.append(duplicateOf)
+                                bytesSaved += os.path.getsize(stagingPath)
+                                continue
+
+                        parent, _ = os.path.split(nextFileName)
+                        destFolder = os.path.join(projectFolder, parent)
+                        os.makedirs(destFolder, exist_ok=True)
+
+                        for stagedPath, subFilename, windows in stagedFiles:
+                            newFileName = subFilename
+                            absFilePath = os.path.join(destFolder, newFileName)
+
+                            if destFolder not in existingNames:
+                                existingNames[destFolder] = set(os.listdir(destFolder))
+                            if newFileName in existingNames[destFolder]:
+                                if existingFiles == 'keepExisting':
+                                    # rename new file
+                                    newFileName = self._resolve_filename(destFolder, subFilename, existingNames)
+                                    absFilePath = os.path.join(destFolder, newFileName)
                                     imgs_warn[key] = 'An image with name "{}" already exists under given path on disk. Image has been renamed to "{}".'.format(
                                         subFilename, newFileName
                                     )
-                        
-                        elif existingFiles == 'skipExisting':
-                            # ignore new file
-                            imgs_warn[key] = f'Image "{newFileName}" already exists on disk and has been skipped.'
-                            imgs_valid.append(key)
-                            imgPaths_valid.append(os.path.join(parent, newFileName))
-                            continue
 
-                        elif existingFiles == 'replaceExisting':
-                            # overwrite new file; first remove metadata
-                            queryStr = sql.SQL('''
-                                DELETE FROM {id_iu}
-                                WHERE image = (
-                                    SELECT id FROM {id_img}
-                                    WHERE filename = %s
-                                );
-                                DELETE FROM {id_anno}
-                                WHERE image = (
-                                    SELECT id FROM {id_img}
-                                    WHERE filename = %s
-                                );
-                                DELETE FROM {id_pred}
-                                WHERE image = (
-                                    SELECT id FROM {id_img}
-                                    WHERE filename = %s
-                                );
-                                DELETE FROM {id_img}
-                                WHERE filename = %s;
-                            ''').format(
-                                id_iu=sql.Identifier(project, 'image_user'),
-                                id_anno=sql.Identifier(project, 'annotation'),
-                                id_pred=sql.Identifier(project, 'prediction'),
-                                id_img=sql.Identifier(project, 'image')
-                            )
-                            self.dbConnector.execute(queryStr,
-                                tuple([nextFileName]*4), None)
-
-                            # remove file
-                            try:
-                                os.remove(absFilePath)
-                                imgs_warn[key] = 'Image "{}" already existed on disk and has been deleted.\n'.format(newFileName) + \
-                                                    'All metadata (views, annotations, predictions) have been removed from the database.'
-                            except:
-                                imgs_warn[key] = 'Image "{}" already existed on disk but could not be deleted.\n'.format(newFileName) + \
-                                                    'All metadata (views, annotations, predictions) have been removed from the database.'
-                    
-                    # write to disk
-                    fileParent, _ = os.path.split(absFilePath)
-                    if len(fileParent):
-                        os.makedirs(fileParent, exist_ok=True)
-                    subImage.save(absFilePath)
-
-                    imgs_valid.append(key)
-                    imgPaths_valid.append(os.path.join(parent, newFileName))
-
-            except Exception as e:
-                imgs_error[key] = str(e)
-
-        # register valid images in database
-        if len(imgPaths_valid):
-            queryStr = sql.SQL('''
-                INSERT INTO {id_img} (filename)
-                VALUES %s
-                ON CONFLICT (filename) DO NOTHING;
-            ''').format(
-                id_img=sql.Identifier(project, 'image')
-            )
-            self.dbConnector.insert(queryStr, [(i,) for i in imgPaths_valid])
+                                elif existingFiles == 'skipExisting':
+                                    # ignore new file
+                                    imgs_warn[key] = f'Image "{newFileName}" already exists on disk and has been skipped.'
+                                    imgs_valid.append(key)
+                                    imgPaths_valid.append(os.path.join(parent, newFileName))
+                                    continue
+
+                                elif existingFiles == 'replaceExisting':
+                                    # overwrite existing file; metadata is removed together with the next batch registration
+                                    imgPaths_replace.append(os.path.join(parent, newFileName))
+                                    imgs_warn[key] = 'Image "{}" already existed on disk and has been replaced.\n'.format(newFileName) + \
+                                                        'All metadata (views, annotations, predictions) have been removed from the database.'
+
+                            # move to project folder (replaces existing files)
+                            shutil.move(stagedPath, absFilePath)
+                            existingNames[destFolder].add(newFileName)
+                            if contentHash not in uploadHashes:
+                                uploadHashes[contentHash] = os.path.join(parent, newFileName)
+
+                            imgs_valid.append(key)
+                            if windows is None:
+                                imgPaths_valid.append(os.path.join(parent, newFileName))
+                                imgPaths_register.append((os.path.join(parent, newFileName), contentHash))
+                            else:
+                                # register virtual patches instead of parent image
+                                for window in windows:
+                                    virtualPath = get_virtual_filename(os.path.join(parent, newFileName), window)
+                                    imgPaths_valid.append(virtualPath)
+                                    imgPaths_register.append((virtualPath, contentHash))
+
+                    except Exception as e:
+                        if isinstance(e, BrokenProcessPool):
+                            # e.g. a worker process has been killed; start a new pool next time
+                            self.uploadPool = None
+                        imgs_error[key] = str(e)
+
+                # register valid images in database
+                self._register_uploaded_images(project, imgPaths_register, imgPaths_replace)
+                imgPaths_register, imgPaths_replace, completed = [], [], []
+
+            # register remaining images
+            self._register_uploaded_images(project, imgPaths_register, imgPaths_replace)
+
+        finally:
+            shutil.rmtree(stagingDir, ignore_errors=True)
 
         result = {
             'imgs_valid': imgs_valid,
             'imgPaths_valid': imgPaths_valid,
             'imgs_warn': imgs_warn,
-            'imgs_error': imgs_error
+            'imgs_error': imgs_error,
+            'imgs_duplicate': imgs_duplicate,
+            'dedup': {
+                'num_duplicates': len(imgs_duplicate),
+                'bytes_saved': bytesSaved
+            }
         }
 
         return result
 
 
+    def _iterate_image_diff(self, projectFolder, project, startAfter=None):
+        '''
+            Compares the image files in the project folder on disk with the
+            image entries in the database with a sorted merge: files on disk
+            are listed in sorted order (see "helpers.iterDirectory") and merged
+            against a server-side cursor over the database entries, sorted by
+            their (parent) file name. Memory usage therefore does not depend
+            on the number of images, and differences are yielded as soon as
+            they are found.
+            Files registered as aliases of identical images (see "image_alias")
+            count as registered as well.
+            Yields tuples of (file name, image ID, alias flag). The image ID is
+            None for files that are on disk, but not in the database, and set
+            for database entries without file on disk. The alias flag is True
+            if the latter is an alias entry instead of an image.
+            The comparison can be resumed after a given file name through
+            argument "startAfter".
+        '''
+        # sort key: file name of parent image (for virtual patches), in byte order
+        parentExpr = sql.SQL('split_part(filename, {}, 1) COLLATE "C"').format(
+            sql.Literal(VIRTUAL_WINDOW_SEPARATOR))
+        if startAfter is not None:
+            whereImg = sql.SQL('WHERE {} > %s').format(parentExpr)
+            whereAlias = sql.SQL('WHERE filename COLLATE "C" > %s')
+            queryArgs = (startAfter, startAfter)
+        else:
+            whereImg, whereAlias = sql.SQL(''), sql.SQL('')
+            queryArgs = None
+        queryStr = sql.SQL('''
+            SELECT id, parent, is_alias FROM (
+                SELECT id, {parentExpr} AS parent, FALSE AS is_alias
+                FROM {id_img}
+                {whereImg}
+                UNION ALL
+                SELECT image AS id, filename COLLATE "C" AS parent, TRUE AS is_alias
+                FROM {id_alias}
+                {whereAlias}
+            ) AS entries
+            ORDER BY parent;
+        ''').format(
+            parentExpr=parentExpr,
+            id_img=sql.Identifier(project, 'image'),
+            id_alias=sql.Identifier(project, 'image_alias'),
+            whereImg=whereImg,
+            whereAlias=whereAlias
+        )
+        imgs_disk = iterDirectory(projectFolder, recursive=True, startAfter=startAfter)
+        imgs_db = self.dbConnector.execute_iterate(queryStr, queryArgs,
+                        self.watchFolderBatchSize)
+
+        nextDisk = next(imgs_disk, None)
+        nextDB = next(imgs_db, None)
+        while nextDisk is not None or nextDB is not None:
+            if nextDB is None or (nextDisk is not None and nextDisk < nextDB['parent']):
+                # untracked file on disk
+                yield nextDisk, None, False
+                nextDisk = next(imgs_disk, None)
+            elif nextDisk is None or nextDB['parent'] < nextDisk:
+                # orphaned database entry
+                yield nextDB['parent'], nextDB['id'], nextDB['is_alias']
+                nextDB = next(imgs_db, None)
+            else:
+                # file registered (possibly multiple times as virtual patches)
+                while nextDB is not None and nextDB['parent'] == nextDisk:
+                    nextDB = next(imgs_db, None)
+                nextDisk = next(imgs_disk, None)
+
+
     def scanForImages(self, project):
         '''
             Searches the project image folder on disk for
@@ -396,22 +755,13 @@ class DataWorker:
         if (not os.path.isdir(projectFolder)) and (not os.path.islink(projectFolder)):
             # no folder exists for the project (should not happen due to broadcast at project creation)
             return []
-        imgs_disk = listDirectory(projectFolder, recursive=True)
-        
-        # get all existing file paths from database
-        imgs_database = set()
-        queryStr = sql.SQL('''
-            SELECT filename FROM {id_img};
-        ''').format(
-            id_img=sql.Identifier(project, 'image')
-        )
-        result = self.dbConnector.execute(queryStr, None, 'all')
-        for r in range(len(result)):
-            imgs_database.add(result[r]['filename'])
 
-        # filter
-        imgs_candidates = imgs_disk.difference(imgs_database)
-        return list(imgs_candidates)
+        # compare with database; virtual patches count as registered parent image
+        imgs_candidates = []
+        for filename, imageID, _ in self._iterate_image_diff(projectFolder, project):
+            if imageID is None:
+                imgs_candidates.append(filename)
+        return imgs_candidates
 
 
     def addExistingImages(self, project, imageList=None):
@@ -424,6 +774,10 @@ class DataWorker:
             the intersection between identified images on
             disk and in the iterable are added.
 
+            If image deduplication is enabled, files whose contents
+            are identical to an existing image are registered as
+            aliases of the latter instead.
+
             Returns a list of image IDs and file names that
             were eventually added to the project database schema.
         '''
@@ -438,14 +792,22 @@ class DataWorker:
         if not len(imgs_add):
             return 0, []
 
+        projectFolder = os.path.join(self.config.getProperty('FileServer', 'staticfiles_dir'), project)
+        imgs_unique, imgs_duplicate = self._deduplicate_files(project, projectFolder, imgs_add)
+        imgs_add = [i[0] for i in imgs_unique]
+
         # add to database
-        queryStr = sql.SQL('''
-            INSERT INTO {id_img} (filename)
-            VALUES %s;
-        ''').format(
-            id_img=sql.Identifier(project, 'image')
-        )
-        self.dbConnector.insert(queryStr, tuple([(i,) for i in imgs_add]))
+        if len(imgs_unique):
+            queryStr = sql.SQL('''
+                INSERT INTO {id_img} (filename, content_hash)
+                VALUES %s;
+            ''').format(
+                id_img=sql.Identifier(project, 'image')
+            )
+            self.dbConnector.insert(queryStr, imgs_unique)
+        self._register_image_aliases(project, imgs_duplicate)
+        if not len(imgs_add):
+            return 0, []
 
         # get IDs of newly added images
         queryStr = sql.SQL('''
@@ -575,29 +937,47 @@ class DataWorker:
             entries for which no image can be found on disk anymore. Removes
             and returns those entries and all associated (meta-) data from the
             database.
+            Orphaned entries are removed in chunks while the comparison is
+            ongoing, so that an interrupted run can simply be repeated.
+            Aliases of images (see "addExistingImages") whose files are miss-
+            ing are removed, too; the images they point to are kept.
         '''
-        imgs_DB = self.dbConnector.execute(sql.SQL('''
-            SELECT id, filename FROM {id_img};
-        ''').format(
-            id_img=sql.Identifier(project, 'image')
-        ), None, 'all')
-
         projectFolder = os.path.join(self.config.getProperty('FileServer', 'staticfiles_dir'), project)
         if (not os.path.isdir(projectFolder)) and (not os.path.islink(projectFolder)):
             return []
-        imgs_disk = listDirectory(projectFolder, recursive=True)
-        imgs_disk = set(imgs_disk)
-        
-        # get orphaned images
+
+        # get and remove orphaned images
         imgs_orphaned = []
-        for i in imgs_DB:
-            if i['filename'] not in imgs_disk:
-                imgs_orphaned.append(i['id'])
-        # imgs_orphaned = list(set(imgs_DB).difference(imgs_disk))
-        if not len(imgs_orphaned):
-            return []
-        
-        # remove
+        chunk = []
+        aliases_orphaned = []
+        for filename, imageID, isAlias in self._iterate_image_diff(projectFolder, project):
+            if imageID is None:
+                continue
+            if isAlias:
+                aliases_orphaned.append(filename)
+                if len(aliases_orphaned) >= self.watchFolderBatchSize:
+                    self._delete_image_aliases(project, aliases_orphaned)
+                    aliases_orphaned = []
+                continue
+            chunk.append(imageID)
+            if len(chunk) >= self.watchFolderBatchSize:
+                self._delete_image_entries(project, chunk)
+                imgs_orphaned.extend(chunk)
+                chunk = []
+        if len(chunk):
+            self._delete_image_entries(project, chunk)
+            imgs_orphaned.extend(chunk)
+        if len(aliases_orphaned):
+            self._delete_image_aliases(project, aliases_orphaned)
+
+        return imgs_orphaned
+
+
+    def _delete_image_entries(self, project, imageIDs):
+        '''
+            Removes the images with given IDs and all associated (meta-)
+            data from the database.
+        '''
         self.dbConnector.execute(sql.SQL('''
             DELETE FROM {id_iu} WHERE image IN %s;
             DELETE FROM {id_anno} WHERE image IN %s;
@@ -608,9 +988,18 @@ class DataWorker:
             id_anno=sql.Identifier(project, 'annotation'),
             id_pred=sql.Identifier(project, 'prediction'),
             id_img=sql.Identifier(project, 'image')
-        ), tuple([tuple(imgs_orphaned)] * 4), None)
+        ), tuple([tuple(imageIDs)] * 4), None)
 
-        return imgs_orphaned
+
+    def _delete_image_aliases(self, project, filenames):
+        '''
+            Removes alias entries with given file names from the database.
+        '''
+        self.dbConnector.execute(sql.SQL('''
+            DELETE FROM {id_alias} WHERE filename = ANY(%s::VARCHAR[]);
+        ''').format(
+            id_alias=sql.Identifier(project, 'image_alias')
+        ), (list(filenames),), None)
 
 
 
@@ -893,29 +1282,177 @@ class DataWorker:
 
 
 
-    def watchImageFolders(self):
+    def getWatchedProjects(self):
         '''
-            Queries all projects that have the image folder watch functionality
-            enabled and updates the projects, one by one, with the latest image
-            changes.
+            Returns all projects that have the image folder watch functiona-
+            lity enabled, together with the flag whether images missing on
+            disk should be removed from the database.
         '''
-        print('Scanning project image folders for changes...')
         projects = self.dbConnector.execute('''
                 SELECT shortname, watch_folder_remove_missing_enabled
                 FROM aide_admin.project
                 WHERE watch_folder_enabled IS TRUE;
             ''', None, 'all')
+        if projects is None:
+            return []
+        return [(p['shortname'], p['watch_folder_remove_missing_enabled']) for p in projects]
 
-        for p in projects:
-            pName = p['shortname']
 
-            # add new images
-            _, imgs_added = self.addExistingImages(pName)
+    def _filter_unregistered(self, project, filenames):
+        '''
+            Returns the file names out of the given ones that are neither re-
+            gistered as an image (or as parent of virtual patches), nor as an
+            alias of an image (uses the indices on the parent file names).
+        '''
+        if not len(filenames):
+            return []
+        result = self.dbConnector.execute(sql.SQL('''
+            SELECT t.fn FROM unnest(%s::VARCHAR[]) AS t(fn)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {id_img} AS i
+                WHERE split_part(i.filename, {separator}, 1) COLLATE "C" = t.fn
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM {id_alias} AS a
+                WHERE a.filename COLLATE "C" = t.fn
+            );
+        ''').format(
+            id_img=sql.Identifier(project, 'image'),
+            id_alias=sql.Identifier(project, 'image_alias'),
+            separator=sql.Literal(VIRTUAL_WINDOW_SEPARATOR)
+        ), (list(filenames),), 'all')
+        if result is None:
+            return []
+        return [r['fn'] for r in result]
 
-            # remove orphaned images (if enabled)
-            if p['watch_folder_remove_missing_enabled']:
-                imgs_orphaned = self.removeOrphanedImages(pName)
-                print(f'\t[Project {pName}] {len(imgs_added)} new images found and added, {len(imgs_orphaned)} orphaned images removed from database.')
+
+    def _register_watched_images(self, project, imgs_new):
+        '''
+            Registers image files that appeared in a watched project folder
+            in the database, unless they are already registered (also as
+            parent of virtual patches, or as alias). Only files that are not
+            registered are hashed; duplicates of existing images are
+            registered as aliases if deduplication is enabled. Returns IDs
+            and file names of the images added.
+        '''
+        imgs_added = []
+        projectFolder = os.path.join(self.config.getProperty('FileServer', 'staticfiles_dir'), project)
+        for chunk in array_split(imgs_new, self.watchFolderBatchSize):
+            # skip files registered already (e.g. through an upload), so
+            # that they are neither hashed again nor aliased to themselves
+            chunk = self._filter_unregistered(project, chunk)
+            if not len(chunk):
+                continue
+            imgs_unique, imgs_duplicate = self._deduplicate_files(project, projectFolder, chunk)
+            if len(imgs_unique):
+                # anti-join on the candidates only (uses index on parent file name)
+                result = self.dbConnector.execute(sql.SQL('''
+                    INSERT INTO {id_img} (filename, content_hash)
+                    SELECT fn, h FROM unnest(%s::VARCHAR[], %s::VARCHAR[]) AS t(fn, h)
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {id_img} AS i
+                        WHERE split_part(i.filename, {separator}, 1) COLLATE "C" = t.fn
+                    )
+                    ON CONFLICT (filename) DO NOTHING
+                    RETURNING id, filename;
+                ''').format(
+                    id_img=sql.Identifier(project, 'image'),
+                    separator=sql.Literal(VIRTUAL_WINDOW_SEPARATOR)
+                ), ([i[0] for i in imgs_unique], [i[1] for i in imgs_unique]), 'all')
+                if result is not None:
+                    imgs_added.extend(result)
+            self._register_image_aliases(project, imgs_duplicate)
+        return imgs_added
+
+
+    def _remove_watched_images(self, project, imgs_removed):
+        '''
+            Removes images (and virtual patches thereof) whose files disap-
+            peared from a watched project folder from the database, as well
+            as aliases with missing files. Returns the IDs of the images re-
+            moved.
+        '''
+        imgs_orphaned = []
+        for chunk in array_split(imgs_removed, self.watchFolderBatchSize):
+            if not len(chunk):
+                continue
+            self._delete_image_aliases(project, chunk)
+            result = self.dbConnector.execute(sql.SQL('''
+                SELECT id FROM {id_img}
+                WHERE split_part(filename, {separator}, 1) COLLATE "C" = ANY(%s::VARCHAR[]);
+            ''').format(
+                id_img=sql.Identifier(project, 'image'),
+                separator=sql.Literal(VIRTUAL_WINDOW_SEPARATOR)
+            ), (list(chunk),), 'all')
+            if result is None or not len(result):
+                continue
+            imageIDs = [r['id'] for r in result]
+            self._delete_image_entries(project, imageIDs)
+            imgs_orphaned.extend(imageIDs)
+        return imgs_orphaned
+
+
+    def watchProjectFolder(self, project, removeMissing=False):
+        '''
+            Updates the project's image entries in the database with the
+            latest changes in the project's image folder on disk.
+            A snapshot of the folder (see "folderWatcher.FolderSnapshot") is
+            kept on the file server, so that only directories that changed
+            since the last scan are listed. The snapshot is only updated after
+            the changes have been registered in the database. Upon the first scan, the snapshot
+            is created and the database fully synchronized with the folder.
+            If "removeMissing" is True, images whose files are not on disk
+            anymore are removed from the database as well.
+            Scans are skipped if another scan of the same project is running.
+            Returns the images added and the IDs of the images removed.
+        '''
+        projectFolder = os.path.join(self.config.getProperty('FileServer', 'staticfiles_dir'), project)
+        if (not os.path.isdir(projectFolder)) and (not os.path.islink(projectFolder)):
+            return [], []
+
+        snapshot = FolderSnapshot(os.path.join(self.snapshotDir, project + '.sqlite'), projectFolder)
+        os.makedirs(self.snapshotDir, exist_ok=True)
+        with open(os.path.join(self.snapshotDir, project + '.lock'), 'w') as lockFile:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    # project is being scanned by another worker
+                    return [], []
+
+            if not snapshot.exists():
+                # first scan: take snapshot, then synchronize database in full
+                snapshot.scan()
+                _, imgs_added = self.addExistingImages(project)
+                imgs_orphaned = (self.removeOrphanedImages(project) if removeMissing else [])
 
             else:
-                print(f'\t[Project {pName}] {len(imgs_added)} new images found and added.')
\ No newline at end of file
+                imgs_new, imgs_removed = snapshot.scan()
+                imgs_added = self._register_watched_images(project, imgs_new)
+                imgs_orphaned = (self._remove_watched_images(project, imgs_removed) if removeMissing else [])
+
+            # only record changes once they are reflected in the database (re-
+            # ported again by the next scan otherwise)
+            snapshot.save()
+
+        if imgs_added is None:
+            imgs_added = []
+        if removeMissing:
+            print(f'\t[Project {project}] {len(imgs_added)} new images found and added, {len(imgs_orphaned)} orphaned images removed from database.')
+        else:
+            print(f'\t[Project {project}] {len(imgs_added)} new images found and added.')
+        return imgs_added, imgs_orphaned
+
+
+
+    def watchImageFolders(self):
+        '''
+            Queries all projects that have the image folder watch functionality
+            enabled and updates the projects, one by one, with the latest image
+            changes.
+            Note: when run through Celery, the projects are instead distributed
+            across the FileServer workers (see "celery_interface").
+        '''
+        print('Scanning project image folders for changes...')
+        for pName, removeMissing in self.getWatchedProjects():
+            self.watchProjectFolder(pName, removeMissing)
@@ -0,0 +1,201 @@
+'''
+    Incremental scanning of project image folders.
+    Keeps a persistent snapshot of a project's directory tree (modification
+    times of all directories and the image file names therein) in an SQLite
+    database on the file server. Upon every scan, only directories whose
+    modification time changed since the last scan are listed again, so that
+    the cost of a rescan is proportional to the number of directories and
+    changes rather than to the total number of files.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import time
+import sqlite3
+from util.helpers import valid_image_extensions
+
+
+class FolderSnapshot:
+
+    # directories modified less than this many seconds before a scan are
+    # listed again upon the next scan (mtime granularity of file systems)
+    MTIME_SAFETY_MARGIN = 2.0
+
+
+    def __init__(self, snapshotPath, baseDir):
+        self.snapshotPath = snapshotPath
+        self.baseDir = baseDir
+        self.pending = None         # changes found by the last scan, not yet saved
+
+
+    def exists(self):
+        '''
+            Returns True if a snapshot of the folder has been saved before.
+        '''
+        if not os.path.isfile(self.snapshotPath):
+            return False
+        conn = self._connect()
+        try:
+            return conn.execute('SELECT 1 FROM directory LIMIT 1;').fetchone() is not None
+        finally:
+            conn.close()
+
+
+    def _connect(self):
+        parent, _ = os.path.split(self.snapshotPath)
+        if len(parent):
+            os.makedirs(parent, exist_ok=True)
+        conn = sqlite3.connect(self.snapshotPath)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS directory (
+                path TEXT PRIMARY KEY,
+                parent TEXT,
+                mtime REAL NOT NULL
+            );
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS file (
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                PRIMARY KEY (directory, name)
+            );
+        ''')
+        return conn
+
+
+    def _list_directory(self, absDir, baseDirReal):
+        '''
+            Lists the image files and subdirectories of a single directory.
+            Symbolic links pointing to the base directory or one of its
+            parents are skipped to avoid circular scans.
+        '''
+        files, subdirs = set(), []
+        with os.scandir(absDir) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        if os.path.splitext(entry.name)[1].lower() in valid_image_extensions:
+                            files.add(entry.name)
+                    elif entry.is_dir():
+                        if entry.is_symlink():
+                            target = os.path.realpath(entry.path)
+                            if baseDirReal == target or baseDirReal.startswith(target + os.sep):
+                                # circular link; avoid
+                                continue
+                        subdirs.append(entry.name)
+                except OSError:
+                    continue
+        return files, subdirs
+
+
+    def scan(self):
+        '''
+            Walks the directory tree and lists all directories that are new
+            or have changed since the last scan. Returns two lists of file
+            paths (relative to the base directory) with the image files that
+            have been added, resp. removed since.
+            The snapshot itself is not modified; the changes are only re-
+            corded upon calling "save" (e.g. after they have been registered
+            in the database), so that they are reported again by the next
+            scan if processing them fails.
+        '''
+        imgs_added, imgs_removed = [], []
+        pending = {
+            'files_added': [],
+            'files_removed': [],
+            'dirs_updated': [],
+            'dirs_removed': []
+        }
+        baseDirReal = os.path.realpath(self.baseDir)
+        now = time.time()
+
+        conn = self._connect()
+        try:
+            known = {}
+            children = {}
+            for path, parent, mtime in conn.execute('SELECT path, parent, mtime FROM directory;'):
+                known[path] = mtime
+                if parent is not None:
+                    children.setdefault(parent, []).append(path)
+
+            visited = set()
+            stack = [('', None)]
+            while len(stack):
+                relDir, parent = stack.pop()
+                if relDir in visited:
+                    continue
+                absDir = os.path.join(self.baseDir, relDir)
+                try:
+                    mtime = os.stat(absDir).st_mtime
+                except OSError:
+                    # directory vanished; treated as removed below
+                    continue
+                visited.add(relDir)
+
+                if relDir in known and known[relDir] == mtime:
+                    # directory unchanged; only its subdirectories need to be checked
+                    for child in children.get(relDir, []):
+                        stack.append((child, relDir))
+                    continue
+
+                # directory is new or has changed: list contents and compare
+                try:
+                    files, subdirs = self._list_directory(absDir, baseDirReal)
+                except OSError:
+                    continue
+                filesBefore = set([r[0] for r in conn.execute(
+                    'SELECT name FROM file WHERE directory = ?;', (relDir,))])
+                newFiles = files.difference(filesBefore)
+                goneFiles = filesBefore.difference(files)
+                pending['files_added'].extend([(relDir, f) for f in newFiles])
+                pending['files_removed'].extend([(relDir, f) for f in goneFiles])
+                imgs_added.extend([os.path.join(relDir, f) for f in newFiles])
+                imgs_removed.extend([os.path.join(relDir, f) for f in goneFiles])
+
+                # recently modified directories are listed again next time
+                if now - mtime < self.MTIME_SAFETY_MARGIN:
+                    mtime = -1
+                pending['dirs_updated'].append((relDir, parent, mtime))
+
+                for s in subdirs:
+                    stack.append((os.path.join(relDir, s), relDir))
+
+            # directories that do not exist anymore
+            for relDir in set(known.keys()).difference(visited):
+                goneFiles = [r[0] for r in conn.execute(
+                    'SELECT name FROM file WHERE directory = ?;', (relDir,))]
+                imgs_removed.extend([os.path.join(relDir, f) for f in goneFiles])
+                pending['dirs_removed'].append((relDir,))
+        finally:
+            conn.close()
+
+        self.pending = pending
+        return imgs_added, imgs_removed
+
+
+    def save(self):
+        '''
+            Records the changes found by the last call of "scan" in the
+            snapshot (in a single transaction). Does nothing if there are no
+            pending changes.
+        '''
+        pending = self.pending
+        if pending is None:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany('INSERT OR IGNORE INTO file (directory, name) VALUES (?, ?);',
+                    pending['files_added'])
+                conn.executemany('DELETE FROM file WHERE directory = ? AND name = ?;',
+                    pending['files_removed'])
+                conn.executemany('''
+                    INSERT INTO directory (path, parent, mtime) VALUES (?, ?, ?)
+                    ON CONFLICT (path) DO UPDATE SET parent = excluded.parent, mtime = excluded.mtime;
+                ''', pending['dirs_updated'])
+                conn.executemany('DELETE FROM file WHERE directory = ?;', pending['dirs_removed'])
+                conn.executemany('DELETE FROM directory WHERE path = ?;', pending['dirs_removed'])
+        finally:
+            conn.close()
+        self.pending = None
@@ -166,13 +166,14 @@ class DataAdministrationMiddleware:
 
 
     def uploadImages(self, project, images, existingFiles='keepExisting',
-        splitImages=False, splitProperties=None):
+        splitImages=False, splitProperties=None, deduplicate=None):
         '''
             Image upload is handled directly through the
             dataWorker, without a Celery dispatching bridge.
         '''
         return self.dataWorker.uploadImages(project, images, existingFiles,
-                                            splitImages, splitProperties)
+                                            splitImages, splitProperties,
+                                            deduplicate)
 
 
 
@@ -4,8 +4,12 @@
     2019 Benjamin Kellenberger
 '''
 
+import io
+import csv
 from contextlib import contextmanager
+from uuid import uuid4
 import psycopg2
+from psycopg2 import sql
 from psycopg2.pool import ThreadedConnectionPool
 from psycopg2.extras import RealDictCursor, execute_values
 psycopg2.extras.register_uuid()
@@ -129,6 +133,32 @@ class Database():
                     print(e)
 
 
+    def execute_iterate(self, query, arguments, batchSize=10000):
+        '''
+            Executes a query with a server-side (named) cursor and yields the
+            resulting rows one by one, while fetching them from the server in
+            batches of "batchSize". Memory usage is thus independent of the
+            number of rows returned, and rows can be processed as soon as the
+            first batch has arrived.
+        '''
+        with self._get_connection() as conn:
+            conn.autocommit = False     # named cursors require a transaction
+            try:
+                with conn.cursor(name='aide_' + uuid4().hex, cursor_factory=RealDictCursor) as cursor:
+                    cursor.itersize = batchSize
+                    cursor.execute(query, arguments)
+                    for row in cursor:
+                        yield row
+                conn.commit()
+            except:
+                if not conn.closed:
+                    conn.rollback()
+                raise
+            finally:
+                if not conn.closed:
+                    conn.autocommit = True
+
+
     def insert(self, query, values):
         with self._get_connection() as conn:
             cursor = conn.cursor()
@@ -149,4 +179,34 @@ class Database():
                 except Exception as e:
                     if not conn.closed:
                         conn.rollback()
-                    print(e)
\ No newline at end of file
+                    print(e)
+
+
+    def copy_from(self, table, columns, values):
+        '''
+            Inserts rows (iterable of tuples) into a table (psycopg2 "sql.
+            Identifier") with a single "COPY" statement, which is considerably
+            faster than "insert" for large numbers of rows. Values must have a
+            text representation that PostgreSQL accepts for the respective
+            column (e.g. numbers, strings, UUIDs, booleans) or be None (NULL).
+            Unlike "insert", errors are raised to the caller.
+        '''
+        # strings (also empty ones) are quoted, so that only None maps to NULL
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC, lineterminator='\n')
+        for row in values:
+            writer.writerow(row)
+        buffer.seek(0)
+        query = sql.SQL('COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv)').format(
+            table=table,
+            columns=sql.SQL(',').join([sql.Identifier(c) for c in columns])
+        )
+        with self._get_connection() as conn:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.copy_expert(query, buffer)
+                conn.commit()
+            except:
+                if not conn.closed:
+                    conn.rollback()
+                raise
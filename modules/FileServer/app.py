@@ -5,9 +5,21 @@
 '''
 
 import os
-from bottle import static_file
+from io import BytesIO
+from bottle import static_file, request, response, abort
 from util.cors import enable_cors
 from util import helpers
+from util.imageSharding import ImageCache, parse_window
+
+
+# MIME types of image formats virtual patches are encoded in
+IMAGE_MIME_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'BMP': 'image/bmp',
+    'ICO': 'image/x-icon'
+}
 
 
 class FileServer():
@@ -24,9 +36,37 @@ class FileServer():
         if not self.staticAddress.startswith(os.sep):
             self.staticAddress = os.sep + self.staticAddress
 
+        # cache of decoded parent images to crop virtual patches from
+        self.imageCache = ImageCache(self.config.getProperty('FileServer', 'virtual_image_cache_size', type=int, fallback=512)*1024*1024)
+
         self._initBottle()
 
 
+    def _send_window(self, project, path, window):
+        '''
+            Crops a virtual patch from its parent image on disk and returns
+            it encoded in the format of the parent image.
+        '''
+        try:
+            window = parse_window(window)
+        except Exception as e:
+            abort(400, str(e))
+        root = os.path.abspath(os.path.join(self.staticDir, project))
+        filePath = os.path.abspath(os.path.join(root, path))
+        if not filePath.startswith(root + os.sep) or not os.path.isfile(filePath):
+            abort(404, 'File does not exist.')
+
+        parent = self.imageCache.get_image(filePath)
+        patch = parent.crop((window[0], window[1], window[0]+window[2], window[1]+window[3]))
+        imageFormat = parent.format if parent.format is not None else 'PNG'
+        if imageFormat == 'JPEG' and patch.mode not in ('RGB', 'L', 'CMYK'):
+            patch = patch.convert('RGB')
+        bio = BytesIO()
+        patch.save(bio, imageFormat)
+        response.content_type = IMAGE_MIME_TYPES.get(imageFormat, 'application/octet-stream')
+        return bio.getvalue()
+
+
     def _initBottle(self):
 
         ''' static routing to files '''
@@ -35,8 +75,12 @@ class FileServer():
         # def send_file_deprecated(path):
         #     return static_file(path, root=self.staticDir)
 
-        
+
         @enable_cors
         @self.app.route(os.path.join('/', self.staticAddress, '<project>/files/<path:path>'))
         def send_file(project, path):
-            return static_file(path, root=os.path.join(self.staticDir, project))
\ No newline at end of file
+            window = request.query.get('window')
+            if window is not None:
+                # virtual image patch
+                return self._send_window(project, path, window)
+            return static_file(path, root=os.path.join(self.staticDir, project))
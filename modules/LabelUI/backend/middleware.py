@@ -16,7 +16,7 @@ from psycopg2 import sql
 from modules.Database.app import Database
 from .sql_string_builder import SQLStringBuilder
 from .annotation_sql_tokens import QueryStrings_annotation, AnnotationParser
-from util import helpers
+from util import helpers, maskCodec
 
 
 class DBMiddleware():
@@ -30,6 +30,7 @@ class DBMiddleware():
         self._fetchProjectSettings()
         self.sqlBuilder = SQLStringBuilder()
         self.annoParser = AnnotationParser()
+        self.segMaskCodec = maskCodec.get_codec(self.config)
 
 
     def _fetchProjectSettings(self):
@@ -98,6 +99,12 @@ class DBMiddleware():
                     elif isinstance(value, UUID):
                         value = str(value)
                     entry[c] = value
+                if entry.get('segmentationmask', None) is not None:
+                    # the labeling UI expects masks in the raw format
+                    entry['segmentationmask'], width, height = maskCodec.to_raw(
+                        entry['segmentationmask'], entry.get('width', None), entry.get('height', None))
+                    if 'width' in entry:
+                        entry['width'], entry['height'] = width, height
                 
                 if b['ctype'] == 'annotation':
                     response[imgID]['annotations'][entryID] = entry
@@ -574,6 +581,10 @@ class DBMiddleware():
                             annoValues.append(timeReq)
                         elif cname == 'username':
                             annoValues.append(username)
+                        elif cname == 'segmentationMask' and annotationTokens.get(cname, None) is not None:
+                            # submitted in the raw format; encode for storage
+                            annoValues.append(maskCodec.transcode(annotationTokens[cname], self.segMaskCodec,
+                                annotationTokens.get('width', None), annotationTokens.get('height', None)))
                         elif cname in annotationTokens:
                             annoValues.append(annotationTokens[cname])
                         elif cname == 'unsure':
@@ -148,12 +148,12 @@ class ModelMarketplaceMiddleware:
 
         sharedModelID = self.dbConnector.execute(sql.SQL('''
             INSERT INTO aide_admin.modelMarketplace
-            (name, description, labelclasses, author, statedict,
+            (name, description, labelclasses, author, statedict, statedict_ref,
             model_library, alCriterion_library,
             annotationType, predictionType,
             origin_project, origin_uuid, public, anonymous)
 
-            SELECT %s, %s, %s, %s, statedict,
+            SELECT %s, %s, %s, %s, statedict, statedict_ref,
             model_library, alCriterion_library,
             %s, %s,
             %s, id, %s, %s
@@ -202,7 +202,10 @@ class ProjectConfigMiddleware:
             'minnumannoperimage',
             'maxnumimages_train',
             'watch_folder_enabled',
-            'watch_folder_remove_missing_enabled'
+            'watch_folder_remove_missing_enabled',
+            'prediction_retention_num_states',
+            'prediction_retention_summarize',
+            'prediction_partitioning_enabled'
         ])
         if parameters is not None and parameters != '*':
             if isinstance(parameters, str):
@@ -310,12 +313,14 @@ class ProjectConfigMiddleware:
                 id_schema=sql.Identifier(shortname),
                 id_auth=sql.Identifier(self.config.getProperty('Database', 'user')),
                 id_image=sql.Identifier(shortname, 'image'),
+                id_imageAlias=sql.Identifier(shortname, 'image_alias'),
                 id_iu=sql.Identifier(shortname, 'image_user'),
                 id_labelclassGroup=sql.Identifier(shortname, 'labelclassgroup'),
                 id_labelclass=sql.Identifier(shortname, 'labelclass'),
                 id_annotation=sql.Identifier(shortname, 'annotation'),
                 id_cnnstate=sql.Identifier(shortname, 'cnnstate'),
                 id_prediction=sql.Identifier(shortname, 'prediction'),
+                id_predictionSummary=sql.Identifier(shortname, 'prediction_summary'),
                 id_workflow=sql.Identifier(shortname, 'workflow'),
                 id_workflowHistory=sql.Identifier(shortname, 'workflowhistory'),
                 annotation_fields=sql.SQL(', ').join([sql.SQL(field) for field in annotationFields]),
@@ -435,7 +440,10 @@ class ProjectConfigMiddleware:
             ('ui_settings', str),
             ('interface_enabled', bool),
             ('watch_folder_enabled', bool),
-            ('watch_folder_remove_missing_enabled', bool)
+            ('watch_folder_remove_missing_enabled', bool),
+            ('prediction_retention_num_states', int),
+            ('prediction_retention_summarize', bool),
+            ('prediction_partitioning_enabled', bool)
         ]
 
         vals, params = parse_parameters(projectSettings, fieldNames, absent_ok=True, escape=False)
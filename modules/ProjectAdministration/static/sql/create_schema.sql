@@ -23,9 +23,25 @@ CREATE TABLE IF NOT EXISTS {id_image} (
     --fVec bytea,
     date_added TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     last_requested TIMESTAMPTZ,
+    content_hash VARCHAR,
     PRIMARY KEY (id)
 );
 
+-- sorted (parent) file names for comparisons with the image folder
+CREATE INDEX IF NOT EXISTS image_filename_parent_idx ON {id_image} ((split_part(filename, '?window=', 1) COLLATE "C"));
+
+-- hash index of ingested files (for patches: of the original file) for deduplication
+CREATE INDEX IF NOT EXISTS image_content_hash_idx ON {id_image} (content_hash);
+
+-- files on disk that are exact duplicates of a registered image
+CREATE TABLE IF NOT EXISTS {id_imageAlias} (
+    filename VARCHAR NOT NULL,
+    image uuid NOT NULL,
+    PRIMARY KEY (filename),
+    FOREIGN KEY (image) REFERENCES {id_image}(id) ON DELETE CASCADE
+);
+CREATE INDEX IF NOT EXISTS image_alias_filename_idx ON {id_imageAlias} ((filename COLLATE "C"));
+
 CREATE TABLE IF NOT EXISTS {id_iu} (
     username VARCHAR NOT NULL,
     image uuid NOT NULL,
@@ -82,8 +98,10 @@ CREATE TABLE IF NOT EXISTS {id_cnnstate} (
     model_library VARCHAR,
     alCriterion_library VARCHAR,
     timeCreated TIMESTAMPTZ NOT NULL DEFAULT NOW(),
-    stateDict bytea NOT NULL,
+    stateDict bytea,
+    stateDict_ref VARCHAR,
     partial boolean NOT NULL,
+    num_images BIGINT,
     PRIMARY KEY (id)
 );
 
@@ -99,6 +117,21 @@ CREATE TABLE IF NOT EXISTS {id_prediction} (
     FOREIGN KEY (image) REFERENCES {id_image}(id),
     FOREIGN KEY (cnnstate) REFERENCES {id_cnnstate}(id)
 );
+CREATE INDEX IF NOT EXISTS prediction_cnnstate_idx ON {id_prediction} (cnnstate);
+
+CREATE TABLE IF NOT EXISTS {id_predictionSummary} (
+    image uuid NOT NULL,
+    cnnstate uuid NOT NULL,
+    timeCreated TIMESTAMPTZ NOT NULL,
+    num_predictions BIGINT NOT NULL,
+    confidence_mean real,
+    confidence_max real,
+    priority_mean real,
+    priority_max real,
+    PRIMARY KEY (image, cnnstate),
+    FOREIGN KEY (image) REFERENCES {id_image}(id) ON DELETE CASCADE,
+    FOREIGN KEY (cnnstate) REFERENCES {id_cnnstate}(id) ON DELETE CASCADE
+);
 
 CREATE TABLE IF NOT EXISTS {id_workflow} (
     id uuid DEFAULT uuid_generate_v4(),
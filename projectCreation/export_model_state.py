@@ -42,11 +42,19 @@ if __name__ == '__main__':
 
     # get state dict
     print('Retrieving model state...')
-    stateDict_raw = dbConn.execute('SELECT statedict FROM {schema}.cnnstate WHERE partial IS FALSE ORDER BY timecreated DESC LIMIT 1;'.format(schema=config.getProperty('Database', 'schema')), None, 1)
+    stateDict_raw = dbConn.execute('SELECT statedict, statedict_ref FROM {schema}.cnnstate WHERE partial IS FALSE ORDER BY timecreated DESC LIMIT 1;'.format(schema=config.getProperty('Database', 'schema')), None, 1)
+    stateDict_raw = stateDict_raw[0]
+    if stateDict_raw['statedict_ref'] is not None:
+        # model state is in external store
+        from util.modelStateStore import get_model_state_store
+        stateDict_raw = get_model_state_store(config).get(stateDict_raw['statedict_ref'])
+    else:
+        stateDict_raw = stateDict_raw['statedict']
 
     
     # convert from bytes and save to disk
     print('Saving model state...')
-    stateDict_parsed = io.BytesIO(stateDict_raw[0]['statedict'])
-    stateDict_parsed = torch.load(stateDict_parsed, map_location=lambda storage, loc: storage)
+    # (compressed or reduced-precision states are restored to the plain format)
+    from ai.models.pytorch.stateSerialization import load_state
+    stateDict_parsed = load_state(io.BytesIO(stateDict_raw))
     torch.save(stateDict_parsed, open(args.target_file, 'wb'))
\ No newline at end of file
@@ -8,7 +8,7 @@
 import os
 import argparse
 from psycopg2 import sql
-from util.helpers import valid_image_extensions
+from util.helpers import valid_image_extensions, base64ToImage
 
 
 if __name__ == '__main__':
@@ -44,9 +44,6 @@ if __name__ == '__main__':
     import glob
     from tqdm import tqdm
     import datetime
-    import numpy as np
-    from PIL import Image
-    import base64
     from io import BytesIO
     from util.configDef import Config
     from modules import Database
@@ -149,8 +146,6 @@ if __name__ == '__main__':
             # convert base64 mask to image
             width = nextItem['width']
             height = nextItem['height']
-            raster = np.frombuffer(base64.b64decode(nextItem['segmentationmask']), dtype=np.uint8)
-            raster = np.reshape(raster, (height,width,))
-            img = Image.fromarray(raster)
+            img = base64ToImage(nextItem['segmentationmask'], width, height)
             img.save(targetName)
             print(targetName)
\ No newline at end of file
@@ -28,6 +28,9 @@
       accordingly.
     - Flag "annotationType" specifies the target table into which the provided bounding boxes are inserted.
       May either be "annotation" or "prediction".
+    - If flag "deduplicate" is set (or "deduplicate_images" is enabled in section [FileServer] of the .ini
+      file), images whose contents are identical to another image are not added again; they are registered
+      as aliases of the latter, and their labels are attached to it.
     - The optional flag "al_criterion" will specify how to calculate the "priority" value for each prediction,
       if "annotationType" is set to "prediction" and confidence values are provided (see above). It may take one
       of the following values:
@@ -51,7 +54,8 @@
 import os
 import argparse
 from psycopg2 import sql
-from util.helpers import valid_image_extensions
+from util.helpers import valid_image_extensions, hashFiles
+from util.imageSharding import VIRTUAL_WINDOW_SEPARATOR
 
 
 if __name__ == '__main__':
@@ -69,6 +73,8 @@ if __name__ == '__main__':
                     help='Kind of the provided annotations. One of {"annotation", "prediction"} (default: annotation)')
     parser.add_argument('--al_criterion', type=str, default='TryAll', const=1, nargs='?',
                     help='Criterion for the priority field. One of {"BreakingTies", "MaxConfidence", "TryAll"} (default: TryAll)')
+    parser.add_argument('--deduplicate', action='store_true',
+                    help='Skip images with contents identical to other images and attach their labels to the latter (default: value of "deduplicate_images" in the settings file).')
     args = parser.parse_args()
     
 
@@ -221,16 +227,83 @@ if __name__ == '__main__':
     ''').format(id_img=sql.Identifier(args.project, 'image')), None, 'all')
     imgs_existing = set([i['filename'] for i in imgs_existing])
 
-    imgs_filenames = list(imgs_filenames.difference(imgs_existing))
-    imgs_filenames = [(i,) for i in imgs_filenames]
+    imgs_filenames = sorted(imgs_filenames.difference(imgs_existing))
+
+    # find duplicates by content hash
+    deduplicate = args.deduplicate or config.getProperty('FileServer', 'deduplicate_images', type=bool, fallback=False)
+    imgs_hashes = [None] * len(imgs_filenames)
+    imgs_aliases = []
+    if deduplicate:
+        print('Hashing images for deduplication...')
+        imgs_hashes = hashFiles([os.path.join(imgBaseDir, i) for i in imgs_filenames])
+        # patches of split images carry the hash of their original image:
+        # only hashes of exactly one image that is not a patch can be aliased
+        knownHashes = dbConn.execute(sql.SQL('''
+            SELECT content_hash, MIN(filename) AS filename,
+                COUNT(*) = 1 AND bool_and(strpos(filename, {separator}) = 0) AS single
+            FROM {id_img}
+            WHERE content_hash = ANY(%s::VARCHAR[])
+            GROUP BY content_hash;
+        ''').format(
+            id_img=sql.Identifier(args.project, 'image'),
+            separator=sql.Literal(VIRTUAL_WINDOW_SEPARATOR)
+        ),
+        (list(set([h for h in imgs_hashes if h is not None])),), 'all')
+        splitHashes = set([k['content_hash'] for k in knownHashes or [] if not k['single']])
+        knownHashes = dict([(k['content_hash'], k['filename']) for k in knownHashes or [] if k['single']])
+
+        canonical = {}
+        imgs_unique, hashes_unique = [], []
+        imgs_split = []
+        for filename, contentHash in zip(imgs_filenames, imgs_hashes):
+            if contentHash is not None and contentHash in splitHashes:
+                # duplicate of a split image: not imported
+                imgs_split.append(filename)
+            elif contentHash is not None and contentHash in knownHashes:
+                canonical[filename] = knownHashes[contentHash]
+                imgs_aliases.append((filename, contentHash))
+            else:
+                imgs_unique.append(filename)
+                hashes_unique.append(contentHash)
+                if contentHash is not None:
+                    knownHashes[contentHash] = filename
+        imgs_filenames, imgs_hashes = imgs_unique, hashes_unique
+
+        # attach labels of duplicates to the identical image
+        for baseName in imgs.keys():
+            if imgs[baseName] in canonical:
+                imgs[baseName] = canonical[imgs[baseName]]
+        print(f'{len(imgs_aliases)} duplicate images found.')
+        if len(imgs_split):
+            print(f'{len(imgs_split)} images are identical to split images and have been skipped (labels are not imported):')
+            for filename in imgs_split:
+                print(f'\t{filename}')
 
     # push image to database
     print('Adding to database...')
     dbConn.insert(sql.SQL('''
-        INSERT INTO {id_img} (filename)
+        INSERT INTO {id_img} (filename, content_hash)
         VALUES %s;
     ''').format(id_img=sql.Identifier(args.project, 'image')),
-    imgs_filenames)
+    list(zip(imgs_filenames, imgs_hashes)))
+
+    if len(imgs_aliases):
+        dbConn.insert(sql.SQL('''
+            INSERT INTO {id_alias} (filename, image)
+            SELECT a.filename, img.id
+            FROM (VALUES %s) AS a(filename, content_hash)
+            JOIN LATERAL (
+                SELECT (array_agg(id))[1] AS id FROM {id_img}
+                WHERE content_hash = a.content_hash
+                HAVING COUNT(*) = 1
+            ) AS img
+            ON TRUE
+            ON CONFLICT (filename) DO NOTHING;
+        ''').format(
+            id_alias=sql.Identifier(args.project, 'image_alias'),
+            id_img=sql.Identifier(args.project, 'image')
+        ),
+        imgs_aliases)
 
     
     # locate all label files
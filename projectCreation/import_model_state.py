@@ -202,11 +202,17 @@ if __name__ == '__main__':
     torch.save(stateDict, bio)
     stateDict = bio.getvalue()
 
-    # commit to DB
+    # commit to DB (or model state store, if configured)
     print('Committing to DB...')
+    from util.modelStateStore import get_model_state_store
+    stateStore = get_model_state_store(config)
+    stateDict_ref = None
+    if stateStore is not None:
+        stateDict_ref = stateStore.put(stateDict)
+        stateDict = None
     queryStr = sql.SQL('''
-        INSERT INTO {id_cnns}.cnnstate (timeCreated, stateDict, partial)
-        VALUES ( %s, %s, FALSE);
+        INSERT INTO {id_cnns}.cnnstate (timeCreated, stateDict, stateDict_ref, partial)
+        VALUES ( %s, %s, %s, FALSE);
     ''').format(id_cnns=sql.Identifier(args.project, 'cnnstate'))
     now = current_time()
-    dbConn.execute(queryStr, (now, stateDict, ), None)
\ No newline at end of file
+    dbConn.execute(queryStr, (now, stateDict, stateDict_ref, ), None)
\ No newline at end of file
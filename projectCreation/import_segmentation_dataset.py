@@ -6,6 +6,7 @@ import os
 import argparse
 from psycopg2 import sql
 from util.helpers import valid_image_extensions
+from util import maskCodec
 
 
 if __name__ == '__main__':
@@ -34,7 +35,6 @@ if __name__ == '__main__':
     import datetime
     import numpy as np
     from PIL import Image
-    import base64
     from io import BytesIO
     from util.configDef import Config
     from modules import Database
@@ -49,6 +49,7 @@ if __name__ == '__main__':
     currentDT = '{}-{}-{} {}:{}:{}'.format(currentDT.year, currentDT.month, currentDT.day, currentDT.hour, currentDT.minute, currentDT.second)
 
     config = Config()
+    segMaskCodec = maskCodec.get_codec(config)
     dbConn = Database(config)
     if dbConn.connectionPool is None:
         raise Exception('Error connecting to database.')
@@ -193,8 +194,7 @@ if __name__ == '__main__':
             sz = segMask.size
 
             # convert
-            dataArray = np.array(segMask).astype(np.uint8)
-            b64str = base64.b64encode(dataArray.ravel()).decode('utf-8')
+            b64str = maskCodec.encode_mask(np.array(segMask).astype(np.uint8), segMaskCodec)
 
             # add to database
             if args.annotation_type == 'annotation':
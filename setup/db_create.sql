@@ -43,6 +43,9 @@ CREATE TABLE IF NOT EXISTS aide_admin.project (
     ai_model_settings VARCHAR,
     ai_alCriterion_library VARCHAR,
     ai_alCriterion_settings VARCHAR,
+    prediction_retention_num_states INTEGER,
+    prediction_retention_summarize BOOLEAN NOT NULL DEFAULT TRUE,
+    prediction_partitioning_enabled BOOLEAN NOT NULL DEFAULT FALSE,
     PRIMARY KEY(shortname)
 );
 
@@ -127,7 +130,8 @@ CREATE TABLE IF NOT EXISTS aide_admin.modelMarketplace (
     model_library VARCHAR NOT NULL,
     annotationType labelType NOT NULL,
     predictionType labelType NOT NULL,
-    statedict BYTEA NOT NULL,
+    statedict BYTEA,
+    statedict_ref VARCHAR,
     timeCreated TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     alCriterion_library VARCHAR,
     origin_project VARCHAR,
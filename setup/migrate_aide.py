@@ -203,6 +203,48 @@ MODIFICATIONS_sql = [
         selectCount INTEGER NOT NULL DEFAULT 0,
         PRIMARY KEY (id),
         FOREIGN KEY (author) REFERENCES aide_admin.user(name)
+    );''',
+
+    # sorted (parent) file names for comparisons with the image folder
+    '''CREATE INDEX IF NOT EXISTS image_filename_parent_idx ON "{schema}".image ((split_part(filename, '?window=', 1) COLLATE "C"));''',
+
+    # image deduplication
+    'ALTER TABLE "{schema}".image ADD COLUMN IF NOT EXISTS content_hash VARCHAR;',
+    'CREATE INDEX IF NOT EXISTS image_content_hash_idx ON "{schema}".image (content_hash);',
+    '''CREATE TABLE IF NOT EXISTS "{schema}".image_alias (
+        filename VARCHAR NOT NULL,
+        image uuid NOT NULL,
+        PRIMARY KEY (filename),
+        FOREIGN KEY (image) REFERENCES "{schema}".image(id) ON DELETE CASCADE
+    );''',
+    '''CREATE INDEX IF NOT EXISTS image_alias_filename_idx ON "{schema}".image_alias ((filename COLLATE "C"));''',
+
+    # references to model states in external store
+    'ALTER TABLE "{schema}".cnnstate ADD COLUMN IF NOT EXISTS stateDict_ref VARCHAR;',
+    'ALTER TABLE "{schema}".cnnstate ALTER COLUMN stateDict DROP NOT NULL;',
+    'ALTER TABLE aide_admin.modelMarketplace ADD COLUMN IF NOT EXISTS statedict_ref VARCHAR;',
+    'ALTER TABLE aide_admin.modelMarketplace ALTER COLUMN statedict DROP NOT NULL;',
+
+    # number of training images per model state (weights for model state averaging)
+    'ALTER TABLE "{schema}".cnnstate ADD COLUMN IF NOT EXISTS num_images BIGINT;',
+
+    # prediction retention
+    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS prediction_retention_num_states INTEGER;',
+    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS prediction_retention_summarize BOOLEAN NOT NULL DEFAULT TRUE;',
+    'ALTER TABLE aide_admin.project ADD COLUMN IF NOT EXISTS prediction_partitioning_enabled BOOLEAN NOT NULL DEFAULT FALSE;',
+    'CREATE INDEX IF NOT EXISTS prediction_cnnstate_idx ON "{schema}".prediction (cnnstate);',
+    '''CREATE TABLE IF NOT EXISTS "{schema}".prediction_summary (
+        image uuid NOT NULL,
+        cnnstate uuid NOT NULL,
+        timeCreated TIMESTAMPTZ NOT NULL,
+        num_predictions BIGINT NOT NULL,
+        confidence_mean real,
+        confidence_max real,
+        priority_mean real,
+        priority_max real,
+        PRIMARY KEY (image, cnnstate),
+        FOREIGN KEY (image) REFERENCES "{schema}".image(id) ON DELETE CASCADE,
+        FOREIGN KEY (cnnstate) REFERENCES "{schema}".cnnstate(id) ON DELETE CASCADE
     );'''
 ]
 
@@ -0,0 +1,102 @@
+'''
+    Moves model states that are stored in the database (project "cnnstate"
+    tables and the Model Marketplace) to the model state store configured in
+    section [ModelStateStore] of the configuration file. The rows then only
+    hold a reference to the (content-addressed, hence deduplicated) blob in
+    the store.
+    Rows are migrated one at a time, so the script can be interrupted and
+    re-run at any time. Run "migrate_aide.py" first.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import argparse
+
+
+def _migrate_table(dbConn, stateStore, tableName, dryRun=False):
+    '''
+        Migrates all model states of a given table (psycopg2.sql object).
+        Returns the number of rows migrated and the number of bytes moved.
+    '''
+    from psycopg2 import sql
+
+    ids = dbConn.execute(sql.SQL('''
+        SELECT id FROM {table}
+        WHERE statedict IS NOT NULL AND statedict_ref IS NULL;
+    ''').format(table=tableName), None, 'all')
+    if ids is None:
+        return 0, 0
+
+    numMigrated, numBytes = 0, 0
+    for row in ids:
+        stateDict = dbConn.execute(sql.SQL('''
+            SELECT statedict FROM {table} WHERE id = %s;
+        ''').format(table=tableName), (row['id'],), 1)
+        stateDict = stateDict[0]['statedict']
+        numBytes += len(stateDict)
+        numMigrated += 1
+        if dryRun:
+            continue
+
+        ref = stateStore.put(bytes(stateDict))
+        dbConn.execute(sql.SQL('''
+            UPDATE {table}
+            SET statedict_ref = %s, statedict = NULL
+            WHERE id = %s;
+        ''').format(table=tableName), (ref, row['id']), None)
+    return numMigrated, numBytes
+
+
+
+def migrate_model_states(dryRun=False):
+    from psycopg2 import sql
+    from modules import Database
+    from util.configDef import Config
+    from util.modelStateStore import get_model_state_store
+
+    config = Config()
+    dbConn = Database(config)
+    if dbConn.connectionPool is None:
+        raise Exception('Error connecting to database.')
+
+    stateStore = get_model_state_store(config)
+    if stateStore is None:
+        raise Exception('No model state store configured (see section [ModelStateStore] in the settings file).')
+
+    tables = [('Model Marketplace', sql.Identifier('aide_admin', 'modelmarketplace'))]
+    projects = dbConn.execute('SELECT shortname FROM aide_admin.project;', None, 'all')
+    if projects is not None:
+        for p in projects:
+            tables.append((p['shortname'], sql.Identifier(p['shortname'], 'cnnstate')))
+
+    errors = []
+    for name, tableName in tables:
+        try:
+            numMigrated, numBytes = _migrate_table(dbConn, stateStore, tableName, dryRun)
+            print(f'[{name}] {numMigrated} model states ({numBytes/1e6:.2f} MB) {"to be migrated" if dryRun else "migrated"}.')
+        except Exception as e:
+            errors.append(f'[{name}] {str(e)}')
+    return errors
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Move model states from the database to the model state store.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--dry_run', action='store_true',
+                    help='Only report the number and size of model states that would be migrated.')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    errors = migrate_model_states(args.dry_run)
+    if len(errors):
+        print('\nErrors:')
+        for e in errors:
+            print(f'\t"{e}"')
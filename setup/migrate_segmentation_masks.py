@@ -0,0 +1,151 @@
+'''
+    Re-encodes the segmentation masks of all projects (annotations and pre-
+    dictions) that are still stored in the raw format with the codec set in
+    section [Project] of the configuration file (see "util.maskCodec"), and
+    reports the resulting compression ratios.
+    Masks are processed in batches; masks that have been modified in the
+    meantime (e.g. by a user) are left untouched. The script can therefore be
+    run while AIDE is in use, and be interrupted and re-run at any time. Run
+    "migrate_aide.py" first.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import time
+import argparse
+
+
+def _migrate_table(dbConn, tableName, codec, batchSize, pause=0, dryRun=False):
+    '''
+        Re-encodes all raw segmentation masks of a given table (psycopg2.sql
+        object). Returns a dict with the number of masks migrated and skipped
+        (e.g. due to missing dimensions or corrupt data), their total size in
+        bytes before and after, and the compression ratios of the individual
+        masks.
+    '''
+    from psycopg2 import sql
+    from util import maskCodec
+
+    stats = {
+        'num_migrated': 0,
+        'num_skipped': 0,
+        'bytes_before': 0,
+        'bytes_after': 0,
+        'ratios': []
+    }
+    lastID = '00000000-0000-0000-0000-000000000000'
+    while True:
+        batch = dbConn.execute(sql.SQL('''
+            SELECT id, segmentationmask, width, height FROM {table}
+            WHERE id > %s::uuid AND segmentationmask IS NOT NULL
+            AND position(':' in segmentationmask) = 0
+            ORDER BY id
+            LIMIT %s;
+        ''').format(table=tableName), (lastID, batchSize), 'all')
+        if batch is None or not len(batch):
+            break
+        lastID = str(batch[-1]['id'])
+
+        values = []
+        for row in batch:
+            try:
+                encoded = maskCodec.transcode(row['segmentationmask'], codec, row['width'], row['height'])
+            except Exception:
+                stats['num_skipped'] += 1
+                continue
+            stats['num_migrated'] += 1
+            stats['bytes_before'] += len(row['segmentationmask'])
+            stats['bytes_after'] += len(encoded)
+            stats['ratios'].append(len(row['segmentationmask']) / max(1, len(encoded)))
+            values.append((str(row['id']), encoded, row['segmentationmask']))
+
+        if not dryRun and len(values):
+            dbConn.insert(sql.SQL('''
+                UPDATE {table} AS t
+                SET segmentationmask = v.mask
+                FROM (VALUES %s) AS v(id, mask, prev)
+                WHERE t.id = v.id::uuid AND t.segmentationmask = v.prev;
+            ''').format(table=tableName), values)
+        if pause > 0:
+            time.sleep(pause)
+    return stats
+
+
+
+def _format_stats(stats):
+    if not stats['num_migrated']:
+        return f'no masks to migrate ({stats["num_skipped"]} skipped)'
+    ratios = sorted(stats['ratios'])
+    return '{} masks, {:.2f} MB -> {:.2f} MB (ratio {:.1f}; per mask: min {:.1f}, median {:.1f}, max {:.1f}); {} skipped'.format(
+        stats['num_migrated'],
+        stats['bytes_before']/1e6,
+        stats['bytes_after']/1e6,
+        stats['bytes_before'] / max(1, stats['bytes_after']),
+        ratios[0], ratios[len(ratios)//2], ratios[-1],
+        stats['num_skipped']
+    )
+
+
+
+def migrate_segmentation_masks(codec=None, batchSize=100, pause=0, dryRun=False):
+    from psycopg2 import sql
+    from modules import Database
+    from util.configDef import Config
+    from util import maskCodec
+
+    config = Config()
+    dbConn = Database(config)
+    if dbConn.connectionPool is None:
+        raise Exception('Error connecting to database.')
+
+    if codec is None:
+        codec = maskCodec.get_codec(config)
+    if codec not in maskCodec.MASK_CODECS or codec == 'raw':
+        raise Exception(f'Invalid target codec "{codec}".')
+
+    tables = []
+    projects = dbConn.execute('SELECT shortname, annotationType, predictionType FROM aide_admin.project;', None, 'all')
+    if projects is not None:
+        for p in projects:
+            if p['annotationtype'] == 'segmentationMasks':
+                tables.append((p['shortname'], 'annotation'))
+            if p['predictiontype'] == 'segmentationMasks':
+                tables.append((p['shortname'], 'prediction'))
+
+    errors = []
+    for project, table in tables:
+        try:
+            stats = _migrate_table(dbConn, sql.Identifier(project, table), codec, batchSize, pause, dryRun)
+            print(f'[{project}] {table}s {"to be migrated" if dryRun else "migrated"} to "{codec}": {_format_stats(stats)}.')
+        except Exception as e:
+            errors.append(f'[{project}] {table}s: {str(e)}')
+    return errors
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Re-encode segmentation masks stored in the raw format with a compressed codec.')
+    parser.add_argument('--settings_filepath', type=str, default='config/settings.ini', const=1, nargs='?',
+                    help='Manual specification of the directory of the settings.ini file; only considered if environment variable unset (default: "config/settings.ini").')
+    parser.add_argument('--codec', type=str, default=None,
+                    help='Target codec ("png" or "rle"; default: as set in the settings file).')
+    parser.add_argument('--batch_size', type=int, default=100,
+                    help='Number of masks to re-encode per batch (default: 100).')
+    parser.add_argument('--pause', type=float, default=0,
+                    help='Number of seconds to wait between two batches, to reduce the load on the database (default: 0).')
+    parser.add_argument('--dry_run', action='store_true',
+                    help='Only report the number of masks and the compression ratios that would be achieved.')
+    args = parser.parse_args()
+
+    if not 'AIDE_CONFIG_PATH' in os.environ:
+        os.environ['AIDE_CONFIG_PATH'] = str(args.settings_filepath)
+    if not 'AIDE_MODULES' in os.environ:
+        os.environ['AIDE_MODULES'] = ''     # for compatibility with Celery worker import
+
+    errors = migrate_segmentation_masks(args.codec, max(1, args.batch_size), args.pause, args.dry_run)
+    if len(errors):
+        print('\nErrors:')
+        for e in errors:
+            print(f'\t"{e}"')
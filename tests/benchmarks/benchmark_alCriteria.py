@@ -0,0 +1,124 @@
+'''
+    Speed of ranking the predictions of an inference result with the built-
+    in AL criteria (Breaking Ties, Max Confidence, and both composed; "ai/al/
+    builtins"): the previous implementation, which computed the heuristics
+    for one prediction at a time, compared to "apply_heuristics" on the dict
+    format and on a "PredictionBatch". The priorities of all variants are
+    checked to be identical.
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_alCriteria --num_images 100 --num_predictions 100 --num_classes 10
+
+    2020 Benjamin Kellenberger
+'''
+
+import copy
+import time
+import argparse
+import numpy as np
+
+from util.predictionBatch import PredictionBatch
+from ai.al.functional.noarch.functional import _breaking_ties, _max_confidence, apply_heuristics
+
+
+def breaking_ties_reference(prediction):
+    '''
+        Previous implementation of "_breaking_ties", kept as a reference.
+    '''
+    btVal = None
+    if 'logits' in prediction:
+        logits = np.array(prediction['logits'].copy())
+
+        if logits.ndim == 3:
+            # spatial prediction
+            logits = np.sort(logits, 0)
+            btVal = 1 - np.mean(logits[-1,...] - logits[-2,...])
+        else:
+            logits = np.sort(logits)
+            btVal = 1 - (logits[-1] - logits[-2])
+    return btVal
+
+
+def max_confidence_reference(prediction):
+    '''
+        Previous implementation of "_max_confidence", kept as a reference.
+    '''
+    if 'logits' in prediction:
+        return max(prediction['logits'])
+    return None
+
+
+def rank_reference(data, heuristics, floor=None):
+    '''
+        Previous ranking of the built-in criteria: one prediction at a time,
+        with the maximum over all heuristics (and "floor", as with "Compose").
+    '''
+    for imgID in data.keys():
+        if 'predictions' in data[imgID]:
+            for p in range(len(data[imgID]['predictions'])):
+                values = [h(data[imgID]['predictions'][p]) for h in heuristics]
+                if floor is not None:
+                    values.append(floor)
+                data[imgID]['predictions'][p]['priority'] = max(values)
+    return data
+
+
+CRITERIA = {
+    'BreakingTies': ([breaking_ties_reference], [_breaking_ties], None),
+    'MaxConfidence': ([max_confidence_reference], [_max_confidence], None),
+    'Compose': ([breaking_ties_reference, max_confidence_reference], [_breaking_ties, _max_confidence], -1)
+}
+
+
+def create_predictions(numImages, numPredictions, numClasses):
+    logits = np.random.dirichlet(np.ones(numClasses), numImages * numPredictions).astype(np.float32)
+    imageIDs = [f'image_{i}' for i in range(numImages)]
+    return PredictionBatch(imageIDs, np.repeat(np.arange(numImages), numPredictions), logits=logits)
+
+
+def get_priorities(data):
+    if isinstance(data, PredictionBatch):
+        return data['priority'].tolist()
+    return [p['priority'] for imgID in data.keys() for p in data[imgID].get('predictions', [])]
+
+
+def _time(fun, inputs, numRepetitions):
+    times = []
+    for _ in range(numRepetitions):
+        data = copy.deepcopy(inputs)
+        start = time.perf_counter()
+        result = fun(data)
+        times.append(time.perf_counter() - start)
+    return result, sorted(times)[len(times)//2]
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ranking with the built-in AL criteria.')
+    parser.add_argument('--num_images', type=int, default=100)
+    parser.add_argument('--num_predictions', type=int, default=100,
+                        help='Number of predictions per image.')
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--num_repetitions', type=int, default=5)
+    args = parser.parse_args()
+    np.random.seed(0)
+
+    batch = create_predictions(args.num_images, args.num_predictions, args.num_classes)
+    predictions = batch.to_dict()
+    print(f'{len(batch)} predictions ({args.num_images} images, {args.num_classes} classes)')
+    print(f'{"criterion":>15}{"variant":>18}{"ms":>10}{"predictions/s":>16}{"speedup":>10}  identical')
+    for name, (referenceHeuristics, heuristics, floor) in CRITERIA.items():
+        variants = (
+            ('per prediction', predictions, lambda data: rank_reference(data, referenceHeuristics, floor)),
+            ('dict', predictions, lambda data: apply_heuristics(data, heuristics, floor)),
+            ('PredictionBatch', batch, lambda data: apply_heuristics(data, heuristics, floor))
+        )
+        reference, referenceTime = None, None
+        for variant, inputs, fun in variants:
+            result, seconds = _time(fun, inputs, args.num_repetitions)
+            priorities = np.array(get_priorities(result), dtype=np.float64)
+            if reference is None:
+                reference, referenceTime = priorities, seconds
+            identical = np.allclose(priorities, reference, rtol=0, atol=1e-6)
+            print(f'{name:>15}{variant:>18}{1000*seconds:10.1f}{len(batch)/seconds:16.0f}{referenceTime/seconds:10.2f}  {identical}')
@@ -0,0 +1,197 @@
+'''
+    Scaling of the bounding box filter ("ai/filter/detection/boundingBox-
+    Filter.py"), which merges overlapping boxes (e.g. of multiple users),
+    with the number of boxes per image: the vectorized implementation
+    compared to a straightforward reference implementation in pure Python
+    (pairwise loop and breadth-first search; only run up to the number of
+    boxes given by "--reference_max_boxes"). The outputs of both are checked
+    to be identical. Boxes are simulated as several users annotating the
+    same objects with small deviations.
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_boundingBoxFilter --num_boxes 100 1000 10000 50000
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import argparse
+from collections import Counter
+import numpy as np
+
+from ai.filter.detection.boundingBoxFilter import BoundingBoxFilter
+
+
+DEFAULT_OPTIONS = {
+    'box_rule': 'average',
+    'min_iou': 0.75,
+    'class_agnostic': False,
+    'class_assignment': 'mode',
+    'keep_unsure': True
+}
+
+
+def iou_reference(a, b):
+    # boxes as (x1, y1, x2, y2); no "+1" for the widths
+    intersection = max(0, min(a[2], b[2]) - max(a[0], b[0])) * max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    union = (a[2]-a[0]) * (a[3]-a[1]) + (b[2]-b[0]) * (b[3]-b[1]) - intersection
+    return intersection / max(union, 1e-12)
+
+
+def groups_reference(boxes, labels, minIoU, classAgnostic):
+    '''
+        Returns the groups of (transitively) overlapping boxes as lists of
+        indices, ordered by their first box.
+    '''
+    neighbors = [[] for _ in boxes]
+    for i in range(len(boxes)):
+        for j in range(i+1, len(boxes)):
+            if (classAgnostic or labels[i] == labels[j]) and iou_reference(boxes[i], boxes[j]) >= minIoU:
+                neighbors[i].append(j)
+                neighbors[j].append(i)
+    groups = []
+    visited = set()
+    for i in range(len(boxes)):
+        if i in visited:
+            continue
+        group, queue = [], [i]
+        visited.add(i)
+        while len(queue):
+            n = queue.pop()
+            group.append(n)
+            for m in neighbors[n]:
+                if m not in visited:
+                    visited.add(m)
+                    queue.append(m)
+        groups.append(sorted(group))
+    return groups
+
+
+def filter_reference(data, options):
+    '''
+        Reference implementation of "BoundingBoxFilter.filter" for the de-
+        terministic options (label class assignment "mode").
+    '''
+    data_out = {}
+    for key in data.keys():
+        if not len(data[key].get('annotations', {})):
+            continue
+        data_out[key] = {'annotations': []}
+        annotations = []
+        for anno in data[key]['annotations'].values():
+            if options['keep_unsure'] and anno.get('unsure', False):
+                data_out[key]['annotations'].append(anno)
+            else:
+                annotations.append(anno)
+        boxes = [(a['x'] - a['width']/2, a['y'] - a['height']/2, a['x'] + a['width']/2, a['y'] + a['height']/2) for a in annotations]
+        labels = [a['label'] for a in annotations]
+        for group in groups_reference(boxes, labels, options['min_iou'], options['class_agnostic']):
+            if len(group) == 1:
+                data_out[key]['annotations'].append(annotations[group[0]])
+                continue
+            members = [boxes[g] for g in group]
+            if options['box_rule'] == 'intersection':
+                box = [max(b[0] for b in members), max(b[1] for b in members), min(b[2] for b in members), min(b[3] for b in members)]
+            elif options['box_rule'] == 'union':
+                box = [min(b[0] for b in members), min(b[1] for b in members), max(b[2] for b in members), max(b[3] for b in members)]
+            else:
+                box = [sum(b[c] for b in members) / len(members) for c in range(4)]
+            # most frequent label; ties: label that appears first in the group
+            groupLabels = [labels[g] for g in group]
+            counts = Counter(groupLabels)
+            label = max(counts.keys(), key=lambda l: (counts[l], -groupLabels.index(l)))
+            anno = dict(annotations[group[0]])
+            anno.update({
+                'x': (box[0] + box[2]) / 2,
+                'y': (box[1] + box[3]) / 2,
+                'width': box[2] - box[0],
+                'height': box[3] - box[1],
+                'label': label
+            })
+            data_out[key]['annotations'].append(anno)
+    return data_out
+
+
+def create_annotations(numObjects, numUsers, imageSize=None, numClasses=3, jitter=2.0, unsureRate=0.0, seed=0):
+    '''
+        Simulates "numUsers" users annotating the same "numObjects" objects
+        (boxes jittered by up to "jitter" units, occasionally with another
+        label), shuffled. The image size grows with the number of objects
+        unless given.
+    '''
+    rng = np.random.RandomState(seed)
+    if imageSize is None:
+        imageSize = 40 * np.sqrt(numObjects) + 100
+    centers = rng.uniform(50, imageSize-50, (numObjects, 2))
+    sizes = rng.uniform(10, 60, (numObjects, 2))
+    labels = rng.randint(0, numClasses, numObjects)
+    annotations = []
+    for _ in range(numUsers):
+        offsets = rng.uniform(-jitter, jitter, (numObjects, 4))
+        userLabels = np.where(rng.rand(numObjects) < 0.1, rng.randint(0, numClasses, numObjects), labels)
+        unsure = rng.rand(numObjects) < unsureRate
+        for o in range(numObjects):
+            annotations.append({
+                'x': float(centers[o,0] + offsets[o,0]),
+                'y': float(centers[o,1] + offsets[o,1]),
+                'width': float(sizes[o,0] + offsets[o,2]),
+                'height': float(sizes[o,1] + offsets[o,3]),
+                'label': f'class_{userLabels[o]}',
+                'unsure': bool(unsure[o])
+            })
+    order = rng.permutation(len(annotations))
+    return {'image': {'annotations': dict([(f'anno_{i}', annotations[o]) for i, o in enumerate(order)])}}
+
+
+def _time(fun, numRepetitions):
+    times = []
+    for _ in range(numRepetitions):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return result, sorted(times)[len(times)//2]
+
+
+def _outputs_equal(a, b):
+    if a.keys() != b.keys():
+        return False
+    for key in a.keys():
+        annosA, annosB = a[key]['annotations'], b[key]['annotations']
+        if len(annosA) != len(annosB):
+            return False
+        for annoA, annoB in zip(annosA, annosB):
+            if annoA['label'] != annoB['label'] or \
+                not np.allclose([annoA[k] for k in ('x', 'y', 'width', 'height')],
+                                [annoB[k] for k in ('x', 'y', 'width', 'height')]):
+                return False
+    return True
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the bounding box filter.')
+    parser.add_argument('--num_boxes', type=int, nargs='+', default=[100, 1000, 10000, 50000],
+                        help='Number of boxes per image (all users).')
+    parser.add_argument('--num_users', type=int, default=3)
+    parser.add_argument('--box_rule', type=str, default='average', choices=['average', 'intersection', 'union'])
+    parser.add_argument('--class_agnostic', action='store_true')
+    parser.add_argument('--reference_max_boxes', type=int, default=2000)
+    parser.add_argument('--num_repetitions', type=int, default=3)
+    args = parser.parse_args()
+
+    options = dict(DEFAULT_OPTIONS)
+    options.update({'box_rule': args.box_rule, 'class_agnostic': args.class_agnostic})
+    bboxFilter = BoundingBoxFilter(None, None, None, dict(options))
+
+    print(f'{"boxes":>8}{"output":>8}{"vectorized (ms)":>18}{"reference (ms)":>17}{"speedup":>10}  identical')
+    for numBoxes in args.num_boxes:
+        data = create_annotations(max(1, numBoxes // args.num_users), args.num_users)
+        result, seconds = _time(lambda: bboxFilter.filter(data), args.num_repetitions)
+        numIn = len(data['image']['annotations'])
+        numOut = len(result['image']['annotations'])
+        if numIn > args.reference_max_boxes:
+            print(f'{numIn:>8}{numOut:>8}{1000*seconds:18.1f}{"skipped":>17}')
+            continue
+        reference, referenceSeconds = _time(lambda: filter_reference(data, options), 1)
+        print(f'{numIn:>8}{numOut:>8}{1000*seconds:18.1f}{1000*referenceSeconds:17.1f}{referenceSeconds/seconds:10.2f}  {_outputs_equal(result, reference)}')
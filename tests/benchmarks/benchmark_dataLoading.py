@@ -0,0 +1,181 @@
+'''
+    Throughput (images per second) of the DataLoader for a varying number of
+    worker processes ("num_workers"), measured inside a task of a Celery
+    worker with the prefork pool, as the AIWorker runs its tasks: in daemonic
+    pool processes that are recycled after every task (unless warm workers
+    are enabled). Images are synthetic JPEGs, decoded and resized with the
+    AIWorker's image loading functions on the CPU.
+
+    The script starts the Celery worker itself. By default, tasks are
+    exchanged through a temporary folder (filesystem transport), so that no
+    message broker is required; an existing broker and result backend (e.g.
+    the ones of AIDE) can be used instead through "--broker" and "--backend".
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_dataLoading --num_images 500 --num_workers 0 1 2 4
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+import numpy as np
+from PIL import Image
+from celery import Celery
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from ai.models.pytorch.functional._util import dataLoading
+from ai.models.pytorch.functional.datasets.imageCache import load_image
+
+
+ENV_FOLDER = 'AIDE_BENCHMARK_DIR'
+ENV_BROKER = 'AIDE_BENCHMARK_BROKER'
+ENV_BACKEND = 'AIDE_BENCHMARK_BACKEND'
+ENV_MAX_TASKS = 'AIDE_BENCHMARK_MAX_TASKS_PER_CHILD'
+
+
+app = Celery('AIDE_benchmark')
+
+
+def configure(folder):
+    queueDir = os.path.join(folder, 'queue')
+    os.makedirs(queueDir, exist_ok=True)
+    os.makedirs(os.path.join(folder, 'results'), exist_ok=True)
+    maxTasksPerChild = int(os.environ.get(ENV_MAX_TASKS, 1))
+    app.conf.update(
+        broker_url=os.environ.get(ENV_BROKER, 'filesystem://'),
+        result_backend=os.environ.get(ENV_BACKEND, 'file://' + os.path.join(folder, 'results')),
+        broker_transport_options={
+            'data_folder_in': queueDir,
+            'data_folder_out': queueDir,
+            'control_folder': os.path.join(folder, 'control')
+        },
+        task_default_queue='aide_benchmark_dataLoading',
+        worker_max_tasks_per_child=(maxTasksPerChild if maxTasksPerChild > 0 else None),
+        worker_prefetch_multiplier=1,
+        accept_content=['json'],
+        task_serializer='json',
+        result_serializer='json'
+    )
+
+if ENV_FOLDER in os.environ:
+    configure(os.environ[ENV_FOLDER])
+
+
+
+class _LocalFileServer:
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def getImage(self, filename):
+        return Image.open(os.path.join(self.folder, filename))
+
+
+
+class _ImageDataset(Dataset):
+
+    def __init__(self, folder, targetSize):
+        self.fileServer = _LocalFileServer(folder)
+        self.filenames = sorted([f for f in os.listdir(folder) if f.endswith('.jpg')])
+        self.targetSize = tuple(targetSize)
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def __getitem__(self, idx):
+        img, _ = load_image(self.fileServer, self.filenames[idx], None, self.targetSize)
+        img = img.resize(self.targetSize, Image.BILINEAR)
+        return torch.from_numpy(np.asarray(img).copy()).permute(2, 0, 1).float() / 255.0
+
+
+
+@app.task(name='benchmark.load_images')
+def load_images(folder, numWorkers, batchSize, targetSize):
+    process = multiprocessing.current_process()
+    daemonic = process.daemon
+    kwargs = dataLoading.sanitize_kwargs({'num_workers': numWorkers, 'batch_size': batchSize})
+    start = time.perf_counter()
+    numImages = 0
+    try:
+        for batch in DataLoader(_ImageDataset(folder, targetSize), **kwargs):
+            numImages += batch.size(0)
+    except Exception as e:
+        return {'process': process.name, 'daemonic': daemonic, 'error': repr(e)}
+    return {
+        'process': process.name,
+        'daemonic': daemonic,
+        'num_images': numImages,
+        'seconds': time.perf_counter() - start
+    }
+
+
+def create_images(folder, numImages, size):
+    for idx in range(numImages):
+        gradient = np.linspace(0, 255, size[0], dtype=np.float32)[None,:,None]
+        noise = np.random.uniform(0, 64, (size[1], size[0], 3)).astype(np.float32)
+        arr = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        Image.fromarray(arr).save(os.path.join(folder, f'{idx}.jpg'), quality=90)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark DataLoader worker processes inside a Celery prefork worker.')
+    parser.add_argument('--num_images', type=int, default=500)
+    parser.add_argument('--image_size', type=int, nargs=2, default=[2000, 1500])
+    parser.add_argument('--target_size', type=int, nargs=2, default=[800, 600])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 1, 2, 4])
+    parser.add_argument('--max_tasks_per_child', type=int, default=1,
+                        help='Tasks per pool process of the Celery worker before it is recycled (1 as for the AIWorker; 0 for warm workers).')
+    parser.add_argument('--broker', type=str, default=None,
+                        help='Broker URL of an existing message broker (default: filesystem transport in a temporary folder).')
+    parser.add_argument('--backend', type=str, default=None,
+                        help='Result backend URL (default: files in a temporary folder).')
+    parser.add_argument('--timeout', type=int, default=600)
+    args = parser.parse_args()
+
+    tempDir = tempfile.mkdtemp()
+    worker = None
+    try:
+        imageDir = os.path.join(tempDir, 'images')
+        os.makedirs(imageDir)
+        print(f'Creating {args.num_images} images of size {args.image_size[0]}x{args.image_size[1]}...')
+        create_images(imageDir, args.num_images, args.image_size)
+
+        env = os.environ.copy()
+        env[ENV_FOLDER] = tempDir
+        env[ENV_MAX_TASKS] = str(args.max_tasks_per_child)
+        if args.broker is not None:
+            env[ENV_BROKER] = args.broker
+        if args.backend is not None:
+            env[ENV_BACKEND] = args.backend
+        os.environ.update(env)
+        configure(tempDir)
+
+        worker = subprocess.Popen([sys.executable, '-m', 'celery', '-A', 'tests.benchmarks.benchmark_dataLoading',
+                                    'worker', '--pool=prefork', '--concurrency=1', '--loglevel=warning'],
+                                    env=env)
+
+        print(f'{"num_workers":>12}{"images/s":>12}{"seconds":>10}  pool process')
+        for numWorkers in args.num_workers:
+            result = load_images.delay(imageDir, numWorkers, args.batch_size, args.target_size).get(timeout=args.timeout)
+            processInfo = result['process'] + (' (daemonic)' if result['daemonic'] else '')
+            if 'error' in result:
+                print(f'{numWorkers:>12}{"failed":>12}{"":>10}  {processInfo}: {result["error"]}')
+                continue
+            print(f'{numWorkers:>12}{result["num_images"]/result["seconds"]:12.1f}{result["seconds"]:10.2f}  {processInfo}')
+
+    finally:
+        if worker is not None:
+            worker.terminate()
+            worker.wait()
+        shutil.rmtree(tempDir, ignore_errors=True)
@@ -0,0 +1,73 @@
+'''
+    Decoding speed of JPEG images at reduced resolution ("util.helpers.draft-
+    Image") compared to decoding them in full, for a range of image and model
+    input sizes. Both variants are resized to the model input size afterwards,
+    as done by the datasets of the built-in models; the mean absolute diffe-
+    rence of the resulting images is reported as well.
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_draftImage --image_sizes 4000x3000 2000x1500 --target_sizes 800x600 224x224
+
+    2020 Benjamin Kellenberger
+'''
+
+import io
+import time
+import argparse
+import numpy as np
+from PIL import Image
+
+from util.helpers import draftImage
+
+
+def _parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def create_jpeg(size, quality=90):
+    # smooth gradients plus noise, roughly as compressible as photographs
+    xx, yy = np.meshgrid(np.linspace(0, 1, size[0]), np.linspace(0, 1, size[1]))
+    arr = np.stack([xx, yy, (xx + yy) / 2], -1) * 192
+    arr += np.random.uniform(0, 63, arr.shape)
+    bio = io.BytesIO()
+    Image.fromarray(arr.astype(np.uint8)).save(bio, format='JPEG', quality=quality)
+    return bio.getvalue()
+
+
+def decode(data, targetSize, useDraft):
+    img = Image.open(io.BytesIO(data))
+    if useDraft:
+        img = draftImage(img, targetSize)
+    img = img.convert('RGB')
+    decodedSize = img.size
+    return img.resize(targetSize, Image.BILINEAR), decodedSize
+
+
+def _time(fun, numRepetitions):
+    times = []
+    for _ in range(numRepetitions):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return result, np.median(times)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark reduced-resolution JPEG decoding.')
+    parser.add_argument('--image_sizes', type=_parse_size, nargs='+', default=[(6000, 4000), (4000, 3000), (2000, 1500)])
+    parser.add_argument('--target_sizes', type=_parse_size, nargs='+', default=[(800, 600), (512, 512), (224, 224)])
+    parser.add_argument('--num_repetitions', type=int, default=10)
+    args = parser.parse_args()
+
+    print(f'{"image":>12}{"target":>12}{"decoded":>12}{"full (ms)":>12}{"draft (ms)":>12}{"speedup":>10}{"mean |diff|":>13}')
+    for imageSize in args.image_sizes:
+        data = create_jpeg(imageSize)
+        for targetSize in args.target_sizes:
+            (fullImg, _), fullTime = _time(lambda: decode(data, targetSize, False), args.num_repetitions)
+            (draftImg, decodedSize), draftTime = _time(lambda: decode(data, targetSize, True), args.num_repetitions)
+            diff = np.abs(np.asarray(fullImg, dtype=np.float32) - np.asarray(draftImg, dtype=np.float32)).mean()
+            print(f'{"%dx%d" % imageSize:>12}{"%dx%d" % targetSize:>12}{"%dx%d" % decodedSize:>12}' +
+                f'{1000*fullTime:12.1f}{1000*draftTime:12.1f}{fullTime/draftTime:10.2f}{diff:13.2f}')
@@ -0,0 +1,111 @@
+'''
+    Cost of rescanning a watched project folder with a synthetic tree of
+    (by default) one million empty image files, using the incremental folder
+    snapshots ("folderWatcher.FolderSnapshot"): the initial scan, a rescan
+    without changes, and rescans after adding files to a few directories.
+    The rescans should take time proportional to the number of directories
+    and changes, not to the number of files.
+    Optionally, the database side ("DataWorker._register_watched_images") is
+    measured as well for a given project (use a test project; the files are
+    registered).
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_folderWatcher --num_files 1000000 --num_dirs 1000
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import importlib.util
+
+
+def _load_folder_watcher():
+    # avoid importing the "modules" package (requires Celery configuration)
+    path = os.path.join(os.path.dirname(__file__), '..', '..', 'modules/DataAdministration/backend/folderWatcher.py')
+    spec = importlib.util.spec_from_file_location('folderWatcher', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def create_tree(baseDir, numFiles, numDirs):
+    filesPerDir = max(1, numFiles // numDirs)
+    for d in range(numDirs):
+        dirPath = os.path.join(baseDir, f'{d // 100:03d}', f'{d:06d}')
+        os.makedirs(dirPath, exist_ok=True)
+        for f in range(filesPerDir):
+            open(os.path.join(dirPath, f'IMG_{f:06d}.JPG'), 'w').close()
+    return filesPerDir * numDirs
+
+
+def add_files(baseDir, numDirs, filesPerDir, tag):
+    added = []
+    for d in range(numDirs):
+        dirPath = os.path.join(baseDir, f'{d // 100:03d}', f'{d:06d}')
+        for f in range(filesPerDir):
+            fileName = os.path.join(dirPath, f'NEW_{tag}_{f:06d}.JPG')
+            open(fileName, 'w').close()
+            added.append(os.path.relpath(fileName, baseDir))
+    return added
+
+
+def timed(fun, *args):
+    t = time.perf_counter()
+    result = fun(*args)
+    return result, time.perf_counter() - t
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark rescans of watched project folders.')
+    parser.add_argument('--num_files', type=int, default=1000000)
+    parser.add_argument('--num_dirs', type=int, default=1000)
+    parser.add_argument('--changed_dirs', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--files_per_change', type=int, default=10)
+    parser.add_argument('--base_dir', type=str, default=None,
+                        help='Directory to create the synthetic tree in (default: temporary directory).')
+    parser.add_argument('--project', type=str, default=None,
+                        help='Also measure the database registration of the new files for this (test) project. Requires "AIDE_CONFIG_PATH" and "AIDE_MODULES".')
+    args = parser.parse_args()
+
+    folderWatcher = _load_folder_watcher()
+    folderWatcher.FolderSnapshot.MTIME_SAFETY_MARGIN = 0
+
+    tempDir = tempfile.mkdtemp(dir=args.base_dir)
+    try:
+        treeDir = os.path.join(tempDir, 'tree')
+        (numFiles, elapsed) = timed(create_tree, treeDir, args.num_files, args.num_dirs)
+        print(f'created {numFiles} files in {args.num_dirs} directories ({elapsed:.1f} s)')
+
+        snapshot = folderWatcher.FolderSnapshot(os.path.join(tempDir, 'snapshot.sqlite'), treeDir)
+        (added, _), elapsed = timed(snapshot.scan)
+        _, elapsedSave = timed(snapshot.save)
+        print(f'initial scan:\t\t{elapsed:8.2f} s (+ {elapsedSave:.2f} s to save; {len(added)} files)')
+
+        time.sleep(1)
+        (added, _), elapsed = timed(snapshot.scan)
+        snapshot.save()
+        print(f'rescan, no changes:\t{elapsed:8.2f} s ({len(added)} files)')
+
+        worker = None
+        if args.project is not None:
+            from util.configDef import Config
+            from modules.DataAdministration.backend.dataWorker import DataWorker
+            worker = DataWorker(Config())
+
+        for numChanged in args.changed_dirs:
+            newFiles = add_files(treeDir, min(numChanged, args.num_dirs), args.files_per_change, numChanged)
+            time.sleep(1)
+            (added, _), elapsed = timed(snapshot.scan)
+            snapshot.save()
+            message = f'rescan, {numChanged} dirs changed:\t{elapsed:8.2f} s ({len(added)} new files)'
+            if worker is not None:
+                _, elapsedDB = timed(worker._register_watched_images, args.project, added)
+                message += f'; database: {elapsedDB:.2f} s'
+            print(message)
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
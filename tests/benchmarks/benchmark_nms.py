@@ -0,0 +1,179 @@
+'''
+    Speed of non-maximum suppression of the RetinaNet decoder ("ai/models/
+    pytorch/functional/_retinanet/utils.py") for a growing number of boxes:
+    the previous, sequential implementation of "box_nms" (one box kept per
+    iteration) compared to the vectorized "batched_nms" (class-agnostic and
+    class-aware), and the previous, sequential Soft-NMS compared to "soft_-
+    nms" (class-agnostic, i.e. one group, and class-aware, where the top box
+    of every class is kept at once). The previous Soft-NMS is only run up to
+    the number of boxes given by "--soft_sequential_max_boxes". Boxes and
+    scores are random; the boxes kept are checked to be identical to the ones
+    kept by the respective sequential implementation.
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_nms --num_boxes 1000 10000 50000
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import argparse
+import torch
+
+from ai.models.pytorch.functional._retinanet.utils import batched_nms, soft_nms, box_overlap
+
+
+def box_nms_sequential(bboxes, scores, threshold=0.5, mode='union'):
+    '''
+        Previous implementation of "box_nms", kept as a reference.
+    '''
+    if bboxes.dim()==1:
+        bboxes = bboxes.unsqueeze(0)
+        scores = scores.unsqueeze(0)
+
+    x1 = bboxes[:,0]
+    y1 = bboxes[:,1]
+    x2 = bboxes[:,2]
+    y2 = bboxes[:,3]
+
+    areas = (x2-x1+1) * (y2-y1+1)
+    _, order = scores.sort(0, descending=True)
+
+    keep = []
+    while order.numel() > 0:
+        i = order[0]
+        keep.append(i)
+
+        if order.numel() == 1:
+            break
+
+        xx1 = x1[order[1:]].clamp(min=x1[i])
+        yy1 = y1[order[1:]].clamp(min=y1[i])
+        xx2 = x2[order[1:]].clamp(max=x2[i])
+        yy2 = y2[order[1:]].clamp(max=y2[i])
+
+        w = (xx2-xx1+1).clamp(min=0)
+        h = (yy2-yy1+1).clamp(min=0)
+        inter = w*h
+
+        if mode == 'union':
+            ovr = inter / (areas[i] + areas[order[1:]] - inter)
+        elif mode == 'min':
+            ovr = inter / areas[order[1:]].clamp(max=areas[i])
+        else:
+            raise TypeError('Unknown nms mode: %s.' % mode)
+
+        ids = (ovr<=threshold).nonzero().squeeze()
+        if ids.numel() == 0:
+            break
+        order = order[ids+1]
+        if not order.dim():
+            order = order.unsqueeze(0)
+    return torch.LongTensor(keep)
+
+
+def soft_nms_sequential(bboxes, scores, idxs=None, threshold=0.5, decay='linear', sigma=0.5, score_thresh=0.001):
+    '''
+        Previous implementation of "soft_nms" (IoU only), kept as a reference:
+        one box kept per iteration, over all groups.
+    '''
+    scores = scores.clone()
+    remaining = (scores >= score_thresh).nonzero().squeeze(1)
+
+    keep = []
+    while remaining.numel() > 0:
+        top = int(scores[remaining].argmax())
+        i = remaining[top]
+        keep.append(i)
+        remaining = torch.cat((remaining[:top], remaining[top+1:]))
+        if remaining.numel() == 0:
+            break
+
+        ovr = box_overlap(bboxes[i].unsqueeze(0), bboxes[remaining])[0]
+        if idxs is not None:
+            ovr = ovr.masked_fill(idxs[remaining] != idxs[i], float('-inf'))
+        if decay == 'linear':
+            weight = torch.where(ovr > threshold, 1 - ovr, torch.ones_like(ovr))
+        else:
+            weight = torch.exp(-(ovr.clamp(min=0)**2) / sigma)
+        scores[remaining] = scores[remaining] * weight
+        remaining = remaining[scores[remaining] >= score_thresh]
+
+    if not len(keep):
+        return torch.zeros(0, dtype=torch.long, device=bboxes.device), scores[:0]
+    keep = torch.stack(keep)
+    return keep, scores[keep]
+
+
+def random_boxes(numBoxes, imageSize, minSize=16, maxSize=128, numClasses=10, dtype=torch.float32):
+    xy = torch.rand(numBoxes, 2, dtype=dtype) * (imageSize - maxSize)
+    wh = minSize + torch.rand(numBoxes, 2, dtype=dtype) * (maxSize - minSize)
+    boxes = torch.cat([xy, xy + wh], 1)
+    scores = torch.rand(numBoxes, dtype=dtype)
+    labels = torch.randint(0, numClasses, (numBoxes,))
+    return boxes, scores, labels
+
+
+def _time(fun, numRepetitions):
+    times = []
+    for _ in range(numRepetitions):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return result, sorted(times)[len(times)//2]
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark non-maximum suppression.')
+    parser.add_argument('--num_boxes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--image_size', type=int, default=2000,
+                        help='Side length of the (square) area the boxes are distributed in.')
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--decay', type=str, default='linear', choices=['linear', 'gaussian'],
+                        help='Score decay of Soft-NMS.')
+    parser.add_argument('--methods', type=str, nargs='+',
+                        default=['sequential', 'batched', 'batched_class_aware',
+                                'soft_sequential', 'soft', 'soft_sequential_class_aware', 'soft_class_aware'],
+                        choices=['sequential', 'batched', 'batched_class_aware',
+                                'soft_sequential', 'soft', 'soft_sequential_class_aware', 'soft_class_aware'])
+    parser.add_argument('--soft_sequential_max_boxes', type=int, default=10000,
+                        help='The previous Soft-NMS keeps one box per iteration; it is skipped for more boxes than this.')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_repetitions', type=int, default=3)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    print(f'{"boxes":>8}{"method":>30}{"kept":>8}{"ms":>12}{"speedup":>10}  identical to sequential')
+    for numBoxes in args.num_boxes:
+        boxes, scores, labels = [t.to(args.device) for t in random_boxes(numBoxes, args.image_size, numClasses=args.num_classes)]
+        funs = {
+            'sequential': lambda: box_nms_sequential(boxes, scores, args.threshold),
+            'batched': lambda: batched_nms(boxes, scores, None, args.threshold),
+            'batched_class_aware': lambda: batched_nms(boxes, scores, labels, args.threshold),
+            'soft_sequential': lambda: soft_nms_sequential(boxes, scores, None, args.threshold, args.decay)[0],
+            'soft': lambda: soft_nms(boxes, scores, None, args.threshold, decay=args.decay)[0],
+            'soft_sequential_class_aware': lambda: soft_nms_sequential(boxes, scores, labels, args.threshold, args.decay)[0],
+            'soft_class_aware': lambda: soft_nms(boxes, scores, labels, args.threshold, decay=args.decay)[0]
+        }
+        references = {}
+        for method in args.methods:
+            # reference: sequential variant of the same kind (hard or soft, class-aware or not)
+            referenceMethod = {
+                'batched': 'sequential',
+                'soft': 'soft_sequential',
+                'soft_class_aware': 'soft_sequential_class_aware'
+            }.get(method, None)
+            if method.startswith('soft_sequential') and numBoxes > args.soft_sequential_max_boxes:
+                print(f'{numBoxes:>8}{method:>30}{"skipped":>20}')
+                continue
+            keep, seconds = _time(funs[method], args.num_repetitions)
+            references[method] = (keep.cpu(), seconds)
+            identical, speedup = '', f'{"":>10}'
+            if referenceMethod in references:
+                reference, referenceTime = references[referenceMethod]
+                identical = str(torch.equal(keep.cpu(), reference))
+                speedup = f'{referenceTime/seconds:10.2f}'
+            print(f'{numBoxes:>8}{method:>30}{keep.numel():>8}{1000*seconds:12.1f}{speedup}  {identical}')
@@ -0,0 +1,100 @@
+'''
+    Throughput of target encoding (collate function of the RetinaNet data
+    loader) and prediction decoding with anchor boxes cached per input size
+    ("DataEncoder._get_anchor_boxes"), compared to computing them anew for
+    every image resp. batch, as done before. The outputs of both variants
+    are checked to be identical. Decoding computes the anchors once per batch
+    and is dominated by non-maximum suppression, so the difference is expected
+    to be largest for target encoding, which computes them once per image.
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_retinanetAnchors --input_sizes 512 800 --batch_size 8
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import argparse
+import torch
+
+from ai.models.pytorch.functional._retinanet.encoder import DataEncoder
+from ai.models.pytorch.functional._retinanet.collation import Collator
+from ai.models.pytorch.functional._retinanet.utils import change_box_order
+
+
+class UncachedDataEncoder(DataEncoder):
+    '''
+        Computes the anchor boxes anew upon every call (previous behavior).
+    '''
+    def _get_anchor_boxes(self, input_size, device=None, dtype=None, order='xywh'):
+        anchors = self._compute_anchor_boxes(input_size).to(device=device or torch.device('cpu'),
+                                                            dtype=dtype or torch.float32)
+        if order == 'xyxy':
+            return change_box_order(anchors, 'xywh2xyxy')
+        return anchors
+
+
+def make_batch(inputSize, batchSize, numBoxes, numClasses):
+    batch = []
+    for idx in range(batchSize):
+        xy = torch.rand(numBoxes, 2) * (inputSize - 64)
+        wh = 16 + torch.rand(numBoxes, 2) * 48
+        boxes = torch.cat([xy, xy + wh], 1)
+        labels = torch.randint(0, numClasses, (numBoxes,))
+        batch.append((torch.rand(3, inputSize, inputSize), boxes, labels, None, idx))
+    return batch
+
+
+def make_predictions(encoder, inputSize, batchSize, numClasses):
+    numAnchors = encoder._get_anchor_boxes(torch.Tensor([inputSize, inputSize])).size(0)
+    loc_preds = 0.1 * torch.randn(batchSize, numAnchors, 4)
+    cls_preds = torch.randn(batchSize, numAnchors, numClasses) - 4      # few candidates above threshold
+    return loc_preds, cls_preds
+
+
+def _time(fun, numRepetitions):
+    result = fun()      # warm-up (fills the cache)
+    times = []
+    for _ in range(numRepetitions):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return result, sorted(times)[len(times)//2]
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark caching of RetinaNet anchor boxes.')
+    parser.add_argument('--input_sizes', type=int, nargs='+', default=[512, 800])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_boxes', type=int, default=20,
+                        help='Number of ground truth boxes per image.')
+    parser.add_argument('--num_classes', type=int, default=10)
+    parser.add_argument('--num_repetitions', type=int, default=10)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+
+    print(f'{"input size":>11}{"stage":>10}{"before (ms)":>14}{"cached (ms)":>14}{"speedup":>10}{"images/s before":>18}{"images/s cached":>18}')
+    for inputSize in args.input_sizes:
+        encoders = (UncachedDataEncoder(), DataEncoder())
+        collators = [Collator(None, None, (inputSize, inputSize), e) for e in encoders]
+        batch = make_batch(inputSize, args.batch_size, args.num_boxes, args.num_classes)
+        loc_preds, cls_preds = make_predictions(encoders[1], inputSize, args.batch_size, args.num_classes)
+
+        stages = {
+            'collate': [lambda c=c: c.collate_fn(batch) for c in collators],
+            'decode': [lambda e=e: e.decode(loc_preds, cls_preds, inputSize, cls_thresh=0.5, nms_thresh=0.5)
+                                for e in encoders]
+        }
+        for stage, funs in stages.items():
+            (resultBefore, timeBefore), (resultCached, timeCached) = [_time(f, args.num_repetitions) for f in funs]
+
+            # outputs must be identical
+            flatBefore = [t for r in resultBefore for t in (r if isinstance(r, list) else [r]) if torch.is_tensor(t)]
+            flatCached = [t for r in resultCached for t in (r if isinstance(r, list) else [r]) if torch.is_tensor(t)]
+            assert len(flatBefore) == len(flatCached) and all(torch.equal(a, b) for a, b in zip(flatBefore, flatCached)), \
+                f'outputs of {stage} differ'
+
+            print(f'{inputSize:>11}{stage:>10}{1000*timeBefore:14.1f}{1000*timeCached:14.1f}{timeBefore/timeCached:10.2f}' +
+                f'{args.batch_size/timeBefore:18.1f}{args.batch_size/timeCached:18.1f}')
@@ -0,0 +1,136 @@
+'''
+    Size, save and load time, and change in accuracy of model states stored
+    in the compact format ("ai/models/pytorch/stateSerialization.py") for
+    all combinations of compression (zstd, zlib), precision (fp16, bf16)
+    and layout (chunked or not), compared to plain "torch.save".
+
+    The accuracy change is reported as the maximum absolute difference of
+    the model parameters, and as the maximum absolute difference of the
+    model outputs on a random input, relative to the largest output of the
+    original model.
+
+    By default, randomly initialized RetinaNet, ResNet and UNet models are
+    used. Trained weights compress differently, so exported model states
+    (e.g. from the Model Marketplace, see "projectCreation/export_model_
+    state.py") can be benchmarked as well:
+
+        python -m tests.benchmarks.benchmark_stateSerialization --state_files retinanet.pth
+
+    2020 Benjamin Kellenberger
+'''
+
+import io
+import time
+import argparse
+import itertools
+import torch
+
+from ai.models.pytorch import stateSerialization
+from ai.models.pytorch.functional._retinanet.model import RetinaNet
+from ai.models.pytorch.functional.classification.resnet import ResNet
+from ai.models.pytorch.functional.segmentationMasks.unet import UNet
+
+
+LABELCLASS_MAP = dict([(f'class_{idx}', idx) for idx in range(10)])
+
+MODELS = {
+    'RetinaNet': (lambda: RetinaNet(dict(LABELCLASS_MAP), backbone='resnet50', pretrained=False), (1, 3, 512, 512)),
+    'ResNet': (lambda: ResNet(dict(LABELCLASS_MAP), featureExtractor='resnet50', pretrained=False), (1, 3, 224, 224)),
+    'UNet': (lambda: UNet(dict(LABELCLASS_MAP)), (1, 3, 256, 256))
+}
+
+OPTIONS = [{'compression': c, 'precision': p, 'chunked': ch} for c, p, ch in
+            itertools.product(('none', 'zlib', 'zstd'), ('fp32', 'fp16', 'bf16'), (False, True))]
+
+
+def _flatten_outputs(output):
+    if torch.is_tensor(output):
+        return [output.float().flatten()]
+    result = []
+    for o in output:
+        result.extend(_flatten_outputs(o))
+    return result
+
+
+def _timed(fun, numRepetitions):
+    times = []
+    for _ in range(numRepetitions):
+        start = time.perf_counter()
+        result = fun()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def benchmark_state(name, stateDict, modelClass, inputSize, numRepetitions):
+    print(f'\n{name}')
+    print(f'{"format":<28}{"size (MB)":>12}{"ratio":>8}{"save (s)":>10}{"load (s)":>10}{"max |dW|":>12}{"rel. |dY|":>12}')
+
+    def _save_plain():
+        bio = io.BytesIO()
+        torch.save(stateDict, bio)
+        return bio.getvalue()
+    plain, saveTime = _timed(_save_plain, numRepetitions)
+    _, loadTime = _timed(lambda: stateSerialization.load_state(plain), numRepetitions)
+    print(f'{"torch.save (plain)":<28}{len(plain)/1e6:12.1f}{1.0:8.2f}{saveTime:10.3f}{loadTime:10.3f}{"-":>12}{"-":>12}')
+
+    # reference outputs
+    reference = None
+    if modelClass is not None:
+        torch.manual_seed(0)
+        inputs = torch.rand(*inputSize)
+        model = modelClass.loadFromStateDict(stateDict).eval()
+        with torch.no_grad():
+            reference = torch.cat(_flatten_outputs(model(inputs)))
+
+    for options in OPTIONS:
+        data, saveTime = _timed(lambda: stateSerialization.save_state(stateDict, **options), numRepetitions)
+        loaded, loadTime = _timed(lambda: stateSerialization.load_state(data), numRepetitions)
+
+        paramDiff = 0.0
+        for path, tensor in stateSerialization.walk_tensors(stateDict):
+            if tensor.is_floating_point() and tensor.numel():
+                diff = (stateSerialization.get_path(loaded, path).float() - tensor.float()).abs().max()
+                paramDiff = max(paramDiff, diff.item())
+
+        outputDiff = '-'
+        if reference is not None:
+            model = modelClass.loadFromStateDict(loaded).eval()
+            with torch.no_grad():
+                output = torch.cat(_flatten_outputs(model(inputs)))
+            outputDiff = f'{((output - reference).abs().max() / reference.abs().max().clamp(min=1e-12)).item():12.2e}'
+
+        label = f'{options["compression"]}/{options["precision"]}' + ('/chunked' if options['chunked'] else '')
+        print(f'{label:<28}{len(data)/1e6:12.1f}{len(plain)/len(data):8.2f}{saveTime:10.3f}{loadTime:10.3f}{paramDiff:12.2e}{outputDiff:>12}')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the serialization formats of model states.')
+    parser.add_argument('--models', type=str, nargs='*', default=list(MODELS.keys()),
+                        help='Randomly initialized models to benchmark (one or more of {}).'.format(', '.join(MODELS.keys())))
+    parser.add_argument('--state_files', type=str, nargs='*', default=[],
+                        help='Model state files (any format) to benchmark additionally.')
+    parser.add_argument('--model_class', type=str, default=None,
+                        help='Model ({}) to compare outputs of the model states in "state_files" with.'.format(', '.join(MODELS.keys())))
+    parser.add_argument('--num_repetitions', type=int, default=3)
+    args = parser.parse_args()
+
+    modelClasses = {
+        'RetinaNet': RetinaNet,
+        'ResNet': ResNet,
+        'UNet': UNet
+    }
+
+    for modelName in args.models:
+        constructor, inputSize = MODELS[modelName]
+        model = constructor()
+        benchmark_state(modelName, model.getStateDict(), modelClasses[modelName], inputSize, args.num_repetitions)
+
+    for stateFile in args.state_files:
+        with open(stateFile, 'rb') as f:
+            stateDict = stateSerialization.load_state(f)
+        modelClass, inputSize = None, None
+        if args.model_class is not None:
+            modelClass = modelClasses[args.model_class]
+            inputSize = MODELS[args.model_class][1]
+        benchmark_state(stateFile, stateDict, modelClass, inputSize, args.num_repetitions)
@@ -0,0 +1,83 @@
+'''
+    Throughput of the verification stage of the image upload pipeline
+    ("dataWorker._prepare_upload") on synthetic JPEGs: inline (as for small
+    uploads), and in a process pool with a varying number of workers. The
+    time to start the pool is reported separately, since it is paid once per
+    web server worker.
+
+    Usage (from the root of the repository, with environment variables
+    "AIDE_CONFIG_PATH" and "AIDE_MODULES" set as for AIDE itself):
+
+        python -m tests.benchmarks.benchmark_upload --num_images 200 --num_workers 1 2 4
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor
+
+from modules.DataAdministration.backend.dataWorker import _prepare_upload
+
+
+def create_images(folder, numImages, size):
+    paths = []
+    for idx in range(numImages):
+        gradient = np.linspace(0, 255, size[0], dtype=np.float32)[None,:,None]
+        noise = np.random.uniform(0, 64, (size[1], size[0], 3)).astype(np.float32)
+        arr = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(folder, f'{idx}.jpg')
+        Image.fromarray(arr).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def run_inline(paths, splitArgs):
+    for p in paths:
+        _prepare_upload(p, p + '_patches', os.path.basename(p), splitArgs)
+
+
+def run_pool(pool, paths, splitArgs):
+    jobs = [pool.submit(_prepare_upload, p, p + '_patches', os.path.basename(p), splitArgs) for p in paths]
+    for j in jobs:
+        j.result()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the verification of uploaded images.')
+    parser.add_argument('--num_images', type=int, default=200)
+    parser.add_argument('--image_size', type=int, nargs=2, default=[2000, 1500])
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--split', action='store_true',
+                        help='Additionally split images into patches of 800x600 (stride 400x300).')
+    args = parser.parse_args()
+
+    splitArgs = ((800, 600), (400, 300), True) if args.split else None
+    tempDir = tempfile.mkdtemp()
+    try:
+        paths = create_images(tempDir, args.num_images, args.image_size)
+        totalMB = sum([os.path.getsize(p) for p in paths]) / 1e6
+
+        t = time.perf_counter()
+        run_inline(paths, splitArgs)
+        elapsed = time.perf_counter() - t
+        print(f'inline:\t\t{args.num_images/elapsed:8.1f} images/s\t{totalMB/elapsed:8.1f} MB/s')
+
+        for numWorkers in args.num_workers:
+            t = time.perf_counter()
+            pool = ProcessPoolExecutor(max_workers=numWorkers)
+            pool.submit(os.getpid).result()
+            startup = time.perf_counter() - t
+
+            t = time.perf_counter()
+            run_pool(pool, paths, splitArgs)
+            elapsed = time.perf_counter() - t
+            pool.shutdown()
+            print(f'{numWorkers} workers:\t{args.num_images/elapsed:8.1f} images/s\t{totalMB/elapsed:8.1f} MB/s\t(pool start: {1000*startup:.0f} ms)')
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
@@ -0,0 +1,103 @@
+'''
+    Speed of the decoding of point predictions of the weakly-supervised
+    point model ("ai/models/pytorch/functional/_wsodPoints/encoder.py") for
+    large heatmaps: peak picking with radius-based suppression (max-pooling)
+    for a range of radii ("nms_dist"), compared to the previous decoding,
+    which returned every cell above the confidence threshold (once per class
+    exceeding it). Heatmaps are synthetic: Gaussian blobs of random size and
+    class on top of low noise.
+
+    Usage (from the root of the repository):
+
+        python -m tests.benchmarks.benchmark_wsodDecode --heatmap_sizes 256 1024 2048 --nms_dist 0 2 5
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import argparse
+import torch
+
+from ai.models.pytorch.functional._wsodPoints.encoder import DataEncoder
+
+
+def decode_thresholded(loc_preds, min_conf=0.5):
+    '''
+        Previous implementation of "DataEncoder.decode", kept as a reference.
+    '''
+    if loc_preds.dim() == 2:
+        loc_preds = loc_preds.unsqueeze(0)
+    loc_preds = loc_preds.float()
+
+    loc_preds_flat = loc_preds.view(loc_preds.size(0), -1)
+    positions_flat = torch.nonzero(loc_preds_flat >= min_conf)
+    confidences = torch.index_select(loc_preds_flat, 1, positions_flat[:,1]).permute(1,0)
+    points = (torch.nonzero(loc_preds >= min_conf)[:,1:]).cpu()
+    labels = (torch.argmax(confidences, 1).squeeze()).cpu()
+
+    sz = torch.tensor(loc_preds.size(), dtype=torch.float)
+    points = (points.float() + 0.5) / sz[1:]
+    return points, labels, confidences
+
+
+def create_heatmap(size, numClasses, numObjects, minSigma=1.0, maxSigma=4.0):
+    yy = torch.arange(size, dtype=torch.float32)[:,None]
+    xx = torch.arange(size, dtype=torch.float32)[None,:]
+    heatmap = 0.2 * torch.rand(numClasses, size, size)
+    centers = torch.rand(numObjects, 2) * size
+    sigmas = minSigma + torch.rand(numObjects) * (maxSigma - minSigma)
+    labels = torch.randint(0, numClasses, (numObjects,))
+    for o in range(numObjects):
+        # only update a window around the blob
+        r = int(4 * sigmas[o]) + 1
+        y0, x0 = [int(c) for c in centers[o]]
+        ys, xs = slice(max(0, y0-r), y0+r+1), slice(max(0, x0-r), x0+r+1)
+        dist = (yy[ys] - centers[o,0])**2 + (xx[:,xs] - centers[o,1])**2
+        blob = (0.5 + 0.5 * torch.rand(1)) * torch.exp(-dist / (2 * sigmas[o]**2))
+        heatmap[labels[o],ys,xs] = torch.max(heatmap[labels[o],ys,xs], blob)
+    return heatmap
+
+
+def _time(fun, numRepetitions, device):
+    times = []
+    for _ in range(numRepetitions):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = fun()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return result, sorted(times)[len(times)//2]
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark decoding of point predictions.')
+    parser.add_argument('--heatmap_sizes', type=int, nargs='+', default=[256, 1024, 2048])
+    parser.add_argument('--num_classes', type=int, default=4)
+    parser.add_argument('--object_density', type=float, default=1e-3,
+                        help='Number of objects per heatmap cell.')
+    parser.add_argument('--min_conf', type=float, default=0.5)
+    parser.add_argument('--nms_dist', type=int, nargs='+', default=[0, 2, 5])
+    parser.add_argument('--top_k', type=int, default=None)
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--num_repetitions', type=int, default=5)
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    device = torch.device(args.device)
+    encoder = DataEncoder(args.num_classes)
+
+    print(f'{"heatmap":>11}{"objects":>9}{"method":>22}{"points":>9}{"ms":>10}{"cells/s (M)":>13}')
+    for size in args.heatmap_sizes:
+        numObjects = max(1, int(args.object_density * size * size))
+        heatmap = create_heatmap(size, args.num_classes, numObjects).to(device)
+
+        funs = [('thresholded (before)', lambda: decode_thresholded(heatmap, args.min_conf))]
+        for nms_dist in args.nms_dist:
+            funs.append((f'nms_dist={nms_dist}', lambda nms_dist=nms_dist: encoder.decode(heatmap, args.min_conf, nms_dist, args.top_k)))
+
+        for name, fun in funs:
+            (points, _, _), seconds = _time(fun, args.num_repetitions, device)
+            print(f'{"%dx%d" % (size, size):>11}{numObjects:>9}{name:>22}{points.size(0):>9}{1000*seconds:10.1f}' +
+                f'{size*size/seconds/1e6:13.1f}')
@@ -0,0 +1,60 @@
+'''
+    Test configuration. Tests are run from the root of the repository:
+
+        python -m pytest tests
+
+    Tests that require optional dependencies (e.g. NumPy, PyTorch) are
+    skipped if these are not installed. Benchmarks are not collected; they
+    are run as modules instead (see "tests/benchmarks").
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import sys
+import types
+import importlib
+import importlib.util
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+
+@pytest.fixture
+def load_module():
+    '''
+        Returns a function that loads a single module of AIDE from its path
+        (relative to the root of the repository), without importing the
+        package it resides in. Importing "modules" sets up Celery, which re-
+        quires a configuration file and a message broker.
+    '''
+    def _load(relPath):
+        name = 'aide_test_' + os.path.splitext(relPath)[0].replace('/', '_')
+        if name in sys.modules:
+            return sys.modules[name]
+        path = os.path.join(os.path.dirname(__file__), '..', relPath)
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        return module
+    return _load
+
+
+
+@pytest.fixture
+def import_module():
+    '''
+        Returns a function that imports a sub-module of AIDE by its name (e.g.
+        "modules.AIWorker.backend.fileserver"), so that it can in turn import
+        other sub-modules of package "modules". The package itself is set up
+        as a namespace, without running its "__init__" (see "load_module").
+    '''
+    def _import(name):
+        if name.split('.')[0] == 'modules' and 'modules' not in sys.modules:
+            package = types.ModuleType('modules')
+            package.__path__ = [os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'modules'))]
+            sys.modules['modules'] = package
+        return importlib.import_module(name)
+    return _import
@@ -0,0 +1,179 @@
+'''
+    Tests the vectorized built-in AL criteria ("breaking_ties", "max_confi-
+    dence" and "apply_heuristics" in "ai/al/functional/noarch/functional.py")
+    against the per-prediction functions, and the rankings of the dict format
+    and of prediction batches against the previous, per-prediction ranking.
+
+    2020 Benjamin Kellenberger
+'''
+
+import copy
+import math
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from util.predictionBatch import PredictionBatch
+from ai.al.functional.noarch.functional import breaking_ties, max_confidence, apply_heuristics, \
+    _breaking_ties, _max_confidence
+from ai.al.builtins.breakingties import BreakingTies
+from ai.al.builtins.maxconfidence import MaxConfidence
+from ai.al.builtins.compose import Compose
+from tests.benchmarks.benchmark_alCriteria import breaking_ties_reference, max_confidence_reference, \
+    rank_reference, create_predictions, get_priorities, CRITERIA
+
+
+def _assert_priorities_equal(priorities, expected):
+    assert len(priorities) == len(expected)
+    for p, e in zip(priorities, expected):
+        if e is None:
+            assert p is None
+        else:
+            assert p == pytest.approx(e, abs=1e-12)
+
+
+def _mixed_predictions():
+    # different numbers of classes per image and within images
+    np.random.seed(0)
+    data = {}
+    for idx, numClasses in enumerate([2, 3, 10, 3]):
+        data[f'image_{idx}'] = {'predictions': [
+            {'x': 0.5, 'y': 0.5, 'logits': np.random.dirichlet(np.ones(numClasses)).tolist()} for _ in range(5)
+        ]}
+    data['image_1']['predictions'].append({'x': 0.5, 'y': 0.5, 'logits': [0.2, 0.1, 0.3, 0.4]})
+    data['image_empty'] = {'predictions': []}
+    data['image_none'] = {}
+    return data
+
+
+
+@pytest.mark.parametrize('numClasses', [2, 3, 10])
+def test_vectorized_functions(numClasses):
+    np.random.seed(numClasses)
+    logits = np.random.rand(50, numClasses)
+    bt = breaking_ties(logits)
+    mc = max_confidence(logits)
+    for idx in range(50):
+        prediction = {'logits': logits[idx,:].tolist()}
+        assert bt[idx] == pytest.approx(breaking_ties_reference(prediction), abs=1e-12)
+        assert bt[idx] == pytest.approx(_breaking_ties(prediction), abs=1e-12)
+        assert mc[idx] == max_confidence_reference(prediction) == _max_confidence(prediction)
+
+
+def test_ties():
+    logits = np.array([[0.4, 0.4, 0.2], [0.5, 0.5, 0.5]])
+    assert breaking_ties(logits).tolist() == [1.0, 1.0]
+
+
+def test_single_class():
+    logits = np.array([[0.7], [0.2]])
+    assert np.isnan(breaking_ties(logits)).all()
+    assert max_confidence(logits).tolist() == [0.7, 0.2]
+    assert _breaking_ties({'logits': [0.7]}) is None
+    assert _max_confidence({'logits': [0.7]}) == 0.7
+
+
+def test_nan():
+    logits = np.array([[0.2, np.nan, 0.7], [np.nan, 0.3, 0.1], [0.1, 0.3, 0.6]])
+    assert np.isnan(breaking_ties(logits)[:2]).all()
+    assert np.isnan(max_confidence(logits)[:2]).all()
+    assert breaking_ties(logits)[2] == pytest.approx(0.7)
+    assert _breaking_ties({'logits': [0.2, float('nan'), 0.7]}) is None
+    assert _max_confidence({'logits': [0.2, float('nan'), 0.7]}) is None
+
+
+def test_missing_logits():
+    for prediction in ({}, {'logits': None}):
+        assert _breaking_ties(prediction) is None
+        assert _max_confidence(prediction) is None
+    # fallback for models without logits
+    assert _breaking_ties({'logits': None, 'margin': 0.25}) == 0.75
+    assert _max_confidence({'confidence': 0.8}) == 0.8
+
+
+def test_segmentation_mask():
+    np.random.seed(0)
+    prediction = {'logits': np.random.rand(4, 8, 6)}
+    assert _breaking_ties(prediction) == pytest.approx(breaking_ties_reference(prediction), abs=1e-12)
+    assert _max_confidence(prediction) == pytest.approx(prediction['logits'].max(0).mean())
+
+
+@pytest.mark.parametrize('criterion', CRITERIA.keys())
+def test_apply_heuristics_dict(criterion):
+    referenceHeuristics, heuristics, floor = CRITERIA[criterion]
+    data = _mixed_predictions()
+    expected = get_priorities(rank_reference(copy.deepcopy(data), referenceHeuristics, floor))
+    _assert_priorities_equal(get_priorities(apply_heuristics(data, heuristics, floor)), expected)
+    assert 'predictions' not in data['image_none']
+
+
+@pytest.mark.parametrize('criterion', CRITERIA.keys())
+def test_apply_heuristics_prediction_batch(criterion):
+    referenceHeuristics, heuristics, floor = CRITERIA[criterion]
+    np.random.seed(0)
+    batch = create_predictions(5, 20, 4)
+    expected = get_priorities(rank_reference(batch.to_dict(), referenceHeuristics, floor))
+    _assert_priorities_equal(get_priorities(apply_heuristics(batch, heuristics, floor)), expected)
+    # same priorities as the dict format
+    _assert_priorities_equal(get_priorities(apply_heuristics(batch.to_dict(), heuristics, floor)), expected)
+
+
+@pytest.mark.parametrize('criterion', CRITERIA.keys())
+def test_apply_heuristics_invalid(criterion):
+    # predictions whose priority cannot be computed: None (or the floor)
+    _, heuristics, floor = CRITERIA[criterion]
+    data = {'image': {'predictions': [
+        {'logits': [0.9]},
+        {'logits': [0.2, float('nan'), 0.7]},
+        {'logits': [0.2, None, 0.7]},
+        {'logits': None},
+        {},
+        {'logits': []}
+    ]}}
+    priorities = get_priorities(apply_heuristics(data, heuristics, floor))
+    if criterion == 'BreakingTies':
+        assert priorities == [None] * 6
+    elif criterion == 'MaxConfidence':
+        assert priorities == [0.9] + [None] * 5
+    else:
+        assert priorities == [0.9] + [-1] * 5
+
+
+def test_apply_heuristics_prediction_batch_fallback():
+    # prediction batches without logits: margin resp. confidence
+    batch = PredictionBatch(['a', 'b'], [0, 0, 1],
+                            margin=np.array([0.25, np.nan, 0.5]),
+                            confidence=np.array([0.8, 0.6, np.nan]))
+    assert get_priorities(apply_heuristics(batch, [_breaking_ties]))[0::2] == [0.75, 0.5]
+    assert math.isnan(batch['priority'][1])
+    assert batch.to_dict()['a']['predictions'][1]['priority'] is None
+    assert get_priorities(apply_heuristics(batch, [_max_confidence]))[:2] == pytest.approx([0.8, 0.6])
+    assert get_priorities(apply_heuristics(batch, [_breaking_ties, _max_confidence], -1)) == pytest.approx([0.8, 0.6, 0.5])
+
+
+def test_builtins():
+    data = _mixed_predictions()
+    options = {'rank': {'heuristics': ['ai.al.functional.noarch.functional._breaking_ties',
+                                        'ai.al.functional.noarch.functional._max_confidence']}}
+    compose = Compose(None, None, None, None, options)
+    assert compose.acceptsPredictionBatch
+    for criterion, ranker in (('BreakingTies', BreakingTies(None, None, None, None, None)),
+                                ('MaxConfidence', MaxConfidence(None, None, None, None, None)),
+                                ('Compose', compose)):
+        referenceHeuristics, _, floor = CRITERIA[criterion]
+        expected = get_priorities(rank_reference(copy.deepcopy(data), referenceHeuristics, floor))
+        _assert_priorities_equal(get_priorities(ranker.rank(copy.deepcopy(data), None)), expected)
+
+
+def test_compose_custom_heuristic():
+    # custom heuristics are applied per prediction; no prediction batches
+    options = {'rank': {'heuristics': ['ai.al.functional.noarch.functional._max_confidence',
+                                        'tests.test_alCriteria.constant_heuristic']}}
+    compose = Compose(None, None, None, None, options)
+    assert not compose.acceptsPredictionBatch
+    data = compose.rank({'image': {'predictions': [{'logits': [0.1, 0.9]}, {'logits': [0.1, 0.2]}, {}]}}, None)
+    assert get_priorities(data) == [0.9, 0.5, 0.5]
+
+
+def constant_heuristic(prediction):
+    return 0.5
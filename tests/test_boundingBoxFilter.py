@@ -0,0 +1,217 @@
+'''
+    Tests the bounding box filter ("ai/filter/detection/boundingBoxFilter.py")
+    against reference outputs: hand-computed ones for small cases, and those
+    of a straightforward implementation in pure Python for simulated anno-
+    tations of multiple users (see "tests/benchmarks/benchmark_boundingBox-
+    Filter.py").
+
+    2020 Benjamin Kellenberger
+'''
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from ai.filter.detection.boundingBoxFilter import BoundingBoxFilter, box_ious, _overlap_edges, _connected_components
+from tests.benchmarks.benchmark_boundingBoxFilter import DEFAULT_OPTIONS, iou_reference, groups_reference, \
+    filter_reference, create_annotations
+
+
+def _filter(options=None):
+    filterOptions = dict(DEFAULT_OPTIONS)
+    filterOptions.update(options or {})
+    return BoundingBoxFilter(None, None, None, filterOptions)
+
+
+def _anno(x1, y1, x2, y2, label='a', unsure=False):
+    return {'x': (x1+x2)/2, 'y': (y1+y2)/2, 'width': x2-x1, 'height': y2-y1, 'label': label, 'unsure': unsure}
+
+
+def _data(*annotations):
+    return {'image': {'annotations': dict([(f'anno_{i}', a) for i, a in enumerate(annotations)])}}
+
+
+def _boxes(annotations):
+    return [[a['x'] - a['width']/2, a['y'] - a['height']/2, a['x'] + a['width']/2, a['y'] + a['height']/2] for a in annotations]
+
+
+def _random_boxes(numBoxes, seed, size=100):
+    rng = np.random.RandomState(seed)
+    xy = rng.uniform(0, size, (numBoxes, 2))
+    wh = rng.uniform(5, 30, (numBoxes, 2))
+    return np.concatenate([xy, xy + wh], 1), rng.randint(0, 3, numBoxes)
+
+
+
+def test_iou_convention():
+    # no "+1" for widths and heights
+    a = np.array([[0, 0, 10, 10]], dtype=np.float64)
+    others = np.array([
+        [5, 0, 15, 10],         # half overlapping: 50 / 150
+        [10, 0, 20, 10],        # touching
+        [0, 0, 10, 10],         # identical
+        [0, 0, 5, 5],           # contained: 25 / 100
+        [3, 3, 3, 8],           # zero area
+        [20, 20, 30, 30]        # disjoint
+    ], dtype=np.float64)
+    ious = box_ious(a, others)[0]
+    assert ious.tolist() == pytest.approx([1/3, 0, 1, 0.25, 0, 0])
+    for idx in range(len(others)):
+        assert ious[idx] == pytest.approx(iou_reference(a[0], others[idx]))
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('minIoU', [0.0, 0.1, 0.5])
+@pytest.mark.parametrize('classAgnostic', [False, True])
+def test_overlap_edges(seed, minIoU, classAgnostic):
+    boxes, labels = _random_boxes(100, seed)
+    expected = set()
+    for i in range(len(boxes)):
+        for j in range(i+1, len(boxes)):
+            if (classAgnostic or labels[i] == labels[j]) and iou_reference(boxes[i], boxes[j]) >= minIoU:
+                expected.add((i, j))
+    for chunkSize in (7, 32, 1024):
+        edges_i, edges_j = _overlap_edges(boxes, labels, minIoU, classAgnostic, chunkSize)
+        assert (edges_i < edges_j).all()
+        assert set(zip(edges_i.tolist(), edges_j.tolist())) == expected
+        assert len(edges_i) == len(expected)
+
+
+def test_overlap_edges_empty():
+    edges_i, edges_j = _overlap_edges(np.array([[0, 0, 1, 1], [5, 5, 6, 6]], dtype=np.float64), np.array([0, 0]), 0.5, False)
+    assert not len(edges_i) and not len(edges_j)
+
+
+def _components_reference(numNodes, edges_i, edges_j):
+    neighbors = [[] for _ in range(numNodes)]
+    for i, j in zip(edges_i, edges_j):
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+    result = list(range(numNodes))
+    for n in range(numNodes):
+        if result[n] != n:
+            continue
+        queue = [n]
+        while len(queue):
+            m = queue.pop()
+            for k in neighbors[m]:
+                if result[k] != n:
+                    result[k] = n
+                    queue.append(k)
+    return result
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('numEdges', [0, 10, 50, 200])
+def test_connected_components(seed, numEdges):
+    rng = np.random.RandomState(seed)
+    edges_i, edges_j = rng.randint(0, 100, numEdges), rng.randint(0, 100, numEdges)
+    groups = _connected_components(100, edges_i, edges_j)
+    # every node points to the smallest node of its group
+    assert groups.tolist() == _components_reference(100, edges_i.tolist(), edges_j.tolist())
+
+
+def test_connected_components_chain():
+    # long chain, connected in reverse order
+    numNodes = 1000
+    edges_i = np.arange(numNodes-1)[::-1]
+    groups = _connected_components(numNodes, edges_i, edges_i + 1)
+    assert (groups == 0).all()
+    groups = _connected_components(numNodes, np.array([0, 2, 5]), np.array([1, 3, 4]))
+    assert groups[:7].tolist() == [0, 0, 2, 2, 4, 4, 6]
+
+
+@pytest.mark.parametrize('boxRule, expected', [
+    ('average', [1, 0, 11, 10]),
+    ('intersection', [2, 0, 10, 10]),
+    ('union', [0, 0, 12, 10])
+])
+def test_box_rules(boxRule, expected):
+    data = _data(_anno(0, 0, 10, 10), _anno(2, 0, 12, 10), _anno(50, 50, 60, 60))
+    result = _filter({'box_rule': boxRule, 'min_iou': 0.5}).filter(data)['image']['annotations']
+    assert len(result) == 2
+    assert _boxes(result)[0] == pytest.approx(expected)
+    # boxes without overlap are passed through unchanged
+    assert result[1] is data['image']['annotations']['anno_2']
+
+
+def test_min_iou_inclusive():
+    # IoU of exactly 1/3
+    data = _data(_anno(0, 0, 10, 10), _anno(5, 0, 15, 10))
+    assert len(_filter({'min_iou': 1/3}).filter(data)['image']['annotations']) == 1
+    assert len(_filter({'min_iou': 0.34}).filter(data)['image']['annotations']) == 2
+
+
+def test_transitive_groups():
+    # first and last box do not overlap enough, but are connected through the middle one
+    data = _data(_anno(0, 0, 10, 10), _anno(2, 0, 12, 10), _anno(4, 0, 14, 10))
+    assert iou_reference([0, 0, 10, 10], [4, 0, 14, 10]) < 0.5
+    result = _filter({'min_iou': 0.5, 'box_rule': 'union'}).filter(data)['image']['annotations']
+    assert _boxes(result) == [pytest.approx([0, 0, 14, 10])]
+
+
+def test_class_agnostic():
+    data = _data(_anno(0, 0, 10, 10, 'a'), _anno(1, 0, 11, 10, 'b'))
+    assert len(_filter({'min_iou': 0.5}).filter(data)['image']['annotations']) == 2
+    assert len(_filter({'min_iou': 0.5, 'class_agnostic': True}).filter(data)['image']['annotations']) == 1
+
+
+def test_label_mode():
+    boxes = [(0, 0, 10, 10), (1, 0, 11, 10), (0, 1, 10, 11), (1, 1, 11, 11)]
+    options = {'min_iou': 0.5, 'class_agnostic': True}
+
+    # majority
+    data = _data(*[_anno(*b, label=l) for b, l in zip(boxes, ['a', 'b', 'b', 'c'])])
+    assert _filter(options).filter(data)['image']['annotations'][0]['label'] == 'b'
+
+    # ties: label that appears first in the group
+    data = _data(*[_anno(*b, label=l) for b, l in zip(boxes, ['c', 'a', 'a', 'c'])])
+    assert _filter(options).filter(data)['image']['annotations'][0]['label'] == 'c'
+    data = _data(_anno(50, 50, 60, 60, 'a'), *[_anno(*b, label=l) for b, l in zip(boxes, ['b', 'a', 'a', 'b'])])
+    result = _filter(options).filter(data)['image']['annotations']
+    assert [r['label'] for r in result] == ['a', 'b']
+
+
+def test_label_random():
+    boxes = [(0, 0, 10, 10), (1, 0, 11, 10), (0, 1, 10, 11)]
+    data = _data(*[_anno(*b, label=l) for b, l in zip(boxes, ['a', 'b', 'c'])])
+    bboxFilter = _filter({'min_iou': 0.5, 'class_agnostic': True, 'class_assignment': 'random'})
+    labels = set()
+    for seed in range(50):
+        np.random.seed(seed)
+        result = bboxFilter.filter(data)['image']['annotations']
+        assert len(result) == 1
+        labels.add(result[0]['label'])
+        # reproducible with a fixed seed
+        np.random.seed(seed)
+        assert bboxFilter.filter(data)['image']['annotations'][0]['label'] == result[0]['label']
+    assert labels == {'a', 'b', 'c'}
+
+
+@pytest.mark.parametrize('keepUnsure', [False, True])
+def test_unsure(keepUnsure):
+    data = _data(_anno(0, 0, 10, 10), _anno(1, 0, 11, 10, unsure=True))
+    result = _filter({'min_iou': 0.5, 'keep_unsure': keepUnsure}).filter(data)['image']['annotations']
+    assert len(result) == (2 if keepUnsure else 1)
+
+
+def test_empty_images():
+    data = {'a': {'annotations': {}}, 'b': {}, 'c': _data(_anno(0, 0, 10, 10))['image']}
+    assert list(_filter().filter(data).keys()) == ['c']
+
+
+@pytest.mark.parametrize('boxRule', ['average', 'intersection', 'union'])
+@pytest.mark.parametrize('classAgnostic', [False, True])
+@pytest.mark.parametrize('numObjects', [10, 200])
+def test_filter_reference(boxRule, classAgnostic, numObjects):
+    # several blocks of the IoU matrix for 200 objects x 3 users
+    options = dict(DEFAULT_OPTIONS)
+    options.update({'box_rule': boxRule, 'class_agnostic': classAgnostic})
+    data = create_annotations(numObjects, 3, jitter=4.0, unsureRate=0.05, seed=numObjects)
+    result = _filter(options).filter(data)['image']['annotations']
+    expected = filter_reference(data, options)['image']['annotations']
+    assert 0 < len(result) < len(data['image']['annotations'])
+    assert len(result) == len(expected)
+    for r, e in zip(result, expected):
+        assert r['label'] == e['label']
+        assert [r[k] for k in ('x', 'y', 'width', 'height')] == pytest.approx([e[k] for k in ('x', 'y', 'width', 'height')])
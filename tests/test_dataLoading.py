@@ -0,0 +1,65 @@
+'''
+    Tests for the parallel data loading helpers ("ai/models/pytorch/
+    functional/_util/dataLoading.py").
+
+    2020 Benjamin Kellenberger
+'''
+
+import multiprocessing
+import pytest
+
+for dependency in ('torch', 'numpy', 'PIL', 'psycopg2', 'netifaces', 'pytz'):
+    pytest.importorskip(dependency)     # "util.helpers" is imported by the module
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+
+class _Dataset(Dataset):
+
+    def __len__(self):
+        return 32
+
+    def __getitem__(self, idx):
+        return torch.full((3,), float(idx))
+
+
+@pytest.fixture
+def dataLoading(load_module):
+    return load_module('ai/models/pytorch/functional/_util/dataLoading.py')
+
+
+@pytest.mark.parametrize('kwargs,expected', [
+    ({'num_workers': 0, 'prefetch_factor': 4, 'persistent_workers': True}, {'num_workers': 0}),
+    ({'num_workers': None}, {'num_workers': 0}),
+    ({'num_workers': -3}, {'num_workers': 0}),
+    ({'num_workers': '2', 'prefetch_factor': 0}, {'num_workers': 2, 'prefetch_factor': 1}),
+    ({'num_workers': 1, 'pin_memory': True}, {'num_workers': 1, 'pin_memory': False}),
+    ({'num_workers': 0, 'unknown_argument': 1}, {'num_workers': 0})
+])
+def test_sanitize_kwargs(dataLoading, kwargs, expected):
+    assert dataLoading.sanitize_kwargs(kwargs, 'cpu') == expected
+
+
+def _load_in_daemon(dataLoading, numWorkers, queue):
+    try:
+        kwargs = dataLoading.sanitize_kwargs({'num_workers': numWorkers, 'batch_size': 4})
+        numSamples = sum([b.size(0) for b in DataLoader(_Dataset(), **kwargs)])
+        queue.put(numSamples)
+    except Exception as e:
+        queue.put(repr(e))
+
+
+@pytest.mark.parametrize('numWorkers', [0, 2])
+def test_worker_processes_in_daemon(dataLoading, numWorkers):
+    '''
+        AIWorker tasks run in daemonic processes (Celery prefork pool), which
+        must be able to start DataLoader workers.
+    '''
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    process = context.Process(target=_load_in_daemon, args=(dataLoading, numWorkers, queue), daemon=True)
+    process.start()
+    result = queue.get(timeout=60)
+    process.join(timeout=60)
+    assert result == len(_Dataset())
@@ -0,0 +1,132 @@
+'''
+    Tests for the local disk cache of files retrieved from a remote File-
+    Server ("modules/AIWorker/backend/fileCache.py").
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import time
+import pytest
+
+
+KB = 1024
+
+
+@pytest.fixture
+def fileCacheModule(load_module):
+    return load_module('modules/AIWorker/backend/fileCache.py')
+
+
+@pytest.fixture
+def cache(fileCacheModule, tmp_path):
+    return fileCacheModule.RemoteFileCache(str(tmp_path / 'cache'), 100 * KB)
+
+
+def _url(idx):
+    return f'http://fileserver/project/files/{idx}.jpg'
+
+
+def _age(cache, url, seconds):
+    # make a file appear to have been used "seconds" ago
+    filePath, _ = cache._get_paths(url)
+    t = time.time() - seconds
+    os.utime(filePath, (t, t))
+
+
+def _cached_size(cache):
+    return sum([size for _, size, _ in cache._scan()])
+
+
+def test_put_get(cache):
+    assert cache.get(_url(0)) is None
+    cache.put(_url(0), b'abc', etag='"1"')
+    assert cache.get(_url(0)) == b'abc'
+    meta = cache.get_metadata(_url(0))
+    assert meta['etag'] == '"1"' and meta['size'] == 3
+
+
+def test_put_requires_validator(cache):
+    cache.put(_url(0), b'abc')
+    assert cache.get(_url(0)) is None
+    cache.put(_url(0), b'abc', lastModified='Wed, 21 Oct 2020 07:28:00 GMT')
+    assert cache.get(_url(0)) == b'abc'
+
+
+def test_disabled(fileCacheModule, tmp_path):
+    cache = fileCacheModule.RemoteFileCache(str(tmp_path / 'cache'), 0)
+    cache.put(_url(0), b'abc', etag='"1"')
+    assert cache.get(_url(0)) is None
+    assert not os.path.exists(str(tmp_path / 'cache'))
+
+
+def test_running_size(cache):
+    for idx in range(5):
+        cache.put(_url(idx), os.urandom(10 * KB), etag=str(idx))
+    cache.put(_url(0), os.urandom(5 * KB), etag='new')       # replaces previous version
+    conn = cache._connect()
+    total = conn.execute('SELECT total FROM cache_size;').fetchone()[0]
+    conn.close()
+    assert total == 45 * KB == _cached_size(cache)
+
+
+def test_scan_only_when_limit_exceeded(cache, monkeypatch):
+    scans = []
+    scan = cache._scan
+    monkeypatch.setattr(cache, '_scan', lambda: scans.append(1) or scan())
+
+    cache.put(_url(0), os.urandom(10 * KB), etag='0')
+    assert len(scans) == 1          # initialization of the total size
+    for idx in range(1, 10):
+        cache.put(_url(idx), os.urandom(10 * KB), etag=str(idx))
+    assert len(scans) == 1
+
+    # exceeding the limit: evict down to a fraction of it
+    cache.put(_url(10), os.urandom(10 * KB), etag='10')
+    assert len(scans) == 2
+    assert sum([size for _, size, _ in scan()]) <= cache.maxSize * cache.EVICTION_TARGET
+
+    # no scan until the limit is exceeded again
+    cache.put(_url(11), os.urandom(5 * KB), etag='11')
+    assert len(scans) == 2
+
+
+def test_evicts_least_recently_used(cache):
+    for idx in range(10):
+        cache.put(_url(idx), os.urandom(10 * KB), etag=str(idx))
+        _age(cache, _url(idx), 100 - idx)
+    # use oldest file
+    assert cache.get(_url(0)) is not None
+    cache.put(_url(10), os.urandom(10 * KB), etag='10')
+    assert cache.get(_url(0)) is not None
+    assert cache.get(_url(1)) is None
+    assert cache.get(_url(2)) is None
+    assert cache.get(_url(10)) is not None
+    assert _cached_size(cache) <= cache.maxSize
+
+
+def test_existing_files_counted(fileCacheModule, cache):
+    for idx in range(9):
+        cache.put(_url(idx), os.urandom(10 * KB), etag=str(idx))
+    os.remove(os.path.join(cache.cacheDir, cache.INDEX_NAME))
+
+    # new instance (e.g. after an update): total size is determined from files
+    cache = fileCacheModule.RemoteFileCache(cache.cacheDir, cache.maxSize)
+    cache.put(_url(9), os.urandom(10 * KB), etag='9')
+    cache.put(_url(10), os.urandom(10 * KB), etag='10')
+    assert _cached_size(cache) <= cache.maxSize
+
+
+def test_oversized_file(cache):
+    cache.put(_url(0), os.urandom(cache.maxSize + 1), etag='0')
+    assert cache.get(_url(0)) is None
+
+
+def test_freshness(fileCacheModule, tmp_path):
+    cache = fileCacheModule.RemoteFileCache(str(tmp_path / 'cache'), 100 * KB, maxAge=60)
+    cache.put(_url(0), b'abc', etag='0')
+    meta = cache.get_metadata(_url(0))
+    assert cache.is_fresh(meta)
+    meta['validated'] -= 120
+    assert not cache.is_fresh(meta)
+    assert not cache.is_fresh(None)
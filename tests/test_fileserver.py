@@ -0,0 +1,243 @@
+'''
+    Tests for the retrieval of files from a remote FileServer by the AI-
+    Worker ("modules/AIWorker/backend/fileserver.py"): keep-alive connec-
+    tions, revalidation of cached files with their ETag (status 304), and
+    prefetching. The remote FileServer is stood in for by a local HTTP
+    server.
+
+    2020 Benjamin Kellenberger
+'''
+
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+for dependency in ('requests', 'urllib3', 'numpy', 'PIL', 'psycopg2', 'netifaces', 'pytz'):
+    pytest.importorskip(dependency)
+
+
+PROJECT = 'project'
+
+
+class _FileServerStandIn(ThreadingHTTPServer):
+    '''
+        Serves files from a dict under "/<project>/files/<filename>" with an
+        ETag (hash of the contents), answers conditional requests with
+        status 304, and records all requests.
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        super(_FileServerStandIn, self).__init__(('127.0.0.1', 0), _Handler)
+        self.files = {}
+        self.requests = []
+        self.delay = 0
+        self.lock = threading.Lock()
+
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def get_requests(self, filename=None):
+        with self.lock:
+            return [r for r in self.requests if filename is None or r['filename'] == filename]
+
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'       # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        prefix = f'/{PROJECT}/files/'
+        filename = self.path[len(prefix):] if self.path.startswith(prefix) else None
+        data = server.files.get(filename, None)
+        status = 404
+        if data is not None:
+            etag = '"' + hashlib.sha1(data).hexdigest() + '"'
+            status = (304 if self.headers.get('If-None-Match') == etag else 200)
+        with server.lock:
+            server.requests.append({
+                'filename': filename,
+                'status': status,
+                'client': self.client_address,
+                'if_none_match': self.headers.get('If-None-Match')
+            })
+        time.sleep(server.delay)
+
+        self.send_response(status)
+        if data is not None:
+            self.send_header('ETag', etag)
+        if status == 200:
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+
+class _Config:
+
+    def __init__(self, values):
+        self.values = values
+
+    def getProperty(self, section, name, type=str, fallback=None):
+        value = self.values.get((section, name), None)
+        if value is None:
+            return fallback
+        return (type(value) if type is not None else value)
+
+
+
+@pytest.fixture
+def httpServer():
+    server = _FileServerStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def fileserverModule(import_module, monkeypatch):
+    module = import_module('modules.AIWorker.backend.fileserver')
+    # the stand-in runs on localhost, but is to be treated as a remote FileServer
+    monkeypatch.setattr(module, 'is_localhost', lambda uri: False)
+    return module
+
+
+@pytest.fixture
+def makeFileServer(fileserverModule, httpServer, tmp_path):
+    def _make(cacheSize=16, maxAge=0):
+        return fileserverModule.FileServer(_Config({
+            ('Server', 'dataServer_uri'): httpServer.url(),
+            ('AIWorker', 'file_cache_dir'): str(tmp_path / 'cache'),
+            ('AIWorker', 'file_cache_size'): cacheSize,
+            ('AIWorker', 'file_cache_max_age'): maxAge,
+            ('AIWorker', 'file_pool_size'): 4,
+            ('AIWorker', 'file_request_retries'): 0,
+            ('AIWorker', 'file_request_timeout'): 10
+        }))
+    return _make
+
+
+def _add_files(httpServer, numFiles):
+    for idx in range(numFiles):
+        httpServer.files[f'{idx}.jpg'] = f'image {idx}'.encode('utf-8') * 100
+
+
+def _wait_for_prefetching(fileServer, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        with fileServer._get_lock():
+            if not len(fileServer._pending):
+                return
+        time.sleep(0.01)
+    raise TimeoutError('files have not been prefetched in time')
+
+
+
+def test_keep_alive(httpServer, makeFileServer):
+    _add_files(httpServer, 10)
+    fileServer = makeFileServer(cacheSize=0)
+    assert not fileServer.isLocal
+    for idx in range(10):
+        assert fileServer.getFile(PROJECT, f'{idx}.jpg') == httpServer.files[f'{idx}.jpg']
+    requests = httpServer.get_requests()
+    assert len(requests) == 10
+    # all requests through the same connection
+    assert len(set([r['client'] for r in requests])) == 1
+
+
+def test_missing_file(httpServer, makeFileServer):
+    fileServer = makeFileServer()
+    assert fileServer.getFile(PROJECT, 'missing.jpg') is None
+
+
+def test_no_cache(httpServer, makeFileServer):
+    _add_files(httpServer, 1)
+    fileServer = makeFileServer(cacheSize=0)
+    for _ in range(3):
+        assert fileServer.getFile(PROJECT, '0.jpg') == httpServer.files['0.jpg']
+    requests = httpServer.get_requests()
+    assert [r['status'] for r in requests] == [200, 200, 200]
+    assert all(r['if_none_match'] is None for r in requests)
+
+
+def test_etag_revalidation(httpServer, makeFileServer):
+    _add_files(httpServer, 1)
+    fileServer = makeFileServer(maxAge=0)
+    for _ in range(3):
+        assert fileServer.getFile(PROJECT, '0.jpg') == httpServer.files['0.jpg']
+    requests = httpServer.get_requests('0.jpg')
+    assert [r['status'] for r in requests] == [200, 304, 304]
+    assert requests[1]['if_none_match'] is not None
+
+    # file changed on the server: downloaded again
+    httpServer.files['0.jpg'] = b'changed image'
+    assert fileServer.getFile(PROJECT, '0.jpg') == b'changed image'
+    assert fileServer.getFile(PROJECT, '0.jpg') == b'changed image'
+    assert [r['status'] for r in httpServer.get_requests('0.jpg')] == [200, 304, 304, 200, 304]
+
+
+def test_max_age(httpServer, makeFileServer):
+    _add_files(httpServer, 1)
+    fileServer = makeFileServer(maxAge=60)
+    for _ in range(3):
+        assert fileServer.getFile(PROJECT, '0.jpg') == httpServer.files['0.jpg']
+    # served from the cache without contacting the server
+    assert len(httpServer.get_requests('0.jpg')) == 1
+
+
+def test_cache_shared_between_instances(httpServer, makeFileServer):
+    # e.g. between data loader worker processes
+    _add_files(httpServer, 1)
+    makeFileServer(maxAge=60).getFile(PROJECT, '0.jpg')
+    assert makeFileServer(maxAge=60).getFile(PROJECT, '0.jpg') == httpServer.files['0.jpg']
+    assert len(httpServer.get_requests('0.jpg')) == 1
+
+
+def test_prefetch(httpServer, makeFileServer):
+    _add_files(httpServer, 8)
+    fileServer = makeFileServer(maxAge=60)
+    filenames = [f'{idx}.jpg' for idx in range(8)]
+    fileServer.prefetch(PROJECT, filenames)
+    _wait_for_prefetching(fileServer)
+    assert sorted([r['filename'] for r in httpServer.get_requests()]) == sorted(filenames)
+
+    # served from the cache
+    for filename in filenames:
+        assert fileServer.getFile(PROJECT, filename) == httpServer.files[filename]
+    assert len(httpServer.get_requests()) == len(filenames)
+
+
+def test_prefetch_pending(httpServer, makeFileServer):
+    # files requested while they are being prefetched are not requested twice
+    _add_files(httpServer, 4)
+    httpServer.delay = 0.2
+    fileServer = makeFileServer(maxAge=0)
+    filenames = [f'{idx}.jpg' for idx in range(4)]
+    fileServer.prefetch(PROJECT, filenames + filenames)
+    for filename in filenames:
+        assert fileServer.getFile(PROJECT, filename) == httpServer.files[filename]
+    _wait_for_prefetching(fileServer)
+    for filename in filenames:
+        # downloaded once; files prefetched before being requested are revalidated
+        assert [r['status'] for r in httpServer.get_requests(filename)] in ([200], [200, 304])
+    # the first file is requested while it is being prefetched
+    assert len(httpServer.get_requests(filenames[0])) == 1
+
+
+def test_prefetch_disabled_without_cache(httpServer, makeFileServer):
+    _add_files(httpServer, 2)
+    fileServer = makeFileServer(cacheSize=0)
+    fileServer.prefetch(PROJECT, ['0.jpg', '1.jpg'])
+    time.sleep(0.1)
+    assert not len(httpServer.get_requests())
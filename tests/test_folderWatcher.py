@@ -0,0 +1,98 @@
+'''
+    Tests for the incremental snapshots of watched project folders
+    ("modules/DataAdministration/backend/folderWatcher.py").
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import time
+import pytest
+
+for dependency in ('numpy', 'PIL', 'psycopg2', 'netifaces', 'pytz'):
+    pytest.importorskip(dependency)     # required by "util.helpers"
+
+
+def _touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'w').close()
+
+
+@pytest.fixture
+def snapshot(load_module, tmp_path):
+    folderWatcher = load_module('modules/DataAdministration/backend/folderWatcher.py')
+    folderWatcher.FolderSnapshot.MTIME_SAFETY_MARGIN = 0      # do not wait for mtime granularity
+    baseDir = tmp_path / 'project'
+    baseDir.mkdir()
+    _touch(str(baseDir / 'a.jpg'))
+    _touch(str(baseDir / 'sub' / 'b.png'))
+    _touch(str(baseDir / 'sub' / 'notes.txt'))
+    return folderWatcher.FolderSnapshot(str(tmp_path / 'snapshot.sqlite'), str(baseDir))
+
+
+def _bump_mtime(path):
+    # make sure the change is visible on file systems with coarse mtimes
+    t = time.time() + 10
+    os.utime(path, (t, t))
+
+
+def test_first_scan(snapshot):
+    assert not snapshot.exists()
+    added, removed = snapshot.scan()
+    assert sorted(added) == ['a.jpg', os.path.join('sub', 'b.png')]
+    assert removed == []
+
+
+def test_scan_does_not_save(snapshot):
+    added, _ = snapshot.scan()
+    assert not snapshot.exists()
+
+    # changes are reported again until saved
+    snapshot.pending = None
+    addedAgain, _ = snapshot.scan()
+    assert sorted(addedAgain) == sorted(added)
+
+    snapshot.save()
+    assert snapshot.exists()
+    added, removed = snapshot.scan()
+    assert added == [] and removed == []
+
+
+def test_rescan_changes(snapshot):
+    snapshot.scan()
+    snapshot.save()
+
+    subDir = os.path.join(snapshot.baseDir, 'sub')
+    _touch(os.path.join(subDir, 'c.jpg'))
+    os.remove(os.path.join(snapshot.baseDir, 'a.jpg'))
+    _bump_mtime(subDir)
+    _bump_mtime(snapshot.baseDir)
+
+    added, removed = snapshot.scan()
+    assert added == [os.path.join('sub', 'c.jpg')]
+    assert removed == ['a.jpg']
+
+    # failed registration: not saved, so the changes are reported again
+    added, removed = snapshot.scan()
+    assert added == [os.path.join('sub', 'c.jpg')]
+    assert removed == ['a.jpg']
+
+    snapshot.save()
+    assert snapshot.scan() == ([], [])
+
+
+def test_removed_directory(snapshot):
+    snapshot.scan()
+    snapshot.save()
+
+    subDir = os.path.join(snapshot.baseDir, 'sub')
+    os.remove(os.path.join(subDir, 'b.png'))
+    os.remove(os.path.join(subDir, 'notes.txt'))
+    os.rmdir(subDir)
+    _bump_mtime(snapshot.baseDir)
+
+    added, removed = snapshot.scan()
+    assert added == []
+    assert removed == [os.path.join('sub', 'b.png')]
+    snapshot.save()
+    assert snapshot.scan() == ([], [])
@@ -0,0 +1,96 @@
+'''
+    Tests for the in-memory cache of decoded parent images of virtual patches
+    ("ImageCache" in "util/imageSharding.py").
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import pickle
+import pytest
+
+pytest.importorskip('PIL')
+pytest.importorskip('numpy')
+
+from PIL import Image
+from util.imageSharding import ImageCache
+
+
+def _save(tmp_path, name, size, mode='RGB', color=0):
+    path = str(tmp_path / name)
+    Image.new(mode, size, color).save(path)
+    return path
+
+
+
+def test_bounded_by_bytes(tmp_path):
+    # 100x100 RGB: 30000 bytes per image
+    paths = [_save(tmp_path, f'{i}.png', (100, 100)) for i in range(3)]
+    cache = ImageCache(70000)
+    for path in paths[:2]:
+        cache.get_image(path)
+    assert cache.size == 60000 and len(cache.cache) == 2
+
+    # least recently used image is evicted
+    cache.get_image(paths[0])
+    cache.get_image(paths[2])
+    assert cache.size == 60000
+    assert [k[0] for k in cache.cache.keys()] == [paths[0], paths[2]]
+
+
+def test_bands(tmp_path):
+    cache = ImageCache(10**6)
+    cache.get_image(_save(tmp_path, 'gray.png', (100, 50), 'L'))
+    cache.get_image(_save(tmp_path, 'rgba.png', (100, 50), 'RGBA'))
+    assert cache.size == 100*50 + 100*50*4
+
+
+def test_oversized(tmp_path):
+    cache = ImageCache(20000)
+    small = _save(tmp_path, 'small.png', (100, 50))
+    cache.get_image(small)
+    image = cache.get_image(_save(tmp_path, 'large.png', (200, 200)))
+    assert image.size == (200, 200)
+    # larger than the cache: not stored, nothing evicted
+    assert [k[0] for k in cache.cache.keys()] == [small]
+    assert cache.size == 15000
+
+
+def test_disabled(tmp_path):
+    cache = ImageCache(0)
+    cache.get_image(_save(tmp_path, 'a.png', (10, 10)))
+    assert not len(cache.cache) and cache.size == 0
+
+
+def test_cached_instance(tmp_path):
+    path = _save(tmp_path, 'a.png', (10, 10))
+    cache = ImageCache(10**6)
+    assert cache.get_image(path) is cache.get_image(path)
+
+
+def test_replaced_file(tmp_path):
+    path = _save(tmp_path, 'a.png', (10, 10), color=(0, 0, 0))
+    cache = ImageCache(10**6)
+    assert cache.get_image(path).getpixel((0, 0)) == (0, 0, 0)
+    _save(tmp_path, 'a.png', (10, 10), color=(255, 0, 0))
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    assert cache.get_image(path).getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_get_window(tmp_path):
+    path = str(tmp_path / 'a.png')
+    image = Image.new('RGB', (100, 80))
+    image.putpixel((30, 20), (1, 2, 3))
+    image.save(path)
+    patch = ImageCache(10**6).get_window(path, (30, 20, 40, 50))
+    assert patch.size == (40, 50)
+    assert patch.getpixel((0, 0)) == (1, 2, 3)
+
+
+def test_pickle(tmp_path):
+    cache = ImageCache(10**6)
+    cache.get_image(_save(tmp_path, 'a.png', (10, 10)))
+    copy = pickle.loads(pickle.dumps(cache))
+    assert copy.maxSize == 10**6
+    assert not len(copy.cache) and copy.size == 0
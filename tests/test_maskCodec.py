@@ -0,0 +1,136 @@
+'''
+    Tests the encoding of segmentation masks for the database ("util/mask-
+    Codec.py"): round-trips of all codecs, detection of the codec (including
+    masks in the legacy raw format), conversion to the raw format for the
+    labeling UI, and transcoding.
+
+    2020 Benjamin Kellenberger
+'''
+
+import base64
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+
+from PIL import Image
+from util import maskCodec
+
+
+def _mask(height=30, width=40, seed=0):
+    # large uniform areas and a few noisy pixels
+    rng = np.random.RandomState(seed)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[height//4:height//2,:] = 1
+    mask[:,width//2:] = 3
+    mask[rng.rand(height, width) < 0.05] = 255
+    return mask
+
+
+def _raw(mask):
+    # legacy format: base64 of the raw pixel values, without prefix
+    return base64.b64encode(mask.tobytes()).decode('utf-8')
+
+
+class _Config:
+
+    def __init__(self, codec):
+        self.codec = codec
+
+    def getProperty(self, section, name, type=str, fallback=None):
+        return (fallback if self.codec is None else self.codec)
+
+
+
+@pytest.mark.parametrize('codec', maskCodec.MASK_CODECS)
+@pytest.mark.parametrize('size', [(30, 40), (1, 1), (1, 17), (13, 1), (257, 3)])
+def test_round_trip(codec, size):
+    mask = _mask(*size)
+    maskString = maskCodec.encode_mask(mask, codec)
+    assert isinstance(maskString, str)
+    assert maskCodec.detect_codec(maskString) == codec
+    decoded = maskCodec.decode_mask(maskString, size[1], size[0])
+    assert decoded.dtype == np.uint8
+    assert np.array_equal(decoded, mask)
+    if codec != 'raw':
+        # size stored in the mask itself
+        assert np.array_equal(maskCodec.decode_mask(maskString), mask)
+
+
+@pytest.mark.parametrize('codec', maskCodec.MASK_CODECS)
+def test_uniform(codec):
+    for value in (0, 7, 255):
+        mask = np.full((64, 48), value, dtype=np.uint8)
+        assert np.array_equal(maskCodec.decode_mask(maskCodec.encode_mask(mask, codec), 48, 64), mask)
+
+
+def test_pil_image():
+    mask = _mask()
+    maskString = maskCodec.encode_mask(Image.fromarray(mask, mode='L'), 'png')
+    assert np.array_equal(maskCodec.decode_mask(maskString), mask)
+
+
+@pytest.mark.parametrize('codec', maskCodec.MASK_CODECS)
+@pytest.mark.parametrize('size', [(0, 0), (0, 5), (5, 0)])
+def test_empty(codec, size):
+    maskString = maskCodec.encode_mask(np.zeros(size, dtype=np.uint8), codec)
+    assert maskCodec.detect_codec(maskString) == ('rle' if codec == 'png' else codec)
+    assert maskCodec.decode_mask(maskString, size[1], size[0]).shape == size
+
+
+def test_compression():
+    # uniform areas: much smaller than the raw format
+    mask = np.zeros((512, 512), dtype=np.uint8)
+    mask[100:300,50:450] = 2
+    rawLength = len(maskCodec.encode_mask(mask, 'raw'))
+    for codec in ('png', 'rle'):
+        assert len(maskCodec.encode_mask(mask, codec)) < rawLength / 100
+
+
+def test_detect_codec_legacy():
+    mask = _mask()
+    assert maskCodec.detect_codec(_raw(mask)) == 'raw'
+    assert maskCodec.detect_codec('') == 'raw'
+    assert maskCodec.detect_codec(None) == 'raw'
+    # base64 strings cannot contain the prefix separator
+    assert maskCodec.detect_codec('cG5nMQ==') == 'raw'
+    assert np.array_equal(maskCodec.decode_mask(_raw(mask), 40, 30), mask)
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        maskCodec.encode_mask(_mask(), 'jpeg')
+    with pytest.raises(ValueError):
+        maskCodec.encode_mask(np.zeros((4, 4, 3), dtype=np.uint8))
+    with pytest.raises(ValueError):
+        maskCodec.decode_mask(_raw(_mask()))
+    with pytest.raises(ValueError):
+        maskCodec.decode_mask(maskCodec.encode_mask(_mask(), 'png'), 30, 40)
+
+
+def test_to_raw():
+    mask = _mask()
+    raw = _raw(mask)
+    assert maskCodec.to_raw(raw, 40, 30) == (raw, 40, 30)
+    for codec in ('png', 'rle'):
+        assert maskCodec.to_raw(maskCodec.encode_mask(mask, codec)) == (raw, 40, 30)
+        assert maskCodec.to_raw(maskCodec.encode_mask(mask, codec), 40, 30) == (raw, 40, 30)
+
+
+@pytest.mark.parametrize('source', maskCodec.MASK_CODECS)
+@pytest.mark.parametrize('target', maskCodec.MASK_CODECS)
+def test_transcode(source, target):
+    mask = _mask()
+    maskString = maskCodec.encode_mask(mask, source)
+    transcoded = maskCodec.transcode(maskString, target, 40, 30)
+    assert maskCodec.detect_codec(transcoded) == target
+    assert np.array_equal(maskCodec.decode_mask(transcoded, 40, 30), mask)
+    if source == target:
+        assert transcoded is maskString
+
+
+def test_get_codec():
+    assert maskCodec.get_codec(_Config(None)) == maskCodec.DEFAULT_CODEC
+    assert maskCodec.get_codec(_Config(' RLE ')) == 'rle'
+    assert maskCodec.get_codec(_Config('raw')) == 'raw'
+    assert maskCodec.get_codec(_Config('gif')) == maskCodec.DEFAULT_CODEC
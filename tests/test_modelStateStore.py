@@ -0,0 +1,142 @@
+'''
+    Tests for the content-addressed model state stores
+    ("util/modelStateStore.py").
+
+    The S3 store is tested against a mocked S3 server (package "moto"). To
+    test against a real S3-compatible server (e.g. a local MinIO instance)
+    instead, set the environment variables "AIDE_TEST_S3_ENDPOINT_URL",
+    "AIDE_TEST_S3_BUCKET" (must exist), "AIDE_TEST_S3_ACCESS_KEY_ID" and
+    "AIDE_TEST_S3_SECRET_ACCESS_KEY".
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import io
+import hashlib
+import pytest
+from util import modelStateStore
+from util.modelStateStore import LocalModelStateStore, REF_PREFIX
+
+
+STATE = os.urandom(3 * modelStateStore.CHUNK_SIZE + 17)     # spans multiple chunks
+REF = REF_PREFIX + hashlib.sha256(STATE).hexdigest()
+MISSING_REF = REF_PREFIX + hashlib.sha256(b'missing').hexdigest()
+
+
+
+@pytest.fixture
+def localStore(tmp_path):
+    return LocalModelStateStore(str(tmp_path / 'store'))
+
+
+@pytest.fixture
+def s3Store():
+    pytest.importorskip('boto3')
+    endpointURL = os.environ.get('AIDE_TEST_S3_ENDPOINT_URL', None)
+    if endpointURL is not None:
+        # real S3-compatible server (e.g. MinIO)
+        yield modelStateStore.S3ModelStateStore(os.environ['AIDE_TEST_S3_BUCKET'],
+                                    prefix='aide-test-' + os.urandom(4).hex(),
+                                    endpointURL=endpointURL,
+                                    accessKeyID=os.environ.get('AIDE_TEST_S3_ACCESS_KEY_ID', None),
+                                    secretAccessKey=os.environ.get('AIDE_TEST_S3_SECRET_ACCESS_KEY', None))
+        return
+
+    moto = pytest.importorskip('moto')
+    mock = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_s3')       # moto >= 5 resp. < 5
+    with mock():
+        store = modelStateStore.S3ModelStateStore('aide-test', prefix='states/',
+                                    region='us-east-1',
+                                    accessKeyID='testing', secretAccessKey='testing')
+        store.client.create_bucket(Bucket='aide-test')
+        yield store
+
+
+@pytest.fixture(params=['local', 's3'])
+def store(request):
+    return request.getfixturevalue(request.param + 'Store')
+
+
+
+def test_put_returns_content_reference(store):
+    assert store.put(STATE) == REF
+    assert store.exists(REF)
+    assert not store.exists(MISSING_REF)
+
+
+def test_put_file_object(store):
+    assert store.put(io.BytesIO(STATE)) == REF
+    assert store.get(REF) == STATE
+
+
+def test_get_round_trip(store):
+    ref = store.put(STATE)
+    assert store.get(ref) == STATE
+    stream = store.open(ref)
+    try:
+        assert stream.read() == STATE
+    finally:
+        stream.close()
+
+
+def test_put_deduplicates(store, monkeypatch):
+    ref = store.put(STATE)
+    writes = []
+    original = store._write
+    monkeypatch.setattr(store, '_write', lambda *args: writes.append(args) or original(*args))
+    assert store.put(bytearray(STATE)) == ref
+    assert store.put(io.BytesIO(STATE)) == ref
+    assert not len(writes)
+    assert store.put(b'other state') != ref
+    assert len(writes) == 1
+
+
+def test_get_missing_blob(store):
+    with pytest.raises(Exception):
+        store.get(MISSING_REF)
+
+
+@pytest.mark.parametrize('ref', [
+    'abc',
+    REF_PREFIX + 'abc',
+    REF_PREFIX + 'G' * 64,
+    REF_PREFIX + '../' + '0' * 61
+])
+def test_invalid_reference(store, ref):
+    with pytest.raises(ValueError):
+        store.get(ref)
+
+
+def test_local_get_verifies_hash(localStore):
+    ref = localStore.put(STATE)
+    path = localStore._get_path(ref[len(REF_PREFIX):])
+    with open(path, 'r+b') as f:
+        f.seek(len(STATE) // 2)
+        f.write(b'\x00' if STATE[len(STATE) // 2] else b'\x01')
+    with pytest.raises(Exception, match='hash mismatch'):
+        localStore.get(ref)
+
+
+def test_local_no_temporary_files(localStore):
+    ref = localStore.put(STATE)
+    files = []
+    for root, _, names in os.walk(localStore.baseDir):
+        files.extend(names)
+    assert files == [ref[len(REF_PREFIX):]]
+
+
+def test_s3_get_verifies_hash(s3Store):
+    ref = s3Store.put(STATE)
+    key = s3Store._get_key(ref[len(REF_PREFIX):])
+    s3Store.client.put_object(Bucket=s3Store.bucket, Key=key, Body=STATE[:-1])
+    with pytest.raises(Exception, match='hash mismatch'):
+        s3Store.get(ref)
+
+
+def test_s3_prefix(s3Store):
+    ref = s3Store.put(STATE)
+    key = s3Store._get_key(ref[len(REF_PREFIX):])
+    assert key.startswith(s3Store.prefix + '/')
+    assert not s3Store.prefix.endswith('/')
+    s3Store.client.head_object(Bucket=s3Store.bucket, Key=key)
@@ -0,0 +1,212 @@
+'''
+    Tests the vectorized non-maximum suppression of the RetinaNet decoder
+    ("batched_nms" and "soft_nms" in "ai/models/pytorch/functional/_retina-
+    net/utils.py") against the previous, sequential implementation of
+    "box_nms" and straightforward per-box reference implementations.
+
+    2020 Benjamin Kellenberger
+'''
+
+import pytest
+
+for dependency in ('torch', 'torchvision', 'numpy', 'PIL'):
+    pytest.importorskip(dependency)
+
+import torch
+from ai.models.pytorch.functional._retinanet.utils import batched_nms, soft_nms, box_nms, box_overlap
+from ai.models.pytorch.functional._retinanet.encoder import DataEncoder
+from tests.benchmarks.benchmark_nms import box_nms_sequential, random_boxes
+
+
+def _reference_nms(boxes, scores, groups, threshold, method):
+    # greedy suppression, one box at a time
+    order = sorted(range(len(scores)), key=lambda i: -float(scores[i]))
+    keep = []
+    for i in order:
+        suppressed = False
+        for k in keep:
+            if groups is not None and groups[k] != groups[i]:
+                continue
+            if float(box_overlap(boxes[k:k+1], boxes[i:i+1], method)) > threshold:
+                suppressed = True
+                break
+        if not suppressed:
+            keep.append(i)
+    return keep
+
+
+def _reference_soft_nms(boxes, scores, groups, threshold, method, decay, sigma, score_thresh):
+    scores = [float(s) for s in scores]
+    remaining = [i for i in range(len(scores)) if scores[i] >= score_thresh]
+    keep = []
+    while len(remaining):
+        i = max(remaining, key=lambda k: scores[k])
+        keep.append(i)
+        remaining.remove(i)
+        for j in remaining:
+            if groups is not None and groups[j] != groups[i]:
+                continue
+            ovr = float(box_overlap(boxes[i:i+1], boxes[j:j+1], method))
+            if decay == 'linear':
+                weight = (1 - ovr if ovr > threshold else 1)
+            else:
+                weight = torch.exp(torch.tensor(-max(ovr, 0)**2 / sigma, dtype=torch.float64)).item()
+            scores[j] *= weight
+        remaining = [j for j in remaining if scores[j] >= score_thresh]
+    return keep, [scores[k] for k in keep]
+
+
+def _boxes(numBoxes, seed, imageSize=300, numClasses=3):
+    # densely packed, so that many boxes overlap; double precision avoids ties
+    torch.manual_seed(seed)
+    return random_boxes(numBoxes, imageSize, numClasses=numClasses, dtype=torch.float64)
+
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('numBoxes', [1, 2, 50, 300])
+@pytest.mark.parametrize('threshold', [0.1, 0.5, 0.8])
+@pytest.mark.parametrize('mode', ['union', 'min'])
+def test_batched_nms_sequential(seed, numBoxes, threshold, mode):
+    boxes, scores, _ = _boxes(numBoxes, seed)
+    reference = box_nms_sequential(boxes, scores, threshold, mode)
+    method = ('iou' if mode == 'union' else 'min')
+    assert torch.equal(batched_nms(boxes, scores, None, threshold, method), reference)
+    # small tiles and blocks: suppression across tiles
+    assert torch.equal(batched_nms(boxes, scores, None, threshold, method, tile_size=16, block_size=8), reference)
+    assert torch.equal(box_nms(boxes, scores, threshold, mode), reference)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('threshold', [0.1, 0.5])
+def test_batched_nms_groups(seed, threshold):
+    boxes, scores, labels = _boxes(300, seed)
+    keep = batched_nms(boxes, scores, labels, threshold, tile_size=32, block_size=16)
+
+    # same as suppressing each group on its own
+    expected = []
+    for label in labels.unique():
+        ids = (labels == label).nonzero().squeeze(1)
+        expected.append(ids[box_nms_sequential(boxes[ids], scores[ids], threshold)])
+    expected = torch.cat(expected)
+    expected = expected[scores[expected].argsort(descending=True)]
+    assert torch.equal(keep, expected)
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('grouped', [False, True])
+def test_batched_nms_diou(seed, grouped):
+    boxes, scores, labels = _boxes(100, seed)
+    groups = (labels if grouped else None)
+    keep = batched_nms(boxes, scores, groups, 0.3, 'diou', tile_size=16, block_size=8)
+    assert keep.tolist() == _reference_nms(boxes, scores, groups, 0.3, 'diou')
+
+
+def test_batched_nms_empty():
+    keep = batched_nms(torch.zeros(0, 4), torch.zeros(0))
+    assert keep.numel() == 0 and keep.dtype == torch.long
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('decay', ['linear', 'gaussian'])
+@pytest.mark.parametrize('grouped', [False, True])
+def test_soft_nms(seed, decay, grouped):
+    boxes, scores, labels = _boxes(60, seed)
+    groups = (labels if grouped else None)
+    keep, keepScores = soft_nms(boxes, scores, groups, 0.3, decay=decay, sigma=0.5, score_thresh=0.05)
+    expected, expectedScores = _reference_soft_nms(boxes, scores, groups, 0.3, 'iou', decay, 0.5, 0.05)
+    assert keep.tolist() == expected
+    assert torch.allclose(keepScores, torch.tensor(expectedScores, dtype=torch.float64))
+    # input scores are not modified
+    assert torch.equal(scores, _boxes(60, seed)[1])
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('decay', ['linear', 'gaussian'])
+def test_soft_nms_groups(seed, decay):
+    # same as Soft-NMS of each group on its own, merged by decreasing score
+    boxes, scores, labels = _boxes(400, seed, numClasses=7)
+    keep, keepScores = soft_nms(boxes, scores, labels, 0.3, decay=decay, score_thresh=0.05)
+    expected, expectedScores = [], []
+    for label in labels.unique():
+        ids = (labels == label).nonzero().squeeze(1)
+        keepL, scoresL = soft_nms(boxes[ids], scores[ids], None, 0.3, decay=decay, score_thresh=0.05)
+        expected.append(ids[keepL])
+        expectedScores.append(scoresL)
+    expectedScores, order = torch.cat(expectedScores).sort(descending=True)
+    assert torch.equal(keep, torch.cat(expected)[order])
+    assert torch.equal(keepScores, expectedScores)
+
+
+def test_soft_nms_ties():
+    # equal scores: lower index first, as with the sequential implementation
+    boxes = torch.tensor([[0, 0, 10, 10], [100, 0, 110, 10], [0, 100, 10, 110], [1, 1, 11, 11]], dtype=torch.float32)
+    scores = torch.tensor([0.5, 0.9, 0.5, 0.9])
+    keep, _ = soft_nms(boxes, scores, torch.tensor([0, 1, 2, 0]), threshold=0.9)
+    assert keep.tolist() == [1, 3, 0, 2]
+
+
+@pytest.mark.parametrize('method', ['iou', 'min', 'diou'])
+def test_box_overlap_aligned(method):
+    boxes, _, _ = _boxes(50, 0)
+    others, _, _ = _boxes(50, 1)
+    assert torch.allclose(box_overlap(boxes, others, method, aligned=True), box_overlap(boxes, others, method).diagonal())
+
+
+def test_soft_nms_keeps_distant_boxes():
+    # boxes that do not overlap keep their scores
+    boxes = torch.tensor([[0, 0, 10, 10], [100, 100, 110, 110], [1, 1, 11, 11]], dtype=torch.float32)
+    scores = torch.tensor([0.9, 0.8, 0.7])
+    keep, keepScores = soft_nms(boxes, scores, threshold=0.5, decay='linear')
+    assert keep.tolist() == [0, 1, 2]
+    assert torch.allclose(keepScores[:2], scores[:2])
+    assert keepScores[2] < scores[2]
+
+
+def test_soft_nms_invalid_decay():
+    with pytest.raises(TypeError):
+        soft_nms(torch.zeros(1, 4), torch.ones(1), decay='unknown')
+
+
+@pytest.mark.parametrize('nms_method', ['iou', 'diou', 'soft_linear', 'soft_gaussian'])
+@pytest.mark.parametrize('nms_class_aware', [False, True])
+def test_decode_batch(nms_method, nms_class_aware):
+    # decoding a batch at once is the same as decoding each image on its own
+    torch.manual_seed(0)
+    encoder = DataEncoder()
+    numAnchors = encoder._get_anchor_boxes(torch.Tensor([128, 128])).size(0)
+    loc_preds = 0.1 * torch.randn(3, numAnchors, 4)
+    cls_preds = torch.randn(3, numAnchors, 4) - 2
+    kwargs = {
+        'cls_thresh': 0.5,
+        'nms_thresh': 0.3,
+        'return_conf': True,
+        'nms_method': nms_method,
+        'nms_class_aware': nms_class_aware
+    }
+    boxes, labels, confs = encoder.decode(loc_preds, cls_preds, 128, **kwargs)
+    for b in range(3):
+        boxesB, labelsB, confsB = encoder.decode(loc_preds[b], cls_preds[b], 128, **kwargs)
+        assert torch.equal(boxes[b], boxesB[0])
+        assert torch.equal(labels[b], labelsB[0])
+        assert torch.allclose(confs[b], confsB[0])
+
+
+def test_decode_sequential():
+    # class-agnostic IoU-based decoding keeps the same boxes as the previous implementation
+    torch.manual_seed(0)
+    encoder = DataEncoder()
+    numAnchors = encoder._get_anchor_boxes(torch.Tensor([128, 128])).size(0)
+    loc_preds = 0.1 * torch.randn(numAnchors, 4)
+    cls_preds = torch.randn(numAnchors, 4) - 2
+    boxes, labels = encoder.decode(loc_preds, cls_preds, 128, cls_thresh=0.5, nms_thresh=0.3)
+
+    anchors = encoder._get_anchor_boxes(torch.Tensor([128, 128]))
+    xy = loc_preds[:,:2] * anchors[:,2:] + anchors[:,:2]
+    wh = loc_preds[:,2:].exp() * anchors[:,2:]
+    allBoxes = torch.cat([xy-wh/2, xy+wh/2], 1)
+    score, allLabels = cls_preds.sigmoid().max(1)
+    ids = (score > 0.5).nonzero().squeeze(1)
+    keep = box_nms_sequential(allBoxes[ids], score[ids], 0.3)
+    assert torch.equal(boxes[0], allBoxes[ids[keep]])
+    assert torch.equal(labels[0], allLabels[ids[keep]])
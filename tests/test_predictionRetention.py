@@ -0,0 +1,227 @@
+'''
+    Smoke tests for the prediction retention policy ("util/prediction-
+    Retention.py"): summarizing and removing the predictions of old model
+    states, and partitioning the "prediction" table by model state.
+
+    Requires a PostgreSQL server (version 13 or newer); the tests are skipped
+    unless its connection string (e.g. "dbname=aide_test user=aide") is set
+    in the environment variable "AIDE_TEST_DB". Every test creates its own
+    schema (a mock project) and drops it afterwards.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import uuid
+import pytest
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor
+from util import predictionRetention
+
+
+CONFIDENCES = (0.2, 0.6)       # of the two predictions per image and model state
+
+
+
+class _DBConnector:
+    '''
+        Minimal stand-in for "modules.Database.app.Database" on a single
+        connection; every statement is committed.
+    '''
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, arguments, numReturn=None):
+        with self.connection.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query, arguments)
+            result = None
+            if numReturn == 'all':
+                result = cursor.fetchall()
+            elif numReturn is not None:
+                result = cursor.fetchmany(numReturn)
+        self.connection.commit()
+        return result
+
+
+
+@pytest.fixture
+def db():
+    dsn = os.environ.get('AIDE_TEST_DB', None)
+    if dsn is None:
+        pytest.skip('no test database configured (environment variable "AIDE_TEST_DB")')
+    connection = psycopg2.connect(dsn)
+    project = 'aide_test_' + uuid.uuid4().hex[:8]
+    dbConnector = _DBConnector(connection)
+    dbConnector.execute(sql.SQL('''
+        CREATE SCHEMA {schema};
+        CREATE TABLE {id_image} (
+            id uuid DEFAULT gen_random_uuid(),
+            filename VARCHAR UNIQUE NOT NULL,
+            PRIMARY KEY (id)
+        );
+        CREATE TABLE {id_cnnstate} (
+            id uuid DEFAULT gen_random_uuid(),
+            timeCreated TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            partial boolean NOT NULL,
+            PRIMARY KEY (id)
+        );
+        CREATE TABLE {id_pred} (
+            id uuid DEFAULT gen_random_uuid(),
+            image uuid NOT NULL,
+            timeCreated TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            cnnstate UUID,
+            confidence real,
+            label uuid,
+            priority real,
+            PRIMARY KEY (id),
+            FOREIGN KEY (image) REFERENCES {id_image}(id),
+            FOREIGN KEY (cnnstate) REFERENCES {id_cnnstate}(id)
+        );
+        CREATE INDEX prediction_cnnstate_idx ON {id_pred} (cnnstate);
+        CREATE TABLE {id_summary} (
+            image uuid NOT NULL,
+            cnnstate uuid NOT NULL,
+            timeCreated TIMESTAMPTZ NOT NULL,
+            num_predictions BIGINT NOT NULL,
+            confidence_mean real,
+            confidence_max real,
+            priority_mean real,
+            priority_max real,
+            PRIMARY KEY (image, cnnstate),
+            FOREIGN KEY (image) REFERENCES {id_image}(id) ON DELETE CASCADE,
+            FOREIGN KEY (cnnstate) REFERENCES {id_cnnstate}(id) ON DELETE CASCADE
+        );
+    ''').format(
+        schema=sql.Identifier(project),
+        id_image=sql.Identifier(project, 'image'),
+        id_cnnstate=sql.Identifier(project, 'cnnstate'),
+        id_pred=sql.Identifier(project, 'prediction'),
+        id_summary=sql.Identifier(project, 'prediction_summary')
+    ), None)
+    try:
+        yield dbConnector, project
+    finally:
+        connection.rollback()
+        dbConnector.execute(sql.SQL('DROP SCHEMA {} CASCADE;').format(sql.Identifier(project)), None)
+        connection.close()
+
+
+def _add_state(dbConnector, project, hoursAgo, partial=False):
+    return dbConnector.execute(sql.SQL('''
+        INSERT INTO {} (timeCreated, partial)
+        VALUES (NOW() - %s * INTERVAL '1 hour', %s)
+        RETURNING id;
+    ''').format(sql.Identifier(project, 'cnnstate')), (hoursAgo, partial), 1)[0]['id']
+
+
+def _add_predictions(dbConnector, project, imageIDs, stateID):
+    for imageID in imageIDs:
+        for confidence in CONFIDENCES:
+            dbConnector.execute(sql.SQL('''
+                INSERT INTO {} (image, cnnstate, confidence, priority)
+                VALUES (%s, %s, %s, %s);
+            ''').format(sql.Identifier(project, 'prediction')), (imageID, stateID, confidence, 1 - confidence))
+
+
+def _populate(dbConnector, project):
+    '''
+        Two images and three model states (oldest first) with two predictions
+        per image each, plus a newer, partial model state and predictions
+        without model state.
+    '''
+    imageIDs = [dbConnector.execute(sql.SQL('INSERT INTO {} (filename) VALUES (%s) RETURNING id;').format(
+        sql.Identifier(project, 'image')), (f'image_{i}.jpg',), 1)[0]['id'] for i in range(2)]
+    stateIDs = [_add_state(dbConnector, project, hoursAgo) for hoursAgo in (3, 2, 1)]
+    partialID = _add_state(dbConnector, project, 0, partial=True)
+    for stateID in stateIDs + [partialID, None]:
+        _add_predictions(dbConnector, project, imageIDs, stateID)
+    return imageIDs, stateIDs, partialID
+
+
+def _count(dbConnector, project, table='prediction', stateID=None):
+    query = sql.SQL('SELECT COUNT(*) AS cnt FROM {} WHERE cnnstate IS NOT DISTINCT FROM %s;').format(
+        sql.Identifier(project, table))
+    return dbConnector.execute(query, (stateID,), 1)[0]['cnt']
+
+
+
+@pytest.mark.parametrize('partitioned', [False, True])
+def test_apply_retention(db, partitioned):
+    dbConnector, project = db
+    imageIDs, stateIDs, partialID = _populate(dbConnector, project)
+    numPredictions = len(imageIDs) * len(CONFIDENCES)
+    if partitioned:
+        assert predictionRetention.partition_table(dbConnector, project)
+
+    stats = predictionRetention.apply_retention(dbConnector, project, 1)
+    assert stats == {
+        'num_states': 2,
+        'num_summarized': 2 * len(imageIDs),
+        'num_deleted': (0 if partitioned else 2 * numPredictions),
+        'num_partitions_dropped': (2 if partitioned else 0)
+    }
+
+    # predictions of the latest model state, partial states, and without state are kept
+    for stateID in stateIDs[:2]:
+        assert _count(dbConnector, project, stateID=stateID) == 0
+    for stateID in (stateIDs[2], partialID, None):
+        assert _count(dbConnector, project, stateID=stateID) == numPredictions
+
+    summaries = dbConnector.execute(sql.SQL('SELECT * FROM {} ORDER BY cnnstate, image;').format(
+        sql.Identifier(project, 'prediction_summary')), None, 'all')
+    assert set([s['cnnstate'] for s in summaries]) == set(stateIDs[:2])
+    for s in summaries:
+        assert s['num_predictions'] == len(CONFIDENCES)
+        assert s['confidence_mean'] == pytest.approx(sum(CONFIDENCES) / len(CONFIDENCES))
+        assert s['confidence_max'] == pytest.approx(max(CONFIDENCES))
+        assert s['priority_max'] == pytest.approx(1 - min(CONFIDENCES))
+
+    # repeating is safe
+    stats = predictionRetention.apply_retention(dbConnector, project, 1)
+    assert stats['num_states'] == 0 and stats['num_summarized'] == 0
+    assert _count(dbConnector, project, 'prediction_summary', stateIDs[0]) == len(imageIDs)
+
+
+def test_partition_table(db):
+    dbConnector, project = db
+    imageIDs, stateIDs, partialID = _populate(dbConnector, project)
+    numPredictions = len(imageIDs) * len(CONFIDENCES)
+    assert not predictionRetention.is_partitioned(dbConnector, project)
+    assert predictionRetention.get_partitions(dbConnector, project) == set()
+
+    assert predictionRetention.partition_table(dbConnector, project)
+    assert predictionRetention.is_partitioned(dbConnector, project)
+    assert predictionRetention.partition_table(dbConnector, project)        # no-op
+    expected = set([predictionRetention.get_partition_name(s) for s in stateIDs + [partialID]])
+    expected.add(predictionRetention.DEFAULT_PARTITION)
+    assert predictionRetention.get_partitions(dbConnector, project) == expected
+
+    # all rows are copied
+    for stateID in stateIDs + [partialID, None]:
+        assert _count(dbConnector, project, stateID=stateID) == numPredictions
+    assert _count(dbConnector, project, predictionRetention.DEFAULT_PARTITION, None) == numPredictions
+
+    # indices of the partitioned table
+    indices = dbConnector.execute('''
+        SELECT tablename, indexname FROM pg_indexes
+        WHERE schemaname = %s;
+    ''', (project,), 'all')
+    indices = set([(i['tablename'], i['indexname']) for i in indices])
+    assert (predictionRetention.DEFAULT_PARTITION, 'prediction_cnnstate_idx') in indices
+    assert ('prediction', 'prediction_part_id_idx') in indices
+    assert ('prediction', 'prediction_part_image_idx') in indices
+
+    # new model state: predictions stored in the default partition are moved to its partition
+    stateID = _add_state(dbConnector, project, 0)
+    _add_predictions(dbConnector, project, imageIDs, stateID)
+    assert _count(dbConnector, project, predictionRetention.DEFAULT_PARTITION, stateID) == numPredictions
+    predictionRetention.create_partition(dbConnector, project, stateID)
+    predictionRetention.create_partition(dbConnector, project, stateID)     # no-op
+    partitionName = predictionRetention.get_partition_name(stateID)
+    assert partitionName in predictionRetention.get_partitions(dbConnector, project)
+    assert _count(dbConnector, project, predictionRetention.DEFAULT_PARTITION, stateID) == 0
+    assert _count(dbConnector, project, partitionName, stateID) == numPredictions
+    assert _count(dbConnector, project, stateID=stateID) == numPredictions
@@ -0,0 +1,124 @@
+'''
+    Tests the incremental averaging of model states ("ai/models/pytorch/
+    stateAveraging.py", as used by "genericPyTorchModel._average_state_dicts")
+    against the previous implementation ("averageStateDicts" of the built-in
+    models), for model states passed as dicts, in "torch.save" format, and in
+    the compact format (chunked or not).
+
+    2020 Benjamin Kellenberger
+'''
+
+import io
+import copy
+import pytest
+
+for dependency in ('torch', 'torchvision', 'numpy', 'PIL', 'psycopg2', 'netifaces', 'pytz'):
+    pytest.importorskip(dependency)
+
+import torch
+from ai.models.pytorch import stateSerialization
+from ai.models.pytorch.genericPyTorchModel import _average_state_dicts
+from ai.models.pytorch.stateAveraging import StreamingStateAverager, get_parameter_keys
+from ai.models.pytorch.functional._retinanet.model import RetinaNet
+from ai.models.pytorch.functional.classification.resnet import ResNet
+from ai.models.pytorch.functional.segmentationMasks.unet import UNet
+from ai.models.pytorch.functional._wsodPoints.model import WSODPointModel
+
+
+NUM_STATES = 3
+LABELCLASS_MAP = {'a': 0, 'b': 1, 'c': 2}
+
+MODELS = {
+    'RetinaNet': (RetinaNet, lambda: RetinaNet(dict(LABELCLASS_MAP), backbone='resnet18', pretrained=False, out_planes=64)),
+    'ResNet': (ResNet, lambda: ResNet(dict(LABELCLASS_MAP), featureExtractor='resnet18', pretrained=False)),
+    'UNet': (UNet, lambda: UNet(dict(LABELCLASS_MAP), depth=3, numFeaturesExponent=3)),
+    'WSOD': (WSODPointModel, lambda: WSODPointModel(dict(LABELCLASS_MAP), backbone='resnet18', pretrained=False))
+}
+
+
+class _Config:
+    '''
+        Configuration with default values only (model states stored in the
+        database, plain "torch.save" format).
+    '''
+    def getProperty(self, section, name, type=str, fallback=None):
+        return fallback
+
+
+def _make_states(constructor):
+    states = []
+    for idx in range(NUM_STATES):
+        torch.manual_seed(idx)
+        stateDict = constructor().getStateDict()
+        for key, tensor in stateDict['model_state'].items():
+            # buffers (e.g. batch norm statistics) differ as well
+            if tensor.is_floating_point():
+                stateDict['model_state'][key] = tensor + torch.randn_like(tensor)
+        states.append(stateDict)
+    return states
+
+
+def _serialize(stateDict, format):
+    if format == 'torch.save':
+        bio = io.BytesIO()
+        torch.save(stateDict, bio)
+        return bio.getvalue()
+    elif format == 'compact':
+        return stateSerialization.save_state(stateDict, compression='zlib')
+    elif format == 'chunked':
+        return stateSerialization.save_state(stateDict, compression='zlib', chunked=True)
+
+
+@pytest.fixture(scope='module', params=list(MODELS.keys()))
+def model(request):
+    modelClass, constructor = MODELS[request.param]
+    states = _make_states(constructor)
+    reference = modelClass.averageStateDicts(copy.deepcopy(states))
+    return modelClass, states, reference
+
+
+def _assert_state_equal(result, reference, tolerance=1e-6):
+    assert set(result.keys()) == set(reference.keys())
+    for key in reference.keys():
+        if key != 'model_state':
+            assert result[key] == reference[key], key
+    assert set(result['model_state'].keys()) == set(reference['model_state'].keys())
+    for key, tensor in reference['model_state'].items():
+        assert result['model_state'][key].dtype == tensor.dtype, key
+        assert torch.allclose(result['model_state'][key], tensor, rtol=tolerance, atol=tolerance), key
+
+
+@pytest.mark.parametrize('format', ['torch.save', 'compact', 'chunked'])
+def test_average_equals_previous(model, format):
+    modelClass, states, reference = model
+    progress = []
+    result = _average_state_dicts(_Config(), modelClass, [_serialize(s, format) for s in states],
+                                lambda **kwargs: progress.append(kwargs['done']))
+    assert progress == list(range(1, NUM_STATES+1))
+    _assert_state_equal(stateSerialization.load_state(result), reference)
+
+
+def test_dict_inputs(model):
+    modelClass, states, reference = model
+    averager = StreamingStateAverager(get_parameter_keys(modelClass.loadFromStateDict(states[0])))
+    for stateDict in states:
+        averager.add(copy.deepcopy(stateDict))
+    _assert_state_equal(averager.result(), reference)
+
+
+def test_equal_weights(model):
+    modelClass, states, reference = model
+    result = _average_state_dicts(_Config(), modelClass, [_serialize(s, 'chunked') for s in states],
+                                lambda **kwargs: None, weights=[5]*NUM_STATES)
+    # summation of the weighted parameters is subject to rounding
+    _assert_state_equal(stateSerialization.load_state(result), reference, 1e-5)
+
+
+def test_buffers_from_last_state(model):
+    modelClass, states, _ = model
+    result = stateSerialization.load_state(_average_state_dicts(_Config(), modelClass,
+                                [_serialize(s, 'chunked') for s in states], lambda **kwargs: None))
+    parameterKeys = set([k for k, _ in modelClass.loadFromStateDict(states[0]).named_parameters()])
+    for key, tensor in states[-1]['model_state'].items():
+        if key not in parameterKeys:
+            assert torch.equal(result['model_state'][key], tensor), key
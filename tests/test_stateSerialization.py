@@ -0,0 +1,182 @@
+'''
+    Round-trip tests for the compact model state format
+    ("ai/models/pytorch/stateSerialization.py"), for all combinations of
+    options and for model states in the legacy ("torch.save") format.
+
+    2020 Benjamin Kellenberger
+'''
+
+import io
+import itertools
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('numpy')
+
+
+COMPRESSIONS = ('none', 'zlib', 'zstd')
+PRECISIONS = ('fp32', 'fp16', 'bf16')
+
+# maximum relative error of fp32 values stored in reduced precision
+TOLERANCES = {
+    'fp32': 0,
+    'fp16': 2**-11,
+    'bf16': 2**-8
+}
+
+
+@pytest.fixture
+def stateSerialization(load_module):
+    return load_module('ai/models/pytorch/stateSerialization.py')
+
+
+def _make_state():
+    generator = torch.Generator().manual_seed(0)
+    return {
+        'model_state': {
+            'conv.weight': torch.randn(16, 3, 3, 3, generator=generator),
+            'conv.bias': torch.randn(16, generator=generator),
+            'bn.running_mean': torch.randn(16, generator=generator, dtype=torch.float64),
+            'bn.num_batches_tracked': torch.tensor(42, dtype=torch.int64),
+            'head.weight': torch.randn(8, 16, generator=generator).to(torch.float16),
+            'mask': torch.rand(4, 4, generator=generator) > 0.5,
+            'empty': torch.zeros(0, 5)
+        },
+        'labelclassMap': {'cat': 0, 'dog': 1},
+        'backbone': 'resnet18',
+        'pretrained': False,
+        'numAnchors': 9
+    }
+
+
+def _assert_state_equal(loaded, state, precision):
+    assert set(loaded.keys()) == set(state.keys())
+    for key, value in state.items():
+        if key != 'model_state':
+            assert loaded[key] == value
+    for key, tensor in state['model_state'].items():
+        result = loaded['model_state'][key]
+        assert result.dtype == tensor.dtype, key
+        assert result.shape == tensor.shape, key
+        if tensor.dtype == torch.float32:
+            assert torch.allclose(result, tensor, rtol=TOLERANCES[precision], atol=(1e-6 if TOLERANCES[precision] else 0)), key
+        else:
+            assert torch.equal(result, tensor), key
+
+
+@pytest.mark.parametrize('compression,precision,chunked',
+                        list(itertools.product(COMPRESSIONS, PRECISIONS, (False, True))))
+def test_round_trip(stateSerialization, compression, precision, chunked):
+    state = _make_state()
+    original = dict([(k, v.clone()) for k, v in state['model_state'].items()])
+    data = stateSerialization.save_state(state, compression=compression, precision=precision, chunked=chunked)
+    assert data.startswith(stateSerialization.MAGIC)
+
+    # input state is left untouched
+    for key, tensor in original.items():
+        assert state['model_state'][key].dtype == tensor.dtype
+        assert torch.equal(state['model_state'][key], tensor)
+
+    _assert_state_equal(stateSerialization.load_state(data), state, precision)
+    _assert_state_equal(stateSerialization.load_state(io.BytesIO(data)), state, precision)
+
+    # to file-like object
+    bio = io.BytesIO()
+    stateSerialization.save_state(state, bio, compression=compression, precision=precision, chunked=chunked)
+    assert bio.getvalue() == data
+
+
+@pytest.mark.parametrize('compression,precision',
+                        list(itertools.product(COMPRESSIONS, PRECISIONS)))
+def test_reader_tensor_access(stateSerialization, compression, precision):
+    state = _make_state()
+    for chunked in (False, True):
+        data = stateSerialization.save_state(state, compression=compression, precision=precision, chunked=chunked)
+        reader = stateSerialization.StateReader(data)
+        assert reader.chunked == chunked
+        expectedKeys = [('model_state', k) for k in state['model_state'].keys()]
+        assert sorted(reader.keys()) == sorted(expectedKeys)
+
+        # sequential iteration
+        tensors = dict(reader.iter_tensors())
+        assert sorted(tensors.keys()) == sorted(expectedKeys)
+
+        # random access, in reverse order
+        for path in reversed(expectedKeys):
+            tensor = reader.get_tensor(path)
+            assert torch.equal(tensor, tensors[path])
+
+        if chunked:
+            # metadata without tensors
+            metadata = reader.get_metadata()
+            assert metadata['labelclassMap'] == state['labelclassMap']
+            assert all(v is None for v in metadata['model_state'].values())
+
+
+class _NonSeekable(io.RawIOBase):
+
+    def __init__(self, data):
+        self.bio = io.BytesIO(data)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.bio.read(size)
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        raise OSError('not seekable')
+
+
+def test_chunked_non_seekable_stream(stateSerialization):
+    state = _make_state()
+    data = stateSerialization.save_state(state, compression='zlib', chunked=True)
+    _assert_state_equal(stateSerialization.load_state(_NonSeekable(data)), state, 'fp32')
+
+
+@pytest.mark.parametrize('legacyState', [
+    _make_state,
+    lambda: _make_state()['model_state'],
+    lambda: {'model_state': None, 'labelclassMap': {}}
+])
+def test_legacy_format(stateSerialization, legacyState):
+    state = legacyState()
+    bio = io.BytesIO()
+    torch.save(state, bio)
+    data = bio.getvalue()
+
+    reader = stateSerialization.StateReader(data)
+    assert reader.legacy
+    for loaded in (stateSerialization.load_state(data), stateSerialization.load_state(io.BytesIO(data))):
+        assert set(loaded.keys()) == set(state.keys())
+        for path, tensor in stateSerialization.walk_tensors(state):
+            assert torch.equal(stateSerialization.get_path(loaded, path), tensor)
+
+
+def test_zstd_fallback(stateSerialization, monkeypatch):
+    monkeypatch.setattr(stateSerialization, 'zstandard', None)
+    state = _make_state()
+    data = stateSerialization.save_state(state, compression='zstd', chunked=True)
+    reader = stateSerialization.StateReader(data)
+    assert reader.compression == 'zlib'
+    _assert_state_equal(reader.load(), state, 'fp32')
+
+
+def test_zstd_required_for_loading(stateSerialization, monkeypatch):
+    pytest.importorskip('zstandard')
+    data = stateSerialization.save_state(_make_state(), compression='zstd')
+    monkeypatch.setattr(stateSerialization, 'zstandard', None)
+    with pytest.raises(Exception, match='zstandard'):
+        stateSerialization.load_state(data)
+
+
+@pytest.mark.parametrize('options', [
+    {'compression': 'lz4'},
+    {'precision': 'int8'}
+])
+def test_invalid_options(stateSerialization, options):
+    with pytest.raises(ValueError):
+        stateSerialization.save_state(_make_state(), **options)
@@ -0,0 +1,92 @@
+'''
+    Tests the splitting of tensors into shards on regular grids and their re-
+    assembly ("shardTensor" and "foldShards" in "ai/extras/_functional/tensor-
+    Sharding.py"), for centred (padded) and tight grids.
+
+    2020 Benjamin Kellenberger
+'''
+
+import pytest
+
+for dependency in ('torch', 'numpy'):
+    pytest.importorskip(dependency)
+
+import torch
+from ai.extras._functional import tensorSharding
+
+
+# tensor size (H, W), shard size (h, w), stride
+LAYOUTS = [
+    ((100, 130), (32, 40), None),
+    ((100, 130), (32, 40), 0.5),
+    ((64, 80), (32, 40), (16, 20)),
+    ((33, 41), (32, 40), 7),
+    ((20, 30), (32, 40), None)          # smaller than a shard
+]
+
+
+def _crop(tensor, x, y, shardSize):
+    # shard at (x, y), with zeros outside the tensor
+    out = torch.zeros(tensor.size(0), shardSize[0], shardSize[1])
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(tensor.size(2), x + shardSize[1]), min(tensor.size(1), y + shardSize[0])
+    if x1 > x0 and y1 > y0:
+        out[:,y0-y:y1-y,x0-x:x1-x] = tensor[:,y0:y1,x0:x1]
+    return out
+
+
+
+@pytest.mark.parametrize('tensorSize, shardSize, stride', LAYOUTS)
+@pytest.mark.parametrize('tight', [False, True])
+def test_shards(tensorSize, shardSize, stride, tight):
+    torch.manual_seed(0)
+    tensor = torch.rand(2, 3, *tensorSize)
+    shards, coordsX, coordsY = tensorSharding.shardTensor(tensor, shardSize, stride, tight=tight)
+    numShards = coordsX.numel()
+    assert shards.size() == (2*numShards, 3, *shardSize)
+    for b in range(2):
+        for n in range(numShards):
+            assert torch.equal(shards[b*numShards+n], _crop(tensor[b], int(coordsX[n]), int(coordsY[n]), shardSize))
+
+    # the whole tensor is covered
+    covered = torch.zeros(tensorSize, dtype=torch.bool)
+    for x, y in zip(coordsX.tolist(), coordsY.tolist()):
+        covered[max(0, y):y+shardSize[0],max(0, x):x+shardSize[1]] = True
+    assert covered.all()
+
+    if tight:
+        # shards start within the tensor and end at its border at the latest (unless it is smaller)
+        assert (coordsX >= 0).all() and (coordsY >= 0).all()
+        assert (coordsX + shardSize[1] <= max(tensorSize[1], shardSize[1])).all()
+        assert (coordsY + shardSize[0] <= max(tensorSize[0], shardSize[0])).all()
+
+
+@pytest.mark.parametrize('tensorSize, shardSize, stride', LAYOUTS)
+@pytest.mark.parametrize('tight', [False, True])
+@pytest.mark.parametrize('blending', ['average', 'linear', 'gaussian'])
+def test_fold(tensorSize, shardSize, stride, tight, blending):
+    torch.manual_seed(0)
+    tensor = torch.rand(2, 3, *tensorSize)
+    shards, _, _ = tensorSharding.shardTensor(tensor, shardSize, stride, tight=tight)
+    out = tensorSharding.foldShards(shards, tensorSize, stride, blending, tight=tight)
+    assert torch.allclose(out, tensor, atol=1e-5)
+
+
+@pytest.mark.parametrize('tight', [False, True])
+def test_fold_sum(tight):
+    tensor = torch.ones(1, 1, 100, 130)
+    shards, coordsX, coordsY = tensorSharding.shardTensor(tensor, (32, 40), 0.5, tight=tight)
+    out = tensorSharding.foldShards(shards, (100, 130), 0.5, 'sum', tight=tight)
+
+    # number of shards covering every element
+    expected = torch.zeros(100, 130)
+    for x, y in zip(coordsX.tolist(), coordsY.tolist()):
+        expected[max(0, y):y+32,max(0, x):x+40] += 1
+    assert torch.equal(out[0,0], expected)
+
+
+def test_tight_locations():
+    # last shards end at the tensor border
+    coordsX, coordsY = tensorSharding.getShardLocations((100, 130), (32, 40), tight=True)
+    assert sorted(set(coordsX.tolist())) == [0, 40, 80, 90]
+    assert sorted(set(coordsY.tolist())) == [0, 32, 64, 68]
@@ -6,6 +6,8 @@
 
 import os
 import importlib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from functools import reduce
 from datetime import datetime
 import pytz
@@ -17,6 +19,7 @@ import base64
 import numpy as np
 from PIL import Image, ImageColor
 from psycopg2 import sql
+from util import maskCodec
 
 
 def array_split(arr, size):
@@ -230,6 +233,79 @@ def listDirectory(baseDir, recursive=False):
 
 
 
+def iterDirectory(baseDir, recursive=False, startAfter=None):
+    '''
+        Generator version of "listDirectory". Yields the paths (relative to
+        "baseDir") of all image files in ascending code point order, which is
+        the same order as produced by PostgreSQL for strings with collation
+        "C". Only one directory listing per level of the tree is held in
+        memory at a time.
+        If "startAfter" is provided, only paths greater than it are yielded,
+        and directories that cannot contain such paths are skipped.
+    '''
+    baseDirReal = os.path.realpath(baseDir)
+    def _scan_sorted(fileDir, relPrefix):
+        entries = []
+        try:
+            with os.scandir(fileDir) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file():
+                            if os.path.splitext(entry.name)[1].lower() in valid_image_extensions:
+                                entries.append((relPrefix + entry.name, None))
+                        elif entry.is_dir() and recursive:
+                            if entry.is_symlink():
+                                target = os.path.realpath(entry.path)
+                                if baseDirReal == target or baseDirReal.startswith(target + os.sep):
+                                    # circular link; avoid
+                                    continue
+                            # sort key of directory is prefix of all its contents
+                            entries.append((relPrefix + entry.name + os.sep, entry.path))
+                    except OSError:
+                        continue
+        except OSError:
+            return
+        entries.sort(key=lambda e: e[0])
+        for key, dirPath in entries:
+            if dirPath is not None:
+                if startAfter is None or key > startAfter or startAfter.startswith(key):
+                    yield from _scan_sorted(dirPath, key)
+            elif startAfter is None or key > startAfter:
+                yield key
+
+    yield from _scan_sorted(baseDir, '')
+
+
+
+def hashFile(filePath, blockSize=1048576):
+    '''
+        Computes the SHA-256 hash of a file's contents, streaming the file in
+        blocks of "blockSize" bytes. Returns the hash as a hex string.
+    '''
+    h = hashlib.sha256()
+    with open(filePath, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+def hashFiles(filePaths, numWorkers=None):
+    '''
+        Hashes multiple files in parallel threads (hashlib releases the GIL
+        while hashing large blocks). Returns a list of hex hashes in order of
+        "filePaths"; entries are None for files that could not be read.
+    '''
+    def _hash(filePath):
+        try:
+            return hashFile(filePath)
+        except OSError:
+            return None
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        return list(executor.map(_hash, filePaths))
+
+
+
 def hexToRGB(hexString):
     '''
         Receives a HTML/CSS-compliant hex color string
@@ -267,9 +343,10 @@ def base64ToImage(base64str, width, height, toPIL=True):
         AIDE's database (e.g. for segmentation masks) and
         returns a PIL image with its contents if "toPIL" is
         True (default), or an ndarray otherwise.
+        The mask codec is detected automatically (see
+        "util.maskCodec").
     '''
-    raster = np.frombuffer(base64.b64decode(base64str), dtype=np.uint8)
-    raster = np.reshape(raster, (int(height),int(width),))
+    raster = maskCodec.decode_mask(base64str, width, height)
     if not toPIL:
         return raster
     image = Image.fromarray(raster)
@@ -293,23 +370,49 @@ def setImageCorrupt(dbConnector, project, imageID, corrupt):
 
 
 
-def getPILimage(input, imageID, project, dbConnector, convertRGB=False):
+def draftImage(img, targetSize):
+    '''
+        Configures a PIL image that has been opened, but not yet
+        loaded, to be decoded at reduced resolution where supported
+        by the format (JPEG: DCT scaling by 1/2, 1/4 or 1/8). The
+        strongest reduction is chosen for which the image still
+        covers "targetSize" (tuple of width, height). The image is
+        left unchanged for other formats or if "targetSize" is None.
+        Since annotations are stored in relative coordinates, they
+        remain valid for the reduced image.
+    '''
+    if targetSize is None or img.format != 'JPEG':
+        return img
+    try:
+        img.draft(img.mode, (int(targetSize[0]), int(targetSize[1])))
+    except Exception:
+        # image already loaded or draft mode unsupported; decode in full
+        pass
+    return img
+
+
+
+def getPILimage(input, imageID, project, dbConnector, convertRGB=False, targetSize=None):
     '''
         Reads an input (file path or BytesIO object) and
         returns a PIL image instance.
         Also checks if the image is intact. If it is not,
         the "corrupt" flag is set in the database as True,
         and None is returned.
+        If "targetSize" (width, height) is provided, JPEG images
+        are decoded at the lowest resolution that still covers it
+        (see "draftImage").
     '''
     img = None
     try:
         img = Image.open(input)
         if convertRGB:
+            img = draftImage(img, targetSize)
             # conversion implicitly verifies the image (TODO)
             img = img.convert('RGB')
         else:
             img.verify()
-            img = Image.open(input)
+            img = draftImage(Image.open(input), targetSize)
 
     except:
         # something failed; set "corrupt" flag to False for image
@@ -5,10 +5,17 @@
     2020 Benjamin Kellenberger
 '''
 
+import os
+from collections import OrderedDict
+from threading import Lock
 from PIL import Image
 import numpy as np
 
 
+# separator between parent file name and window of virtual image patches
+VIRTUAL_WINDOW_SEPARATOR = '?window='
+
+
 def split_image(image, patchSize, stride=None, tight=True):
     '''
         Receives a PIL image and splits it into patches on a regular grid.
@@ -37,7 +44,33 @@ def split_image(image, patchSize, stride=None, tight=True):
 
     # assertions
     assert isinstance(image, Image.Image), 'Input is not a PIL Image.'
-    sz = image.size
+    xLoc, yLoc, patchSize = _get_split_locations(image.size, patchSize, stride, tight)
+
+    if len(xLoc) <= 1 and len(yLoc) <= 1:
+        # patch size is greater than image size; return image
+        return [image], [(0,0)]
+    
+    # do the cropping
+    patches = []
+    coords = []
+    for x in range(len(xLoc)):
+        for y in range(len(yLoc)):
+            pos = (int(xLoc[x]), int(yLoc[y]))
+            patch = image.crop((pos[0], pos[1], pos[0]+patchSize[0], pos[1]+patchSize[1]))
+            patches.append(patch)
+            coords.append(pos)
+    
+    return patches, coords
+
+
+
+def _get_split_locations(sz, patchSize, stride=None, tight=True):
+    '''
+        Calculates the left (x) and top (y) patch positions on a regular
+        grid for an image of size "sz" (width, height). See "split_image"
+        for a description of the parameters.
+        Returns the lists of x and y positions and the effective patch size.
+    '''
     if isinstance(patchSize, int):
         patchSize = min(patchSize, max(sz[0], sz[1]))
         patchSize = (patchSize, patchSize)
@@ -75,18 +108,143 @@ def split_image(image, patchSize, stride=None, tight=True):
         while yLoc[-1] + patchSize[1] < sz[1]:
             yLoc.append(yLoc[-1] + stride[1])
     
+    return xLoc, yLoc, patchSize
+
+
+
+def get_split_positions(imageSize, patchSize, stride=None, tight=True):
+    '''
+        Returns the windows that "split_image" would crop from an image of
+        size "imageSize" (width, height), without requiring the image to be
+        loaded. Each window is a tuple of (x, y, width, height).
+    '''
+    xLoc, yLoc, patchSize = _get_split_locations(imageSize, patchSize, stride, tight)
     if len(xLoc) <= 1 and len(yLoc) <= 1:
-        # patch size is greater than image size; return image
-        return [image], [(0,0)]
-    
-    # do the cropping
-    patches = []
-    coords = []
+        return [(0, 0, imageSize[0], imageSize[1])]
+    windows = []
     for x in range(len(xLoc)):
         for y in range(len(yLoc)):
-            pos = (int(xLoc[x]), int(yLoc[y]))
-            patch = image.crop((pos[0], pos[1], pos[0]+patchSize[0], pos[1]+patchSize[1]))
-            patches.append(patch)
-            coords.append(pos)
-    
-    return patches, coords
\ No newline at end of file
+            windows.append((int(xLoc[x]), int(yLoc[y]), patchSize[0], patchSize[1]))
+    return windows
+
+
+
+def get_virtual_filename(filename, window):
+    '''
+        Returns the file name under which a patch (window of x, y, width,
+        height) of an image file is registered as a virtual image.
+        The window is appended as a URL query, so that the file server can
+        crop the patch from the parent image on the fly.
+    '''
+    return '{}{}{}'.format(filename, VIRTUAL_WINDOW_SEPARATOR,
+                        ','.join([str(int(w)) for w in window]))
+
+
+
+def parse_window(windowStr):
+    '''
+        Parses a window string of format "x,y,width,height" and returns
+        it as a tuple of ints.
+    '''
+    window = tuple([int(w) for w in windowStr.split(',')])
+    assert len(window) == 4, f'Invalid window specification "{windowStr}".'
+    assert window[2] > 0 and window[3] > 0, f'Invalid window size "{windowStr}".'
+    return window
+
+
+
+def parse_virtual_filename(filename):
+    '''
+        Splits an image file name into the file name of the parent image on
+        disk and the window (tuple of x, y, width, height) of the virtual
+        patch. The window is None for regular images.
+    '''
+    idx = filename.rfind(VIRTUAL_WINDOW_SEPARATOR)
+    if idx < 0:
+        return filename, None
+    return filename[:idx], parse_window(filename[idx+len(VIRTUAL_WINDOW_SEPARATOR):])
+
+
+
+class ImageCache:
+    '''
+        Thread-safe least recently used cache of decoded images. Used to
+        crop virtual patches from their parent images without decoding the
+        parent file anew for every patch. Entries are keyed by file path and
+        modification time, so that files replaced on disk are reloaded.
+        The cache is bounded by the total size (in bytes) of the decoded
+        images (width * height * number of bands); images larger than the
+        cache are not stored.
+    '''
+    def __init__(self, maxSize=512*1024*1024):
+        self.maxSize = maxSize
+        self.cache = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+        self._pid = os.getpid()
+
+
+    @staticmethod
+    def _get_num_bytes(image):
+        return image.width * image.height * len(image.getbands())
+
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        state['cache'] = OrderedDict()
+        state['size'] = 0
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+        self._pid = os.getpid()
+
+
+    def _get_lock(self):
+        if self._pid != os.getpid():
+            # forked process (e.g. data loader worker); the lock might have
+            # been held by another thread of the parent at the time of forking
+            self.lock = Lock()
+            self._pid = os.getpid()
+        return self.lock
+
+
+    def get_image(self, filePath):
+        '''
+            Returns the decoded PIL image stored under "filePath", either
+            from the cache or loaded from disk.
+        '''
+        key = (filePath, os.path.getmtime(filePath))
+        with self._get_lock():
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key][0]
+
+        image = Image.open(filePath)
+        image.load()
+
+        numBytes = self._get_num_bytes(image)
+        if numBytes <= self.maxSize:
+            with self._get_lock():
+                if key in self.cache:
+                    # loaded by another thread in the meantime
+                    self.cache.move_to_end(key)
+                    return self.cache[key][0]
+                self.cache[key] = (image, numBytes)
+                self.size += numBytes
+                while self.size > self.maxSize:
+                    _, (_, evicted) = self.cache.popitem(last=False)
+                    self.size -= evicted
+        return image
+
+
+    def get_window(self, filePath, window):
+        '''
+            Returns the patch (PIL image) of the file under "filePath" as
+            specified by "window" (tuple of x, y, width, height).
+        '''
+        image = self.get_image(filePath)
+        return image.crop((window[0], window[1], window[0]+window[2], window[1]+window[3]))
@@ -0,0 +1,174 @@
+'''
+    Encoding of segmentation masks (2D arrays of uint8 label class indices)
+    for storage in the database.
+
+    Masks have traditionally been stored as base64 string of the raw pixel
+    values (row-major), which requires about 1.33 bytes per pixel and the
+    width and height of the mask to decode. Masks consist mostly of large
+    uniform areas, so they can be stored much more compactly with one of the
+    following codecs:
+    - "png":    grayscale PNG image (DEFLATE-compressed, with row filters)
+    - "rle":    run-length encoding (header with height, width and number
+                of runs, followed by the run values and lengths), compressed
+                with zlib
+    Encoded masks are base64 strings as well, prefixed with codec name and
+    version (e.g. "png1:"). Since the prefix separator is not part of the
+    base64 alphabet, the codec is detected automatically upon decoding, and
+    masks in the raw format ("raw"; no prefix) can be decoded as before.
+
+    The labeling UI still receives (and submits) masks in the raw format;
+    see "to_raw".
+
+    2020 Benjamin Kellenberger
+'''
+
+import io
+import zlib
+import struct
+import base64
+import numpy as np
+from PIL import Image
+
+
+MASK_CODECS = ('png', 'rle', 'raw')
+
+DEFAULT_CODEC = 'png'
+
+_PREFIXES = {
+    'png': 'png1:',
+    'rle': 'rle1:'
+}
+
+_RLE_HEADER = struct.Struct('<III')
+
+
+
+def get_codec(config):
+    '''
+        Returns the codec for new segmentation masks as set in section [Pro-
+        ject] of the configuration file.
+    '''
+    codec = config.getProperty('Project', 'segmentation_mask_codec', type=str, fallback=DEFAULT_CODEC)
+    codec = (codec.strip().lower() if isinstance(codec, str) else DEFAULT_CODEC)
+    if codec not in MASK_CODECS:
+        print(f'WARNING: unknown segmentation mask codec "{codec}"; using "{DEFAULT_CODEC}" instead.')
+        codec = DEFAULT_CODEC
+    return codec
+
+
+
+def detect_codec(maskString):
+    '''
+        Returns the codec ("png", "rle", or "raw") of an encoded mask.
+    '''
+    if isinstance(maskString, str):
+        for codec, prefix in _PREFIXES.items():
+            if maskString.startswith(prefix):
+                return codec
+    return 'raw'
+
+
+
+def _to_array(mask):
+    mask = np.asarray(mask)
+    if mask.ndim != 2:
+        raise ValueError(f'Segmentation mask must be two-dimensional (got shape {mask.shape}).')
+    return mask.astype(np.uint8, copy=False)
+
+
+
+def _encode_rle(mask):
+    flat = mask.ravel()
+    if len(flat):
+        starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+        lengths = np.diff(np.concatenate((starts, [len(flat)])))
+        values = flat[starts]
+    else:
+        lengths = np.zeros(0, dtype=np.int64)
+        values = np.zeros(0, dtype=np.uint8)
+    bytea = _RLE_HEADER.pack(mask.shape[0], mask.shape[1], len(values)) + \
+        values.astype(np.uint8).tobytes() + lengths.astype('<u4').tobytes()
+    return zlib.compress(bytea, 6)
+
+
+
+def _decode_rle(bytea):
+    bytea = zlib.decompress(bytea)
+    height, width, numRuns = _RLE_HEADER.unpack_from(bytea, 0)
+    offset = _RLE_HEADER.size
+    values = np.frombuffer(bytea, dtype=np.uint8, count=numRuns, offset=offset)
+    lengths = np.frombuffer(bytea, dtype='<u4', count=numRuns, offset=offset+numRuns)
+    if int(lengths.sum()) != height * width:
+        raise ValueError('Run-length encoded segmentation mask is corrupt.')
+    return np.repeat(values, lengths).reshape((height, width))
+
+
+
+def encode_mask(mask, codec=DEFAULT_CODEC):
+    '''
+        Encodes a segmentation mask (PIL image or 2D array of label class
+        indices) with the given codec and returns the string for the data-
+        base. Empty masks (zero width or height) cannot be stored as PNG
+        and are run-length encoded instead.
+    '''
+    mask = _to_array(mask)
+    if codec == 'png' and not mask.size:
+        codec = 'rle'
+    if codec == 'raw':
+        bytea = mask.tobytes()
+    elif codec == 'png':
+        buffer = io.BytesIO()
+        Image.fromarray(mask, mode='L').save(buffer, format='PNG', compress_level=6)
+        bytea = buffer.getvalue()
+    elif codec == 'rle':
+        bytea = _encode_rle(mask)
+    else:
+        raise ValueError(f'Unknown segmentation mask codec "{codec}".')
+    return _PREFIXES.get(codec, '') + base64.b64encode(bytea).decode('utf-8')
+
+
+
+def decode_mask(maskString, width=None, height=None):
+    '''
+        Decodes a segmentation mask from its database string (codec detected
+        automatically) and returns it as a 2D uint8 array. Width and height
+        are only required for masks in the raw format.
+    '''
+    codec = detect_codec(maskString)
+    if codec == 'raw':
+        if width is None or height is None:
+            raise ValueError('Width and height are required to decode raw segmentation masks.')
+        raster = np.frombuffer(base64.b64decode(maskString), dtype=np.uint8)
+        return np.reshape(raster, (int(height), int(width)))
+
+    bytea = base64.b64decode(maskString[len(_PREFIXES[codec]):])
+    if codec == 'png':
+        raster = np.array(Image.open(io.BytesIO(bytea)).convert('L'))
+    else:
+        raster = _decode_rle(bytea)
+    if width is not None and height is not None and raster.shape != (int(height), int(width)):
+        raise ValueError(f'Segmentation mask has size {raster.shape[1]}x{raster.shape[0]} (expected {int(width)}x{int(height)}).')
+    return raster
+
+
+
+def to_raw(maskString, width=None, height=None):
+    '''
+        Returns a segmentation mask in the raw format (as expected by the
+        labeling UI), together with its width and height.
+    '''
+    if detect_codec(maskString) == 'raw':
+        return maskString, width, height
+    raster = decode_mask(maskString, width, height)
+    return base64.b64encode(raster.tobytes()).decode('utf-8'), raster.shape[1], raster.shape[0]
+
+
+
+def transcode(maskString, codec, width=None, height=None):
+    '''
+        Re-encodes a segmentation mask with the given codec. Returns the mask
+        unchanged if it is already encoded with it.
+    '''
+    if detect_codec(maskString) == codec:
+        return maskString
+    return encode_mask(decode_mask(maskString, width, height), codec)
@@ -0,0 +1,269 @@
+'''
+    Content-addressed storage of model states outside the database.
+    Model states are stored as blobs named after the SHA-256 hash of their
+    contents, and database rows (project "cnnstate" tables, Model Marketplace)
+    only hold references of the form "sha256:<hash>". Identical states (e.g.
+    a model state shared through the Model Marketplace) are therefore stored
+    only once.
+
+    Available backends (see section [ModelStateStore] in the configuration
+    file):
+    - "database": model states are stored in the database as before (default;
+                  no store instance is created).
+    - "filesystem": blobs are stored in a directory, which may be on a net-
+                    work share that is accessible to all AIWorkers.
+    - "s3": blobs are stored in an S3-compatible object storage (requires
+            package "boto3"). Any S3-compatible server can be used through
+            parameter "s3_endpoint_url" (e.g. a local MinIO instance).
+
+    Blobs are read and written in chunks, and may be passed as bytes or as
+    binary file-like objects.
+
+    2020 Benjamin Kellenberger
+'''
+
+import os
+import io
+import hashlib
+import tempfile
+from uuid import uuid4
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    # only required for the S3 backend
+    boto3 = None
+
+
+CHUNK_SIZE = 1048576
+REF_PREFIX = 'sha256:'
+
+
+def iter_chunks(stateDict):
+    '''
+        Yields the contents of a model state (bytes or binary file-like
+        object) in chunks.
+    '''
+    if isinstance(stateDict, (bytes, bytearray, memoryview)):
+        stateDict = io.BytesIO(stateDict)
+    for chunk in iter(lambda: stateDict.read(CHUNK_SIZE), b''):
+        yield chunk
+
+
+def to_bytes(stateDict):
+    '''
+        Returns the contents of a model state (bytes or binary file-like
+        object) as bytes.
+    '''
+    if stateDict is None or isinstance(stateDict, bytes):
+        return stateDict
+    if isinstance(stateDict, (bytearray, memoryview)):
+        return bytes(stateDict)
+    return stateDict.read()
+
+
+def is_reference(value):
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+
+
+class ModelStateStore:
+    '''
+        Base class of model state stores. Subclasses implement the backend-
+        specific functions "_exists", "_write" and "_open".
+    '''
+
+    @staticmethod
+    def _parse_reference(ref):
+        if not is_reference(ref):
+            raise ValueError(f'Invalid model state reference "{ref}".')
+        contentHash = ref[len(REF_PREFIX):]
+        if len(contentHash) != 64 or not all(c in '0123456789abcdef' for c in contentHash):
+            raise ValueError(f'Invalid model state reference "{ref}".')
+        return contentHash
+
+
+    def put(self, stateDict):
+        '''
+            Stores a model state (bytes or binary file-like object) and re-
+            turns its reference. The contents are hashed while being spooled
+            to a temporary file, which is only transferred to the backend if
+            no identical blob exists yet.
+        '''
+        with tempfile.TemporaryFile() as tempFile:
+            h = hashlib.sha256()
+            for chunk in iter_chunks(stateDict):
+                h.update(chunk)
+                tempFile.write(chunk)
+            contentHash = h.hexdigest()
+            if not self._exists(contentHash):
+                tempFile.seek(0)
+                self._write(contentHash, tempFile)
+        return REF_PREFIX + contentHash
+
+
+    def open(self, ref):
+        '''
+            Returns a readable binary file-like object for the model state
+            with given reference. The caller is responsible for closing it.
+        '''
+        return self._open(self._parse_reference(ref))
+
+
+    def get(self, ref):
+        '''
+            Reads the model state with given reference in chunks, verifies its
+            hash, and returns it as bytes.
+        '''
+        contentHash = self._parse_reference(ref)
+        stream = self._open(contentHash)
+        try:
+            h = hashlib.sha256()
+            bio = io.BytesIO()
+            for chunk in iter_chunks(stream):
+                h.update(chunk)
+                bio.write(chunk)
+        finally:
+            stream.close()
+        if h.hexdigest() != contentHash:
+            raise Exception(f'Model state "{ref}" is corrupt (hash mismatch).')
+        return bio.getvalue()
+
+
+    def exists(self, ref):
+        return self._exists(self._parse_reference(ref))
+
+
+    def _exists(self, contentHash):
+        raise NotImplementedError('not implemented for base class.')
+
+
+    def _write(self, contentHash, fileObj):
+        raise NotImplementedError('not implemented for base class.')
+
+
+    def _open(self, contentHash):
+        raise NotImplementedError('not implemented for base class.')
+
+
+
+class LocalModelStateStore(ModelStateStore):
+    '''
+        Stores model states as files in a (local or network-mounted) direc-
+        tory, in sub-folders by the first characters of their hash.
+    '''
+
+    def __init__(self, baseDir):
+        self.baseDir = baseDir
+        os.makedirs(self.baseDir, exist_ok=True)
+
+
+    def _get_path(self, contentHash):
+        return os.path.join(self.baseDir, contentHash[:2], contentHash[2:4], contentHash)
+
+
+    def _exists(self, contentHash):
+        return os.path.isfile(self._get_path(contentHash))
+
+
+    def _write(self, contentHash, fileObj):
+        # write under temporary name, then rename (atomic on the same volume)
+        filePath = self._get_path(contentHash)
+        os.makedirs(os.path.dirname(filePath), exist_ok=True)
+        tempPath = filePath + '.' + str(uuid4()) + '.tmp'
+        try:
+            with open(tempPath, 'wb') as f:
+                for chunk in iter_chunks(fileObj):
+                    f.write(chunk)
+            os.replace(tempPath, filePath)
+        finally:
+            if os.path.isfile(tempPath):
+                os.remove(tempPath)
+
+
+    def _open(self, contentHash):
+        filePath = self._get_path(contentHash)
+        if not os.path.isfile(filePath):
+            raise Exception(f'Model state "{REF_PREFIX}{contentHash}" not found in store.')
+        return open(filePath, 'rb')
+
+
+
+class S3ModelStateStore(ModelStateStore):
+    '''
+        Stores model states as objects in a bucket of an S3-compatible object
+        storage.
+    '''
+
+    def __init__(self, bucket, prefix='', endpointURL=None, region=None,
+                accessKeyID=None, secretAccessKey=None):
+        if boto3 is None:
+            raise Exception('Package "boto3" is required for the S3 model state store.')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3',
+                            endpoint_url=endpointURL,
+                            region_name=region,
+                            aws_access_key_id=accessKeyID,
+                            aws_secret_access_key=secretAccessKey)
+
+
+    def _get_key(self, contentHash):
+        if len(self.prefix):
+            return self.prefix + '/' + contentHash
+        return contentHash
+
+
+    def _exists(self, contentHash):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._get_key(contentHash))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+
+    def _write(self, contentHash, fileObj):
+        # multipart upload in chunks for large states
+        self.client.upload_fileobj(fileObj, self.bucket, self._get_key(contentHash))
+
+
+    def _open(self, contentHash):
+        response = self.client.get_object(Bucket=self.bucket, Key=self._get_key(contentHash))
+        return response['Body']
+
+
+
+def get_model_state_store(config):
+    '''
+        Returns the model state store configured in section [ModelStateStore]
+        of the configuration file, or None if model states are to be stored
+        in the database.
+    '''
+    backend = config.getProperty('ModelStateStore', 'backend', type=str, fallback='database').strip().lower()
+    if backend in ('', 'database'):
+        return None
+
+    elif backend == 'filesystem':
+        baseDir = config.getProperty('ModelStateStore', 'base_dir', type=str, fallback=None)
+        if baseDir is None or not len(baseDir):
+            raise Exception('Parameter "base_dir" is required for the filesystem model state store.')
+        return LocalModelStateStore(baseDir)
+
+    elif backend == 's3':
+        def _get(name):
+            value = config.getProperty('ModelStateStore', name, type=str, fallback=None)
+            return (value if value is not None and len(value) else None)
+        bucket = _get('s3_bucket')
+        if bucket is None:
+            raise Exception('Parameter "s3_bucket" is required for the S3 model state store.')
+        return S3ModelStateStore(bucket,
+                                prefix=(_get('s3_prefix') or ''),
+                                endpointURL=_get('s3_endpoint_url'),
+                                region=_get('s3_region'),
+                                accessKeyID=_get('s3_access_key_id'),
+                                secretAccessKey=_get('s3_secret_access_key'))
+
+    else:
+        raise Exception(f'Unknown model state store backend "{backend}".')
@@ -0,0 +1,200 @@
+'''
+    Columnar format for the predictions of a model.
+
+    Models traditionally return their predictions as a dict of images, each
+    with a list of dicts of Python values (one per prediction; see "doc/cus-
+    tom_model.md"). For models that predict many objects per image (e.g.
+    bounding boxes), creating these objects (and calling ".item()" on every
+    value) can take as long as the forward pass of the model itself.
+    A "PredictionBatch" instead holds one NumPy array per field (e.g. "x",
+    "y", "confidence"; "logits" as a 2D array), together with the index of
+    the image each prediction belongs to. It can be created directly from
+    tensors. Label classes are stored as indices into a list of label class
+    IDs.
+
+    The AIWorker writes prediction batches to the database as they are.
+    Ranking functions (AL criteria) receive them as well if they declare to
+    support them (attribute "acceptsPredictionBatch"); all others get
+    the dict format (see "to_dict").
+
+    2020 Benjamin Kellenberger
+'''
+
+import itertools
+import numpy as np
+
+
+def _to_numpy(value):
+    if hasattr(value, 'detach'):
+        # PyTorch tensor
+        value = value.detach().cpu().numpy()
+    return np.asarray(value)
+
+
+
+def _to_list(array):
+    '''
+        Converts an array into a list of Python values, with NaNs replaced
+        by None.
+    '''
+    if array.dtype.kind == 'f' and array.ndim == 1:
+        invalid = np.isnan(array)
+        if invalid.any():
+            array = array.astype(object)
+            array[invalid] = None
+    return array.tolist()
+
+
+
+def get_label_classes(labelclassMap_inv):
+    '''
+        Converts a dict of label class indices (model outputs) to label class
+        IDs into a list, as expected by "PredictionBatch".
+    '''
+    if not len(labelclassMap_inv):
+        return []
+    labelClasses = [None] * (max(labelclassMap_inv.keys()) + 1)
+    for idx, labelclassID in labelclassMap_inv.items():
+        labelClasses[idx] = labelclassID
+    return labelClasses
+
+
+
+def accepts_prediction_batch(fun):
+    '''
+        Returns True if the given (ranking) function or the object it is
+        bound to declares to support prediction batches.
+    '''
+    return bool(getattr(getattr(fun, '__self__', fun), 'acceptsPredictionBatch', False))
+
+
+
+class PredictionBatch:
+
+    def __init__(self, imageIDs, imageIndex, labelClasses=None, **fields):
+        '''
+            Inputs:
+            - imageIDs:     list of the IDs of all images covered by the batch,
+                            including images without predictions
+            - imageIndex:   array (or tensor) with the index of the image in
+                            "imageIDs" for every prediction
+            - labelClasses: optional list of label class IDs. If provided,
+                            field "label" contains indices into this list.
+            - fields:       arrays (or tensors) with the values of all predic-
+                            tions, with one entry (or row, e.g. for "logits")
+                            per prediction. Fields set to None are omitted.
+        '''
+        self.imageIDs = [str(i) for i in imageIDs]
+        self.imageIndex = _to_numpy(imageIndex).astype(np.int64).reshape(-1)
+        self.labelClasses = (None if labelClasses is None else list(labelClasses))
+        self.fields = {}
+        for key, value in fields.items():
+            if value is not None:
+                self[key] = value
+
+
+    @classmethod
+    def concatenate(cls, batches):
+        '''
+            Concatenates a list of prediction batches (e.g. one per data
+            loader batch) into one. All batches must have the same fields and
+            label classes.
+        '''
+        batches = [b for b in batches if b is not None]
+        if not len(batches):
+            return cls([], [])
+        imageIDs = []
+        imageIndex = []
+        for b in batches:
+            imageIndex.append(b.imageIndex + len(imageIDs))
+            imageIDs.extend(b.imageIDs)
+        fields = {}
+        for key in batches[0].fields.keys():
+            fields[key] = np.concatenate([b.fields[key] for b in batches], 0)
+        return cls(imageIDs, np.concatenate(imageIndex), batches[0].labelClasses, **fields)
+
+
+    def __len__(self):
+        return len(self.imageIndex)
+
+
+    def __contains__(self, key):
+        return key in self.fields
+
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+
+    def __setitem__(self, key, value):
+        value = _to_numpy(value)
+        if value.ndim == 0 or value.shape[0] != len(self.imageIndex):
+            raise ValueError(f'Field "{key}" has {value.shape[0] if value.ndim else 0} entries (expected {len(self.imageIndex)}).')
+        self.fields[key] = value
+
+
+    def keys(self):
+        return self.fields.keys()
+
+
+    def get_image_ids(self):
+        '''
+            Returns the image ID of every prediction.
+        '''
+        return np.asarray(self.imageIDs, dtype=object)[self.imageIndex]
+
+
+    def get_labels(self):
+        '''
+            Returns the label class ID of every prediction (None if the batch
+            has no labels).
+        '''
+        if 'label' not in self.fields:
+            return None
+        if self.labelClasses is None:
+            return self.fields['label']
+        return np.asarray(self.labelClasses, dtype=object)[self.fields['label'].astype(np.int64)]
+
+
+    def _get_column(self, key):
+        if key == 'image':
+            return self.get_image_ids().tolist()
+        elif key == 'label':
+            return self.get_labels().tolist()
+        return _to_list(self.fields[key])
+
+
+    def to_rows(self, fieldNames, constants=None):
+        '''
+            Returns an iterator of tuples with the values of the given fields
+            for every prediction (e.g. for "Database.copy_from"). Values for
+            field names in dict "constants" are the same for all predictions;
+            field "image" holds the image IDs, and fields not present (or not
+            one-dimensional) are None.
+        '''
+        if constants is None:
+            constants = {}
+        columns = []
+        for fn in fieldNames:
+            if fn in constants:
+                columns.append(itertools.repeat(constants[fn], len(self)))
+            elif fn == 'image' or (fn in self.fields and self.fields[fn].ndim == 1):
+                columns.append(self._get_column(fn))
+            else:
+                columns.append(itertools.repeat(None, len(self)))
+        return zip(*columns)
+
+
+    def to_dict(self):
+        '''
+            Returns the predictions in the dict format of the model API (one
+            entry with a list of predictions per image).
+        '''
+        response = dict([(imgID, {'predictions': []}) for imgID in self.imageIDs])
+        columns = dict([(key, self._get_column(key)) for key in self.fields.keys()])
+        imageIDs = self.get_image_ids()
+        for idx in range(len(self)):
+            response[imageIDs[idx]]['predictions'].append(
+                dict([(key, columns[key][idx]) for key in columns.keys()])
+            )
+        return response
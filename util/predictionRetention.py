@@ -0,0 +1,261 @@
+'''
+    Retention policy for the predictions of a project.
+
+    Predictions are kept for every model state (to keep track of the model
+    performance over time), so that the "prediction" table grows by a full
+    round of predictions with every inference run. With a retention policy,
+    only the predictions of the latest K model states are kept in full; the
+    ones of older states are summarized into per-image aggregates (number of
+    predictions, mean and maximum confidence and priority; table "predic-
+    tion_summary") and then removed.
+
+    Optionally, the "prediction" table can be partitioned by model state
+    ("cnnstate"). Every model state then gets its own partition, so that
+    removing the predictions of a state amounts to dropping its partition
+    instead of deleting its rows. Predictions of model states without a
+    partition (e.g. ones created before the conversion, or ones with no
+    model state at all) are stored in the default partition.
+    PostgreSQL requires the primary key of a partitioned table to contain
+    the partition key, so the primary key on the prediction IDs is replaced
+    by a plain (non-unique) index upon conversion.
+
+    2020 Benjamin Kellenberger
+'''
+
+import uuid
+from psycopg2 import sql
+
+
+DEFAULT_PARTITION = 'prediction_default'
+
+
+
+def get_partition_name(stateID):
+    return 'prediction_' + uuid.UUID(str(stateID)).hex
+
+
+
+def is_partitioned(dbConnector, project):
+    '''
+        Returns True if the project's "prediction" table is partitioned by
+        model state.
+    '''
+    result = dbConnector.execute('''
+            SELECT c.relkind
+            FROM pg_class AS c
+            JOIN pg_namespace AS n
+            ON c.relnamespace = n.oid
+            WHERE n.nspname = %s AND c.relname = 'prediction';
+        ''', (project,), 1)
+    return result is not None and len(result) > 0 and result[0]['relkind'] == 'p'
+
+
+
+def get_partitions(dbConnector, project):
+    '''
+        Returns the names of all partitions of the project's "prediction"
+        table (empty if the table is not partitioned).
+    '''
+    result = dbConnector.execute('''
+            SELECT c.relname
+            FROM pg_inherits AS i
+            JOIN pg_class AS c
+            ON i.inhrelid = c.oid
+            JOIN pg_class AS p
+            ON i.inhparent = p.oid
+            JOIN pg_namespace AS n
+            ON p.relnamespace = n.oid
+            WHERE n.nspname = %s AND p.relname = 'prediction';
+        ''', (project,), 'all')
+    if result is None:
+        return set()
+    return set([r['relname'] for r in result])
+
+
+
+def partition_table(dbConnector, project):
+    '''
+        Converts the project's "prediction" table into a table partitioned
+        by model state, with one partition per existing model state and a
+        default partition. All rows are copied; the table is locked for the
+        duration of the conversion. Does nothing if the table is already
+        partitioned. Returns True if the table is partitioned afterwards.
+
+        The new table only takes over the columns and their defaults of the
+        original one: the primary key on "id" is dropped (IDs are indexed
+        instead, but no longer checked for uniqueness), and the indices and
+        foreign keys are re-created explicitly. The index on "cnnstate"
+        ("prediction_cnnstate_idx") is only re-created on the default par-
+        tition, as all other partitions contain a single model state each.
+    '''
+    if is_partitioned(dbConnector, project):
+        return True
+
+    stateIDs = dbConnector.execute(sql.SQL('''
+            SELECT DISTINCT cnnstate FROM {id_pred}
+            WHERE cnnstate IS NOT NULL;
+        ''').format(id_pred=sql.Identifier(project, 'prediction')),
+        None, 'all')
+    if stateIDs is None:
+        stateIDs = []
+
+    # all statements are executed in one transaction
+    queries = [
+        sql.SQL('''
+            ALTER TABLE {id_pred} RENAME TO {name_old};
+            CREATE TABLE {id_pred} (LIKE {id_old} INCLUDING DEFAULTS) PARTITION BY LIST (cnnstate);
+            ALTER TABLE {id_pred} ADD FOREIGN KEY (image) REFERENCES {id_image}(id);
+            ALTER TABLE {id_pred} ADD FOREIGN KEY (cnnstate) REFERENCES {id_cnnstate}(id);
+            CREATE INDEX IF NOT EXISTS prediction_part_id_idx ON {id_pred} (id);
+            CREATE INDEX IF NOT EXISTS prediction_part_image_idx ON {id_pred} (image);
+            CREATE TABLE {id_default} PARTITION OF {id_pred} DEFAULT;
+        ''').format(
+            id_pred=sql.Identifier(project, 'prediction'),
+            name_old=sql.Identifier('prediction_unpartitioned'),
+            id_old=sql.Identifier(project, 'prediction_unpartitioned'),
+            id_image=sql.Identifier(project, 'image'),
+            id_cnnstate=sql.Identifier(project, 'cnnstate'),
+            id_default=sql.Identifier(project, DEFAULT_PARTITION)
+        )
+    ]
+    for s in stateIDs:
+        queries.append(sql.SQL('CREATE TABLE {id_part} PARTITION OF {id_pred} FOR VALUES IN ({stateID});').format(
+            id_part=sql.Identifier(project, get_partition_name(s['cnnstate'])),
+            id_pred=sql.Identifier(project, 'prediction'),
+            stateID=sql.Literal(str(s['cnnstate']))
+        ))
+    queries.append(sql.SQL('''
+            INSERT INTO {id_pred} SELECT * FROM {id_old};
+            DROP TABLE {id_old};
+            CREATE INDEX IF NOT EXISTS prediction_cnnstate_idx ON {id_default} (cnnstate);
+        ''').format(
+            id_pred=sql.Identifier(project, 'prediction'),
+            id_old=sql.Identifier(project, 'prediction_unpartitioned'),
+            id_default=sql.Identifier(project, DEFAULT_PARTITION)
+        ))
+    dbConnector.execute(sql.Composed(queries), None, None)
+    return is_partitioned(dbConnector, project)
+
+
+
+def create_partition(dbConnector, project, stateID):
+    '''
+        Creates the partition for the predictions of a model state, if the
+        project's "prediction" table is partitioned and the partition does
+        not exist yet. Predictions of the model state already stored in the
+        default partition are moved to it.
+    '''
+    if stateID is None or not is_partitioned(dbConnector, project):
+        return
+    queryStr = sql.SQL('''
+        DO $$
+        BEGIN
+            IF to_regclass(format('%I.%I', {project}, {name_part})) IS NULL THEN
+                CREATE TABLE {id_part} (LIKE {id_pred} INCLUDING DEFAULTS);
+                WITH moved AS (
+                    DELETE FROM {id_default}
+                    WHERE cnnstate = {stateID}
+                    RETURNING *
+                )
+                INSERT INTO {id_part} SELECT * FROM moved;
+                ALTER TABLE {id_pred} ATTACH PARTITION {id_part} FOR VALUES IN ({stateID});
+            END IF;
+        END $$;
+    ''').format(
+        project=sql.Literal(project),
+        name_part=sql.Literal(get_partition_name(stateID)),
+        id_part=sql.Identifier(project, get_partition_name(stateID)),
+        id_pred=sql.Identifier(project, 'prediction'),
+        id_default=sql.Identifier(project, DEFAULT_PARTITION),
+        stateID=sql.Literal(str(stateID))
+    )
+    dbConnector.execute(queryStr, None, None)
+
+
+
+def apply_retention(dbConnector, project, numStates, summarize=True):
+    '''
+        Keeps the predictions of the latest "numStates" (non-partial) model
+        states and removes the ones of all older model states, after summarizing them
+        into per-image aggregates (table "prediction_summary") if "summa-
+        rize" is True. Summaries are never overwritten, so that this can be
+        repeated safely. Returns a dict with the number of model states
+        processed, summary rows added, and predictions deleted, as well as
+        partitions dropped.
+    '''
+    stats = {
+        'num_states': 0,
+        'num_summarized': 0,
+        'num_deleted': 0,
+        'num_partitions_dropped': 0
+    }
+    if numStates is None or numStates <= 0:
+        return stats
+
+    oldStates = dbConnector.execute(sql.SQL('''
+            SELECT id FROM {id_cnnstate}
+            WHERE partial IS FALSE
+            ORDER BY timeCreated DESC
+            OFFSET %s;
+        ''').format(id_cnnstate=sql.Identifier(project, 'cnnstate')),
+        (numStates,), 'all')
+    if oldStates is None or not len(oldStates):
+        return stats
+    partitions = get_partitions(dbConnector, project)
+
+    for state in oldStates:
+        stateID = state['id']
+        partitionName = get_partition_name(stateID)
+        present = dbConnector.execute(sql.SQL('''
+                SELECT EXISTS (
+                    SELECT 1 FROM {id_pred} WHERE cnnstate = %s
+                ) AS present;
+            ''').format(id_pred=sql.Identifier(project, 'prediction')),
+            (stateID,), 1)
+        if present is None or not len(present) or not present[0]['present']:
+            continue
+        stats['num_states'] += 1
+
+        if summarize:
+            result = dbConnector.execute(sql.SQL('''
+                    WITH summary AS (
+                        INSERT INTO {id_summary} (image, cnnstate, timeCreated, num_predictions,
+                            confidence_mean, confidence_max, priority_mean, priority_max)
+                        SELECT image, cnnstate, MIN(timeCreated), COUNT(*),
+                            AVG(confidence), MAX(confidence), AVG(priority), MAX(priority)
+                        FROM {id_pred}
+                        WHERE cnnstate = %s
+                        GROUP BY image, cnnstate
+                        ON CONFLICT (image, cnnstate) DO NOTHING
+                        RETURNING 1
+                    )
+                    SELECT COUNT(*) AS num_summarized FROM summary;
+                ''').format(
+                    id_summary=sql.Identifier(project, 'prediction_summary'),
+                    id_pred=sql.Identifier(project, 'prediction')
+                ),
+                (stateID,), 1)
+            if result is None or not len(result):
+                # summarizing failed; keep predictions
+                continue
+            stats['num_summarized'] += result[0]['num_summarized']
+
+        if partitionName in partitions:
+            # dropping the partition only requires a change of the table metadata
+            dbConnector.execute(sql.SQL('DROP TABLE IF EXISTS {};').format(
+                sql.Identifier(project, partitionName)), None, None)
+            stats['num_partitions_dropped'] += 1
+
+        # predictions stored outside a partition of the model state
+        result = dbConnector.execute(sql.SQL('''
+                WITH deleted AS (
+                    DELETE FROM {id_pred}
+                    WHERE cnnstate = %s
+                    RETURNING 1
+                )
+                SELECT COUNT(*) AS num_deleted FROM deleted;
+            ''').format(id_pred=sql.Identifier(project, 'prediction')),
+            (stateID,), 1)
+        if result is not None and len(result):
+            stats['num_deleted'] += result[0]['num_deleted']
+    return stats